@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark recall and latency of the ANNIndex against the brute-force search.
+
+The brute-force search is the exhaustive path of Tree.recommend_objects
+(Prototypes.transform over all candidates, then argsort) without database access.
+
+Objects are clustered vectors that are randomly spread over nodes.
+A query asks for the objects of a few nodes nearest to the prototypes of a cluster.
+
+Usage:
+    python benchmarks/bench_ann_index.py run --n_objects=1000000 --n_probes=4,8,16,32
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.ann_index import ANNIndex
+from morphocluster.processing.prototypes import Prototypes
+
+
+def make_objects(n_objects, n_features, n_nodes, n_clusters=1000, seed=0):
+    rng = np.random.RandomState(seed)
+
+    centers = rng.randn(n_clusters, n_features).astype(np.float32)
+    labels = rng.randint(0, n_clusters, n_objects)
+    vectors = centers[labels] + 0.3 * \
+        rng.randn(n_objects, n_features).astype(np.float32)
+    node_ids = rng.randint(0, n_nodes, n_objects)
+    object_ids = np.array(["{:d}".format(i) for i in range(n_objects)])
+
+    return object_ids, vectors, node_ids, centers
+
+
+def brute_force(vectors, node_ids, allowed, prototypes, k):
+    candidates = np.flatnonzero(np.isin(node_ids, allowed))
+    distances = prototypes.transform(vectors[candidates])
+    return candidates[np.argsort(distances)[:k]]
+
+
+def run(n_objects=200000, n_features=64, n_nodes=100, n_allowed=50, k=1000,
+        n_prototypes=16, n_probes=(4, 8, 16, 32), n_queries=20, n_lists=None):
+    """
+    Run the benchmark.
+
+    Parameters:
+        n_allowed: Number of nodes (of n_nodes) in the candidate set.
+        n_probes: Minimum numbers of scanned lists.
+    """
+    if isinstance(n_probes, int):
+        n_probes = (n_probes,)
+
+    object_ids, vectors, node_ids, centers = make_objects(
+        n_objects, n_features, n_nodes)
+
+    start = time.perf_counter()
+    index = ANNIndex.build(object_ids, vectors, node_ids, n_lists=n_lists)
+    print("Built index with {:,d} lists in {:.1f}s".format(
+        index.n_lists, time.perf_counter() - start))
+
+    rng = np.random.RandomState(1)
+    queries = []
+    for _ in range(n_queries):
+        prototypes = Prototypes(None)
+        prototypes.prototypes_ = centers[rng.randint(len(centers))] + \
+            0.3 * rng.randn(n_prototypes, n_features).astype(np.float32)
+        prototypes.support_ = np.ones(n_prototypes)
+        allowed = rng.choice(n_nodes, n_allowed, replace=False)
+        queries.append((prototypes, allowed))
+
+    # Ground truth
+    start = time.perf_counter()
+    truth = [set(object_ids[brute_force(vectors, node_ids, allowed, prototypes, k)])
+             for prototypes, allowed in queries]
+    time_brute = (time.perf_counter() - start) / n_queries
+
+    print("{:>10s} {:>12s} {:>8s}".format("n_probe", "latency [ms]", "recall"))
+    print("{:>10s} {:12.1f} {:8.3f}".format("brute", 1000 * time_brute, 1.0))
+
+    for n_probe in list(n_probes) + ["exact"]:
+        recalls = []
+        start = time.perf_counter()
+        results = [index.search(prototypes.prototypes_, k, node_ids=allowed,
+                                n_probe=n_probe if n_probe != "exact" else 1,
+                                exact=n_probe == "exact")[0]
+                   for prototypes, allowed in queries]
+        latency = (time.perf_counter() - start) / n_queries
+
+        for rows, expected in zip(results, truth):
+            recalls.append(len(set(index.object_ids[rows]) & expected) / len(expected))
+
+        print("{:>10s} {:12.1f} {:8.3f}".format(
+            str(n_probe), 1000 * latency, np.mean(recalls)))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark the per-fit overhead of the clusterers of the prototypes of a node.
+
+For every node size, `n_nodes` independent problems (mixtures of Gaussians,
+like the sampled objects of a node) are clustered into k prototypes using
+
+    sklearn: sklearn.cluster.KMeans(n_init=2) (make_kmeans, one fit per node).
+    lloyd: processing.prototypes.LloydKMeans (one fit per node).
+    batched: processing.prototypes.fit_prototypes_batched (all nodes at once).
+
+Reported are the mean time per fit and the mean inertia relative to sklearn.
+
+No database is required.
+
+Usage:
+    python benchmarks/bench_batched_kmeans.py run --n_samples=50,200,1000
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.processing.consolidation import make_kmeans
+from morphocluster.processing.prototypes import (LloydKMeans,
+                                                 fit_prototypes_batched)
+
+
+def make_problems(n_nodes, n_samples, n_features, n_modes, seed=0):
+    rng = np.random.RandomState(seed)
+
+    problems = []
+    for _ in range(n_nodes):
+        modes = 3 * rng.randn(n_modes, n_features)
+        X = modes[rng.randint(n_modes, size=n_samples)] + rng.randn(n_samples, n_features)
+        problems.append(X)
+
+    return problems
+
+
+def inertia(X, prototypes_):
+    distances = ((X[:, np.newaxis, :] - prototypes_[np.newaxis]) ** 2).sum(axis=2)
+    return distances.min(axis=1).sum()
+
+
+def _fit_single(problems, make):
+    prototypes = []
+    for i, X in enumerate(problems):
+        clusterer = make(i)
+        clusterer.fit(X)
+        prototypes.append(clusterer.cluster_centers_)
+    return prototypes
+
+
+def run(n_samples=(50, 200, 1000), n_nodes=100, k=16, n_features=32, n_modes=8):
+    """
+    Run the benchmark.
+
+    Parameters:
+        n_samples: Node sizes (number of objects per node).
+        n_nodes: Number of nodes per size.
+        k: Number of prototypes.
+        n_features: Dimensionality of the object vectors.
+        n_modes: Number of modes per node.
+    """
+    if isinstance(n_samples, int):
+        n_samples = (n_samples,)
+
+    methods = {
+        "sklearn": lambda problems: _fit_single(
+            problems, lambda i: make_kmeans(k, random_state=i)),
+        "lloyd": lambda problems: _fit_single(
+            problems, lambda i: LloydKMeans(k, random_state=i)),
+        "batched": lambda problems: [
+            prots.prototypes_ for prots in fit_prototypes_batched(
+                problems, LloydKMeans(k), random_states=range(len(problems)))],
+    }
+
+    print("{:>8s} {:>10s} {:>14s} {:>10s}".format(
+        "samples", "method", "ms per fit", "inertia"))
+
+    for n in n_samples:
+        problems = make_problems(n_nodes, n, n_features, n_modes)
+
+        reference = None
+        for name, fit in methods.items():
+            start = time.perf_counter()
+            prototypes = fit(problems)
+            elapsed = time.perf_counter() - start
+
+            inertias = np.array([inertia(X, p) for X, p in zip(problems, prototypes)])
+            if reference is None:
+                reference = inertias
+
+            print("{:8d} {:>10s} {:14.3f} {:10.3f}".format(
+                n, name, 1000 * elapsed / n_nodes, np.mean(inertias / reference)))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark ancestor and subtree queries: recursive CTE vs. closure table.
+
+Creates a temporary project for each depth (a chain of `depth` nodes, each with
+`fanout - 1` additional leaf children) in the configured database and measures
+Tree.get_path_ids of the deepest node and Tree.node_n_descendants of the root.
+The project is deleted afterwards.
+
+Requires a database (MORPHOCLUSTER_SETTINGS).
+
+Usage:
+    python benchmarks/bench_closure.py run --depths=10,100,1000
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster import create_app
+from morphocluster.extensions import database
+from morphocluster.models import projects
+from morphocluster.tree import Tree
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times)
+
+
+def run(depths=(10, 100, 1000), fanout=3, repeat=20):
+    """
+    Run the benchmark.
+
+    Parameters:
+        depths: Depths of the generated trees.
+        fanout: Children per inner node.
+        repeat: Repetitions per measurement.
+    """
+    if isinstance(depths, int):
+        depths = (depths,)
+
+    app = create_app()
+
+    print("{:>8s} {:>8s} {:>14s} {:>14s} {:>14s} {:>14s}".format(
+        "depth", "nodes", "path CTE [ms]", "path idx [ms]", "desc CTE [ms]", "desc idx [ms]"))
+
+    with app.app_context(), database.engine.connect() as conn:
+        for depth in depths:
+            tree = Tree(conn, use_closure=True)
+            cte_tree = Tree(conn, use_closure=False)
+
+            with conn.begin():
+                project_id = tree.create_project("bench_closure_{}".format(depth))
+                root_id = node_id = tree.create_node(project_id)
+                n_nodes = 1
+                for _ in range(depth):
+                    for _ in range(fanout - 1):
+                        tree.create_node(project_id, parent_id=node_id)
+                    node_id = tree.create_node(project_id, parent_id=node_id)
+                    n_nodes += fanout
+
+            try:
+                assert tree.get_path_ids(node_id) == cte_tree.get_path_ids(node_id)
+
+                results = [
+                    _time(lambda: cte_tree.get_path_ids(node_id), repeat),
+                    _time(lambda: tree.get_path_ids(node_id), repeat),
+                    _time(lambda: cte_tree.node_n_descendants(root_id), repeat),
+                    _time(lambda: tree.node_n_descendants(root_id), repeat),
+                ]
+            finally:
+                conn.execute(projects.delete(
+                    projects.c.project_id == project_id))
+
+            print("{:8d} {:8d} {:14.2f} {:14.2f} {:14.2f} {:14.2f}".format(
+                depth, n_nodes, *results))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
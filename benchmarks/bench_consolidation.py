@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Benchmark the consolidation of cached node values.
+
+Compares the former row-by-row implementation of Tree.consolidate_node
+(one boolean scan of the subtree per node) with
+processing.consolidation.consolidate_subtree on synthetic trees.
+
+Database access is not part of the measurement: The legacy implementation
+reads the objects of a node from an in-memory dict instead of issuing a query.
+
+Usage:
+    python benchmarks/bench_consolidation.py run --sizes=1000,10000,100000
+"""
+
+import itertools
+import sys
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+from morphocluster.member import MemberCollection
+from morphocluster.processing.consolidation import (calc_own_type_objects,
+                                                    calc_type_objects,
+                                                    consolidate_subtree)
+from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+
+
+def make_tree(n_nodes, n_objects_per_node=10, n_features=32, seed=0):
+    """
+    Build a random tree in the shape of the invalid subtree queried by Tree.consolidate_node.
+    """
+    rng = np.random.RandomState(seed)
+
+    # Attach every node to a random earlier node (expected depth O(log n))
+    parent_pos = np.concatenate(
+        ([-1], (rng.rand(n_nodes - 1) * np.arange(1, n_nodes)).astype(int)))
+    node_ids = np.arange(1, n_nodes + 1)
+    parent_ids = np.where(parent_pos >= 0, node_ids[parent_pos], np.nan)
+
+    levels = np.zeros(n_nodes, dtype=int)
+    for i in range(1, n_nodes):
+        levels[i] = levels[parent_pos[i]] + 1
+
+    n_objects = rng.poisson(n_objects_per_node, n_nodes)
+
+    subtree = pd.DataFrame({
+        "node_id": node_ids,
+        "parent_id": parent_ids,
+        "level": levels,
+        "cache_valid": False,
+        "_n_objects_": n_objects,
+        "_n_children_": np.bincount(parent_pos[1:], minlength=n_nodes),
+        "_n_objects_deep": None,
+        "_centroid": None,
+        "_prototypes": None,
+        "_type_objects": None,
+        "_own_type_objects": None,
+    }).set_index("node_id").sort_values("level", ascending=False)
+
+    object_node_ids = np.repeat(node_ids, n_objects)
+    object_ids = np.array(["{}".format(i) for i in range(len(object_node_ids))],
+                          dtype=object)
+    vectors = rng.randn(len(object_node_ids), n_features).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+    return subtree, object_node_ids, object_ids, vectors
+
+
+def consolidate_legacy(invalid_subtree, objects_by_node, n_prototypes, prototypes=True):
+    """
+    Former implementation of Tree.consolidate_node (without database access).
+    """
+    invalid_subtree = invalid_subtree.copy()
+    invalid_subtree["_n_objects"] = invalid_subtree["_n_objects_"]
+    invalid_subtree["_n_children"] = invalid_subtree["_n_children_"]
+    invalid_subtree["__updated"] = False
+
+    clusterer = KMeans(n_prototypes, n_init=2)
+
+    for node_id in invalid_subtree.index:
+        if invalid_subtree.at[node_id, "cache_valid"]:
+            continue
+
+        child_selector = (invalid_subtree['parent_id'] == node_id)
+        children = invalid_subtree.loc[child_selector]
+        children_dict = MemberCollection(children.reset_index().to_dict('records'),
+                                         "zero")
+
+        _n_objects = invalid_subtree.loc[node_id, "_n_objects"]
+        invalid_subtree.at[node_id, "_n_objects_deep"] = (
+            _n_objects + children["_n_objects_deep"].sum())
+
+        objects_ = MemberCollection(objects_by_node.get(node_id, []), "raise")
+        object_ids = [o["object_id"] for o in objects_]
+
+        invalid_subtree.at[node_id, "_own_type_objects"] = calc_own_type_objects(
+            children_dict.vectors, objects_.vectors, object_ids)
+        invalid_subtree.at[node_id, "_type_objects"] = calc_type_objects(
+            [c["_type_objects"] for c in children_dict], object_ids)
+
+        _centroid = []
+        if len(objects_) > 0:
+            obj_mean = np.sum(objects_.vectors, axis=0)
+            obj_mean /= np.linalg.norm(obj_mean)
+            _centroid.append(_n_objects * obj_mean)
+        if len(children_dict) > 0:
+            _centroid.append(np.sum(children_dict.cardinalities[:, np.newaxis] * children_dict.vectors,
+                                    axis=0))
+        if len(_centroid) > 0:
+            _centroid = np.sum(_centroid, axis=0)
+            _centroid /= np.linalg.norm(_centroid)
+        else:
+            _centroid = None
+        invalid_subtree.at[node_id, "_centroid"] = _centroid
+
+        if prototypes:
+            _prototypes = []
+            if len(objects_) > 0:
+                prots = Prototypes(clusterer)
+                prots.fit(objects_.vectors)
+                _prototypes.append(prots)
+            _prototypes.extend(
+                c["_prototypes"] for c in children_dict if c["_prototypes"] is not None)
+            invalid_subtree.at[node_id, "_prototypes"] = (
+                merge_prototypes(_prototypes, n_prototypes) if _prototypes else None)
+
+        invalid_subtree.at[node_id, "__updated"] = True
+
+    return invalid_subtree
+
+
+class _NoPrototypes:
+    """
+    Stand-in clusterer to exclude KMeans from the measurement.
+    """
+    n_clusters = 1
+
+    def __init__(self, random_state=None):
+        self.random_state = random_state
+
+    def fit_predict(self, X):
+        return np.zeros(X.shape[0], dtype=int)
+
+
+def run(sizes=(1000, 10000, 100000), n_objects_per_node=10, n_features=32,
+        n_prototypes=16, prototypes=False, legacy=True, n_workers=1):
+    """
+    Run the benchmark.
+
+    Parameters:
+        sizes: Numbers of nodes.
+        prototypes: Include the (identical) prototype calculation in the measurement.
+        legacy: Also measure the former implementation.
+        n_workers: Number of processes for the fitting of prototypes.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+
+    make_clusterer = None if prototypes else _NoPrototypes
+
+    print("{:>8s} {:>12s} {:>12s} {:>8s}".format(
+        "nodes", "legacy [s]", "new [s]", "speedup"))
+
+    for n_nodes in sizes:
+        subtree, object_node_ids, object_ids, vectors = make_tree(
+            n_nodes, n_objects_per_node, n_features)
+
+        start = time.perf_counter()
+        result = consolidate_subtree(subtree, object_node_ids, object_ids, vectors,
+                                     n_prototypes, make_clusterer=make_clusterer,
+                                     n_workers=n_workers)
+        time_new = time.perf_counter() - start
+
+        time_legacy = np.nan
+        if legacy:
+            objects_by_node = {
+                node_id: [{"object_id": o, "vector": v} for (_, o, v) in group]
+                for node_id, group in itertools.groupby(
+                    zip(object_node_ids, object_ids, vectors), key=lambda x: x[0])}
+
+            start = time.perf_counter()
+            result_legacy = consolidate_legacy(subtree, objects_by_node, n_prototypes,
+                                               prototypes=prototypes)
+            time_legacy = time.perf_counter() - start
+
+            # Deterministic values have to be equal
+            assert (result["_n_objects_deep"] ==
+                    result_legacy["_n_objects_deep"].astype(int)).all()
+            for a, b in zip(result["_centroid"], result_legacy["_centroid"]):
+                assert (a is None and b is None) or np.allclose(
+                    a, b, atol=1e-5)
+
+        print("{:8d} {:12.2f} {:12.2f} {:8.1f}".format(
+            n_nodes, time_legacy, time_new, time_legacy / time_new))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
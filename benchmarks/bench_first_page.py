@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark the time to the first page of paginated results (like /recommended_objects).
+
+For every result size (max_n), the first page of a ranking of objects is produced
+
+    eager: Render all items, serialize and compress every page (former behavior).
+    lazy: Encode the ordering (ids and scores, see result_cache.encode_ordering),
+        render only the first page (see api._load_or_calc with render).
+
+"page 1" is the time to render the second page from the stored ordering.
+
+The ranking itself is the same for both and not measured. The eager variant
+additionally queried the rows of all max_n objects from the database (not
+measured either).
+
+If redis_url is given, the results are stored in a ResultCache
+(result_cache.ResultCache) in this Redis, which includes the round trips.
+
+No database is required.
+
+Usage:
+    python benchmarks/bench_first_page.py run --max_n=1000,10000,100000 [--redis_url=redis://localhost:6379/15]
+"""
+
+import json
+import sys
+import time
+import uuid
+import zlib
+
+import fire
+import numpy as np
+
+from morphocluster.result_cache import decode_ordering, encode_ordering
+
+#: Items per page of /recommended_objects
+PAGE_SIZE = 50
+
+
+def make_ranking(max_n, seed=0):
+    rng = np.random.RandomState(seed)
+    object_ids = ["{:d}".format(i) for i in rng.permutation(max_n)]
+    scores = np.sort(rng.rand(max_n))
+    return object_ids, scores
+
+
+def render(items):
+    return [{"object_id": object_id} for object_id, _ in items]
+
+
+def _serialize(items):
+    return zlib.compress(json.dumps(render(items)).encode())
+
+
+def compute_eager(object_ids, scores):
+    # Rows of the objects like Tree.recommend_objects
+    rows = [{"object_id": o, "path": "/data/{}.jpg".format(o), "rand": 0.5}
+            for o in object_ids]
+    items = [(r["object_id"], None) for r in rows]
+    return [_serialize(items[start:start + PAGE_SIZE])
+            for start in range(0, len(items), PAGE_SIZE)]
+
+
+def compute_lazy(object_ids, scores, page=0):
+    scores = np.asarray(scores, dtype=np.float32)
+    n_pages = (len(object_ids) + PAGE_SIZE - 1) // PAGE_SIZE
+    start = page * PAGE_SIZE
+    pages = {page: _serialize(list(zip(
+        object_ids[start:start + PAGE_SIZE], scores[start:start + PAGE_SIZE].tolist())))}
+    return encode_ordering(object_ids, scores), n_pages, pages
+
+
+def render_page(order, page):
+    return _serialize(decode_ordering(order, page * PAGE_SIZE, (page + 1) * PAGE_SIZE))
+
+
+def first_page_local(method, object_ids, scores):
+    if method == "eager":
+        return compute_eager(object_ids, scores)[0]
+
+    _, _, pages = compute_lazy(object_ids, scores)
+    return pages[0]
+
+
+def first_page_redis(cache, method, object_ids, scores):
+    request_id = uuid.uuid4().hex
+
+    if method == "eager":
+        page_data, _ = cache.get_or_compute(
+            "bench", request_id, 0, lambda: compute_eager(object_ids, scores))
+    else:
+        page_data, _ = cache.get_or_compute(
+            "bench", request_id, 0, lambda: compute_lazy(object_ids, scores), render_page)
+
+    return page_data
+
+
+def run(max_n=(1000, 10000, 100000), repeat=5, redis_url=None):
+    """
+    Run the benchmark.
+
+    Parameters:
+        max_n: Result sizes (number of ranked objects).
+        repeat: Number of measurements per size (the median is reported).
+        redis_url: Store the results in a ResultCache in this Redis.
+    """
+    if isinstance(max_n, int):
+        max_n = (max_n,)
+
+    if redis_url is not None:
+        from redis import StrictRedis
+
+        from morphocluster.result_cache import ResultCache
+
+        cache = ResultCache(StrictRedis.from_url(redis_url), prefix="bench:results")
+
+        def first_page(method, object_ids, scores):
+            return first_page_redis(cache, method, object_ids, scores)
+    else:
+        first_page = first_page_local
+
+    print("{:>8s} {:>8s} {:>16s}".format("max_n", "method", "first page [ms]"))
+
+    for n in max_n:
+        object_ids, scores = make_ranking(n)
+
+        pages = {}
+        for method in ("eager", "lazy"):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pages[method] = first_page(method, object_ids, scores)
+                times.append(time.perf_counter() - start)
+
+            print("{:8d} {:>8s} {:16.2f}".format(n, method, 1000 * np.median(times)))
+
+        assert pages["eager"] == pages["lazy"]
+
+        order, _, _ = compute_lazy(object_ids, scores)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render_page(order, 1)
+            times.append(time.perf_counter() - start)
+
+        print("{:8d} {:>8s} {:16.2f}".format(n, "page 1", 1000 * np.median(times)))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Benchmark edits of concurrent labelers with eager vs. lazy invalidation.
+
+Creates a temporary project (a root with one subtree per labeler, each a chain
+of `depth` nodes with two leaves) in the configured database. Every labeler
+(a thread with its own connection) repeatedly moves objects between the two
+leaves of its subtree using Tree.relocate_objects.
+
+lazy: Tree.relocate_objects (only the old and the new node are written).
+eager: Additionally writes cache_valid = FALSE to all ancestors of both nodes
+    (the former behavior), so that every edit writes the root row.
+
+Afterwards, the time of Tree.consolidate_node(root) (detection of stale
+values + recomputation) is measured. The project and the objects are deleted afterwards.
+
+Requires a database (MORPHOCLUSTER_SETTINGS).
+
+Usage:
+    python benchmarks/bench_invalidation.py run --n_labelers=1,4,16
+"""
+
+import sys
+import threading
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql import text
+
+from morphocluster import create_app
+from morphocluster.extensions import database
+from morphocluster.ingest import copy_from_frame
+from morphocluster.models import objects, projects
+from morphocluster.tree import Tree
+
+OBJECTS_PER_LEAF = 100
+
+
+def _invalidate_eagerly(tree, node_ids):
+    stmt = text("""
+    UPDATE nodes
+    SET cache_valid = FALSE
+    WHERE node_id IN (
+        SELECT ancestor_id FROM nodes_closure WHERE descendant_id = ANY(:node_ids)
+    )
+    """)
+    tree.connection.execute(stmt, node_ids=node_ids)
+
+
+def _create_project(conn, n_labelers, depth):
+    tree = Tree(conn)
+
+    object_ids = np.array(["bench_invalidation_{:d}".format(i)
+                           for i in range(n_labelers * 2 * OBJECTS_PER_LEAF)])
+
+    with conn.begin():
+        copy_from_frame(conn, "objects", pd.DataFrame(
+            {"object_id": object_ids, "path": object_ids}))
+
+        project_id = tree.create_project("bench_invalidation")
+        root_id = tree.create_node(project_id)
+
+        subtrees = []
+        for i in range(n_labelers):
+            node_id = root_id
+            for _ in range(depth):
+                node_id = tree.create_node(project_id, parent_id=node_id)
+
+            leaf_ids = []
+            for j in range(2):
+                start = (2 * i + j) * OBJECTS_PER_LEAF
+                leaf_ids.append(tree.create_node(
+                    project_id, parent_id=node_id,
+                    object_ids=object_ids[start:start + OBJECTS_PER_LEAF]))
+
+            subtrees.append(
+                (leaf_ids, object_ids[2 * i * OBJECTS_PER_LEAF:(2 * i + 1) * OBJECTS_PER_LEAF]))
+
+    return project_id, root_id, subtrees
+
+
+def _labeler(leaf_ids, object_ids, n_edits, eager, latencies):
+    with database.engine.connect() as conn:
+        tree = Tree(conn)
+
+        for i in range(n_edits):
+            dest_id = leaf_ids[(i + 1) % 2]
+            start = time.perf_counter()
+            with conn.begin():
+                tree.relocate_objects(object_ids, dest_id)
+                if eager:
+                    _invalidate_eagerly(tree, leaf_ids)
+            latencies.append(time.perf_counter() - start)
+
+
+def run(n_labelers=(1, 4, 16), n_edits=50, depth=8):
+    """
+    Run the benchmark.
+
+    Parameters:
+        n_labelers: Numbers of concurrent labelers.
+        n_edits: Edits per labeler.
+        depth: Depth of the subtree of each labeler.
+    """
+    if isinstance(n_labelers, int):
+        n_labelers = (n_labelers,)
+
+    app = create_app()
+
+    print("{:>8s} {:>6s} {:>10s} {:>10s} {:>10s} {:>14s}".format(
+        "labelers", "mode", "edits/s", "p50 [ms]", "p95 [ms]", "consolidate [s]"))
+
+    with app.app_context(), database.engine.connect() as conn:
+        for n in n_labelers:
+            for eager in (True, False):
+                project_id, root_id, subtrees = _create_project(conn, n, depth)
+
+                try:
+                    tree = Tree(conn)
+                    tree.consolidate_node(root_id, depth="full")
+
+                    latencies = []
+                    threads = [threading.Thread(target=_labeler, args=(leaf_ids, object_ids, n_edits, eager, latencies))
+                               for leaf_ids, object_ids in subtrees]
+
+                    start = time.perf_counter()
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    elapsed = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    tree.consolidate_node(root_id)
+                    t_consolidate = time.perf_counter() - start
+
+                    print("{:8d} {:>6s} {:10.1f} {:10.2f} {:10.2f} {:14.2f}".format(
+                        n, "eager" if eager else "lazy", len(latencies) / elapsed,
+                        1000 * np.percentile(latencies, 50),
+                        1000 * np.percentile(latencies, 95), t_consolidate))
+                finally:
+                    with conn.begin():
+                        conn.execute(projects.delete(
+                            projects.c.project_id == project_id))
+                        conn.execute(objects.delete(
+                            objects.c.object_id.like("bench_invalidation_%")))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Load test of concurrent labeling sessions with project-wide vs. subtree locking.
+
+Creates a temporary project (a root with one subtree per session, each a node
+with `n_leaves` leaves of OBJECTS_PER_LEAF objects) in the configured database.
+Every session (a thread with its own connection) replays the requests of a
+labeling session on its subtree like the API does, each in its own transaction:
+
+    1. get_children(subtree)             (view the children)
+    2. relocate_objects(batch, leaf)     (accept recommended objects)
+    3. update_node(leaf, approved=...)   (validate the leaf)
+    4. get_node(leaf)                    (reload the leaf)
+
+Additionally, an overview thread repeatedly reads the root (get_node(root)),
+which consolidates the stale values of the whole project.
+
+project: TREE_LOCKING = "project" (every request takes the project lock).
+subtree: TREE_LOCKING = "subtree" (see Tree.lock_paths).
+
+Reported are the completed session steps (1.-4.) per second, their latencies,
+the number of root reads and the number of failed steps (e.g. detected deadlocks).
+The project and the objects are deleted afterwards.
+
+Requires a database (MORPHOCLUSTER_SETTINGS).
+
+Usage:
+    python benchmarks/bench_locking.py run --n_sessions=1,4,16 --duration=20
+"""
+
+import sys
+import threading
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+
+from morphocluster import create_app
+from morphocluster.extensions import database
+from morphocluster.ingest import copy_from_frame
+from morphocluster.models import objects, projects
+from morphocluster.tree import Tree
+
+OBJECTS_PER_LEAF = 200
+
+# Number of objects that are accepted at once
+BATCH_SIZE = 20
+
+
+def _create_project(conn, n_sessions, n_leaves):
+    tree = Tree(conn)
+
+    n_objects = n_sessions * n_leaves * OBJECTS_PER_LEAF
+    object_ids = np.array(["bench_locking_{:d}".format(i)
+                           for i in range(n_objects)])
+
+    with conn.begin():
+        copy_from_frame(conn, "objects", pd.DataFrame(
+            {"object_id": object_ids, "path": object_ids}))
+
+        project_id = tree.create_project("bench_locking")
+        root_id = tree.create_node(project_id)
+
+        subtrees = []
+        for i in range(n_sessions):
+            node_id = tree.create_node(project_id, parent_id=root_id)
+
+            leaves = []
+            for j in range(n_leaves):
+                start = (i * n_leaves + j) * OBJECTS_PER_LEAF
+                leaf_objects = list(
+                    object_ids[start:start + OBJECTS_PER_LEAF])
+                leaves.append((tree.create_node(
+                    project_id, parent_id=node_id, object_ids=leaf_objects), leaf_objects))
+
+            subtrees.append((node_id, leaves))
+
+    return project_id, root_id, subtrees
+
+
+def _session(locking, subtree, stop, seed, latencies, errors):
+    rng = np.random.RandomState(seed)
+    node_id, leaves = subtree
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn, locking=locking)
+
+        while not stop.is_set():
+            src = rng.choice([i for i, (_, leaf_objects) in enumerate(leaves)
+                              if len(leaf_objects) >= BATCH_SIZE])
+            dest = rng.choice([i for i in range(len(leaves)) if i != src])
+            (src_id, src_objects), (dest_id, dest_objects) = leaves[src], leaves[dest]
+            batch = [src_objects[i] for i in rng.choice(
+                len(src_objects), BATCH_SIZE, replace=False)]
+
+            start = time.perf_counter()
+            try:
+                with conn.begin():
+                    tree.get_children(node_id)
+
+                with conn.begin():
+                    tree.relocate_objects(batch, dest_id)
+                    tree.get_node(dest_id)
+
+                with conn.begin():
+                    tree.update_node(
+                        dest_id, {"approved": bool(rng.rand() < 0.5)})
+                    tree.get_node(dest_id)
+            except SQLAlchemyError:
+                errors.append(1)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+            # Keep track of the objects
+            moved = set(batch)
+            src_objects[:] = [o for o in src_objects if o not in moved]
+            dest_objects.extend(batch)
+
+
+def _overview(locking, root_id, stop, reads):
+    with database.engine.connect() as conn:
+        tree = Tree(conn, locking=locking)
+
+        while not stop.is_set():
+            tree.get_node(root_id)
+            reads.append(1)
+
+
+def run(n_sessions=(1, 4, 16), duration=20, n_leaves=4):
+    """
+    Run the load test.
+
+    Parameters:
+        n_sessions: Numbers of concurrent labeling sessions.
+        duration: Duration of every measurement in seconds.
+        n_leaves: Number of leaves of the subtree of each session.
+    """
+    if isinstance(n_sessions, int):
+        n_sessions = (n_sessions,)
+
+    app = create_app()
+
+    print("{:>8s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+        "sessions", "locking", "steps/s", "p50 [ms]", "p95 [ms]", "reads/s", "errors"))
+
+    with app.app_context(), database.engine.connect() as conn:
+        for n in n_sessions:
+            for locking in ("project", "subtree"):
+                project_id, root_id, subtrees = _create_project(
+                    conn, n, n_leaves)
+
+                try:
+                    Tree(conn).consolidate_node(root_id, depth="full")
+
+                    latencies, errors, reads = [], [], []
+                    stop = threading.Event()
+                    threads = [threading.Thread(target=_session, args=(locking, subtree, stop, i, latencies, errors))
+                               for i, subtree in enumerate(subtrees)]
+                    threads.append(threading.Thread(
+                        target=_overview, args=(locking, root_id, stop, reads)))
+
+                    for t in threads:
+                        t.start()
+                    time.sleep(duration)
+                    stop.set()
+                    for t in threads:
+                        t.join()
+
+                    print("{:8d} {:>8s} {:10.1f} {:10.2f} {:10.2f} {:10.1f} {:8d}".format(
+                        n, locking, len(latencies) / duration,
+                        1000 * np.percentile(latencies, 50) if latencies else np.nan,
+                        1000 * np.percentile(latencies, 95) if latencies else np.nan,
+                        len(reads) / duration, len(errors)))
+                finally:
+                    with conn.begin():
+                        conn.execute(projects.delete(
+                            projects.c.project_id == project_id))
+                        conn.execute(objects.delete(
+                            objects.c.object_id.like("bench_locking_%")))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
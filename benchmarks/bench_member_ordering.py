@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark the similarity orderings of the members of a node (arrange_by="sim").
+
+The members are unit vectors around `n_modes` modes (like the centroids of
+the children of a node). For every node size, the members are ordered with
+each method of processing.ordering.similarity_order:
+
+    isomap: 1-D Isomap embedding (former behavior).
+    pca: Projection onto the first principal component.
+    chain: Greedy nearest-neighbour chain.
+
+Reported are the latency and the smoothness (mean distance between
+consecutive members relative to a random order, lower is better).
+"memoized" is the cost of restoring a memoized order from its serialized
+form (like api._arrange_by_sim on a cache hit, without the Redis round trip).
+
+No database is required.
+
+Usage:
+    python benchmarks/bench_member_ordering.py run --n_members=100,1000,10000
+"""
+
+import json
+import sys
+import time
+import zlib
+
+import fire
+import numpy as np
+
+from morphocluster.processing.ordering import ORDERINGS, similarity_order
+
+
+def make_members(n_members, n_features, n_modes, seed=0):
+    rng = np.random.RandomState(seed)
+    modes = rng.randn(n_modes, n_features)
+    vectors = modes[rng.randint(n_modes, size=n_members)] + 0.5 * rng.randn(n_members, n_features)
+    return vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+
+def smoothness(vectors, order):
+    return np.mean(np.linalg.norm(np.diff(vectors[order], axis=0), axis=1))
+
+
+def restore(serialized, member_keys):
+    rank = {k: i for i, k in enumerate(json.loads(zlib.decompress(serialized).decode()))}
+    return np.argsort([rank[k] for k in member_keys], kind="stable")
+
+
+def run(n_members=(100, 1000, 10000), n_features=32, n_modes=20):
+    """
+    Run the benchmark.
+
+    Parameters:
+        n_members: Node sizes (number of members).
+        n_features: Dimensionality of the member vectors.
+        n_modes: Number of modes.
+    """
+    if isinstance(n_members, int):
+        n_members = (n_members,)
+
+    print("{:>8s} {:>10s} {:>12s} {:>12s}".format(
+        "members", "method", "time [ms]", "smoothness"))
+
+    for n in n_members:
+        vectors = make_members(n, n_features, n_modes)
+        member_keys = ["n{}".format(i) for i in range(n)]
+        random_smoothness = smoothness(vectors, np.random.RandomState(0).permutation(n))
+
+        for method in ORDERINGS:
+            start = time.perf_counter()
+            order = similarity_order(vectors, method)
+            elapsed = time.perf_counter() - start
+
+            print("{:8d} {:>10s} {:12.2f} {:12.3f}".format(
+                n, method, 1000 * elapsed, smoothness(vectors, order) / random_smoothness))
+
+        serialized = zlib.compress(json.dumps([member_keys[i] for i in order]).encode())
+        start = time.perf_counter()
+        order = restore(serialized, member_keys)
+        elapsed = time.perf_counter() - start
+
+        print("{:8d} {:>10s} {:12.2f} {:12.3f}".format(
+            n, "memoized", 1000 * elapsed, smoothness(vectors, order) / random_smoothness))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark the methods of merge_prototypes for nodes with many children.
+
+Every child has k prototypes (with random support) around one of
+`n_clusters` cluster centers, like the prototypes of the children of an
+inner node. The children are merged into k prototypes using
+
+    complete: Complete-linkage clustering of all prototypes (former behavior).
+    kmeans: Weighted k-means.
+    hierarchical: Complete linkage in groups of `group_size` children.
+
+Reported are the runtime, the fidelity to the complete-linkage result
+(Prototypes.distance, the modified Hausdorff distance, 0 for the reference)
+and the quantization error (support-weighted mean distance of the prototypes
+of the children to the nearest merged prototype).
+Complete linkage is skipped for more than `max_complete` prototypes (O(n²) memory),
+fidelity is not available then.
+
+Usage:
+    python benchmarks/bench_merge_prototypes.py run --n_children=100,500,2000
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+
+
+def make_children(n_children, k, n_features, n_clusters, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(n_clusters, n_features)
+
+    children = []
+    for i in range(n_children):
+        center = centers[rng.randint(n_clusters)]
+        prots = Prototypes(None)
+        prots.prototypes_ = (center + 0.3 * rng.randn(k, n_features)).astype(np.float32)
+        prots.support_ = rng.randint(1, 100, k).astype(float)
+        children.append(prots)
+
+    return children
+
+
+def quantization_error(children, result):
+    prototypes_ = np.concatenate([c.prototypes_ for c in children])
+    support_ = np.concatenate([c.support_ for c in children])
+
+    return np.average(result.transform(prototypes_), weights=support_)
+
+
+def run(n_children=(100, 500, 2000), k=16, n_features=32, n_clusters=50,
+        group_size=32, max_complete=20000):
+    """
+    Run the benchmark.
+
+    Parameters:
+        n_children: Numbers of children.
+        k: Number of prototypes per child and of the result.
+        n_features: Dimensionality of the prototypes.
+        n_clusters: Number of clusters of the children.
+        group_size: Group size of the hierarchical merge.
+        max_complete: Maximum number of prototypes for complete linkage.
+    """
+    if isinstance(n_children, int):
+        n_children = (n_children,)
+
+    print("{:>8s} {:>13s} {:>10s} {:>10s} {:>10s}".format(
+        "children", "method", "time [s]", "distance", "error"))
+
+    for n in n_children:
+        children = make_children(n, k, n_features, n_clusters)
+
+        reference = None
+        for method in ("complete", "kmeans", "hierarchical"):
+            if method == "complete" and n * k > max_complete:
+                print("{:8d} {:>13s} {:>10s}".format(n, method, "skipped"))
+                continue
+
+            start = time.perf_counter()
+            result = merge_prototypes(
+                children, k, method=method, group_size=group_size)
+            elapsed = time.perf_counter() - start
+
+            if method == "complete":
+                reference = result
+
+            distance = result.distance(reference) if reference is not None else np.nan
+
+            print("{:8d} {:>13s} {:10.3f} {:10.4f} {:10.4f}".format(
+                n, method, elapsed, distance, quantization_error(children, result)))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark the roll-up of the labeling progress (processing.progress.calc_progress)
+against the former per-node loop of Tree.calculate_progress.
+
+The former implementation additionally required a full consolidation of the
+subtree (including prototypes), which is not part of this measurement.
+The legacy loop is quadratic in the number of nodes and is skipped for trees
+larger than `legacy_max`.
+
+Usage:
+    python benchmarks/bench_progress.py run --sizes=5000,50000
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from morphocluster.processing.progress import calc_progress
+
+
+def make_subtree(n_nodes, seed=0):
+    rng = np.random.RandomState(seed)
+
+    # Random tree with a branching factor of ~10
+    parent_pos = np.array([-1] + [rng.randint(0, max(1, i // 10))
+                                  for i in range(1, n_nodes)])
+    node_ids = np.arange(n_nodes)
+    parent_ids = np.where(parent_pos >= 0, parent_pos, np.nan)
+
+    levels = np.zeros(n_nodes, dtype=int)
+    for i in range(1, n_nodes):
+        levels[i] = levels[parent_pos[i]] + 1
+
+    return pd.DataFrame({
+        "node_id": node_ids,
+        "parent_id": parent_ids,
+        "level": levels,
+        "approved": rng.rand(n_nodes) < 0.05,
+        "filled": rng.rand(n_nodes) < 0.1,
+        "name": np.where(rng.rand(n_nodes) < 0.1, "name", None),
+        "n_objects": rng.randint(0, 100, n_nodes),
+    })
+
+
+def rollup_legacy(subtree):
+    """
+    The roll-up loop of the former Tree.calculate_progress.
+    """
+    subtree = subtree.set_index("node_id").sort_values("level", ascending=False)
+
+    for field in ("n_approved_objects", "n_named_objects", "n_approved_nodes", "n_filled_nodes", "n_nodes"):
+        subtree[field] = 1
+
+    for nid in subtree.index:
+        child_selector = (subtree['parent_id'] == nid)
+
+        for field in ("n_approved_objects", "n_named_objects"):
+            subtree.at[nid, field] = max(
+                subtree.at[nid, field],
+                subtree.loc[child_selector, field].sum())
+
+        for field in ("n_approved_nodes", "n_filled_nodes", "n_nodes"):
+            subtree.at[nid, field] = (
+                subtree.at[nid, field]
+                + subtree.loc[child_selector, field].sum())
+
+    return subtree
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def run(sizes=(5000, 50000), legacy_max=10000, repeat=5):
+    """
+    Run the benchmark.
+
+    Parameters:
+        sizes: Numbers of nodes.
+        legacy_max: Largest tree for the legacy loop.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+
+    print("{:>10s} {:>8s} {:>12s} {:>12s}".format(
+        "nodes", "depth", "legacy [s]", "rollup [s]"))
+
+    for n_nodes in sizes:
+        subtree = make_subtree(n_nodes)
+
+        t_rollup = _time(lambda: calc_progress(subtree, 0), repeat)
+
+        if n_nodes <= legacy_max:
+            t_legacy = "{:12.3f}".format(
+                _time(lambda: rollup_legacy(subtree), 1))
+        else:
+            t_legacy = "{:>12s}".format("-")
+
+        print("{:10,d} {:8d} {} {:12.3f}".format(
+            n_nodes, subtree["level"].max(), t_legacy, t_rollup))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
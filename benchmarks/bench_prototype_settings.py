@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Sweep the prototype settings of a project (see Tree.get_prototype_settings).
+
+Synthetic project: A root with one leaf per class. Every class is a mixture of
+`n_modes` Gaussian modes with `n_objects` objects. For every setting
+(number of prototypes k, sample size, clusterer), the leaves are consolidated
+with processing.consolidation.consolidate_subtree on a random sample of their
+objects (like Tree.consolidate_node), then held-out objects of all classes are
+ranked by their distance to the prototypes of each leaf (like Tree.recommend_objects).
+
+Reported are the consolidation latency, the scoring latency of all candidates
+and the recall@n_test (fraction of held-out objects of the class of a leaf
+among its n_test best-ranked candidates, averaged over all leaves).
+
+No database is required.
+
+Usage:
+    python benchmarks/bench_prototype_settings.py run --k=4,16,64 --sample_size=100,1000,5000
+"""
+
+import functools
+import itertools
+import sys
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from morphocluster.processing.consolidation import (consolidate_subtree,
+                                                    make_clusterer)
+
+
+def make_project(n_classes, n_objects, n_test, n_modes, n_features, spread, seed=0):
+    """
+    Returns:
+        (subtree, objects_by_node, test_vectors, test_labels)
+    """
+    rng = np.random.RandomState(seed)
+
+    node_ids = np.arange(1, n_classes + 2)
+    subtree = pd.DataFrame({
+        "node_id": node_ids,
+        "parent_id": [np.nan] + [1] * n_classes,
+        "level": [0] + [1] * n_classes,
+        "cache_valid": False,
+        "_n_objects_": [0] + [n_objects] * n_classes,
+        "_n_children_": [n_classes] + [0] * n_classes,
+        "_n_objects_deep": None,
+        "_centroid": None,
+        "_prototypes": None,
+        "_type_objects": None,
+        "_own_type_objects": None,
+    }).set_index("node_id").sort_values("level", ascending=False)
+
+    objects_by_node = {}
+    test_vectors, test_labels = [], []
+    for label, node_id in enumerate(node_ids[1:]):
+        modes = rng.randn(n_modes, n_features)
+        vectors = (modes[rng.randint(n_modes, size=n_objects + n_test)]
+                   + spread * rng.randn(n_objects + n_test, n_features))
+        vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+        objects_by_node[node_id] = vectors[:n_objects]
+        test_vectors.append(vectors[n_objects:])
+        test_labels.append(np.full(n_test, label))
+
+    return subtree, objects_by_node, np.concatenate(test_vectors), np.concatenate(test_labels)
+
+
+def sample_objects(objects_by_node, sample_size, rng):
+    """
+    Sample up to sample_size objects per node (like Tree._query_object_sample).
+    """
+    node_ids, vectors = [], []
+    for node_id, node_vectors in objects_by_node.items():
+        idx = rng.choice(len(node_vectors), min(sample_size, len(node_vectors)),
+                         replace=False)
+        node_ids.append(np.full(len(idx), node_id))
+        vectors.append(node_vectors[idx])
+
+    node_ids = np.concatenate(node_ids)
+    object_ids = np.arange(len(node_ids)).astype(str).astype(object)
+
+    return node_ids, object_ids, np.concatenate(vectors)
+
+
+def run(k=(4, 16, 64), sample_size=(100, 1000, 5000), clusterer=("kmeans", "minibatch", "lloyd"),
+        metric="euclidean", n_classes=20, n_objects=5000, n_test=200, n_modes=8, n_features=32,
+        spread=1.0):
+    """
+    Run the benchmark.
+
+    Parameters:
+        k: Numbers of prototypes.
+        sample_size: Sample sizes.
+        clusterer: Clusterers (see processing.consolidation.CLUSTERERS).
+        metric: Metric of the ranking.
+        n_classes: Number of classes (leaves).
+        n_objects: Number of objects per class.
+        n_test: Number of held-out objects per class.
+        n_modes: Number of modes per class.
+        n_features: Dimensionality of the object vectors.
+        spread: Standard deviation of the objects around their mode.
+    """
+    if isinstance(k, int):
+        k = (k,)
+    if isinstance(sample_size, int):
+        sample_size = (sample_size,)
+    if isinstance(clusterer, str):
+        clusterer = (clusterer,)
+
+    subtree, objects_by_node, test_vectors, test_labels = make_project(
+        n_classes, n_objects, n_test, n_modes, n_features, spread)
+
+    print("{:>4s} {:>8s} {:>10s} {:>16s} {:>12s} {:>8s}".format(
+        "k", "sample", "clusterer", "consolidate [s]", "score [ms]", "recall"))
+
+    for k_, sample_size_, clusterer_ in itertools.product(k, sample_size, clusterer):
+        rng = np.random.RandomState(0)
+        object_node_ids, object_ids, vectors = sample_objects(
+            objects_by_node, sample_size_, rng)
+
+        start = time.perf_counter()
+        result = consolidate_subtree(
+            subtree, object_node_ids, object_ids, vectors, k_,
+            make_clusterer=functools.partial(make_clusterer, clusterer_, k_),
+            metric=metric)
+        t_consolidate = time.perf_counter() - start
+
+        recalls = []
+        t_score = 0
+        for label, node_id in enumerate(sorted(objects_by_node)):
+            prots = result.at[node_id, "_prototypes"]
+
+            start = time.perf_counter()
+            distances = prots.transform(test_vectors, metric)
+            t_score += time.perf_counter() - start
+
+            top = np.argpartition(distances, n_test)[:n_test]
+            recalls.append(np.mean(test_labels[top] == label))
+
+        print("{:4d} {:8d} {:>10s} {:16.2f} {:12.2f} {:8.3f}".format(
+            k_, sample_size_, clusterer_, t_consolidate,
+            1000 * t_score / len(objects_by_node), np.mean(recalls)))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark peak memory and latency of the exhaustive path of Tree.recommend_objects.
+
+Compares the former implementation (fetch all candidate rows as dicts,
+convert to an object array, full argsort) with the streaming implementation
+(chunks of ids and vectors, running TopK selection).
+
+Database access is simulated by a generator of rows, so that only the
+Python-side memory is measured. Each measurement runs in a fresh process
+to obtain its peak RSS.
+
+Usage:
+    python benchmarks/bench_recommend_memory.py run --sizes=100000,1000000,3000000
+"""
+
+import multiprocessing
+import resource
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.column_types import decode_vectors, encode_vector
+from morphocluster.helpers import TopK
+from morphocluster.processing.prototypes import Prototypes
+
+CHUNK_SIZE = 10000
+
+
+def _rows(n_candidates, n_features, chunk_size=CHUNK_SIZE):
+    """
+    Generate (object_id, path, rand, vector) rows like the database would.
+    """
+    rng = np.random.RandomState(0)
+    for start in range(0, n_candidates, chunk_size):
+        vectors = rng.randn(
+            min(chunk_size, n_candidates - start), n_features).astype(np.float32)
+        for i, v in enumerate(vectors, start):
+            yield ("{:d}".format(i), "/data/{:d}.jpg".format(i), rng.rand(), encode_vector(v))
+
+
+def _prototypes(n_features, n_prototypes=16):
+    prots = Prototypes(None)
+    prots.prototypes_ = np.random.RandomState(1).randn(
+        n_prototypes, n_features).astype(np.float32)
+    prots.support_ = np.ones(n_prototypes)
+    return prots
+
+
+def recommend_legacy(n_candidates, n_features, max_n):
+    prots = _prototypes(n_features)
+
+    objects_ = [dict(zip(("object_id", "path", "rand", "vector"), r))
+                for r in _rows(n_candidates, n_features)]
+    vectors = decode_vectors(o["vector"] for o in objects_)
+    for o, v in zip(objects_, vectors):
+        o["vector"] = v
+    objects_ = np.array(objects_, dtype=object)
+
+    distances = prots.transform(vectors)
+    order = np.argsort(distances)[:max_n]
+    return [o["object_id"] for o in objects_[order]]
+
+
+def recommend_streaming(n_candidates, n_features, max_n):
+    prots = _prototypes(n_features)
+
+    top = TopK(max_n)
+    rows = _rows(n_candidates, n_features)
+    while True:
+        chunk = [(r[0], r[3]) for _, r in zip(range(CHUNK_SIZE), rows)]
+        if not chunk:
+            break
+        object_ids = np.array([r[0] for r in chunk], dtype=object)
+        vectors = decode_vectors(r[1] for r in chunk)
+        top.push(prots.transform(vectors), object_ids, vectors)
+
+    _, object_ids, _ = top.result()
+    return list(object_ids)
+
+
+def _measure(func, args, queue):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((elapsed, peak, result))
+
+
+def _run_isolated(func, *args):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(func, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run(sizes=(100000, 1000000), n_features=64, max_n=1000):
+    """
+    Run the benchmark.
+
+    Parameters:
+        sizes: Numbers of candidate objects (i.e. subtree sizes).
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+
+    print("{:>10s} {:>14s} {:>14s} {:>14s} {:>14s}".format(
+        "candidates", "legacy [s]", "legacy [MiB]", "stream [s]", "stream [MiB]"))
+
+    for n_candidates in sizes:
+        t_legacy, rss_legacy, res_legacy = _run_isolated(
+            recommend_legacy, n_candidates, n_features, max_n)
+        t_stream, rss_stream, res_stream = _run_isolated(
+            recommend_streaming, n_candidates, n_features, max_n)
+
+        assert res_legacy == res_stream
+
+        print("{:10,d} {:14.2f} {:14.0f} {:14.2f} {:14.0f}".format(
+            n_candidates, t_legacy, rss_legacy, t_stream, rss_stream))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
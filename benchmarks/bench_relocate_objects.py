@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark Tree.relocate_objects for batches of moved objects.
+
+Creates a temporary project (a root with `n_nodes` children of depth `depth`,
+objects spread evenly over the leaves) in the configured database and moves
+batches of objects into a single leaf, once with the former implementation
+(SELECT ... FOR UPDATE with IN (...), UPDATE, invalidation of the common paths)
+and once with Tree.relocate_objects. Every measurement is rolled back.
+The project and the objects are deleted afterwards.
+
+Requires a database (MORPHOCLUSTER_SETTINGS).
+
+Usage:
+    python benchmarks/bench_relocate_objects.py run --sizes=1000,10000,100000
+"""
+
+import sys
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql.expression import select
+
+from morphocluster import create_app
+from morphocluster.extensions import database
+from morphocluster.ingest import copy_from_frame
+from morphocluster.models import nodes, nodes_objects, objects, projects
+from morphocluster.tree import Tree, _paths_from_common_ancestor
+
+
+def relocate_objects_legacy(tree, object_ids, node_id):
+    """
+    The former implementation of Tree.relocate_objects.
+    """
+    conn = tree.connection
+
+    tree.lock_project_for_node(node_id)
+
+    project_id = conn.execute(select([nodes.c.project_id]).where(
+        nodes.c.node_id == node_id)).scalar()
+
+    new_node_path = tree.get_path_ids(node_id)
+
+    stmt = select([nodes_objects.c.node_id], for_update=True).where(
+        nodes_objects.c.object_id.in_(object_ids) & (nodes_objects.c.project_id == project_id))
+    old_node_ids = [r["node_id"] for r in conn.execute(stmt).fetchall()]
+
+    stmt = nodes_objects.update().values({"node_id": node_id})\
+        .where(nodes_objects.c.object_id.in_(object_ids) & (nodes_objects.c.project_id == project_id))
+    conn.execute(stmt)
+
+    paths = [new_node_path] + [old_node_ids]
+    paths_to_update = _paths_from_common_ancestor(paths)
+    tree.invalidate_nodes(set(sum(paths_to_update, [])))
+
+
+def _time(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run(sizes=(1000, 10000, 100000), n_nodes=100, depth=3):
+    """
+    Run the benchmark.
+
+    Parameters:
+        sizes: Numbers of moved objects.
+        n_nodes: Number of leaves.
+        depth: Depth of the leaves.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+
+    n_objects = max(sizes) * 2
+    object_ids = np.array(["bench_relocate_{:d}".format(i)
+                           for i in range(n_objects)])
+
+    app = create_app()
+
+    with app.app_context(), database.engine.connect() as conn:
+        tree = Tree(conn)
+
+        with conn.begin():
+            copy_from_frame(conn, "objects", pd.DataFrame(
+                {"object_id": object_ids, "path": object_ids}))
+
+            project_id = tree.create_project("bench_relocate_objects")
+            root_id = tree.create_node(project_id)
+
+            leaves = []
+            for _ in range(n_nodes):
+                node_id = root_id
+                for _ in range(depth):
+                    node_id = tree.create_node(project_id, parent_id=node_id)
+                leaves.append(node_id)
+
+            copy_from_frame(conn, "nodes_objects", pd.DataFrame({
+                "node_id": np.resize(leaves, n_objects),
+                "project_id": project_id,
+                "object_id": object_ids}))
+
+        target_id = leaves[0]
+
+        print("{:>10s} {:>12s} {:>12s}".format("objects", "legacy [s]", "set [s]"))
+
+        try:
+            for size in sizes:
+                moved = list(object_ids[-size:])
+                results = []
+
+                for func in (relocate_objects_legacy, Tree.relocate_objects):
+                    txn = conn.begin()
+                    try:
+                        results.append(
+                            _time(lambda: func(tree, moved, target_id)))
+                    finally:
+                        txn.rollback()
+
+                print("{:10,d} {:12.3f} {:12.3f}".format(size, *results))
+        finally:
+            with conn.begin():
+                conn.execute(projects.delete(
+                    projects.c.project_id == project_id))
+                conn.execute(objects.delete(
+                    objects.c.object_id.like("bench_relocate_%")))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
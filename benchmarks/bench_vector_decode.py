@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Benchmark the decoding of object vectors.
+
+Compares pickled float64 arrays (one unpickle per row, then np.array)
+with raw float32 bytes that are decoded in one batch (column_types.decode_vectors).
+
+Usage:
+    python benchmarks/bench_vector_decode.py run --sizes=10000,100000,1000000
+"""
+
+import pickle
+import sys
+import time
+
+import fire
+import numpy as np
+
+from morphocluster.column_types import decode_vectors, encode_vector
+
+
+def _measure(func, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(sizes=(10000, 100000, 1000000), n_features=64):
+    """
+    Run the benchmark.
+
+    Parameters:
+        sizes: Numbers of vectors.
+        n_features: Dimensionality of the vectors.
+    """
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+
+    print("{:>9s} {:>11s} {:>11s} {:>8s} {:>13s} {:>13s}".format(
+        "vectors", "pickle [s]", "raw [s]", "speedup", "pickle [MiB]", "raw [MiB]"))
+
+    for n_vectors in sizes:
+        vectors = np.random.rand(n_vectors, n_features)
+
+        pickled = [pickle.dumps(v) for v in vectors]
+        raw = [encode_vector(v) for v in vectors]
+
+        time_pickle = _measure(
+            lambda: np.array([pickle.loads(b) for b in pickled]))
+        time_raw = _measure(lambda: decode_vectors(raw, n_features))
+
+        size_pickle = sum(len(b) for b in pickled) / 2**20
+        size_raw = sum(len(b) for b in raw) / 2**20
+
+        print("{:9d} {:11.3f} {:11.3f} {:8.1f} {:13.1f} {:13.1f}".format(
+            n_vectors, time_pickle, time_raw, time_pickle / time_raw, size_pickle, size_raw))
+
+
+if __name__ == "__main__":
+    sys.exit(fire.Fire({"run": run}))
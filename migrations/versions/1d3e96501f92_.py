@@ -0,0 +1,148 @@
+"""Store vectors and prototypes as raw float32 bytes instead of pickles.
+
+Revision ID: 1d3e96501f92
+Revises: fe6fec6b70a6
+Create Date: 2026-10-17 10:12:43.118204
+
+"""
+import pickle
+import struct
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision = '1d3e96501f92'
+down_revision = 'fe6fec6b70a6'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 10000
+
+# Frozen copy of the storage format in morphocluster.column_types
+_PROTOTYPES_HEADER = struct.Struct("<II")
+
+
+def _encode_vector(vector):
+    return np.ascontiguousarray(vector, dtype="<f4").tobytes()
+
+
+def _decode_vector(buffer):
+    return np.frombuffer(buffer, dtype="<f4").copy()
+
+
+def _encode_prototypes(prototypes):
+    prototypes_ = np.ascontiguousarray(prototypes.prototypes_, "<f4")
+    support_ = np.ascontiguousarray(prototypes.support_, "<f8")
+    return (_PROTOTYPES_HEADER.pack(*prototypes_.shape)
+            + prototypes_.tobytes()
+            + support_.tobytes())
+
+
+def _decode_prototypes(buffer):
+    from morphocluster.processing.prototypes import Prototypes
+
+    k, d = _PROTOTYPES_HEADER.unpack_from(buffer)
+    offset = _PROTOTYPES_HEADER.size
+    prototypes_ = np.frombuffer(buffer, "<f4", k * d, offset).reshape(k, d)
+    support_ = np.frombuffer(buffer, "<f8", k, offset + prototypes_.nbytes)
+
+    result = Prototypes(None)
+    result.prototypes_ = prototypes_.copy()
+    result.support_ = support_.copy()
+    return result
+
+
+def _convert_column(table, pk, column, convert, on_error=None):
+    """
+    Convert the values of a bytea column in chunks.
+
+    The converted values are written to a temporary column that replaces
+    the original column at the end.
+
+    Parameters:
+        convert: Callable bytes -> bytes.
+        on_error: SQL assignment for rows that could not be converted (default: raise).
+    """
+    conn = op.get_bind()
+    tmp_column = "{}__converted".format(column)
+
+    op.add_column(table, sa.Column(tmp_column, sa.LargeBinary(), nullable=True))
+
+    select_stmt = text("""
+    SELECT {pk}, {column} FROM {table}
+    WHERE {pk} > :last_pk AND {column} IS NOT NULL
+    ORDER BY {pk}
+    LIMIT :chunk_size
+    """.format(pk=pk, column=column, table=table))
+
+    update_stmt = text("UPDATE {table} SET {tmp_column} = :value WHERE {pk} = :pk".format(
+        table=table, tmp_column=tmp_column, pk=pk))
+
+    failed = []
+    n_converted = 0
+    last_pk = "" if pk == "object_id" else -1
+    while True:
+        rows = conn.execute(select_stmt, last_pk=last_pk,
+                            chunk_size=CHUNK_SIZE).fetchall()
+        if not rows:
+            break
+
+        data = []
+        for row_pk, value in rows:
+            try:
+                data.append({"pk": row_pk, "value": convert(bytes(value))})
+            except Exception:  # pylint: disable=broad-except
+                if on_error is None:
+                    raise
+                failed.append(row_pk)
+
+        if data:
+            conn.execute(update_stmt, data)
+
+        n_converted += len(data)
+        last_pk = rows[-1][0]
+        print("{}.{}: {:,d} converted".format(table, column, n_converted))
+
+    if failed:
+        print("{}.{}: {:,d} values could not be converted".format(
+            table, column, len(failed)))
+        conn.execute(text("UPDATE {table} SET {on_error} WHERE {pk} = ANY(:pks)".format(
+            table=table, on_error=on_error, pk=pk)), pks=failed)
+
+    op.drop_column(table, column)
+    op.alter_column(table, tmp_column, new_column_name=column)
+
+
+def _pickle_to_vector(value):
+    return _encode_vector(pickle.loads(value))
+
+
+def _pickle_to_prototypes(value):
+    return _encode_prototypes(pickle.loads(value))
+
+
+def _vector_to_pickle(value):
+    return pickle.dumps(_decode_vector(value))
+
+
+def _prototypes_to_pickle(value):
+    return pickle.dumps(_decode_prototypes(value))
+
+
+def upgrade():
+    _convert_column("objects", "object_id", "vector", _pickle_to_vector)
+    # Cached values that can not be converted are recalculated by consolidate
+    _convert_column("nodes", "node_id", "_centroid", _pickle_to_vector,
+                    on_error="cache_valid = FALSE")
+    _convert_column("nodes", "node_id", "_prototypes", _pickle_to_prototypes,
+                    on_error="cache_valid = FALSE")
+
+
+def downgrade():
+    _convert_column("objects", "object_id", "vector", _vector_to_pickle)
+    _convert_column("nodes", "node_id", "_centroid", _vector_to_pickle)
+    _convert_column("nodes", "node_id", "_prototypes", _prototypes_to_pickle)
@@ -0,0 +1,46 @@
+"""Add progress counters to nodes.
+
+Revision ID: 3b9d7c2a6e15
+Revises: 8e4b2d6f13a7
+Create Date: 2026-10-17 16:40:12.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d7c2a6e15'
+down_revision = '8e4b2d6f13a7'
+branch_labels = None
+depends_on = None
+
+COUNTERS = [
+    'n_objects',
+    'n_objects_deep',
+    'n_approved_objects',
+    'n_named_objects',
+    'n_approved_nodes',
+    'n_filled_nodes',
+    'n_nodes',
+    'leaves_n_objects',
+    'leaves_n_filled_objects',
+    'leaves_n_approved_objects',
+    'leaves_n_named_objects',
+    'leaves_n_approved_nodes',
+    'leaves_n_filled_nodes',
+    'leaves_n_nodes',
+]
+
+
+def upgrade():
+    # The counters are NULL until they are computed
+    # (on first access or with `flask rebuild-progress`)
+    for counter in COUNTERS:
+        op.add_column('nodes', sa.Column(
+            'progress_' + counter, sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    for counter in COUNTERS:
+        op.drop_column('nodes', 'progress_' + counter)
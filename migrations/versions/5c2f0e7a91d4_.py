@@ -0,0 +1,59 @@
+"""Add closure table nodes_closure.
+
+Revision ID: 5c2f0e7a91d4
+Revises: 1d3e96501f92
+Create Date: 2026-10-17 14:02:51.530261
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f0e7a91d4'
+down_revision = '1d3e96501f92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('nodes_closure',
+                    sa.Column('ancestor_id', sa.BigInteger(), nullable=False),
+                    sa.Column('descendant_id', sa.BigInteger(), nullable=False),
+                    sa.Column('depth', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['ancestor_id'], ['nodes.node_id'],
+                                            ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['descendant_id'], ['nodes.node_id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+                    )
+    op.create_index('idx_closure_descendant_depth', 'nodes_closure',
+                    ['descendant_id', 'depth'], unique=False)
+
+    # Backfill project by project
+    conn = op.get_bind()
+    project_ids = [r for (r,) in conn.execute(
+        text("SELECT project_id FROM projects ORDER BY project_id"))]
+
+    for project_id in project_ids:
+        result = conn.execute(text("""
+        INSERT INTO nodes_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE c AS (
+            SELECT node_id AS ancestor_id, node_id AS descendant_id, 0 AS depth
+            FROM nodes
+            WHERE project_id = :project_id
+            UNION ALL
+            SELECT c.ancestor_id, n.node_id, c.depth + 1
+            FROM c
+            JOIN nodes AS n
+            ON n.parent_id = c.descendant_id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM c
+        """), project_id=project_id)
+        print("Project {}: {:,d} closure rows".format(project_id, result.rowcount))
+
+
+def downgrade():
+    op.drop_index('idx_closure_descendant_depth', table_name='nodes_closure')
+    op.drop_table('nodes_closure')
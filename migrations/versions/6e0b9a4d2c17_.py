@@ -0,0 +1,26 @@
+"""Add incrementally updated prototypes of the own objects of a node.
+
+Revision ID: 6e0b9a4d2c17
+Revises: d52c8f1e7a94
+Create Date: 2026-10-17 22:14:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e0b9a4d2c17'
+down_revision = 'd52c8f1e7a94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled by the next consolidation of each node
+    op.add_column('nodes', sa.Column(
+        '_own_prototypes', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('nodes', '_own_prototypes')
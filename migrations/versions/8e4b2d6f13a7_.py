@@ -0,0 +1,30 @@
+"""Add ingest_checkpoints.
+
+Revision ID: 8e4b2d6f13a7
+Revises: 5c2f0e7a91d4
+Create Date: 2026-10-17 15:21:07.118342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b2d6f13a7'
+down_revision = '5c2f0e7a91d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ingest_checkpoints',
+                    sa.Column('source', sa.String(), nullable=False),
+                    sa.Column('n_done', sa.BigInteger(), nullable=False),
+                    sa.Column('updated', sa.DateTime(timezone=True),
+                              server_default=sa.text('now()'), nullable=True),
+                    sa.PrimaryKeyConstraint('source')
+                    )
+
+
+def downgrade():
+    op.drop_table('ingest_checkpoints')
@@ -0,0 +1,39 @@
+"""Add node versions for lazy invalidation.
+
+Revision ID: a7f31c5e8d20
+Revises: 3b9d7c2a6e15
+Create Date: 2026-10-17 18:05:44.291736
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateSequence, DropSequence
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7f31c5e8d20'
+down_revision = '3b9d7c2a6e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateSequence(sa.Sequence('nodes_version_seq')))
+
+    op.add_column('nodes', sa.Column('version', sa.BigInteger(),
+                                     server_default='0', nullable=False))
+    op.add_column('nodes', sa.Column(
+        '_cache_epoch', sa.BigInteger(), nullable=True))
+    op.create_index('idx_nodes_project_version', 'nodes',
+                    ['project_id', 'version'], unique=False)
+
+    # Currently valid cached values are up to date with all (unversioned) modifications
+    op.execute("UPDATE nodes SET _cache_epoch = 0 WHERE cache_valid")
+
+
+def downgrade():
+    op.drop_index('idx_nodes_project_version', table_name='nodes')
+    op.drop_column('nodes', '_cache_epoch')
+    op.drop_column('nodes', 'version')
+
+    op.execute(DropSequence(sa.Sequence('nodes_version_seq')))
@@ -0,0 +1,35 @@
+"""Add prototype settings to projects.
+
+Revision ID: b3c8e51f0a62
+Revises: 6e0b9a4d2c17
+Create Date: 2026-10-17 23:02:51.318408
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3c8e51f0a62'
+down_revision = '6e0b9a4d2c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The defaults correspond to the former hard-coded values
+    op.add_column('projects', sa.Column('n_prototypes', sa.Integer(),
+                                        server_default='16', nullable=False))
+    op.add_column('projects', sa.Column('prototype_clusterer', sa.String(),
+                                        server_default='kmeans', nullable=False))
+    op.add_column('projects', sa.Column('object_sample_size', sa.Integer(),
+                                        server_default='1000', nullable=False))
+    op.add_column('projects', sa.Column('prototype_metric', sa.String(),
+                                        server_default='euclidean', nullable=False))
+
+
+def downgrade():
+    op.drop_column('projects', 'prototype_metric')
+    op.drop_column('projects', 'object_sample_size')
+    op.drop_column('projects', 'prototype_clusterer')
+    op.drop_column('projects', 'n_prototypes')
@@ -0,0 +1,48 @@
+"""Add nodes_progress_deltas.
+
+Revision ID: c4e1a7d93b58
+Revises: b3c8e51f0a62
+Create Date: 2026-10-17 14:12:40.520731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1a7d93b58'
+down_revision = 'b3c8e51f0a62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('nodes_progress_deltas',
+                    sa.Column('delta_id', sa.BigInteger(), nullable=False),
+                    sa.Column('node_id', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_objects_deep', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_approved_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_named_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_approved_nodes', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_filled_nodes', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_n_nodes', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_filled_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_approved_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_named_objects', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_approved_nodes', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_filled_nodes', sa.BigInteger(), nullable=False),
+                    sa.Column('progress_leaves_n_nodes', sa.BigInteger(), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['node_id'], ['nodes.node_id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('delta_id')
+                    )
+    op.create_index(op.f('ix_nodes_progress_deltas_node_id'),
+                    'nodes_progress_deltas', ['node_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_nodes_progress_deltas_node_id'),
+                  table_name='nodes_progress_deltas')
+    op.drop_table('nodes_progress_deltas')
@@ -0,0 +1,43 @@
+"""Use transaction ids as node versions.
+
+Revision ID: d52c8f1e7a94
+Revises: a7f31c5e8d20
+Create Date: 2026-10-17 20:41:12.508311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateSequence, DropSequence
+
+
+# revision identifiers, used by Alembic.
+revision = 'd52c8f1e7a94'
+down_revision = 'a7f31c5e8d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Sequence values are not comparable with transaction ids:
+    # Invalidate nodes with pending modifications below and reset all versions.
+    op.execute("""
+    UPDATE nodes AS a
+    SET cache_valid = FALSE
+    FROM nodes_closure AS c
+    JOIN nodes AS d
+    ON d.node_id = c.descendant_id
+    WHERE a.node_id = c.ancestor_id
+    AND a.cache_valid
+    AND d.version > COALESCE(a._cache_epoch, 0)
+    """)
+    op.execute("UPDATE nodes SET version = 0, _cache_epoch = CASE WHEN cache_valid THEN 0 END")
+
+    op.execute(DropSequence(sa.Sequence('nodes_version_seq')))
+
+
+def downgrade():
+    op.execute(CreateSequence(sa.Sequence('nodes_version_seq')))
+    op.execute("""
+    SELECT setval('nodes_version_seq', GREATEST(
+        (SELECT max(version) FROM nodes), (SELECT max(_cache_epoch) FROM nodes), 1))
+    """)
@@ -29,11 +29,18 @@ def create_app(test_config=None):
         app.config.update(test_config)
 
     # Register extensions
-    from morphocluster.extensions import database, migrate, redis_lru, rq
+    from morphocluster.extensions import (ann_index, database, dirty_queue,
+                                          feature_store, migrate, node_cache,
+                                          redis_lru, result_cache, rq)
     database.init_app(app)
     redis_lru.init_app(app)
     migrate.init_app(app, database)
     rq.init_app(app)
+    feature_store.init_app(app)
+    ann_index.init_app(app)
+    dirty_queue.init_app(app)
+    node_cache.init_app(app)
+    result_cache.init_app(app)
 
     # Register cli
     from morphocluster import cli
@@ -0,0 +1,423 @@
+"""
+Approximate nearest neighbour index for object vectors (IVF-flat).
+
+The objects of a project are partitioned into lists by k-means.
+A query only scans the lists whose centroids are nearest to the query vectors.
+
+Each object also carries its current node_id, so that a query can be restricted
+to the objects of certain nodes. node_ids are memory-mapped read-write and are
+updated in place when objects are relocated, so that all processes that mapped
+the index see the change immediately. The updates are applied after the commit
+of the relocation (see Tree.transaction) and serialized across processes
+with a lock file next to the index (see ANNIndex.lock).
+
+The index is a directory containing
+    centroids.npy: List centroids of shape [n_lists, n_features].
+    offsets.npy: Start of each list in the rows (CSR-style, n_lists + 1 entries).
+    vectors.npy: Object vectors grouped by list.
+    object_ids.npy: object_id of each row.
+    node_ids.npy: Current node_id of each row.
+    sorted_object_ids.npy, id_order.npy: Sorted object_ids and their rows (for lookups).
+"""
+
+import contextlib
+import fcntl
+import os
+import shutil
+import threading
+
+import numpy as np
+from flask import current_app, has_app_context
+from sklearn.cluster import KMeans
+
+#: dtype of the indexed vectors
+INDEX_DTYPE = np.dtype("<f4")
+
+# Rows per chunk for distance calculations
+_CHUNK_SIZE = 4096
+
+
+def _min_distances(X, Q):
+    """
+    Euclidean distance of each row in X to its nearest row in Q.
+
+    Returns:
+        array of shape = [n_samples]
+    """
+    Q = np.asarray(Q, dtype=INDEX_DTYPE)
+    Q_sqnorm = (Q ** 2).sum(axis=1)
+
+    result = np.empty(len(X), dtype=INDEX_DTYPE)
+    for start in range(0, len(X), _CHUNK_SIZE):
+        chunk = np.asarray(X[start:start + _CHUNK_SIZE], dtype=INDEX_DTYPE)
+        sqdist = (chunk ** 2).sum(axis=1)[:, np.newaxis] - \
+            2 * chunk @ Q.T + Q_sqnorm
+        result[start:start + _CHUNK_SIZE] = sqdist.min(axis=1)
+
+    return np.sqrt(np.maximum(result, 0, out=result), out=result)
+
+
+def _nearest(X, C):
+    """
+    Index of the nearest row in C for each row in X.
+    """
+    C = np.asarray(C, dtype=INDEX_DTYPE)
+    C_sqnorm = (C ** 2).sum(axis=1)
+
+    result = np.empty(len(X), dtype=np.int64)
+    for start in range(0, len(X), _CHUNK_SIZE):
+        chunk = np.asarray(X[start:start + _CHUNK_SIZE], dtype=INDEX_DTYPE)
+        result[start:start + _CHUNK_SIZE] = np.argmin(
+            C_sqnorm - 2 * chunk @ C.T, axis=1)
+
+    return result
+
+
+def _ranges(starts, stops):
+    """
+    Concatenation of np.arange(start, stop) for all pairs.
+    """
+    lengths = stops - starts
+    total = lengths.sum()
+    if not total:
+        return np.empty(0, dtype=np.int64)
+
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shift + np.arange(total)
+
+
+class ANNIndex:
+    """
+    IVF-flat index over object vectors with a node_id per object.
+
+    Use `ANNIndex.build` to create and `ANNIndex.load` to open an index.
+    """
+
+    CENTROIDS_FN = "centroids.npy"
+    OFFSETS_FN = "offsets.npy"
+    VECTORS_FN = "vectors.npy"
+    OBJECT_IDS_FN = "object_ids.npy"
+    NODE_IDS_FN = "node_ids.npy"
+    SORTED_IDS_FN = "sorted_object_ids.npy"
+    ID_ORDER_FN = "id_order.npy"
+
+    #: Fraction of scanned rows after which a query switches to a full scan
+    FULL_SCAN_FRACTION = 0.25
+
+    def __init__(self, centroids, offsets, vectors, object_ids, node_ids,
+                 sorted_ids, id_order, path=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.object_ids = object_ids
+        self.node_ids = node_ids
+        self.sorted_ids = sorted_ids
+        self.id_order = id_order
+        self.path = path
+
+        self._thread_lock = threading.Lock()
+
+    @staticmethod
+    def build(object_ids, vectors, node_ids, n_lists=None, n_train=None, random_state=0):
+        """
+        Build an index.
+
+        Parameters:
+            object_ids, vectors, node_ids: Indexed objects.
+            n_lists: Number of lists (default: sqrt(n_objects)).
+            n_train: Number of objects used to find the list centroids (default: 64 * n_lists).
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+        vectors = np.asarray(vectors, dtype=INDEX_DTYPE)
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+
+        n_objects = len(object_ids)
+
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_objects))
+        n_lists = max(1, min(n_lists, n_objects))
+
+        if n_train is None:
+            n_train = 64 * n_lists
+
+        rng = np.random.RandomState(random_state)
+        if n_objects > n_train:
+            train = vectors[np.sort(rng.choice(n_objects, n_train, replace=False))]
+        else:
+            train = vectors
+
+        if n_lists > 1:
+            centroids = KMeans(n_lists, n_init=1, max_iter=20,
+                               random_state=random_state).fit(train).cluster_centers_
+            centroids = centroids.astype(INDEX_DTYPE)
+            lists = _nearest(vectors, centroids)
+        else:
+            centroids = vectors.mean(axis=0, keepdims=True)
+            lists = np.zeros(n_objects, dtype=np.int64)
+
+        order = np.argsort(lists, kind="stable")
+        offsets = np.searchsorted(lists[order], np.arange(n_lists + 1))
+
+        object_ids = object_ids[order]
+        id_order = np.argsort(object_ids, kind="stable")
+
+        return ANNIndex(centroids, offsets, vectors[order], object_ids,
+                        node_ids[order], object_ids[id_order], id_order)
+
+    def save(self, path):
+        """
+        Save the index to a directory.
+
+        An existing index is replaced as a whole, so that processes that
+        still have it mapped are not affected.
+        """
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        for fn, arr in ((self.CENTROIDS_FN, self.centroids),
+                        (self.OFFSETS_FN, self.offsets),
+                        (self.VECTORS_FN, self.vectors),
+                        (self.OBJECT_IDS_FN, self.object_ids),
+                        (self.NODE_IDS_FN, self.node_ids),
+                        (self.SORTED_IDS_FN, self.sorted_ids),
+                        (self.ID_ORDER_FN, self.id_order)):
+            np.save(os.path.join(tmp_path, fn), arr)
+
+        if os.path.exists(path):
+            old_path = path + ".old"
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path, mode="r+"):
+        """
+        Open a saved index.
+
+        Parameters:
+            mode: "r+" to allow in-place updates of node_ids, "r" for read-only.
+        """
+
+        def _load(fn, mmap_mode="r"):
+            return np.load(os.path.join(path, fn), mmap_mode=mmap_mode)
+
+        return ANNIndex(np.asarray(_load(ANNIndex.CENTROIDS_FN)),
+                        np.asarray(_load(ANNIndex.OFFSETS_FN)),
+                        _load(ANNIndex.VECTORS_FN),
+                        _load(ANNIndex.OBJECT_IDS_FN),
+                        _load(ANNIndex.NODE_IDS_FN, mode),
+                        _load(ANNIndex.SORTED_IDS_FN),
+                        _load(ANNIndex.ID_ORDER_FN),
+                        path)
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def get_rows(self, object_ids):
+        """
+        Get the rows of object_ids (-1 for unknown objects).
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+
+        if not len(self) or not len(object_ids):
+            return np.full(len(object_ids), -1, dtype=np.int64)
+
+        idx = np.minimum(np.searchsorted(
+            self.sorted_ids, object_ids), len(self) - 1)
+        found = self.sorted_ids[idx] == object_ids
+
+        return np.where(found, self.id_order[idx], -1)
+
+    def _flush(self):
+        if isinstance(self.node_ids, np.memmap):
+            self.node_ids.flush()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Context manager that serializes updates of node_ids.
+
+        An index that was loaded from a directory is locked across processes
+        using the file <path>.lock (it persists when the index is rebuilt).
+        """
+        with self._thread_lock:
+            if self.path is None:
+                yield
+                return
+
+            with open(self.path + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update_node_ids(self, object_ids, node_ids):
+        """
+        Record that objects were moved to node_ids (one per object or a single node_id).
+
+        Unknown objects are ignored (they are added when the index is rebuilt).
+        The caller should hold the lock (see lock).
+        """
+        rows = self.get_rows(object_ids)
+        node_ids = np.broadcast_to(np.asarray(node_ids), rows.shape)
+        found = rows >= 0
+        self.node_ids[rows[found]] = node_ids[found]
+        self._flush()
+
+    def replace_node_id(self, old_node_id, new_node_id):
+        """
+        Record that all objects of old_node_id were moved to new_node_id.
+
+        The caller should hold the lock (see lock).
+        """
+        self.node_ids[self.node_ids == old_node_id] = new_node_id
+        self._flush()
+
+    def _filter(self, rows, node_ids, exclude_rows):
+        if node_ids is not None:
+            rows = rows[np.isin(self.node_ids[rows], node_ids)]
+        if exclude_rows is not None:
+            rows = rows[~np.isin(rows, exclude_rows)]
+        return rows
+
+    def search(self, queries, k, node_ids=None, exclude=None, n_probe=8, exact=False):
+        """
+        Find the k objects nearest to any of the query vectors.
+
+        Parameters:
+            queries: array of shape = [n_queries, n_features], e.g. the prototypes of a node.
+            k: Number of results.
+            node_ids: Only consider objects of these nodes.
+            exclude: object_ids that are not considered.
+            n_probe: Minimum number of scanned lists.
+                More lists are scanned until at least k candidates are found.
+            exact: Scan all objects.
+
+        Returns:
+            (rows, distances) sorted by distance.
+            Use `object_ids[rows]` and `vectors[rows]` to get the objects.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=INDEX_DTYPE))
+
+        if node_ids is not None:
+            node_ids = np.asarray(node_ids, dtype=np.int64)
+
+        exclude_rows = None
+        if exclude is not None and len(exclude):
+            exclude_rows = self.get_rows(exclude)
+            exclude_rows = exclude_rows[exclude_rows >= 0]
+
+        if not len(self) or not len(queries):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=INDEX_DTYPE)
+
+        candidates = None
+        if not exact:
+            # Scan lists by increasing distance of their centroid to the queries
+            list_order = np.argsort(_min_distances(self.centroids, queries))
+
+            candidates = []
+            n_candidates = 0
+            n_scanned = 0
+            n_lists = min(n_probe, self.n_lists)
+            start = 0
+            while start < self.n_lists:
+                lists = list_order[start:start + n_lists]
+                rows = _ranges(self.offsets[lists], self.offsets[lists + 1])
+                n_scanned += len(rows)
+
+                rows = self._filter(rows, node_ids, exclude_rows)
+                candidates.append(rows)
+                n_candidates += len(rows)
+
+                start += n_lists
+                if n_candidates >= k:
+                    break
+
+                if n_scanned > self.FULL_SCAN_FRACTION * len(self):
+                    # The filter is very selective: Scanning everything is cheaper
+                    candidates = None
+                    break
+
+                # Double the number of scanned lists
+                n_lists = start
+
+            if candidates is not None:
+                candidates = np.concatenate(candidates)
+
+        if candidates is None:
+            candidates = self._filter(np.arange(len(self)), node_ids, exclude_rows)
+
+        # Read in storage order for a better locality
+        candidates.sort()
+
+        distances = _min_distances(self.vectors[candidates], queries)
+
+        if len(candidates) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            candidates, distances = candidates[top], distances[top]
+
+        order = np.argsort(distances, kind="stable")
+
+        return candidates[order], distances[order]
+
+
+class FlaskANNIndex:
+    """
+    Flask extension that opens the ANNIndex of a project below ANN_INDEX_DIR.
+
+    If ANN_INDEX_DIR is not set or a project has no index, `get` returns None.
+    An index is reopened if it was rebuilt.
+    """
+
+    def __init__(self, app=None):
+        self._indexes = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ANN_INDEX_DIR", None)
+        app.extensions["ann_index"] = self
+
+    def get_path(self, project_id):
+        """
+        Directory of the index of a project (or None if ANN_INDEX_DIR is not set).
+        """
+        if not has_app_context():
+            return None
+
+        index_dir = current_app.config.get("ANN_INDEX_DIR")
+        if not index_dir:
+            return None
+
+        return os.path.join(index_dir, str(project_id))
+
+    def get(self, project_id):
+        """
+        The ANNIndex of a project (or None).
+        """
+        path = self.get_path(project_id)
+        if path is None:
+            return None
+
+        try:
+            mtime = os.stat(os.path.join(path, ANNIndex.ID_ORDER_FN)).st_mtime
+        except FileNotFoundError:
+            return None
+
+        cached = self._indexes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        index = ANNIndex.load(path)
+        self._indexes[path] = (mtime, index)
+        return index
@@ -3,6 +3,7 @@ Created on 19.03.2018
 
 @author: mschroeder
 '''
+import hashlib
 import json
 import os
 import uuid
@@ -27,13 +28,15 @@ from flask_rq2.job import FlaskJob
 from marshmallow import ValidationError
 from redis.exceptions import RedisError
 from rq.queue import Queue
-from sklearn.manifold.isomap import Isomap
 from timer_cm import Timer
 
 from morphocluster import background, models
-from morphocluster.classifier import Classifier
-from morphocluster.extensions import database, redis_lru, rq
+from morphocluster.classifier import Classifier, farthest_from
+from morphocluster.extensions import (database, dirty_queue, node_cache,
+                                      redis_lru, result_cache, rq)
 from morphocluster.helpers import keydefaultdict, seq2array
+from morphocluster.processing.ordering import similarity_order
+from morphocluster.result_cache import decode_ordering, encode_ordering
 from morphocluster.schemas import JobSchema, LogSchema
 from morphocluster.tree import Tree
 
@@ -282,7 +285,7 @@ def create_node():
 
         print(data)
 
-        with connection.begin():
+        with tree.transaction():
             node_id = tree.create_node(
                 int(project_id), parent_id=parent_id, name=name, starred=starred)
 
@@ -301,14 +304,17 @@ def create_node():
         return jsonify(result)
 
 
-def _node(tree, node, include_children=False):
+def _node(tree, node, include_children=False, path=None):
     if node["name"] is None:
         node["name"] = node["node_id"]
 
+    if path is None:
+        path = tree.get_path_ids(node["node_id"])
+
     result = {
         "node_id": node["node_id"],
         "id": node["node_id"],
-        "path": tree.get_path_ids(node["node_id"]),
+        "path": path,
         "text": "{} ({})".format(node["name"], node["_n_children"]),
         "name": node["name"],
         "children": node["_n_children"] > 0,
@@ -323,10 +329,13 @@ def _node(tree, node, include_children=False):
         "parent_id": node["parent_id"],
         "project_id": node["project_id"],
         "filled": node["filled"],
+        # Cached values are outdated and will be updated in the background
+        "stale": node.get("stale", False),
     }
 
     if include_children:
-        result["children"] = [_node(tree, c)
+        # The path of a child extends the path of the node
+        result["children"] = [_node(tree, c, path=path + [c["node_id"]])
                               for c in tree.get_children(node["node_id"])]
 
     return result
@@ -336,36 +345,58 @@ def _object(object_):
     return {"object_id": object_["object_id"]}
 
 
-def _arrange_by_sim(result):
+def _member_key(member):
+    if "node_id" in member:
+        return "n{}".format(member["node_id"])
+    return "o{}".format(member["object_id"])
+
+
+def _arrange_by_sim(result, node_id=None, version=None):
     """
     Return empty tuple for unchanged order.
+
+    The ordering method is MEMBER_ORDERING (see processing.ordering).
+    If node_id is given, the order is memoized in redis_lru for the version
+    of the node and the set of members, i.e. until the membership changes.
     """
-    ISOMAP_FIT_SUBSAMPLE_N = 1000
-    ISOMAP_N_NEIGHBORS = 5
+    method = app.config.get("MEMBER_ORDERING", "isomap")
 
-    if len(result) <= ISOMAP_N_NEIGHBORS:
+    if len(result) <= 5:
         return ()
 
+    member_keys = [_member_key(m) for m in result]
+
+    cache_key = None
+    if node_id is not None:
+        digest = hashlib.sha1(
+            "\n".join(sorted(member_keys)).encode()).hexdigest()
+        cache_key = "arrange_by_sim:{}:{}:{}:{}".format(
+            node_id, version, method, digest)
+
+        try:
+            cached = redis_lru.get(cache_key)
+        except RedisError as e:
+            warnings.warn("RedisError: {}".format(e))
+            cached = None
+
+        if cached is not None:
+            rank = {k: i for i, k in enumerate(
+                json.loads(zlib.decompress(cached).decode()))}
+            return np.argsort([rank[k] for k in member_keys], kind="stable")
+
     # Get vector values
     vectors = seq2array([m["_centroid"] if "_centroid" in m else m["vector"] for m in result],
                         len(result))
 
-    if vectors.shape[0] <= ISOMAP_FIT_SUBSAMPLE_N:
-        subsample = vectors
-    else:
-        idxs = np.random.choice(
-            vectors.shape[0], ISOMAP_FIT_SUBSAMPLE_N, replace=False)
-        subsample = vectors[idxs]
+    order = similarity_order(vectors, method)
 
-    try:
-        isomap = Isomap(
-            n_components=1, n_neighbors=ISOMAP_N_NEIGHBORS, n_jobs=4).fit(subsample)
-        order = np.squeeze(isomap.transform(vectors))
-    except ValueError:
-        print(subsample)
-        raise
-
-    order = np.argsort(order)
+    if cache_key is not None:
+        try:
+            redis_lru.set(cache_key, zlib.compress(json.dumps(
+                [member_keys[i] for i in order]).encode()),
+                ex=app.config.get("MEMBER_ORDERING_TTL", 86400))
+        except RedisError as e:
+            warnings.warn("RedisError: {}".format(e))
 
     return order
 
@@ -377,78 +408,141 @@ def _arrange_by_nleaves(result):
     return np.argsort(n_leaves)[::-1]
 
 
+def _nodes(tree, nodes):
+    # Resolve all paths at once
+    paths = tree.get_paths(n["node_id"] for n in nodes)
+    return [_node(tree, n, path=paths[n["node_id"]]) for n in nodes]
+
+
 def _members(tree, members):
-    return [_node(tree, m) if "node_id" in m else _object(m) for m in members]
+    paths = tree.get_paths(m["node_id"] for m in members if "node_id" in m)
+    return [_node(tree, m, path=paths[m["node_id"]]) if "node_id" in m else _object(m)
+            for m in members]
 
 
-def _load_or_calc(func, func_kwargs, request_id, page, page_size=100, compress=True):
-    print("Load or calc {}...".format(func.__name__))
+def _paginate(result, page_size, compress):
+    """
+    Split a result into serialized (and compressed) pages.
+    """
+    pages = [json_dumps(p).encode() for p in batch(result, page_size)]
 
-    # If a request_id is given, load the result from the cache
-    if request_id is not None:
-        try:
-            cache_key = '{}:{}'.format(func.__name__,
-                                       request_id)
-            print("Loading cache key {}...".format(cache_key))
-            page_result = redis_lru.lindex(cache_key, page)
+    if compress:
+        pages = [zlib.compress(p) for p in pages]
+
+    return pages
 
-            if page_result is None:
-                raise ValueError("Unknown cache_key: {}".format(cache_key))
 
-            n_pages = redis_lru.llen(cache_key)
+def _cache_version(node_id):
+    with database.engine.connect() as connection:
+        return Tree(connection).get_cache_version(node_id)
+
+
+def _load_or_calc(func, func_kwargs, request_id, page, page_size=100, compress=True, unique=False,
+                  render=None):
+    """
+    Load a page of the result of func(**func_kwargs) or calculate the result.
+
+    If no request_id is given, it is derived from the function, its arguments and
+    the version of the node (see ResultCache), so that identical requests
+    share the cached result. If unique is True (nondeterministic results),
+    a random request_id is used.
+
+    If render is given, the result is paginated lazily: func only returns
+    the ordering (keys, scores) that is stored compactly (see result_cache.encode_ordering),
+    and a page is rendered by render([(key, score), ...]) when it is requested first.
+
+    Returns:
+        (page_result, n_pages, request_id)
+    """
+    print("Load or calc {}...".format(func.__name__))
+
+    cache = result_cache.cache
 
-            if compress:
-                page_result = zlib.decompress(page_result).decode()
+    def decode(page_result):
+        if page_result is None:
+            return "[]"
+        if compress:
+            page_result = zlib.decompress(page_result)
+        return page_result.decode()
 
-            #print("Returning page {} from cached result".format(page))
+    def serialize(items):
+        page_result = json_dumps(render(items)).encode()
+        return zlib.compress(page_result) if compress else page_result
 
-            return page_result, n_pages, request_id
+    render_page = None
+    if render is not None:
+        def render_page(order, page):
+            return serialize(decode_ordering(
+                order, page * page_size, (page + 1) * page_size))
 
+    # If a request_id is given, load the result from the cache
+    if request_id is not None:
+        try:
+            cached = cache.get_page(func.__name__, request_id, page, render_page)
         except RedisError as exc:
             raise ValueError(
-                "Could not retrieve cache_key: {}".format(cache_key)) from exc
+                "Could not retrieve request_id: {}".format(request_id)) from exc
 
-    # Otherwise calculate a result
-    request_id = uuid.uuid4().hex
-    cache_key = '{}:{}'.format(func.__name__, request_id)
+        if cached is None:
+            raise ValueError("Unknown request_id: {}".format(request_id))
 
-    # Calculate result
-    result = func(**func_kwargs)
+        page_result, n_pages = cached
 
-    # Paginate full_result
-    pages = batch(result, page_size)
+        return decode(page_result), n_pages, request_id
 
-    # Serialize individual pages
-    pages = [json_dumps(p) for p in pages]
+    def compute():
+        result = func(**func_kwargs)
 
-    n_pages = len(pages)
+        if render is None:
+            return _paginate(result, page_size, compress)
 
-    if n_pages:
-        if compress:
-            #raw_length = sum(len(p) for p in pages)
-            cache_pages = [zlib.compress(p.encode()) for p in pages]
-            #compressed_length = sum(len(p) for p in pages)
+        keys, scores = result
+        scores = np.asarray(scores, dtype=np.float32)
+        n_pages = (len(keys) + page_size - 1) // page_size
 
-            #print("Compressed pages. Ratio: {:.2%}".format(compressed_length / raw_length))
-        else:
-            cache_pages = pages
+        # Render the requested page directly
+        pages = {}
+        if 0 <= page < n_pages:
+            start = page * page_size
+            pages[page] = serialize(list(zip(
+                keys[start:start + page_size], scores[start:start + page_size].tolist())))
 
-        try:
-            redis_lru.rpush(cache_key, *cache_pages)
-        except RedisError as e:
-            warnings.warn("RedisError: {}".format(e))
+        return encode_ordering(keys, scores), n_pages, pages
 
-    if 0 <= page < n_pages:
-        return pages[page], n_pages, request_id
+    if unique:
+        request_id = uuid.uuid4().hex
+    else:
+        version = None
+        if func_kwargs.get("node_id") is not None:
+            version = _cache_version(func_kwargs["node_id"])
+        request_id = cache.make_request_id(func.__name__, func_kwargs, version)
 
-    return "[]", n_pages, request_id
+    try:
+        page_result, n_pages = cache.get_or_compute(
+            func.__name__, request_id, page, compute, render_page)
+    except RedisError as e:
+        warnings.warn("RedisError: {}".format(e))
+        result = compute()
+        if render is None:
+            page_result = result[page] if 0 <= page < len(result) else None
+            n_pages = len(result)
+        else:
+            _, n_pages, pages = result
+            page_result = pages.get(page)
 
+    return decode(page_result), n_pages, request_id
 
-def cache_serialize_page(endpoint, **kwargs):
+
+def cache_serialize_page(endpoint, unique=None, render=None, **kwargs):
     """
     `func` is expected to return a json-serializable list.
     It gains the `page` and `request_id` parameter. The resulting list is split into batches of `page_size` items.
 
+    Results are cached in the ResultCache (see _load_or_calc).
+    `unique(func_kwargs)` tells if a result is nondeterministic and must not be shared.
+    If `render` is given, func returns an ordering (keys, scores) and render(items)
+    renders the (key, score) items of a page (lazy pagination).
+
     Decorated Function:
         func: func(**kwargs) -> list
 
@@ -472,7 +566,8 @@ def cache_serialize_page(endpoint, **kwargs):
                 raise ValueError("page may not be None!")
 
             raw_result, n_pages, request_id = _load_or_calc(
-                func, func_kwargs, request_id, page, **kwargs)
+                func, func_kwargs, request_id, page,
+                unique=unique is not None and unique(func_kwargs), render=render, **kwargs)
 
             meta = {
                 'request_id': request_id,
@@ -556,10 +651,7 @@ def _arrange_by_starred_sim(result, starred):
         return ()
 
     try:
-        classifier = Classifier(starred_vectors)
-        distances = classifier.distances(vectors)
-        max_dist = np.max(distances, axis=0)
-        max_dist_idx = np.argsort(max_dist)[::-1]
+        max_dist_idx = farthest_from(starred_vectors, vectors)
 
         assert len(max_dist_idx) == len(result), "{} != {}".format(
             len(max_dist_idx), len(result))
@@ -572,7 +664,8 @@ def _arrange_by_starred_sim(result, starred):
         raise
 
 
-@cache_serialize_page(".get_node_members")
+@cache_serialize_page(".get_node_members",
+                      unique=lambda kwargs: kwargs.get("arrange_by") == "random")
 def _get_node_members(node_id, nodes=False, objects=False, arrange_by="", starred_first=False, descending=False):
     with database.engine.connect() as connection, Timer("_get_node_members") as timer:
         tree = Tree(connection)
@@ -595,9 +688,13 @@ def _get_node_members(node_id, nodes=False, objects=False, arrange_by="", starre
         if arrange_by != "":
             result = np.array(result, dtype=object)
 
+            if arrange_by in ("sim", "interleaved"):
+                # The memoized order is valid until the membership changes
+                version = tree.get_node(node_id, require_valid=False)["version"]
+
             if arrange_by == "sim":
                 with timer.child("sim"):
-                    order = _arrange_by_sim(result)
+                    order = _arrange_by_sim(result, node_id, version)
             elif arrange_by == "nleaves":
                 with timer.child("nleaves"):
                     order = _arrange_by_nleaves(result)
@@ -610,7 +707,7 @@ def _get_node_members(node_id, nodes=False, objects=False, arrange_by="", starre
                     order = _arrange_by_starred_sim(result, anchors)
             elif arrange_by == "interleaved":
                 with timer.child("interleaved"):
-                    order = _arrange_by_sim(result)
+                    order = _arrange_by_sim(result, node_id, version)
                     if len(order):
                         order0, order1 = np.array_split(order.copy(), 2)
                         order[::2] = order0
@@ -702,7 +799,7 @@ def get_node_stats(node_id):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        with connection.begin():
+        with tree.transaction():
             progress = tree.calculate_progress(node_id)
 
             if arguments["log"] is not None:
@@ -722,7 +819,7 @@ def post_node_members(node_id):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        with connection.begin():
+        with tree.transaction():
             tree.relocate_nodes(node_ids, node_id)
             tree.relocate_objects(object_ids, node_id)
 
@@ -763,7 +860,7 @@ def patch_node(node_id):
             raise ValueError(
                 "parent_id must not be set directly, use /nodes/<node_id>/adopt.")
 
-        with connection.begin():
+        with tree.transaction():
             tree.update_node(node_id, data)
 
             log(connection,
@@ -799,7 +896,7 @@ def node_adopt_members(parent_id):
         node_ids = [int(m["node_id"]) for m in members if "node_id" in m]
         object_ids = [m["object_id"] for m in members if "object_id" in m]
 
-        with connection.begin():
+        with tree.transaction():
             tree.relocate_nodes(node_ids, parent_id)
             tree.relocate_objects(object_ids, parent_id)
 
@@ -885,7 +982,7 @@ def accept_recommended_objects(node_id):
 
         with database.engine.connect() as connection:
             tree = Tree(connection)
-            with t.child("save accepted/rejected to database"), connection.begin():
+            with t.child("save accepted/rejected to database"), tree.transaction():
                 tree.relocate_objects(object_ids, node_id)
                 tree.reject_objects(node_id, rejected_object_ids)
 
@@ -903,8 +1000,7 @@ def accept_recommended_objects(node_id):
 def _node_get_recommended_children(node_id, max_n):
     with database.engine.connect() as connection:
         tree = Tree(connection)
-        result = [_node(tree, c)
-                  for c in tree.recommend_children(node_id, max_n=max_n)]
+        result = _nodes(tree, tree.recommend_children(node_id, max_n=max_n))
         return result
 
 
@@ -932,14 +1028,20 @@ def node_get_recommended_children(node_id):
     return _node_get_recommended_children(node_id=node_id, **arguments)
 
 
-@cache_serialize_page(".node_get_recommended_objects", page_size=50)
+def _render_recommended_objects(items):
+    return [_object({"object_id": object_id}) for object_id, _ in items]
+
+
+@cache_serialize_page(".node_get_recommended_objects", page_size=50,
+                      render=_render_recommended_objects)
 def _node_get_recommended_objects(node_id=None, max_n=None):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        result = [_object(o) for o in tree.recommend_objects(node_id, max_n)]
+        # Only the ranking is computed eagerly, the pages are rendered on demand
+        object_ids, scores = tree.rank_recommended_objects(node_id, max_n)
 
-        return result
+        return [str(o) for o in object_ids], scores
 
 
 @api.route("/nodes/<int:node_id>/recommended_objects", methods=["GET"])
@@ -1081,7 +1183,7 @@ def post_node_classify(node_id):
         tree = Tree(connection)
 
         # Split children into starred and unstarred
-        with connection.begin():
+        with tree.transaction():
             children = tree.get_children(node_id)
 
             starred = []
@@ -1134,8 +1236,8 @@ def post_node_classify(node_id):
                 objects = tree.get_objects(node_id)
                 print("Predicting {} objects of {}...".format(
                     len(objects), node_id))
-                object_vectors = np.array([o["vector"] for o in objects])
                 object_ids = np.array([o["object_id"] for o in objects])
+                object_vectors = tree.get_object_vectors(object_ids)
 
                 type_predicted = classifier.classify(
                     object_vectors, safe=flags["safe"])
@@ -1176,6 +1278,40 @@ def create_log_entry():
     return jsonify({})
 
 
+@api.route("/dirty_queue", methods=["GET"])
+def get_dirty_queue():
+    """
+    Metrics of the background consolidation (queue depth and lag, see DirtyQueue.metrics).
+    """
+    queue = dirty_queue.queue
+
+    if queue is None:
+        return jsonify({"enabled": False})
+
+    return jsonify(dict(queue.metrics(), enabled=True))
+
+
+@api.route("/node_cache", methods=["GET"])
+def get_node_cache():
+    """
+    Hit and miss counters of the node cache (see NodeCache.metrics).
+    """
+    cache = node_cache.cache
+
+    if cache is None:
+        return jsonify({"enabled": False})
+
+    return jsonify(dict(cache.metrics(), enabled=True))
+
+
+@api.route("/result_cache", methods=["GET"])
+def get_result_cache():
+    """
+    Hit and miss counters and size of the result cache (see ResultCache.metrics).
+    """
+    return jsonify(result_cache.cache.metrics())
+
+
 @api.route("/jobs", methods=["POST"])
 def create_job():
     data = JobSchema().load(request.get_json())
@@ -1,6 +1,7 @@
 import flask_rq2
 
-from morphocluster.extensions import database, rq
+from morphocluster.dirty_queue import process_dirty_queue
+from morphocluster.extensions import database, dirty_queue, rq
 from morphocluster.tree import Tree
 import os
 import datetime as dt
@@ -38,6 +39,28 @@ def export_project(project_id):
     return tree_fn
 
 
+@rq.job(timeout=7200)
+def consolidate_dirty(max_runtime=3600, requeue=True):
+    """
+    Consolidate the queued stale nodes bottom-up (see CONSOLIDATE_IN_BACKGROUND).
+
+    Polls the queue for max_runtime seconds and queues itself again afterwards,
+    so that the nodes are consolidated continuously.
+    """
+    queue = dirty_queue.queue
+    if queue is None:
+        raise ValueError("CONSOLIDATE_IN_BACKGROUND is not set.")
+
+    with database.engine.connect() as conn:
+        n_processed = process_dirty_queue(queue, Tree(conn), max_runtime=max_runtime,
+                                          n_workers=app.config["CONSOLIDATE_N_WORKERS"])
+
+    if requeue:
+        consolidate_dirty.queue(max_runtime=max_runtime, requeue=True)
+
+    return n_processed
+
+
 @rq.job(timeout=43200)
 def recluster_project(project_id, min_cluster_size):
     """
@@ -59,8 +82,11 @@ def recluster_project(project_id, min_cluster_size):
     recluster = Recluster()
     recluster.load_tree(tree)
 
-    for features_fn in config["RECLUSTER_FEATURES"]:
-        recluster.load_features(features_fn)
+    if config.get("FEATURE_STORE_PATH"):
+        recluster.load_feature_store(config["FEATURE_STORE_PATH"])
+    else:
+        for features_fn in config["RECLUSTER_FEATURES"]:
+            recluster.load_features(features_fn)
 
     # Cluster 1M objects maximum
     # sample_size = int(1e6)
@@ -82,7 +108,7 @@ def recluster_project(project_id, min_cluster_size):
     with database.engine.connect() as conn:
         db_tree = Tree(conn)
 
-        with conn.begin():
+        with db_tree.transaction():
             project_id = db_tree.load_project(
                 project_name, tree)
             root_id = db_tree.get_root_id(project_id)
@@ -5,19 +5,90 @@ Created on 27.03.2018
 '''
 
 import numpy as np
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import squareform, pdist, cdist
 
+#: Number of rows of X that are compared to the types at once (see farthest_from)
+CHUNK_SIZE = 4096
+
+
+def max_distances(types, X, chunk_size=CHUNK_SIZE):
+    """
+    Maximum euclidean distance of each row of X to any of the types.
+
+    X is processed in chunks, so that the distance matrix is never fully materialized.
+
+    Parameters:
+        types: ndarray of K types by D dimensions.
+        X: ndarray of N samples by D dimensions.
+
+    Returns:
+        ndarray of N distances.
+    """
+    types = np.asarray(types, dtype=float)
+    X = np.asarray(X, dtype=float)
+    types_sqnorm = np.einsum("kd,kd->k", types, types)
+
+    result = np.empty(X.shape[0])
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = X[start:start + chunk_size]
+        # |x|² - 2 x·t + |t|²
+        sqdist = types_sqnorm[np.newaxis, :] - 2 * (chunk @ types.T)
+        result[start:start + chunk_size] = (np.max(sqdist, axis=1)
+                                            + np.einsum("nd,nd->n", chunk, chunk))
+
+    return np.sqrt(np.maximum(result, 0))
+
+
+def farthest_from(types, X, n=None, chunk_size=CHUNK_SIZE):
+    """
+    Indices of the rows of X with the largest maximum distance to the types.
+
+    Parameters:
+        types: ndarray of K types by D dimensions.
+        X: ndarray of N samples by D dimensions.
+        n: Number of returned indices. All if None.
+
+    Returns:
+        ndarray of indices, ordered by decreasing distance.
+    """
+    max_dist = max_distances(types, X, chunk_size)
+
+    if n is None or n >= len(max_dist):
+        return np.argsort(max_dist)[::-1]
+
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Only sort the n farthest
+    top = np.argpartition(max_dist, -n)[-n:]
+    return top[np.argsort(max_dist[top])[::-1]]
+
+
 class Classifier(object):
     """
     This classifier assumes that all vectors are scaled to unit length.
     """
     def __init__(self, X):
         self.types = X
-        
-        # Calculate radius for each type
-        distances = squareform(pdist(X))
-        np.fill_diagonal(distances, np.inf)
-        self.radius = np.min(distances, axis=0)
+        self._radius = None
+
+    @property
+    def radius(self):
+        """
+        Distance of each type to its nearest other type (only needed by classify(safe=True)).
+
+        Calculated lazily using a KD-tree.
+        """
+        if self._radius is None:
+            if len(self.types) < 2:
+                self._radius = np.full(len(self.types), np.inf)
+            else:
+                # The nearest neighbor of each type is itself
+                distances, _ = cKDTree(self.types).query(self.types, k=2)
+                self._radius = distances[:, 1]
+
+        return self._radius
         
         
     def distances(self, X):
@@ -1,4 +1,3 @@
-import itertools
 import os
 from getpass import getpass
 
@@ -8,13 +7,19 @@ import h5py
 import pandas as pd
 from etaprogress.progress import ProgressBar
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import bindparam, select
+from sqlalchemy.sql.expression import select
 from timer_cm import Timer
 from werkzeug.security import generate_password_hash
 
-from morphocluster import models
-from morphocluster.extensions import database
-from morphocluster.tree import Tree
+from morphocluster import ingest, models
+from morphocluster.ann_index import ANNIndex
+from morphocluster.dirty_queue import process_dirty_queue
+from morphocluster.extensions import (ann_index, database, dirty_queue,
+                                      node_cache)
+from morphocluster.feature_store import FeatureStore, FeatureStoreError
+from morphocluster.processing.consolidation import CLUSTERERS
+from morphocluster.processing.prototypes import METRICS
+from morphocluster.tree import Tree, TreeError
 
 
 def _add_user(username, password):
@@ -62,6 +67,9 @@ def init_app(app):
             stmt = models.nodes.update().values(values)
             txn.execute(stmt)
 
+            if node_cache.cache is not None:
+                node_cache.cache.clear()
+
         print("Cache was cleared.")
 
     @app.cli.command()
@@ -87,63 +95,197 @@ def init_app(app):
 
     @app.cli.command()
     @click.argument('collection_fn')
-    def load_object_locations(collection_fn):
+    @click.option('--chunk-size', type=int, default=ingest.CHUNK_SIZE)
+    @click.option('--resume/--restart', default=True, help="Continue an interrupted ingestion.")
+    def load_object_locations(collection_fn, chunk_size, resume):
         """
         Load a collection of objects.
         """
-        # Load collections
-        with database.engine.begin() as txn:
+        with database.engine.connect() as conn:
             print("Loading {}...".format(collection_fn))
-            data = pd.read_csv(collection_fn,
-                               header=None,
-                               names=["object_id", "path", "label"],
-                               usecols=["object_id", "path"])
-
-            data_iter = data.itertuples()
-            bar = ProgressBar(len(data), max_width=40)
-            while True:
-                chunk = tuple(itertools.islice(data_iter, 5000))
-                if not chunk:
-                    break
-                txn.execute(models.objects.insert(),
-                            [row._asdict() for row in chunk])
-
-                bar.numerator += len(chunk)
-                print(bar, end="\r")
-            print()
+            ingest.load_object_locations(
+                conn, collection_fn, chunk_size=chunk_size, resume=resume)
             print("Done.")
 
     @app.cli.command()
     @click.argument('features_fns', nargs=-1)
-    def load_features(features_fns):
+    @click.option('--chunk-size', type=int, default=ingest.CHUNK_SIZE)
+    @click.option('--resume/--restart', default=True, help="Continue an interrupted ingestion.")
+    def load_features(features_fns, chunk_size, resume):
         """
         Load object features from an HDF5 file.
         """
+        with database.engine.connect() as conn:
+            for features_fn in features_fns:
+                print("Loading {}...".format(features_fn))
+                ingest.load_features(
+                    conn, features_fn, chunk_size=chunk_size, resume=resume)
+                print("Done.")
+
+    @app.cli.command()
+    @click.argument('features_fns', nargs=-1)
+    @click.option('--path', default=None, help="Store directory (default: FEATURE_STORE_PATH).")
+    def build_feature_store(features_fns, path):
+        """
+        Append object features from HDF5 files to the memory-mapped feature store.
+        """
+        if path is None:
+            path = app.config["FEATURE_STORE_PATH"]
+
+        if not path:
+            raise click.UsageError("Neither --path nor FEATURE_STORE_PATH is set.")
+
+        store = None
         for features_fn in features_fns:
             print("Loading {}...".format(features_fn))
-            with h5py.File(features_fn, "r", libver="latest") as f_features, database.engine.begin() as conn:
-                object_ids = f_features["objids"]
-                vectors = f_features["features"]
-
-                stmt = (models.objects.update()
-                        .where(models.objects.c.object_id == bindparam('_object_id'))
-                        .values({
-                            'vector': bindparam('vector')
-                        }))
-
-                bar = ProgressBar(len(object_ids), max_width=40)
-                obj_iter = iter(zip(object_ids, vectors))
-                while True:
-                    chunk = tuple(itertools.islice(obj_iter, 1000))
-                    if not chunk:
-                        break
-                    conn.execute(stmt, [{"_object_id": str(object_id), "vector": vector} for (
-                        object_id, vector) in chunk])
-
-                    bar.numerator += len(chunk)
-                    print(bar, end="\r")
-                print()
-                print("Done.")
+
+            with h5py.File(features_fn, "r", libver="latest") as f_features:
+                n_objects, n_features = f_features["features"].shape
+
+            if store is None:
+                try:
+                    store = FeatureStore(path, "a")
+                except FeatureStoreError:
+                    store = FeatureStore.create(path, n_features)
+
+            bar = ProgressBar(n_objects, max_width=40)
+
+            def progress_cb(n):
+                bar.numerator += n
+                print(bar, end="\r")
+
+            store.append_hdf5(features_fn, progress_cb=progress_cb)
+            print()
+            print("Done. The store contains {:,d} objects.".format(len(store)))
+
+    @app.cli.command()
+    @click.argument('project_ids', nargs=-1, type=int)
+    @click.option('--n-lists', type=int, default=None, help="Number of lists (default: sqrt(n_objects)).")
+    def build_ann_index(project_ids, n_lists):
+        """
+        Build the nearest neighbour index of the given (default: all) projects.
+        """
+        index_dir = app.config["ANN_INDEX_DIR"]
+        if not index_dir:
+            raise click.UsageError("ANN_INDEX_DIR is not set.")
+
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            if not project_ids:
+                project_ids = [p["project_id"]
+                               for p in tree.get_projects(visible_only=False)]
+
+            for project_id in project_ids:
+                with Timer("Project {}".format(project_id)) as timer:
+                    with timer.child("Query objects"):
+                        object_ids, node_ids, vectors = tree.get_project_objects(
+                            project_id)
+
+                    print("Indexing {:,d} objects...".format(len(object_ids)))
+
+                    if not len(object_ids):
+                        continue
+
+                    with timer.child("Build"):
+                        index = ANNIndex.build(
+                            object_ids, vectors, node_ids, n_lists=n_lists)
+
+                    with timer.child("Save"):
+                        index.save(ann_index.get_path(project_id))
+
+    @app.cli.command()
+    @click.argument('project_ids', nargs=-1, type=int)
+    def rebuild_closure(project_ids):
+        """
+        Rebuild the closure table of the given (default: all) projects.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            if not project_ids:
+                project_ids = [p["project_id"]
+                               for p in tree.get_projects(visible_only=False)]
+
+            for project_id in project_ids:
+                n_rows = tree.rebuild_closure(project_id)
+                print("Project {}: {:,d} rows.".format(project_id, n_rows))
+
+    @app.cli.command()
+    @click.argument('project_ids', nargs=-1, type=int)
+    def rebuild_progress(project_ids):
+        """
+        Recompute the progress counters of the given (default: all) projects.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            if not project_ids:
+                project_ids = [p["project_id"]
+                               for p in tree.get_projects(visible_only=False)]
+
+            for project_id in project_ids:
+                counters = tree.rebuild_progress(tree.get_root_id(project_id))
+                print("Project {}: {:,d} nodes.".format(
+                    project_id, len(counters)))
+
+    @app.cli.command()
+    @click.argument('project_id', type=int)
+    @click.option('--n-prototypes', type=int, default=None, help="Number of prototypes per node.")
+    @click.option('--clusterer', type=click.Choice(CLUSTERERS), default=None,
+                  help="Clusterer of the prototypes of the own objects of a node.")
+    @click.option('--sample-size', type=int, default=None,
+                  help="Maximum number of objects per node used to calculate cached values.")
+    @click.option('--metric', type=click.Choice(METRICS), default=None,
+                  help="Metric of the merging of prototypes and of recommendations.")
+    def prototype_settings(project_id, n_prototypes, clusterer, sample_size, metric):
+        """
+        Show or change the prototype settings of a project.
+
+        Changes invalidate the cached values of the whole project.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            try:
+                tree.set_prototype_settings(project_id, n_prototypes=n_prototypes, clusterer=clusterer,
+                                            sample_size=sample_size, metric=metric)
+            except TreeError as exc:
+                raise click.ClickException(str(exc)) from exc
+
+            print("Project {}: {}".format(
+                project_id, tree.get_prototype_settings(project_id)))
+
+    @app.cli.command()
+    @click.argument('project_ids', nargs=-1, type=int)
+    def check_progress(project_ids):
+        """
+        Verify the progress counters of the given (default: all) projects against a full recomputation.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            if not project_ids:
+                project_ids = [p["project_id"]
+                               for p in tree.get_projects(visible_only=False)]
+
+            n_inconsistent = 0
+            for project_id in project_ids:
+                inconsistent = tree.check_progress(
+                    tree.get_root_id(project_id))
+
+                if len(inconsistent):
+                    print("Project {}: {:,d} inconsistent nodes:".format(
+                        project_id, len(inconsistent)))
+                    print(inconsistent.head(20).to_string())
+                else:
+                    print("Project {}: OK".format(project_id))
+
+                n_inconsistent += len(inconsistent)
+
+            if n_inconsistent:
+                raise click.ClickException(
+                    "{:,d} inconsistent nodes. Run rebuild-progress to fix them.".format(n_inconsistent))
 
     @app.cli.command()
     @click.argument('tree_fn')
@@ -160,7 +302,7 @@ def init_app(app):
             if project_name is None:
                 project_name = os.path.basename(os.path.splitext(tree_fn)[0])
 
-            with conn.begin():
+            with tree.transaction():
                 print("Loading {}...".format(
                     tree_fn))
                 project_id = tree.load_project(
@@ -233,7 +375,12 @@ def init_app(app):
 
     @app.cli.command()
     @click.argument('root_id', default="visible", callback=validate_consolidate_root_id)
-    def consolidate(root_id):
+    @click.option('--workers', "n_workers", type=int, default=None,
+                  help="Number of processes for prototype fitting (default: CONSOLIDATE_N_WORKERS).")
+    def consolidate(root_id, n_workers):
+        if n_workers is None:
+            n_workers = app.config["CONSOLIDATE_N_WORKERS"]
+
         with database.engine.connect() as conn, Timer("Consolidate") as timer:
             tree = Tree(conn)
 
@@ -250,9 +397,33 @@ def init_app(app):
             for rid in root_ids:
                 with timer.child(str(rid)):
                     print("Consolidating {}...".format(rid))
-                    tree.consolidate_node(rid)
+                    tree.consolidate_node(rid, n_workers=n_workers)
             print("Done.")
 
+    @app.cli.command()
+    @click.option('--max-runtime', type=float, default=None,
+                  help="Keep polling for this many seconds (default: stop when the queue is empty).")
+    @click.option('--workers', "n_workers", type=int, default=None,
+                  help="Number of processes for prototype fitting (default: CONSOLIDATE_N_WORKERS).")
+    def consolidate_dirty(max_runtime, n_workers):
+        """
+        Consolidate the queued stale nodes bottom-up (see CONSOLIDATE_IN_BACKGROUND).
+        """
+        queue = dirty_queue.queue
+        if queue is None:
+            raise click.ClickException("CONSOLIDATE_IN_BACKGROUND is not set.")
+
+        if n_workers is None:
+            n_workers = app.config["CONSOLIDATE_N_WORKERS"]
+
+        print("Queue: {}".format(queue.metrics()))
+
+        with database.engine.connect() as conn:
+            n_processed = process_dirty_queue(queue, Tree(conn), max_runtime=max_runtime,
+                                              n_workers=n_workers)
+
+        print("Consolidated {:d} nodes.".format(n_processed))
+
     @app.cli.command()
     @click.argument('username')
     def add_user(username):
@@ -0,0 +1,190 @@
+"""
+Compact binary column types for NumPy data.
+
+Vectors are stored as raw little-endian float32 bytes in a `bytea` column.
+This is about half the size of a pickled float64 array and can be decoded
+without unpickling, e.g. for many rows at once using `decode_vectors`.
+"""
+
+import struct
+
+import numpy as np
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+from morphocluster.processing.prototypes import (IncrementalPrototypes,
+                                                 Prototypes)
+
+#: dtype of stored vectors
+VECTOR_DTYPE = np.dtype("<f4")
+
+#: dtype of stored prototype support
+SUPPORT_DTYPE = np.dtype("<f8")
+
+# Header of stored prototypes: number of prototypes, number of features
+_PROTOTYPES_HEADER = struct.Struct("<II")
+
+# Trailer of stored incremental prototypes: weight_, n_fit_, n_changed_, n_added_, error_, inertia_
+_INCREMENTAL_FIELDS = ("weight_", "n_fit_", "n_changed_",
+                       "n_added_", "error_", "inertia_")
+_INCREMENTAL_TRAILER = struct.Struct("<6d")
+
+
+def encode_vector(vector):
+    """
+    Encode a vector as raw float32 bytes.
+    """
+    return np.ascontiguousarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def decode_vector(buffer):
+    """
+    Decode raw float32 bytes into a (read-only) vector without copying.
+    """
+    return np.frombuffer(buffer, dtype=VECTOR_DTYPE)
+
+
+def decode_vectors(buffers, n_features=None):
+    """
+    Decode a sequence of raw vectors into a single array of shape = [n_vectors, n_features].
+
+    All vectors are copied into one preallocated buffer that is then
+    interpreted using np.frombuffer.
+    """
+    buffers = list(buffers)
+
+    if not buffers:
+        return np.empty((0, n_features or 0), dtype=VECTOR_DTYPE)
+
+    itemsize = len(buffers[0])
+    if n_features is None:
+        n_features = itemsize // VECTOR_DTYPE.itemsize
+
+    if itemsize != n_features * VECTOR_DTYPE.itemsize:
+        raise ValueError("Vector size does not match n_features.")
+
+    data = bytearray(itemsize * len(buffers))
+    for i, b in enumerate(buffers):
+        if len(b) != itemsize:
+            raise ValueError(
+                "Vector {:d} has a different size: {:d} != {:d}".format(i, len(b), itemsize))
+        data[i * itemsize:(i + 1) * itemsize] = b
+
+    return np.frombuffer(data, dtype=VECTOR_DTYPE).reshape(len(buffers), n_features)
+
+
+def encode_prototypes(prototypes):
+    """
+    Encode a fitted Prototypes object.
+
+    Layout: header (k, d), k*d float32 prototypes, k float64 support.
+    """
+    prototypes_ = np.ascontiguousarray(prototypes.prototypes_, VECTOR_DTYPE)
+    support_ = np.ascontiguousarray(prototypes.support_, SUPPORT_DTYPE)
+
+    if prototypes_.ndim != 2 or support_.shape != prototypes_.shape[:1]:
+        raise ValueError("Invalid prototypes: {} / {}".format(
+            prototypes_.shape, support_.shape))
+
+    return (_PROTOTYPES_HEADER.pack(*prototypes_.shape)
+            + prototypes_.tobytes()
+            + support_.tobytes())
+
+
+def decode_prototypes(buffer):
+    """
+    Decode a Prototypes object encoded with encode_prototypes.
+    """
+    k, d = _PROTOTYPES_HEADER.unpack_from(buffer)
+
+    offset = _PROTOTYPES_HEADER.size
+    prototypes_ = np.frombuffer(
+        buffer, VECTOR_DTYPE, k * d, offset).reshape(k, d)
+
+    offset += prototypes_.nbytes
+    support_ = np.frombuffer(buffer, SUPPORT_DTYPE, k, offset)
+
+    result = Prototypes(None)
+    result.prototypes_ = prototypes_
+    result.support_ = support_
+
+    return result
+
+
+def encode_incremental_prototypes(prototypes):
+    """
+    Encode an IncrementalPrototypes object.
+
+    Layout: encode_prototypes, followed by the statistics of the updates (6 float64).
+    The sums are restored from the prototypes and their support.
+    """
+    return (encode_prototypes(prototypes)
+            + _INCREMENTAL_TRAILER.pack(*(getattr(prototypes, f) for f in _INCREMENTAL_FIELDS)))
+
+
+def decode_incremental_prototypes(buffer):
+    """
+    Decode an IncrementalPrototypes object encoded with encode_incremental_prototypes.
+    """
+    prots = decode_prototypes(buffer)
+
+    result = IncrementalPrototypes(None)
+    result.prototypes_ = prots.prototypes_.astype(float)
+    result.support_ = prots.support_.copy()
+    result.sums_ = result.prototypes_ * result.support_[:, np.newaxis]
+
+    offset = len(buffer) - _INCREMENTAL_TRAILER.size
+    for field, value in zip(_INCREMENTAL_FIELDS, _INCREMENTAL_TRAILER.unpack_from(buffer, offset)):
+        setattr(result, field, value)
+
+    return result
+
+
+class Vector(TypeDecorator):
+    """
+    A vector stored as raw float32 bytes.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_vector(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_vector(value)
+
+
+class PrototypesType(TypeDecorator):
+    """
+    A Prototypes object stored as raw bytes.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_prototypes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_prototypes(value)
+
+
+class IncrementalPrototypesType(TypeDecorator):
+    """
+    An IncrementalPrototypes object stored as raw bytes.
+    """
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_incremental_prototypes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_incremental_prototypes(value)
@@ -24,3 +24,65 @@ RECLUSTER_FEATURES = [
 # Save the results of accept_recommended_objects
 # to enable the calculation of scores like average precision
 SAVE_RECOMMENDATION_STATS = False
+
+# Number of processes used to fit prototypes in `flask consolidate`
+CONSOLIDATE_N_WORKERS = 1
+
+# Directory of a memory-mapped feature store (see `flask build-feature-store`).
+# If None, object vectors are read from the database.
+FEATURE_STORE_PATH = None
+
+# Directory of the approximate nearest neighbour indexes of the projects
+# (see `flask build-ann-index`).
+# If None, Tree.recommend_objects scans all candidate objects.
+ANN_INDEX_DIR = None
+
+# Use the closure table (nodes_closure) for ancestor and subtree queries
+# instead of recursive CTEs. The table is maintained in any case.
+TREE_USE_CLOSURE = True
+
+# Granularity of the locks of tree modifications:
+# "subtree": Advisory locks on the modified nodes and their ancestors
+#   (modifications of disjoint subtrees proceed concurrently, readers are not blocked).
+# "project": One lock per project (modifications and consolidations are serialized).
+TREE_LOCKING = "subtree"
+
+# Cache node records, children and paths in the Redis of REDIS_LRU_URL
+# (see node_cache.NodeCache and the /api/node_cache metrics).
+# NODE_CACHE_TTL: Lifetime of the entries in seconds.
+# NODE_CACHE_GRACE: Evicted nodes are not cached again for this many seconds
+#   (has to exceed the duration of a read, the evictions are repeated after the commit).
+NODE_CACHE = False
+NODE_CACHE_TTL = 3600
+NODE_CACHE_GRACE = 10
+
+# Ordering of the members of a node for arrange_by="sim" and "interleaved"
+# (see processing.ordering and benchmarks/bench_member_ordering.py):
+# "isomap": 1-D Isomap embedding. "pca": First principal component.
+# "chain": Greedy nearest-neighbour chain.
+# The order is memoized in the Redis of REDIS_LRU_URL for MEMBER_ORDERING_TTL seconds
+# (or until the members of the node change).
+MEMBER_ORDERING = "isomap"
+MEMBER_ORDERING_TTL = 86400
+
+# Paginated results (members and recommendations of a node) are cached in the Redis
+# of REDIS_LRU_URL under a key derived from the request and the version of the node
+# (see result_cache.ResultCache and the /api/result_cache metrics).
+# RESULT_CACHE_TTL: Lifetime of the entries in seconds.
+# RESULT_CACHE_MAX_BYTES: Maximum total size of the entries (the oldest are evicted first).
+# RESULT_CACHE_LOCK_TIMEOUT: Maximum duration of a computation that concurrent
+#   identical requests wait for (in seconds).
+RESULT_CACHE_TTL = 3600
+RESULT_CACHE_MAX_BYTES = 512 * 2 ** 20
+RESULT_CACHE_LOCK_TIMEOUT = 120
+
+# Consolidate stale nodes in the background (see `flask consolidate-dirty` and
+# background.consolidate_dirty) instead of when they are read.
+# Readers get the last cached values with a `stale` flag.
+CONSOLIDATE_IN_BACKGROUND = False
+
+# Method of merging the prototypes of the children of a node (see processing.prototypes.merge_prototypes):
+# "complete": Complete-linkage clustering (O(n²) in the number of prototypes of all children).
+# "kmeans": Weighted k-means. "hierarchical": Complete linkage in groups of children.
+# (See benchmarks/bench_merge_prototypes.py.)
+MERGE_PROTOTYPES_METHOD = "complete"
@@ -0,0 +1,196 @@
+"""
+Queue of nodes with stale cached values for the background consolidation.
+
+Modifications (see Tree._record_modification) push the nodes on the modified
+paths. The queue is a Redis sorted set (scored by the depth of the node), so
+that every node is queued at most once and the deepest nodes are consolidated
+first (bottom-up, see process_dirty_queue). A second sorted set records when
+each node was queued first (for the lag).
+
+    <key>: node_id -> depth
+    <key>:since: node_id -> time of the first push (seconds since epoch)
+    <key>:stats: Hash with n_processed, n_failed, last_processed, last_lag
+"""
+
+import time
+
+from flask import current_app, has_app_context
+
+
+class DirtyQueue:
+    """
+    Deduplicated queue of nodes with stale cached values.
+
+    Parameters:
+        redis: Redis connection.
+        key: Name of the sorted set.
+    """
+
+    def __init__(self, redis, key="morphocluster:dirty"):
+        self.redis = redis
+        self.key = key
+        self.since_key = key + ":since"
+        self.stats_key = key + ":stats"
+
+    def push(self, depths):
+        """
+        Queue nodes.
+
+        Parameters:
+            depths: dict node_id -> depth of the node.
+        """
+        if not depths:
+            return
+
+        depths = {int(node_id): int(depth) for node_id, depth in depths.items()}
+        now = time.time()
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.key, depths)
+        pipe.zadd(self.since_key, {node_id: now for node_id in depths}, nx=True)
+        pipe.execute()
+
+    def pop(self):
+        """
+        Remove the deepest node from the queue.
+
+        Returns:
+            (node_id, depth, since) or None if the queue is empty.
+        """
+        popped = self.redis.zpopmax(self.key)
+        if not popped:
+            return None
+
+        (node_id, depth), = popped
+
+        pipe = self.redis.pipeline()
+        pipe.zscore(self.since_key, node_id)
+        pipe.zrem(self.since_key, node_id)
+        since, _ = pipe.execute()
+
+        return int(node_id), int(depth), since
+
+    def record(self, since, failed=False):
+        """
+        Record the consolidation of a popped node.
+        """
+        now = time.time()
+
+        pipe = self.redis.pipeline()
+        pipe.hincrby(self.stats_key, "n_failed" if failed else "n_processed")
+        pipe.hset(self.stats_key, "last_processed", now)
+        if since is not None:
+            pipe.hset(self.stats_key, "last_lag", now - since)
+        pipe.execute()
+
+    def metrics(self):
+        """
+        Metrics of the queue.
+
+        Returns:
+            dict with
+                n_dirty: Number of queued nodes.
+                max_depth: Depth of the deepest queued node (or None).
+                lag: Age of the oldest queued node in seconds (0 if empty).
+                n_processed, n_failed: Number of consolidated (failed) nodes.
+                last_processed: Time of the last consolidation (or None).
+                last_lag: Time that the last consolidated node spent in the queue (or None).
+        """
+        pipe = self.redis.pipeline()
+        pipe.zcard(self.key)
+        pipe.zrange(self.key, -1, -1, withscores=True)
+        pipe.zrange(self.since_key, 0, 0, withscores=True)
+        pipe.hgetall(self.stats_key)
+        n_dirty, deepest, oldest, stats = pipe.execute()
+
+        stats = {k.decode(): float(v) for k, v in stats.items()}
+
+        return {
+            "n_dirty": n_dirty,
+            "max_depth": int(deepest[0][1]) if deepest else None,
+            "lag": time.time() - oldest[0][1] if oldest else 0,
+            "n_processed": int(stats.get("n_processed", 0)),
+            "n_failed": int(stats.get("n_failed", 0)),
+            "last_processed": stats.get("last_processed"),
+            "last_lag": stats.get("last_lag"),
+        }
+
+
+def process_dirty_queue(queue, tree, max_runtime=None, poll_interval=1.0, n_workers=1):
+    """
+    Consolidate queued nodes bottom-up (deepest first).
+
+    Parameters:
+        queue: DirtyQueue.
+        tree: Tree (with a connection of its own).
+        max_runtime: Stop after this many seconds. If None, stop when the queue is empty.
+        poll_interval: Waiting time if the queue is empty (if max_runtime is not None).
+        n_workers: Number of processes used to fit prototypes (see Tree.consolidate_node).
+
+    Returns:
+        Number of consolidated nodes.
+    """
+    start = time.time()
+    n_processed = 0
+
+    while max_runtime is None or time.time() - start < max_runtime:
+        item = queue.pop()
+
+        if item is None:
+            if max_runtime is None:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        node_id, _, since = item
+
+        try:
+            tree.consolidate_node(node_id, n_workers=n_workers)
+        except Exception as e:  # pylint: disable=broad-except
+            # E.g. the node was deleted in the meantime
+            print("Consolidation of node {} failed: {}".format(node_id, e))
+            queue.record(since, failed=True)
+            continue
+
+        queue.record(since)
+        n_processed += 1
+
+    return n_processed
+
+
+class FlaskDirtyQueue:
+    """
+    Flask extension that provides the DirtyQueue (in the Redis of RQ)
+    if CONSOLIDATE_IN_BACKGROUND is set.
+
+    Otherwise, `queue` is None and nodes are consolidated when they are read.
+    """
+
+    def __init__(self, app=None):
+        self._queues = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CONSOLIDATE_IN_BACKGROUND", False)
+        app.extensions["dirty_queue"] = self
+
+    @property
+    def queue(self):
+        """
+        The DirtyQueue of the current app (or None).
+        """
+        if not has_app_context():
+            return None
+
+        if not current_app.config.get("CONSOLIDATE_IN_BACKGROUND"):
+            return None
+
+        from morphocluster.extensions import rq
+
+        try:
+            return self._queues[rq.redis_url]
+        except KeyError:
+            queue = self._queues[rq.redis_url] = DirtyQueue(rq.connection)
+            return queue
@@ -9,7 +9,18 @@ from flask_redis import FlaskRedis
 from flask_migrate import Migrate
 from flask_rq2 import RQ
 
+from morphocluster.ann_index import FlaskANNIndex
+from morphocluster.dirty_queue import FlaskDirtyQueue
+from morphocluster.feature_store import FlaskFeatureStore
+from morphocluster.node_cache import FlaskNodeCache
+from morphocluster.result_cache import FlaskResultCache
+
 database = SQLAlchemy()
 redis_lru = FlaskRedis(config_prefix="REDIS_LRU")
 migrate = Migrate()
 rq = RQ()
+feature_store = FlaskFeatureStore()
+ann_index = FlaskANNIndex()
+dirty_queue = FlaskDirtyQueue()
+node_cache = FlaskNodeCache()
+result_cache = FlaskResultCache()
@@ -0,0 +1,400 @@
+"""
+Memory-mapped on-disk store for object vectors.
+
+The store is a directory containing
+    features.f4: Append-only raw float32 matrix of shape [n_rows, n_features].
+    index_ids.<generation>.npy: Sorted object_ids.
+    index_rows.<generation>.npy: Row in features.f4 for each entry of index_ids.
+    meta.json: n_features, the number of valid rows and the generation of the index.
+
+A commit writes the index of a new generation and then replaces meta.json, so
+meta.json is the commit point: Readers either see the old or the new state,
+never the index of one and the number of rows of the other.
+The index of the previous generation is kept for readers that are still opening it.
+
+The matrix is mapped read-only, so that several processes (e.g. gunicorn workers)
+share the same pages of the OS page cache.
+Vectors are gathered with fancy indexing on the mapped matrix.
+"""
+
+import json
+import os
+
+import h5py
+import numpy as np
+from flask import current_app, has_app_context
+
+#: dtype of the stored vectors
+FEATURE_DTYPE = np.dtype("<f4")
+
+
+def _save_atomic(fn, arr):
+    """
+    Save an array so that readers either see the old or the new file.
+    """
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_fn, fn)
+
+
+class FeatureStoreError(Exception):
+    """
+    Raised by FeatureStore if an error occurs.
+    """
+    pass
+
+
+class FeatureStore:
+    """
+    Append-only memory-mapped float32 matrix with an object_id -> row index.
+
+    Parameters:
+        path: Directory of the store.
+        mode: "r" (read-only) or "a" (append).
+    """
+
+    FEATURES_FN = "features.f4"
+    INDEX_IDS_FN = "index_ids.{}npy"
+    INDEX_ROWS_FN = "index_rows.{}npy"
+    META_FN = "meta.json"
+
+    @staticmethod
+    def _index_fns(path, generation):
+        """
+        Filenames of the index of a generation.
+
+        Stores without a generation (None) use index_ids.npy and index_rows.npy.
+        """
+        infix = "{:d}.".format(generation) if generation is not None else ""
+        return (os.path.join(path, FeatureStore.INDEX_IDS_FN.format(infix)),
+                os.path.join(path, FeatureStore.INDEX_ROWS_FN.format(infix)))
+
+    @staticmethod
+    def create(path, n_features):
+        """
+        Create an empty store.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.exists(os.path.join(path, FeatureStore.META_FN)):
+            raise FeatureStoreError("Store already exists: {}".format(path))
+
+        open(os.path.join(path, FeatureStore.FEATURES_FN), "wb").close()
+        index_ids_fn, index_rows_fn = FeatureStore._index_fns(path, 0)
+        _save_atomic(index_ids_fn, np.empty(0, dtype="U1"))
+        _save_atomic(index_rows_fn, np.empty(0, dtype=np.int64))
+        FeatureStore._write_meta(path, {"n_features": int(n_features),
+                                        "n_rows": 0, "generation": 0})
+
+        return FeatureStore(path, "a")
+
+    @staticmethod
+    def _write_meta(path, meta):
+        # Write atomically, so that readers never see a partial file
+        tmp_fn = os.path.join(path, FeatureStore.META_FN + ".tmp")
+        with open(tmp_fn, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fn, os.path.join(path, FeatureStore.META_FN))
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError("Unknown mode: {}".format(mode))
+
+        self.path = path
+        self.mode = mode
+        self._load()
+
+    def _load(self):
+        # The index of the generation in meta.json may have been removed by
+        # two commits in the meantime, read meta.json again in this case
+        for retry in range(3):
+            try:
+                self._load_generation()
+                return
+            except FileNotFoundError:
+                if retry == 2:
+                    raise
+
+    def _load_generation(self):
+        try:
+            with open(os.path.join(self.path, self.META_FN)) as f:
+                # Identity of the loaded meta.json (see FlaskFeatureStore)
+                self.meta_stat = os.fstat(f.fileno())
+                meta = json.load(f)
+        except FileNotFoundError as exc:
+            raise FeatureStoreError(
+                "No feature store at {}".format(self.path)) from exc
+
+        self.generation = meta.get("generation")
+
+        self.n_features = meta["n_features"]
+        # Rows beyond n_rows stem from an interrupted append and are ignored
+        self.n_rows = meta["n_rows"]
+
+        if self.n_rows:
+            self.vectors = np.memmap(os.path.join(self.path, self.FEATURES_FN),
+                                     dtype=FEATURE_DTYPE, mode="r",
+                                     shape=(self.n_rows, self.n_features))
+        else:
+            self.vectors = np.empty((0, self.n_features), FEATURE_DTYPE)
+
+        index_ids_fn, index_rows_fn = self._index_fns(self.path, self.generation)
+        self._index_ids = np.load(index_ids_fn, mmap_mode="r")
+        self._index_rows = np.load(index_rows_fn, mmap_mode="r")
+
+    def __len__(self):
+        """
+        Number of distinct objects.
+        """
+        return len(self._index_ids)
+
+    def __contains__(self, object_id):
+        return self.get_rows([object_id])[0] >= 0
+
+    @property
+    def object_ids(self):
+        """
+        Sorted object_ids of the store.
+        """
+        return self._index_ids
+
+    def get_rows(self, object_ids):
+        """
+        Get the rows of object_ids.
+
+        Returns:
+            array of shape = [n_objects]. -1 for unknown objects.
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+
+        if not len(self._index_ids) or not len(object_ids):
+            return np.full(len(object_ids), -1, dtype=np.int64)
+
+        idx = np.searchsorted(self._index_ids, object_ids)
+        idx = np.minimum(idx, len(self._index_ids) - 1)
+        found = self._index_ids[idx] == object_ids
+
+        return np.where(found, self._index_rows[idx], -1)
+
+    def get_vectors(self, object_ids, missing="raise"):
+        """
+        Gather the vectors of object_ids.
+
+        Parameters:
+            missing: "raise" | "nan" | "mask"
+                What to do with objects that are not in the store.
+                "mask" additionally returns a boolean mask of the found objects
+                and only their vectors.
+
+        Returns:
+            array of shape = [n_objects, n_features] (and the mask, if missing="mask").
+        """
+        rows = self.get_rows(object_ids)
+        found = rows >= 0
+
+        if missing == "raise" and not found.all():
+            raise KeyError("Unknown objects: {!r}".format(
+                np.asarray(object_ids)[~found][:10].tolist()))
+
+        # Read the rows in storage order for a better locality
+        found_rows = rows[found]
+        order = np.argsort(found_rows, kind="stable")
+        found_vectors = np.empty((len(found_rows), self.n_features), FEATURE_DTYPE)
+        found_vectors[order] = self.vectors[found_rows[order]]
+
+        if missing == "mask":
+            return found_vectors, found
+
+        if missing == "nan":
+            vectors = np.full((len(rows), self.n_features),
+                              np.nan, FEATURE_DTYPE)
+            vectors[found] = found_vectors
+            return vectors
+
+        return found_vectors
+
+    def live_rows(self):
+        """
+        Rows that are referenced by the index (i.e. not shadowed by a later append).
+
+        Returns:
+            (rows, object_ids) in storage order.
+        """
+        order = np.argsort(self._index_rows, kind="stable")
+        return np.asarray(self._index_rows)[order], np.asarray(self._index_ids)[order]
+
+    def append(self, object_ids, vectors):
+        """
+        Append vectors. Existing object_ids are shadowed by the new rows.
+        """
+        if self.mode != "a":
+            raise FeatureStoreError("Store is read-only.")
+
+        object_ids = np.asarray(object_ids, dtype=str)
+        vectors = np.ascontiguousarray(vectors, dtype=FEATURE_DTYPE)
+
+        if vectors.shape != (len(object_ids), self.n_features):
+            raise ValueError("Expected vectors of shape {}, got {}".format(
+                (len(object_ids), self.n_features), vectors.shape))
+
+        if not len(object_ids):
+            return
+
+        # Append data (truncating leftovers of an interrupted append)
+        with open(os.path.join(self.path, self.FEATURES_FN), "r+b") as f:
+            f.truncate(self.n_rows * self.n_features * FEATURE_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        new_rows = np.arange(self.n_rows, self.n_rows + len(object_ids))
+
+        self._commit([object_ids], [new_rows])
+
+    def append_hdf5(self, features_fn, chunk_size=100000, progress_cb=None):
+        """
+        Append the vectors of a HDF5 file with the datasets "objids" and "features".
+
+        The file is read in chunks, so that it does not have to fit into memory.
+        """
+        with h5py.File(features_fn, "r", libver="latest") as f_features:
+            object_ids = f_features["objids"]
+            vectors = f_features["features"]
+
+            chunks_ids = []
+            chunks_rows = []
+            n_rows_before = self.n_rows
+
+            with open(os.path.join(self.path, self.FEATURES_FN), "r+b") as f:
+                f.truncate(self.n_rows * self.n_features *
+                           FEATURE_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+
+                for start in range(0, len(object_ids), chunk_size):
+                    chunk_ids = object_ids[start:start + chunk_size]
+                    chunk_vectors = np.ascontiguousarray(
+                        vectors[start:start + chunk_size], dtype=FEATURE_DTYPE)
+
+                    if chunk_vectors.shape[1] != self.n_features:
+                        raise FeatureStoreError("Expected {:d} features, got {:d}".format(
+                            self.n_features, chunk_vectors.shape[1]))
+
+                    f.write(chunk_vectors.tobytes())
+
+                    # Sometimes, objids are still ints or bytes
+                    chunks_ids.append(np.array(
+                        [o.decode() if isinstance(o, bytes) else str(o)
+                         for o in chunk_ids], dtype=str))
+                    chunks_rows.append(np.arange(n_rows_before + start,
+                                                 n_rows_before + start + len(chunk_ids)))
+
+                    if callable(progress_cb):
+                        progress_cb(len(chunk_ids))
+
+                f.flush()
+                os.fsync(f.fileno())
+
+        if not chunks_ids:
+            return
+
+        self._commit(chunks_ids, chunks_rows)
+
+    def _commit(self, chunks_ids, chunks_rows):
+        """
+        Merge appended rows into the index and update the number of valid rows.
+
+        For duplicate ids, the last (newest) row is kept.
+        """
+        ids = np.concatenate(
+            [np.asarray(self._index_ids, dtype=str)] + chunks_ids)
+        rows = np.concatenate([np.asarray(self._index_rows)] + chunks_rows)
+        order = np.lexsort((-rows, ids))
+        ids, rows = ids[order], rows[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+
+        # The index of the new generation is not referenced before meta.json is replaced
+        old_generation = self.generation
+        generation = old_generation + 1 if old_generation is not None else 0
+        index_ids_fn, index_rows_fn = self._index_fns(self.path, generation)
+        _save_atomic(index_ids_fn, ids[first])
+        _save_atomic(index_rows_fn, rows[first])
+
+        # The data is only visible to readers after meta.json was updated
+        n_rows = self.n_rows + sum(len(r) for r in chunks_rows)
+        self._write_meta(self.path, {"n_features": self.n_features,
+                                     "n_rows": int(n_rows),
+                                     "generation": generation})
+
+        # Keep the previous generation for readers that just read the old meta.json
+        if generation >= 2:
+            self._remove_index(generation - 2)
+        elif generation == 1:
+            self._remove_index(None)
+
+        self._load()
+
+    def _remove_index(self, generation):
+        for fn in self._index_fns(self.path, generation):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+
+class FlaskFeatureStore:
+    """
+    Flask extension that opens the FeatureStore at FEATURE_STORE_PATH (read-only).
+
+    If FEATURE_STORE_PATH is not set, `store` is None and vectors are read from the database.
+    The store is reopened when meta.json was replaced (i.e. after a commit of another process).
+    """
+
+    def __init__(self, app=None):
+        self._stores = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("FEATURE_STORE_PATH", None)
+        app.extensions["feature_store"] = self
+
+    @property
+    def store(self):
+        """
+        The FeatureStore of the current app (or None).
+        """
+        if not has_app_context():
+            return None
+
+        path = current_app.config.get("FEATURE_STORE_PATH")
+        if not path:
+            return None
+
+        store = self._stores.get(path)
+        if store is None or self._is_stale(store):
+            store = self._stores[path] = FeatureStore(path)
+
+        return store
+
+    @staticmethod
+    def _is_stale(store):
+        try:
+            stat = os.stat(os.path.join(store.path, FeatureStore.META_FN))
+        except FileNotFoundError:
+            return False
+
+        # meta.json is replaced (i.e. a new inode) by every commit
+        return ((stat.st_ino, stat.st_mtime_ns)
+                != (store.meta_stat.st_ino, store.meta_stat.st_mtime_ns))
+
+    def reload(self):
+        """
+        Reopen stores, e.g. after an append.
+        """
+        self._stores.clear()
@@ -67,3 +67,56 @@ def combine_covariances(m1, m2, S1, S2, n1, n2):
     B = b * D1 * D2
     
     return 1 / (n1 + n2 ) * (A + B)
+
+class TopK:
+    """
+    Running selection of the k items with the smallest scores.
+
+    Chunks are buffered and reduced with np.argpartition whenever
+    the buffer holds 2*k items, so memory is O(k + chunk size).
+
+    Usage:
+        top = TopK(k)
+        top.push(scores, ids, vectors)
+        scores, ids, vectors = top.result()
+    """
+    def __init__(self, k):
+        self.k = k
+        self._chunks = []
+        self._n = 0
+
+    def push(self, scores, *items):
+        """
+        Add a chunk of scores and corresponding item arrays.
+        """
+        if not len(scores):
+            return
+
+        self._chunks.append((np.asarray(scores),) + tuple(items))
+        self._n += len(scores)
+
+        if self._n >= 2 * self.k:
+            self._reduce()
+
+    def _reduce(self):
+        columns = [np.concatenate(c) for c in zip(*self._chunks)]
+
+        if len(columns[0]) > self.k:
+            idx = np.argpartition(columns[0], self.k - 1)[:self.k] if self.k else []
+            columns = [c[idx] for c in columns]
+
+        self._chunks = [tuple(columns)]
+        self._n = len(columns[0])
+
+    def result(self):
+        """
+        Return (scores, *items) of the selected items, sorted by score.
+        """
+        if not self._chunks:
+            return None
+
+        self._reduce()
+        columns = self._chunks[0]
+        order = np.argsort(columns[0], kind="stable")
+
+        return tuple(c[order] for c in columns)
@@ -0,0 +1,203 @@
+"""
+High-throughput ingestion of objects and features.
+
+Input files are streamed in chunks. Each chunk is copied into a temporary
+staging table using COPY and then merged into `objects` with a single
+set-based statement. After every chunk, the number of processed rows is
+recorded in `ingest_checkpoints` in the same transaction, so that an
+interrupted ingestion can be resumed.
+"""
+
+import io
+import os
+import time
+
+import h5py
+import numpy as np
+import pandas as pd
+from etaprogress.progress import ProgressBar
+from sqlalchemy.sql import text
+
+from morphocluster.column_types import VECTOR_DTYPE
+
+#: Rows per chunk
+CHUNK_SIZE = 100000
+
+
+def copy_from_frame(connection, table, frame, chunk_size=CHUNK_SIZE):
+    """
+    Stream a DataFrame into a table using COPY FROM STDIN (in chunks).
+
+    The DBAPI connection of `connection` is used, so that the copy is part
+    of the current transaction. Missing values are written as NULL,
+    empty strings are kept.
+    """
+    columns = ", ".join(frame.columns)
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, columns)
+
+    cursor = connection.connection.cursor()
+    try:
+        for start in range(0, len(frame), chunk_size):
+            buffer = io.StringIO()
+            frame.iloc[start:start + chunk_size].to_csv(
+                buffer, header=False, index=False, na_rep="\\N")
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+
+
+def _source_key(kind, fn):
+    """
+    Identify an input file. A changed file size restarts the ingestion.
+    """
+    return "{}:{}:{:d}".format(kind, os.path.realpath(fn), os.path.getsize(fn))
+
+
+def _get_checkpoint(connection, source):
+    stmt = text("SELECT n_done FROM ingest_checkpoints WHERE source = :source")
+    return connection.execute(stmt, source=source).scalar() or 0
+
+
+def _set_checkpoint(connection, source, n_done):
+    stmt = text("""
+    INSERT INTO ingest_checkpoints (source, n_done, updated)
+    VALUES (:source, :n_done, now())
+    ON CONFLICT (source) DO UPDATE SET n_done = EXCLUDED.n_done, updated = EXCLUDED.updated
+    """)
+    connection.execute(stmt, source=source, n_done=n_done)
+
+
+def _ingest(connection, source, n_total, chunks, merge_chunk, resume):
+    """
+    Merge chunks and keep track of the progress.
+
+    Parameters:
+        chunks: Callable n_done -> iterable of chunks (starting after n_done rows).
+        merge_chunk: Callable (connection, chunk) -> number of merged rows.
+    """
+    n_done = _get_checkpoint(connection, source) if resume else 0
+
+    if n_done >= n_total:
+        print("Already done.")
+        return
+
+    if n_done:
+        print("Resuming after {:,d} rows.".format(n_done))
+
+    bar = ProgressBar(n_total, max_width=40)
+    bar.numerator = n_done
+
+    n_processed = n_merged = 0
+    start = time.perf_counter()
+    for chunk in chunks(n_done):
+        with connection.begin():
+            n_merged += merge_chunk(connection, chunk)
+            n_done += len(chunk)
+            _set_checkpoint(connection, source, n_done)
+
+        n_processed += len(chunk)
+        bar.numerator = n_done
+        print(bar, "{:,.0f} rows/s".format(
+            n_processed / (time.perf_counter() - start)), end="\r")
+    print()
+
+    elapsed = time.perf_counter() - start
+    print("Processed {:,d} rows ({:,d} merged) in {:.1f}s ({:,.0f} rows/s).".format(
+        n_processed, n_merged, elapsed, n_processed / max(elapsed, 1e-9)))
+
+
+def _merge_locations(connection, chunk):
+    connection.execute(text("""
+    CREATE TEMPORARY TABLE IF NOT EXISTS staging_locations (
+        object_id TEXT,
+        path TEXT
+    ) ON COMMIT DELETE ROWS
+    """))
+
+    copy_from_frame(connection, "staging_locations", chunk)
+
+    result = connection.execute(text("""
+    INSERT INTO objects (object_id, path)
+    SELECT DISTINCT ON (object_id) object_id, path
+    FROM staging_locations
+    ON CONFLICT (object_id) DO UPDATE SET path = EXCLUDED.path
+    """))
+
+    return result.rowcount
+
+
+def load_object_locations(connection, collection_fn, chunk_size=CHUNK_SIZE, resume=True):
+    """
+    Load a collection of objects (CSV: object_id, path, label).
+
+    Existing objects get the new path.
+    """
+    source = _source_key("locations", collection_fn)
+
+    # Count lines without parsing
+    with open(collection_fn, "rb") as f:
+        n_total = sum(1 for _ in f)
+
+    def chunks(n_done):
+        return pd.read_csv(collection_fn,
+                           header=None,
+                           names=["object_id", "path", "label"],
+                           usecols=["object_id", "path"],
+                           dtype={"object_id": str, "path": str},
+                           skiprows=n_done,
+                           chunksize=chunk_size)
+
+    _ingest(connection, source, n_total, chunks, _merge_locations, resume)
+
+
+def _merge_features(connection, chunk):
+    connection.execute(text("""
+    CREATE TEMPORARY TABLE IF NOT EXISTS staging_features (
+        object_id TEXT,
+        vector BYTEA
+    ) ON COMMIT DELETE ROWS
+    """))
+
+    copy_from_frame(connection, "staging_features", chunk)
+
+    result = connection.execute(text("""
+    UPDATE objects AS o
+    SET vector = s.vector
+    FROM staging_features AS s
+    WHERE o.object_id = s.object_id
+    """))
+
+    return result.rowcount
+
+
+def _decode_object_id(object_id):
+    # Sometimes, objids are still ints or bytes
+    return object_id.decode() if isinstance(object_id, bytes) else str(object_id)
+
+
+def load_features(connection, features_fn, chunk_size=CHUNK_SIZE, resume=True):
+    """
+    Load object features from a HDF5 file with the datasets "objids" and "features".
+
+    Objects that are not present in `objects` are skipped.
+    """
+    source = _source_key("features", features_fn)
+
+    with h5py.File(features_fn, "r", libver="latest") as f_features:
+        object_ids = f_features["objids"]
+        vectors = f_features["features"]
+
+        def chunks(n_done):
+            for start in range(n_done, len(object_ids), chunk_size):
+                chunk_vectors = np.ascontiguousarray(
+                    vectors[start:start + chunk_size], dtype=VECTOR_DTYPE)
+
+                # bytea in hex format
+                yield pd.DataFrame({
+                    "object_id": [_decode_object_id(o) for o in object_ids[start:start + chunk_size]],
+                    "vector": ["\\x" + v.tobytes().hex() for v in chunk_vectors],
+                })
+
+        _ingest(connection, source, len(object_ids),
+                chunks, _merge_features, resume)
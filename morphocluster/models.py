@@ -13,6 +13,8 @@ from sqlalchemy.sql.schema import UniqueConstraint, CheckConstraint
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import func
 from morphocluster.extensions import database as db
+from morphocluster.column_types import (IncrementalPrototypesType,
+                                        PrototypesType, Vector)
 
 metadata = db.metadata
 
@@ -20,7 +22,7 @@ metadata = db.metadata
 objects = Table('objects', metadata,
                 Column('object_id', String, primary_key=True),
                 Column('path', String, nullable=False),
-                Column('vector', PickleType, nullable=True),
+                Column('vector', Vector, nullable=True),
                 Column('rand', Float, server_default=func.random())
                 )
 
@@ -31,6 +33,15 @@ projects = Table('projects', metadata,
                  Column('creation_date', DateTime,
                         default=datetime.datetime.now),
                  Column('visible', Boolean, nullable=False, server_default="t"),
+                 # Prototype settings (see Tree.get_prototype_settings)
+                 Column('n_prototypes', Integer,
+                        nullable=False, server_default="16"),
+                 Column('prototype_clusterer', String,
+                        nullable=False, server_default="kmeans"),
+                 Column('object_sample_size', Integer,
+                        nullable=False, server_default="1000"),
+                 Column('prototype_metric', String,
+                        nullable=False, server_default="euclidean"),
                  )
 
 #: :type nodes: sqlalchemy.sql.schema.Table
@@ -52,6 +63,10 @@ nodes = Table('nodes', metadata,
                      nullable=False, server_default="f"),
               Column('preferred', Boolean, default=False,
                      nullable=False, server_default="f"),
+              # Transaction id (txid_current()) of the last modification of the node's
+              # own objects or children (0 if unmodified)
+              Column('version', BigInteger,
+                     nullable=False, server_default="0"),
 
               # ===========================================================================
               # Super Node support
@@ -64,9 +79,11 @@ nodes = Table('nodes', metadata,
               # The following fields are cached values
               # ===========================================================================
               # Centroid (single)
-              Column('_centroid', PickleType, nullable=True),
+              Column('_centroid', Vector, nullable=True),
               # Prototypes (multiple centroid)
-              Column('_prototypes', PickleType, nullable=True),
+              Column('_prototypes', PrototypesType, nullable=True),
+              # Prototypes of the node's own objects (updated incrementally when objects are moved)
+              Column('_own_prototypes', IncrementalPrototypesType, nullable=True),
               # object_ids of type objects representative for all descendants (used as preview)
               Column('_type_objects', ARRAY(String), nullable=True),
               # object_ids of type objects directly under this node (used as preview for the node's objects)
@@ -77,18 +94,84 @@ nodes = Table('nodes', metadata,
               Column('_n_objects', BigInteger, nullable=True),
               # Number of all objects anywhere below this node
               Column('_n_objects_deep', BigInteger, nullable=True),
+              # Newest version that is reflected in the cached values
+              # (all transactions up to this id were finished when they were calculated).
+              # The cached values are stale if a node in the subtree has a newer version.
+              Column('_cache_epoch', BigInteger, nullable=True),
 
               # Validity of cached values
               Column('cache_valid', Boolean,
                      nullable=False, server_default="f"),
 
+              # ===========================================================================
+              # Progress counters (see processing.progress)
+              # Maintained along the path of modified nodes, NULL if unknown.
+              # ===========================================================================
+              Column('progress_n_objects', BigInteger, nullable=True),
+              Column('progress_n_objects_deep', BigInteger, nullable=True),
+              Column('progress_n_approved_objects', BigInteger, nullable=True),
+              Column('progress_n_named_objects', BigInteger, nullable=True),
+              Column('progress_n_approved_nodes', BigInteger, nullable=True),
+              Column('progress_n_filled_nodes', BigInteger, nullable=True),
+              Column('progress_n_nodes', BigInteger, nullable=True),
+              Column('progress_leaves_n_objects', BigInteger, nullable=True),
+              Column('progress_leaves_n_filled_objects', BigInteger, nullable=True),
+              Column('progress_leaves_n_approved_objects', BigInteger, nullable=True),
+              Column('progress_leaves_n_named_objects', BigInteger, nullable=True),
+              Column('progress_leaves_n_approved_nodes', BigInteger, nullable=True),
+              Column('progress_leaves_n_filled_nodes', BigInteger, nullable=True),
+              Column('progress_leaves_n_nodes', BigInteger, nullable=True),
+
               # An orig_id must be unique inside a project
               Index('idx_orig_proj', 'orig_id', 'project_id', unique=True),
 
+              # Recently modified nodes of a project
+              Index('idx_nodes_project_version', 'project_id', 'version'),
+
               # A node may not be its own child
               CheckConstraint("node_id != parent_id")
               )
 
+#: Closure table of the node hierarchy:
+#: One row for every (ancestor, descendant) pair, including (node, node) with depth 0.
+#: :type nodes_closure: sqlalchemy.sql.schema.Table
+nodes_closure = Table('nodes_closure', metadata,
+                      Column('ancestor_id', None,
+                             ForeignKey('nodes.node_id', ondelete="CASCADE"),
+                             primary_key=True),
+                      Column('descendant_id', None,
+                             ForeignKey('nodes.node_id', ondelete="CASCADE"),
+                             primary_key=True),
+                      Column('depth', Integer, nullable=False),
+                      Index('idx_closure_descendant_depth',
+                            'descendant_id', 'depth')
+                      )
+
+#: Pending changes of the progress counters of the nodes (see Tree._record_modification).
+#: The current counters of a node are its stored counters plus the sum of its deltas.
+#: :type nodes_progress_deltas: sqlalchemy.sql.schema.Table
+nodes_progress_deltas = Table('nodes_progress_deltas', metadata,
+                              Column('delta_id', BigInteger, primary_key=True),
+                              Column('node_id', None,
+                                     ForeignKey('nodes.node_id',
+                                                ondelete="CASCADE"),
+                                     index=True, nullable=False),
+                              Column('progress_n_objects', BigInteger, nullable=False),
+                              Column('progress_n_objects_deep', BigInteger, nullable=False),
+                              Column('progress_n_approved_objects', BigInteger, nullable=False),
+                              Column('progress_n_named_objects', BigInteger, nullable=False),
+                              Column('progress_n_approved_nodes', BigInteger, nullable=False),
+                              Column('progress_n_filled_nodes', BigInteger, nullable=False),
+                              Column('progress_n_nodes', BigInteger, nullable=False),
+                              Column('progress_leaves_n_objects', BigInteger, nullable=False),
+                              Column('progress_leaves_n_filled_objects', BigInteger, nullable=False),
+                              Column('progress_leaves_n_approved_objects', BigInteger, nullable=False),
+                              Column('progress_leaves_n_named_objects', BigInteger, nullable=False),
+                              Column('progress_leaves_n_approved_nodes', BigInteger, nullable=False),
+                              Column('progress_leaves_n_filled_nodes', BigInteger, nullable=False),
+                              Column('progress_leaves_n_nodes', BigInteger, nullable=False)
+                              )
+
 nodes_objects = Table('nodes_objects', metadata,
                       Column('node_id', None,
                              ForeignKey('nodes.node_id', ondelete="CASCADE"),
@@ -133,6 +216,15 @@ log = Table("log", metadata,
             Column('data', Text, nullable=True),
             )
 
+#: Progress of resumable ingestions (see morphocluster.ingest)
+#: :type ingest_checkpoints: sqlalchemy.sql.schema.Table
+ingest_checkpoints = Table('ingest_checkpoints', metadata,
+                           Column('source', String, primary_key=True),
+                           Column('n_done', BigInteger, nullable=False),
+                           Column('updated', DateTime(timezone=True),
+                                  server_default=func.now()),
+                           )
+
 # ===============================================================================
 # categories = Table('names', metadata,
 #     Column('name', String, primary_key = True),
@@ -0,0 +1,373 @@
+"""
+Read-through cache of node records, children and paths in Redis (see Tree.get_node,
+Tree.get_children, Tree.get_paths).
+
+Only fresh records (valid and not stale) are cached. Entries are evicted by the
+modifications (see Tree._record_modification and Tree.update_node), which happen
+before the commit, and again after the commit (see Tree.transaction).
+To keep readers that still see the old snapshot from caching
+outdated values, an eviction leaves a tombstone for `grace` seconds that
+blocks the caching of the node. Stores check the tombstones atomically (Lua).
+
+    <prefix>:node:<node_id>: Pickled (generation, record)
+    <prefix>:children:<node_id>: Hash variant -> pickled (generation, child_ids)
+    <prefix>:path:<node_id>: Pickled (generation, path generation, path)
+    <prefix>:evicted:<node_id>: Tombstone
+    <prefix>:gen: Hash with the generations "all" (see clear) and "paths" (see evict_paths)
+    <prefix>:frozen, <prefix>:frozen_paths: Tombstones of clear and evict_paths
+    <prefix>:stats: Hash with the hit and miss counters
+"""
+
+import pickle
+
+from flask import current_app, has_app_context
+
+#: Kinds of entries (for the counters)
+KINDS = ("node", "children", "path")
+
+# Store a value unless a guard key exists or the generations changed since the lookup.
+#   KEYS[1]: Target, KEYS[2]: Generations, KEYS[3...]: Guards
+#   ARGV[1]: Value, ARGV[2]: TTL, ARGV[3]: Hash field ("" for a string),
+#   ARGV[4]: Generation "all", ARGV[5]: Generation "paths" ("" to skip)
+_STORE_SCRIPT = """
+for i = 3, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        return 0
+    end
+end
+local gens = redis.call('HMGET', KEYS[2], 'all', 'paths')
+if (gens[1] or '0') ~= ARGV[4] then
+    return 0
+end
+if ARGV[5] ~= '' and (gens[2] or '0') ~= ARGV[5] then
+    return 0
+end
+if ARGV[3] == '' then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('HSET', KEYS[1], ARGV[3], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def _int(value):
+    return int(value) if value is not None else 0
+
+
+class NodeCache:
+    """
+    Read-through cache of node records, children and paths.
+
+    Parameters:
+        redis: Redis connection.
+        prefix: Prefix of all keys.
+        ttl: Lifetime of the entries in seconds.
+        grace: Lifetime of the tombstones of evicted nodes in seconds.
+            Has to exceed the duration of a read (from its snapshot until it stores the entries),
+            as the evictions are repeated after the commit of the modification.
+            0 disables the tombstones (only safe without concurrent modifications).
+    """
+
+    def __init__(self, redis, prefix="morphocluster:nodes", ttl=3600, grace=10):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        self.grace = int(grace)
+
+        self.gen_key = prefix + ":gen"
+        self.frozen_key = prefix + ":frozen"
+        self.frozen_paths_key = prefix + ":frozen_paths"
+        self.stats_key = prefix + ":stats"
+
+        self._store = redis.register_script(_STORE_SCRIPT)
+
+        # Counters that are sent with the next request
+        self._pending = {}
+
+    def _key(self, kind, node_id):
+        return "{}:{}:{:d}".format(self.prefix, kind, int(node_id))
+
+    def _count(self, kind, hits, misses):
+        for name, n in (("hits", hits), ("misses", misses)):
+            if n:
+                field = "{}_{}".format(kind, name)
+                self._pending[field] = self._pending.get(field, 0) + n
+
+    def _pipeline(self):
+        pipe = self.redis.pipeline()
+        for field, n in self._pending.items():
+            pipe.hincrby(self.stats_key, field, n)
+        n_pending = len(self._pending)
+        self._pending = {}
+        return pipe, n_pending
+
+    def _lookup(self, commands):
+        """
+        Execute commands together with the lookup of the generations.
+
+        Returns:
+            ((gen, paths_gen), results)
+        """
+        pipe, n_pending = self._pipeline()
+        pipe.hmget(self.gen_key, "all", "paths")
+        for name, *args in commands:
+            getattr(pipe, name)(*args)
+        results = pipe.execute()[n_pending:]
+
+        gen, paths_gen = results[0]
+        return (_int(gen), _int(paths_gen)), results[1:]
+
+    def get_nodes(self, node_ids):
+        """
+        Look up node records.
+
+        Returns:
+            (hits, token)
+            hits: dict node_id -> record.
+            token: Generations to pass to set_nodes.
+        """
+        node_ids = [int(n) for n in node_ids]
+        if not node_ids:
+            return {}, None
+
+        token, (values,) = self._lookup(
+            [("mget", [self._key("node", n) for n in node_ids])])
+
+        hits = {}
+        for node_id, value in zip(node_ids, values):
+            if value:
+                gen, record = pickle.loads(value)
+                if gen == token[0]:
+                    hits[node_id] = record
+
+        self._count("node", len(hits), len(node_ids) - len(hits))
+
+        return hits, token
+
+    def set_nodes(self, records, token):
+        """
+        Store node records (unless they were evicted in the meantime).
+
+        Parameters:
+            records: Sequence of dicts with a node_id.
+            token: Token of the lookup (see get_nodes).
+        """
+        if token is None or not records:
+            return
+
+        pipe = self.redis.pipeline()
+        for record in records:
+            node_id = record["node_id"]
+            self._store(
+                keys=[self._key("node", node_id), self.gen_key,
+                      self._key("evicted", node_id), self.frozen_key],
+                args=[pickle.dumps((token[0], record)), self.ttl, "", token[0], ""],
+                client=pipe)
+        pipe.execute()
+
+    def get_children(self, node_id, variant):
+        """
+        Look up the children of a node.
+
+        Parameters:
+            variant: String that identifies the filter and order of the children.
+
+        Returns:
+            (records, token)
+            records: List of the records of the children (None if any entry is missing).
+            token: Generations to pass to set_children.
+        """
+        token, (value,) = self._lookup(
+            [("hget", self._key("children", node_id), variant)])
+
+        child_ids = None
+        if value:
+            gen, child_ids = pickle.loads(value)
+            if gen != token[0]:
+                child_ids = None
+
+        if child_ids is None:
+            self._count("children", 0, 1)
+            return None, token
+
+        hits, _ = self.get_nodes(child_ids)
+        if len(hits) < len(child_ids):
+            self._count("children", 0, 1)
+            return None, token
+
+        self._count("children", 1, 0)
+        return [hits[n] for n in child_ids], token
+
+    def set_children(self, node_id, variant, records, token):
+        """
+        Store the children of a node and their records.
+        """
+        if token is None:
+            return
+
+        self.set_nodes(records, token)
+
+        child_ids = [int(r["node_id"]) for r in records]
+        self._store(
+            keys=[self._key("children", node_id), self.gen_key,
+                  self._key("evicted", node_id), self.frozen_key],
+            args=[pickle.dumps((token[0], child_ids)), self.ttl, variant, token[0], ""])
+
+    def get_paths(self, node_ids):
+        """
+        Look up the paths of nodes.
+
+        Returns:
+            (paths, token)
+            paths: dict node_id -> list of `node_id`s (hits only).
+            token: Generations to pass to set_paths.
+        """
+        node_ids = [int(n) for n in node_ids]
+        if not node_ids:
+            return {}, None
+
+        token, (values,) = self._lookup(
+            [("mget", [self._key("path", n) for n in node_ids])])
+
+        paths = {}
+        for node_id, value in zip(node_ids, values):
+            if value:
+                gen, paths_gen, path = pickle.loads(value)
+                if (gen, paths_gen) == token:
+                    paths[node_id] = path
+
+        self._count("path", len(paths), len(node_ids) - len(paths))
+
+        return paths, token
+
+    def set_paths(self, paths, token):
+        """
+        Store the paths of nodes.
+
+        Parameters:
+            paths: dict node_id -> list of `node_id`s.
+            token: Token of the lookup (see get_paths).
+        """
+        if token is None or not paths:
+            return
+
+        pipe = self.redis.pipeline()
+        for node_id, path in paths.items():
+            self._store(
+                keys=[self._key("path", node_id), self.gen_key,
+                      self._key("evicted", node_id), self.frozen_key, self.frozen_paths_key],
+                args=[pickle.dumps((token[0], token[1], list(path))), self.ttl, "",
+                      token[0], token[1]],
+                client=pipe)
+        pipe.execute()
+
+    def evict(self, node_ids):
+        """
+        Evict the records, children and paths of nodes
+        and block their caching for `grace` seconds.
+        """
+        node_ids = set(int(n) for n in node_ids if n is not None)
+        if not node_ids:
+            return
+
+        pipe = self.redis.pipeline()
+        if self.grace > 0:
+            for node_id in node_ids:
+                pipe.set(self._key("evicted", node_id), 1, ex=self.grace)
+        pipe.delete(*[self._key(kind, n) for kind in KINDS for n in node_ids])
+        pipe.execute()
+
+    def evict_paths(self):
+        """
+        Evict all paths (after nodes were moved).
+        """
+        pipe = self.redis.pipeline()
+        if self.grace > 0:
+            pipe.set(self.frozen_paths_key, 1, ex=self.grace)
+        pipe.hincrby(self.gen_key, "paths")
+        pipe.execute()
+
+    def clear(self):
+        """
+        Evict all entries (after bulk modifications).
+        """
+        pipe = self.redis.pipeline()
+        if self.grace > 0:
+            pipe.set(self.frozen_key, 1, ex=self.grace)
+        pipe.hincrby(self.gen_key, "all")
+        pipe.execute()
+
+    def metrics(self):
+        """
+        Metrics of the cache.
+
+        Returns:
+            dict with
+                hits, misses: Total number of hits (misses).
+                hit_rate: hits / (hits + misses) (or None).
+                <kind>_hits, <kind>_misses: Per kind of entry (see KINDS).
+        """
+        pipe, n_pending = self._pipeline()
+        pipe.hgetall(self.stats_key)
+        stats = pipe.execute()[n_pending]
+
+        stats = {k.decode(): int(v) for k, v in stats.items()}
+
+        result = {}
+        for kind in KINDS:
+            for name in ("hits", "misses"):
+                field = "{}_{}".format(kind, name)
+                result[field] = stats.get(field, 0)
+
+        result["hits"] = sum(result[k + "_hits"] for k in KINDS)
+        result["misses"] = sum(result[k + "_misses"] for k in KINDS)
+        total = result["hits"] + result["misses"]
+        result["hit_rate"] = result["hits"] / total if total else None
+
+        return result
+
+
+class FlaskNodeCache:
+    """
+    Flask extension that provides the NodeCache (in the Redis of redis_lru)
+    if NODE_CACHE is set.
+
+    Otherwise, `cache` is None and nodes are always read from the database.
+    """
+
+    def __init__(self, app=None):
+        self._caches = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("NODE_CACHE", False)
+        app.config.setdefault("NODE_CACHE_TTL", 3600)
+        app.config.setdefault("NODE_CACHE_GRACE", 10)
+        app.extensions["node_cache"] = self
+
+    @property
+    def cache(self):
+        """
+        The NodeCache of the current app (or None).
+        """
+        if not has_app_context():
+            return None
+
+        config = current_app.config
+        if not config.get("NODE_CACHE"):
+            return None
+
+        from morphocluster.extensions import redis_lru
+
+        key = (config["REDIS_LRU_URL"], config["NODE_CACHE_TTL"], config["NODE_CACHE_GRACE"])
+
+        try:
+            return self._caches[key]
+        except KeyError:
+            cache = self._caches[key] = NodeCache(
+                redis_lru, ttl=config["NODE_CACHE_TTL"], grace=config["NODE_CACHE_GRACE"])
+            return cache
@@ -0,0 +1,610 @@
+"""
+Bottom-up consolidation of the cached values of a subtree.
+
+The whole subtree is processed level by level (deepest level first).
+Aggregations over children (`_n_objects_deep`, `_centroid`) are computed
+with batched NumPy operations on a parent->children index that is built once.
+"""
+
+import ctypes
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+
+from morphocluster.classifier import farthest_from
+from morphocluster.processing.prototypes import (IncrementalPrototypes,
+                                                 LloydKMeans, Prototypes,
+                                                 fit_prototypes_batched,
+                                                 merge_prototypes)
+
+#: Number of (own) type objects per node
+N_TYPE_OBJECTS = 9
+
+#: Maximum size (n_problems * n_samples * max(n_clusters, n_features))
+#: of the padded arrays of a batch of LloydKMeans fits
+MAX_BATCH_ELEMENTS = 2 ** 22
+
+
+def _roundrobin(iterables):
+    "roundrobin('ABC', 'D', 'EF') --> A D E B F C"
+    # Recipe credited to George Sakkis
+    num_active = len(iterables)
+    nexts = itertools.cycle(iter(it).__next__ for it in iterables)
+    while num_active:
+        try:
+            for next_ in nexts:
+                yield next_()
+        except StopIteration:
+            # Remove the iterator we just exhausted from the cycle.
+            num_active -= 1
+            nexts = itertools.cycle(itertools.islice(nexts, num_active))
+
+
+def _group_offsets(positions, n):
+    """
+    Offsets of the groups in a sorted array of positions in range(n).
+
+    Members of group i are found at [offsets[i]:offsets[i + 1]].
+    """
+    return np.searchsorted(positions, np.arange(n + 1))
+
+
+class ChildIndex:
+    """
+    Parent -> children index over the rows of a subtree.
+
+    Parameters:
+        node_ids: array of shape = [n_nodes]
+        parent_ids: array of shape = [n_nodes]
+            Missing values mark nodes without parent.
+
+    Attributes:
+        index (pandas.Index): node_id -> row position
+        parent_pos (array of shape = [n_nodes]):
+            Row of the parent of each row or -1 if the parent is not part of the subtree.
+    """
+
+    def __init__(self, node_ids, parent_ids):
+        self.index = pd.Index(node_ids)
+
+        parent_ids = (pd.to_numeric(pd.Series(parent_ids))
+                      .fillna(-1)
+                      .to_numpy(np.int64))
+        self.parent_pos = self.index.get_indexer(parent_ids)
+
+        # Sort rows by parent position, skipping rows without parent
+        order = np.argsort(self.parent_pos, kind="stable")
+        n_orphans = np.count_nonzero(self.parent_pos < 0)
+        self._order = order[n_orphans:]
+        self._offsets = _group_offsets(
+            self.parent_pos[self._order], len(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_positions(self, node_ids):
+        """
+        Row positions of node_ids (-1 for unknown ids).
+        """
+        return self.index.get_indexer(node_ids)
+
+    def children(self, pos):
+        """
+        Rows of the children of the node at row `pos`.
+        """
+        return self._order[self._offsets[pos]:self._offsets[pos + 1]]
+
+    def n_children(self):
+        """
+        Number of children of each row (inside the subtree).
+        """
+        return np.diff(self._offsets)
+
+
+def _object_matrix(column, n_features):
+    """
+    Convert an object column of vectors (or None) to a dense matrix and a mask.
+    """
+    values = column.to_numpy(dtype=object)
+    mask = np.array([v is not None and not (np.isscalar(v) and pd.isna(v))
+                     for v in values], dtype=bool)
+
+    matrix = np.zeros((len(values), n_features))
+    if mask.any():
+        matrix[mask] = np.stack(values[mask])
+
+    return matrix, mask
+
+
+def _infer_n_features(vectors, centroids):
+    if vectors.ndim == 2 and vectors.shape[0] > 0:
+        return vectors.shape[1]
+
+    for c in centroids:
+        if isinstance(c, np.ndarray):
+            return c.shape[-1]
+
+    return None
+
+
+def node_seed(random_state, node_id):
+    """
+    Derive a deterministic seed for a node from a global random_state.
+    """
+    return int(np.random.SeedSequence([random_state, node_id]).generate_state(1)[0])
+
+
+def make_kmeans(n_prototypes, random_state=None):
+    """
+    Default clusterer for the prototypes of a node.
+    """
+    return KMeans(n_prototypes, n_init=2, random_state=random_state)
+
+
+#: Clusterers for the prototypes of a node (see make_clusterer)
+CLUSTERERS = ("kmeans", "minibatch", "lloyd")
+
+
+def make_clusterer(clusterer, n_prototypes, random_state=None):
+    """
+    Create a clusterer for the prototypes of a node.
+
+    Parameters:
+        clusterer: One of CLUSTERERS.
+            kmeans: sklearn.cluster.KMeans (make_kmeans).
+            minibatch: sklearn.cluster.MiniBatchKMeans.
+            lloyd: processing.prototypes.LloydKMeans.
+        n_prototypes (int): Number of prototypes.
+        random_state: Seed.
+    """
+    if clusterer == "kmeans":
+        return make_kmeans(n_prototypes, random_state)
+    if clusterer == "minibatch":
+        return MiniBatchKMeans(n_prototypes, n_init=3, random_state=random_state)
+    if clusterer == "lloyd":
+        return LloydKMeans(n_prototypes, random_state=random_state)
+
+    raise ValueError("Unknown clusterer: {!r}".format(clusterer))
+
+
+def calc_type_objects(children_type_objects, object_ids, random_state=None):
+    """
+    Calculate nine type objects for a node as
+        a) a sample of nine type objects from its children, or
+        b) nine of its own objects, if the node is a leaf.
+
+    Parameters:
+        children_type_objects: list of lists of object_ids
+        object_ids: Sequence of the node's own (sampled) object_ids
+        random_state: Seed for the subsampling of children.
+    """
+    if len(children_type_objects) > 0:
+        # Randomly subsample children
+        idxs = np.random.RandomState(random_state).choice(
+            len(children_type_objects),
+            min(len(children_type_objects), N_TYPE_OBJECTS),
+            replace=False)
+        subsample = [children_type_objects[i] or [] for i in idxs]
+        return list(itertools.islice(_roundrobin(subsample), N_TYPE_OBJECTS))
+
+    return list(object_ids[:N_TYPE_OBJECTS])
+
+
+def calc_own_type_objects(children_vectors, object_vectors, object_ids):
+    """
+    Calculate nine own type objects for a node as
+        a) the nine objects with maximum distance to the children, or
+        b) [], if the node is a leaf.
+    """
+    if len(children_vectors) == 0 or len(object_vectors) == 0:
+        return []
+
+    farthest = farthest_from(children_vectors, object_vectors, N_TYPE_OBJECTS)
+
+    return [object_ids[i] for i in farthest]
+
+
+def fit_prototypes(vectors, make_clusterer, seed):
+    """
+    Fit the prototypes of a single node.
+
+    Returns:
+        (prototypes_, support_)
+    """
+    prots = Prototypes(make_clusterer(random_state=seed))
+    prots.fit(vectors)
+    return prots.prototypes_, prots.support_
+
+
+def fit_prototypes_batch(vectors, jobs, clusterer):
+    """
+    Fit the prototypes of many nodes at once (see fit_prototypes_batched).
+
+    Parameters:
+        vectors: array of shape = [n_objects, n_features]
+        jobs: list of (start, stop, seed) of rows in `vectors`.
+        clusterer: LloydKMeans
+
+    Returns:
+        list of (prototypes_, support_)
+    """
+    prototypes = fit_prototypes_batched(
+        [vectors[start:stop] for start, stop, _ in jobs], clusterer,
+        [seed for _, _, seed in jobs])
+    return [(prots.prototypes_, prots.support_) for prots in prototypes]
+
+
+def _batch_jobs(jobs, n_clusters, n_features, max_jobs=None):
+    """
+    Group jobs of similar size into batches that fit into MAX_BATCH_ELEMENTS.
+
+    Returns:
+        list of lists of positions in jobs.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i][1] - jobs[i][0])
+    width = max(n_clusters, n_features)
+
+    batches, batch = [], []
+    for i in order:
+        # Jobs are sorted by size, so the current job has the most rows of the batch
+        size = jobs[i][1] - jobs[i][0]
+        if batch and ((len(batch) + 1) * size * width > MAX_BATCH_ELEMENTS
+                      or (max_jobs is not None and len(batch) >= max_jobs)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+# Object vectors of a worker process (shared with the parent process)
+_worker_vectors = None
+
+
+def _init_worker(buffer, shape, dtype):
+    global _worker_vectors
+    _worker_vectors = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+    # Parallelism is achieved by the pool, avoid oversubscription
+    threadpool_limits(1)
+
+
+def _fit_prototypes_worker(job):
+    start, stop, make_clusterer, seed = job
+    return fit_prototypes(_worker_vectors[start:stop], make_clusterer, seed)
+
+
+def _fit_prototypes_batch_worker(job):
+    jobs, clusterer = job
+    return fit_prototypes_batch(_worker_vectors, jobs, clusterer)
+
+
+class PrototypeScheduler:
+    """
+    Fit the prototypes of many nodes, optionally in a pool of worker processes.
+
+    The object vectors are copied once into shared memory. Jobs only reference
+    a slice of this matrix, so that no vectors are pickled per job.
+
+    If make_clusterer returns a LloydKMeans, the jobs are fitted in batches
+    of similar size (see fit_prototypes_batched) instead of one by one.
+
+    Parameters:
+        vectors: array of shape = [n_objects, n_features]
+        make_clusterer: Picklable callable `make_clusterer(random_state=...)`.
+        n_workers (int): Number of worker processes. 1 fits in the current process.
+        min_jobs (int): Minimum number of jobs in a batch to use the pool.
+            Small batches are fitted in the current process to avoid the IPC overhead.
+    """
+
+    def __init__(self, vectors, make_clusterer, n_workers=1, min_jobs=None):
+        self.vectors = vectors
+        self.make_clusterer = make_clusterer
+        self.n_workers = n_workers
+        self.min_jobs = 4 * n_workers if min_jobs is None else min_jobs
+        self._executor = None
+
+    def __enter__(self):
+        if self.n_workers > 1 and self.vectors.size > 0:
+            vectors = np.ascontiguousarray(self.vectors)
+            buffer = multiprocessing.RawArray(ctypes.c_byte, vectors.nbytes)
+            np.frombuffer(buffer, dtype=vectors.dtype).reshape(
+                vectors.shape)[:] = vectors
+
+            # Use "spawn" as forking a process with initialized
+            # OpenMP threadpools or open database connections is unsafe.
+            self._executor = ProcessPoolExecutor(
+                self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(buffer, vectors.shape, vectors.dtype))
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def fit(self, jobs):
+        """
+        Fit prototypes for a batch of independent nodes.
+
+        Parameters:
+            jobs: list of (start, stop, seed) of rows in `vectors`.
+
+        Returns:
+            list of Prototypes in the same order as jobs.
+        """
+        clusterer = self.make_clusterer(random_state=None)
+        if isinstance(clusterer, LloydKMeans):
+            results = self._fit_batched(jobs, clusterer)
+        elif self._executor is not None and len(jobs) >= max(2, self.min_jobs):
+            chunksize = max(1, len(jobs) // (4 * self.n_workers))
+            results = self._executor.map(
+                _fit_prototypes_worker,
+                [(start, stop, self.make_clusterer, seed)
+                 for start, stop, seed in jobs],
+                chunksize=chunksize)
+        else:
+            results = (fit_prototypes(self.vectors[start:stop], self.make_clusterer, seed)
+                       for start, stop, seed in jobs)
+
+        prototypes = []
+        for prototypes_, support_ in results:
+            prots = Prototypes(None)
+            prots.prototypes_ = prototypes_
+            prots.support_ = support_
+            prototypes.append(prots)
+
+        return prototypes
+
+    def _fit_batched(self, jobs, clusterer):
+        use_pool = self._executor is not None and len(jobs) >= max(2, self.min_jobs)
+        max_jobs = -(-len(jobs) // (4 * self.n_workers)) if use_pool else None
+
+        n_features = self.vectors.shape[1] if self.vectors.ndim == 2 else 0
+        batches = _batch_jobs(jobs, clusterer.n_clusters, n_features, max_jobs)
+        batch_jobs = [[jobs[i] for i in batch] for batch in batches]
+
+        if use_pool:
+            batch_results = self._executor.map(
+                _fit_prototypes_batch_worker,
+                [(b, clusterer) for b in batch_jobs])
+        else:
+            batch_results = (fit_prototypes_batch(self.vectors, b, clusterer)
+                             for b in batch_jobs)
+
+        results = [None] * len(jobs)
+        for batch, batch_result in zip(batches, batch_results):
+            for i, result in zip(batch, batch_result):
+                results[i] = result
+
+        return results
+
+
+def consolidate_subtree(subtree, object_node_ids, object_ids, vectors,
+                        n_prototypes, make_clusterer=None, n_workers=1,
+                        random_state=0, progress_cb=None, merge_method="complete",
+                        metric="euclidean"):
+    """
+    Recalculate the cached values of all invalid nodes of a subtree in a single bottom-up pass.
+
+    Parameters:
+        subtree (pandas.DataFrame): Nodes indexed by node_id.
+            Required columns: parent_id, level, cache_valid, _n_objects_, _n_children_
+            and the cached columns (_centroid, _prototypes, _type_objects, ...).
+            The children of every invalid node have to be present.
+            The prototypes of the own objects of a node (optional column _own_prototypes,
+            see IncrementalPrototypes) are reused unless they need a refit.
+        object_node_ids: array of shape = [n_objects]
+            node_id for each (sampled) object of an invalid node.
+        object_ids: array of shape = [n_objects]
+        vectors: array of shape = [n_objects, n_features]
+        n_prototypes (int): Number of prototypes per node.
+        make_clusterer: Picklable callable `make_clusterer(random_state=...)`
+            returning a fresh clusterer for Prototypes.
+        n_workers (int): Number of processes for the fitting of prototypes.
+        random_state (int): Global seed. The seed of each node is derived from
+            this and its node_id, so that results do not depend on n_workers.
+        progress_cb: Called with the number of processed nodes after each level.
+        merge_method: Method of merge_prototypes.
+        metric: Metric of merge_prototypes.
+
+    Returns:
+        subtree with updated values and an additional boolean column "__updated".
+    """
+
+    if make_clusterer is None:
+        make_clusterer = functools.partial(make_kmeans, n_prototypes)
+
+    subtree = subtree.copy()
+    n_nodes = len(subtree)
+
+    index = ChildIndex(subtree.index.values, subtree["parent_id"].values)
+    parent_pos = index.parent_pos
+    n_children_sub = index.n_children()
+
+    invalid = ~subtree["cache_valid"].to_numpy(dtype=bool)
+    levels = subtree["level"].to_numpy(np.int64)
+
+    n_objects = subtree["_n_objects_"].fillna(0).to_numpy(np.int64)
+    n_objects_deep = (pd.to_numeric(subtree["_n_objects_deep"])
+                      .fillna(0)
+                      .to_numpy(np.int64))
+
+    # Group (sampled) objects by node
+    object_ids = np.asarray(object_ids, dtype=object)
+    vectors = np.asarray(vectors)
+    obj_pos = index.get_positions(object_node_ids)
+    order = np.argsort(obj_pos, kind="stable")
+    obj_pos, object_ids = obj_pos[order], object_ids[order]
+    if len(order):
+        vectors = vectors[order]
+    obj_offsets = _group_offsets(obj_pos, n_nodes)
+    has_objects = np.diff(obj_offsets) > 0
+
+    centroids_in = subtree["_centroid"].to_numpy(dtype=object)
+    n_features = _infer_n_features(vectors, centroids_in)
+
+    if n_features is not None:
+        centroids, has_centroid = _object_matrix(
+            subtree["_centroid"], n_features)
+
+        # Sum of object vectors per node
+        obj_sum = np.zeros((n_nodes, n_features))
+        if has_objects.any():
+            obj_sum[has_objects] = np.add.reduceat(
+                vectors, obj_offsets[:-1][has_objects], axis=0)
+
+    type_objects = subtree["_type_objects"].to_numpy(dtype=object)
+    own_type_objects = subtree["_own_type_objects"].to_numpy(dtype=object)
+    prototypes = subtree["_prototypes"].to_numpy(dtype=object)
+    if "_own_prototypes" in subtree:
+        own_prototypes = subtree["_own_prototypes"].to_numpy(dtype=object)
+    else:
+        own_prototypes = np.full(n_nodes, None, dtype=object)
+
+    # Child aggregates, filled level by level
+    child_deep_sum = np.zeros(n_nodes, dtype=np.int64)
+    if n_features is not None:
+        child_centroid_sum = np.zeros((n_nodes, n_features))
+
+    # Rows grouped by level, deepest level first
+    level_order = np.argsort(-levels, kind="stable")
+    level_breaks = np.flatnonzero(np.diff(levels[level_order])) + 1
+    level_rows = np.split(level_order, level_breaks)
+
+    # Per-node seeds (independent of the processing order)
+    seeds = {pos: node_seed(random_state, node_id)
+             for pos, node_id in enumerate(index.index)
+             if invalid[pos]}
+
+    with PrototypeScheduler(vectors, make_clusterer, n_workers) as scheduler:
+        previous_rows = None
+        for rows in level_rows:
+            # Aggregate the (finished) level below into its parents
+            if previous_rows is not None:
+                prev = previous_rows[parent_pos[previous_rows] >= 0]
+                prev_parents = parent_pos[prev]
+
+                np.add.at(child_deep_sum, prev_parents, n_objects_deep[prev])
+
+                if n_features is not None:
+                    np.add.at(child_centroid_sum, prev_parents,
+                              n_objects_deep[prev, np.newaxis] * centroids[prev])
+            previous_rows = rows
+
+            rows = rows[invalid[rows]]
+
+            if not len(rows):
+                continue
+
+            # _n_objects_deep
+            n_objects_deep[rows] = n_objects[rows] + child_deep_sum[rows]
+
+            # _centroid
+            if n_features is not None:
+                centroid = np.zeros((len(rows), n_features))
+
+                rows_obj = has_objects[rows]
+                if rows_obj.any():
+                    obj_mean = obj_sum[rows[rows_obj]]
+                    obj_mean /= np.linalg.norm(obj_mean, axis=1)[:, np.newaxis]
+                    centroid[rows_obj] += (n_objects[rows[rows_obj], np.newaxis]
+                                           * obj_mean)
+
+                rows_children = n_children_sub[rows] > 0
+                centroid[rows_children] += child_centroid_sum[rows[rows_children]]
+
+                rows_centroid = rows_obj | rows_children
+                centroid[rows_centroid] /= np.linalg.norm(
+                    centroid[rows_centroid], axis=1)[:, np.newaxis]
+
+                centroids[rows] = centroid
+                has_centroid[rows] = rows_centroid
+
+            # Fit the prototypes of all nodes of this level at once
+            # (unless the incrementally updated prototypes are still good)
+            own_prototypes[rows[~has_objects[rows]]] = None
+            fit_rows = np.array([pos for pos in rows[has_objects[rows]]
+                                 if own_prototypes[pos] is None or own_prototypes[pos].needs_refit()],
+                                dtype=np.int64)
+            fitted = scheduler.fit([
+                (obj_offsets[pos], obj_offsets[pos + 1], seeds[pos])
+                for pos in fit_rows])
+
+            for pos, prots in zip(fit_rows, fitted):
+                obj_slice = slice(obj_offsets[pos], obj_offsets[pos + 1])
+                n_sample = obj_offsets[pos + 1] - obj_offsets[pos]
+                own_prototypes[pos] = IncrementalPrototypes.from_prototypes(
+                    prots, vectors[obj_slice], weight=n_sample / max(n_objects[pos], n_sample))
+
+            # Per-node values: type objects and merged prototypes
+            for pos in rows:
+                children = index.children(pos)
+                obj_slice = slice(obj_offsets[pos], obj_offsets[pos + 1])
+                node_object_ids = object_ids[obj_slice]
+
+                # _type_objects, _own_type_objects
+                type_objects[pos] = calc_type_objects(
+                    [type_objects[c] for c in children], node_object_ids,
+                    random_state=seeds[pos])
+
+                if n_features is not None:
+                    own_type_objects[pos] = calc_own_type_objects(
+                        centroids[children], vectors[obj_slice], node_object_ids)
+                else:
+                    own_type_objects[pos] = []
+
+                # _prototypes
+                node_prototypes = []
+
+                if own_prototypes[pos] is not None:
+                    node_prototypes.append(own_prototypes[pos])
+
+                node_prototypes.extend(
+                    prototypes[c] for c in children if prototypes[c] is not None)
+
+                if node_prototypes:
+                    prototypes[pos] = merge_prototypes(
+                        node_prototypes, n_prototypes, metric=metric,
+                        method=merge_method, random_state=seeds[pos])
+                else:
+                    prototypes[pos] = None
+
+            if callable(progress_cb):
+                progress_cb(len(rows))
+
+    # Write results back into the frame
+    subtree["_n_objects"] = n_objects
+    subtree["_n_children"] = subtree["_n_children_"]
+    subtree["_n_objects_deep"] = n_objects_deep
+
+    centroids_out = np.empty(n_nodes, dtype=object)
+    for pos in range(n_nodes):
+        if not invalid[pos]:
+            centroids_out[pos] = centroids_in[pos]
+        elif n_features is not None and has_centroid[pos]:
+            centroids_out[pos] = centroids[pos]
+        else:
+            centroids_out[pos] = None
+    subtree["_centroid"] = centroids_out
+
+    subtree["_type_objects"] = type_objects
+    subtree["_own_type_objects"] = own_type_objects
+    subtree["_prototypes"] = prototypes
+    subtree["_own_prototypes"] = own_prototypes
+
+    subtree["__updated"] = invalid
+    subtree["cache_valid"] = True
+
+    return subtree
@@ -0,0 +1,104 @@
+"""
+One-dimensional similarity orderings of the members of a node (see api._arrange_by_sim).
+
+    isomap: 1-D Isomap embedding (fitted on a subsample).
+    pca: Projection onto the first principal component.
+    chain: Greedy nearest-neighbour chain, starting at the member
+        with the smallest projection onto the first principal component.
+
+(See benchmarks/bench_member_ordering.py.)
+"""
+
+import numpy as np
+from sklearn.manifold import Isomap
+
+#: Ordering methods (see similarity_order)
+ORDERINGS = ("isomap", "pca", "chain")
+
+#: Maximum number of vectors that the Isomap embedding is fitted on
+ISOMAP_FIT_SUBSAMPLE_N = 1000
+
+#: Number of neighbors of the Isomap embedding
+ISOMAP_N_NEIGHBORS = 5
+
+
+def _first_component(vectors):
+    """
+    Projection onto the first principal component.
+    """
+    centered = vectors - vectors.mean(axis=0)
+    # The first right singular vector is the first principal component
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    return centered @ vt[0]
+
+
+def order_isomap(vectors, random_state=None):
+    if vectors.shape[0] <= ISOMAP_FIT_SUBSAMPLE_N:
+        subsample = vectors
+    else:
+        idxs = np.random.RandomState(random_state).choice(
+            vectors.shape[0], ISOMAP_FIT_SUBSAMPLE_N, replace=False)
+        subsample = vectors[idxs]
+
+    isomap = Isomap(n_components=1, n_neighbors=ISOMAP_N_NEIGHBORS,
+                    n_jobs=4).fit(subsample)
+
+    return np.argsort(np.squeeze(isomap.transform(vectors), axis=1))
+
+
+def order_pca(vectors):
+    return np.argsort(_first_component(vectors))
+
+
+def order_chain(vectors):
+    n = vectors.shape[0]
+
+    # Unvisited vectors (visited ones are swapped with the last unvisited one)
+    remaining = np.arange(n)
+    remaining_vectors = vectors.copy()
+    remaining_sqnorm = np.einsum("nd,nd->n", vectors, vectors)
+
+    order = np.empty(n, dtype=np.intp)
+
+    pos = int(np.argmin(_first_component(vectors)))
+    for i in range(n):
+        order[i] = remaining[pos]
+        current = remaining_vectors[pos].copy()
+
+        last = n - i - 1
+        remaining[pos] = remaining[last]
+        remaining_vectors[pos] = remaining_vectors[last]
+        remaining_sqnorm[pos] = remaining_sqnorm[last]
+
+        if last == 0:
+            break
+
+        # Nearest unvisited vector: argmin |x|² - 2 x·c
+        pos = int(np.argmin(remaining_sqnorm[:last]
+                            - 2 * (remaining_vectors[:last] @ current)))
+
+    return order
+
+
+def similarity_order(vectors, method="isomap", random_state=0):
+    """
+    Order vectors so that similar vectors are close to each other.
+
+    Parameters:
+        vectors: array of shape = [n_samples, n_features]
+        method: One of ORDERINGS.
+        random_state: Seed of the subsample (isomap).
+
+    Returns:
+        array of indices (a permutation of range(n_samples)).
+    """
+    vectors = np.asarray(vectors, dtype=float)
+
+    if method == "isomap":
+        return order_isomap(vectors, random_state)
+    if method == "pca":
+        return order_pca(vectors)
+    if method == "chain":
+        return order_chain(vectors)
+
+    raise ValueError("Unknown ordering: {!r}".format(method))
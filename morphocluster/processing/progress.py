@@ -0,0 +1,273 @@
+"""
+Labeling progress of a subtree.
+
+The progress of a node is derived from per-node counters. The counters of a
+node only depend on its own values (flags, number of objects, number of
+children) and on the sums of the counters of its children. Approved nodes are
+not descended into, i.e. the counters of their children are ignored.
+
+This allows to
+    a) compute the counters of a whole subtree in one bottom-up pass over
+       its levels (deepest level first) using np.add.at (calc_progress_counters) and
+    b) update stored counters along the path of a modified node using the
+       stored counters of the other children (see calc_path_deltas and
+       Tree._record_modification).
+
+No cached values (prototypes, deep object counts, ...) are required.
+"""
+
+import numpy as np
+import pandas as pd
+
+from morphocluster.processing.consolidation import ChildIndex, _group_offsets
+
+#: Fields of the progress (prefixed with "leaves_" for the sum over all leaves)
+PROGRESS_FIELDS = ["n_objects", "n_objects_deep", "n_filled_objects", "n_approved_objects",
+                   "n_named_objects", "n_approved_nodes", "n_filled_nodes", "n_nodes"]
+
+#: Counters stored per node (column progress_<counter> of nodes)
+PROGRESS_COUNTERS = ["n_objects", "n_objects_deep", "n_approved_objects", "n_named_objects",
+                     "n_approved_nodes", "n_filled_nodes", "n_nodes",
+                     "leaves_n_objects", "leaves_n_filled_objects", "leaves_n_approved_objects",
+                     "leaves_n_named_objects", "leaves_n_approved_nodes", "leaves_n_filled_nodes",
+                     "leaves_n_nodes"]
+
+
+def _rows_by_level(levels):
+    """
+    Rows of each level.
+    """
+    order = np.argsort(levels, kind="stable")
+    offsets = _group_offsets(levels[order], levels.max() + 1)
+    return [order[offsets[l]:offsets[l + 1]] for l in range(len(offsets) - 1)]
+
+
+def node_counters(n_objects, approved, filled, named, n_children, children):
+    """
+    Calculate the progress counters of nodes.
+
+    Parameters:
+        n_objects, approved, filled, named, n_children: Arrays of own values.
+        children: dict of PROGRESS_COUNTERS -> array of sums over the children.
+
+    Returns:
+        dict of PROGRESS_COUNTERS -> array
+    """
+    n_objects = np.asarray(n_objects, dtype=np.int64)
+    approved = np.asarray(approved, dtype=bool)
+    filled = np.asarray(filled, dtype=bool)
+    named = np.asarray(named, dtype=bool)
+    leaf = np.asarray(n_children) == 0
+
+    def descend(key):
+        return np.where(approved, 0, children[key])
+
+    n_objects_deep = n_objects + children["n_objects_deep"]
+
+    return {
+        "n_objects": n_objects,
+        "n_objects_deep": n_objects_deep,
+        "n_approved_objects": np.where(approved, n_objects_deep, children["n_approved_objects"]),
+        "n_named_objects": np.where(named, n_objects_deep, descend("n_named_objects")),
+        "n_approved_nodes": approved + descend("n_approved_nodes"),
+        "n_filled_nodes": filled + descend("n_filled_nodes"),
+        "n_nodes": 1 + descend("n_nodes"),
+        "leaves_n_objects": leaf * n_objects + descend("leaves_n_objects"),
+        "leaves_n_filled_objects": leaf * filled * n_objects + descend("leaves_n_filled_objects"),
+        "leaves_n_approved_objects": leaf * approved * n_objects + descend("leaves_n_approved_objects"),
+        "leaves_n_named_objects": leaf * named * n_objects + descend("leaves_n_named_objects"),
+        "leaves_n_approved_nodes": leaf * approved + descend("leaves_n_approved_nodes"),
+        "leaves_n_filled_nodes": leaf * filled + descend("leaves_n_filled_nodes"),
+        "leaves_n_nodes": leaf * 1 + descend("leaves_n_nodes"),
+    }
+
+
+def calc_progress_counters(subtree):
+    """
+    Calculate the progress counters of all nodes of a subtree.
+
+    Parameters:
+        subtree (pandas.DataFrame): All nodes of the subtree with the columns
+            node_id, parent_id, level, approved, filled, name and
+            n_objects (number of own objects).
+
+    Returns:
+        pandas.DataFrame of PROGRESS_COUNTERS (same index as subtree).
+    """
+    child_index = ChildIndex(subtree["node_id"], subtree["parent_id"])
+    parent_pos = child_index.parent_pos
+    n_children = child_index.n_children()
+
+    levels = subtree["level"].to_numpy(np.int64)
+
+    approved = subtree["approved"].fillna(False).to_numpy(bool)
+    filled = subtree["filled"].fillna(False).to_numpy(bool)
+    named = pd.notna(subtree["name"]).to_numpy(bool)
+    n_objects = subtree["n_objects"].to_numpy(np.int64)
+
+    counters = {k: np.zeros(len(subtree), dtype=np.int64)
+                for k in PROGRESS_COUNTERS}
+    children = {k: np.zeros(len(subtree), dtype=np.int64)
+                for k in PROGRESS_COUNTERS}
+
+    for rows in reversed(_rows_by_level(levels)):
+        values = node_counters(n_objects[rows], approved[rows], filled[rows], named[rows],
+                               n_children[rows], {k: v[rows] for k, v in children.items()})
+
+        has_parent = parent_pos[rows] >= 0
+        for k, v in values.items():
+            counters[k][rows] = v
+            np.add.at(children[k], parent_pos[rows[has_parent]], v[has_parent])
+
+    return pd.DataFrame(counters, index=subtree.index)
+
+
+def calc_path_deltas(path, children, modified):
+    """
+    Calculate the changes of the progress counters of the nodes on (a union of) paths.
+
+    The counters of the modified nodes (whose own values or children changed) are recomputed.
+    For all other nodes, only the changes of the counters of their children are propagated:
+    Given the own values of a node, its counters are affine in the sums over its children,
+    so that the resulting deltas commute with concurrent changes below the node.
+
+    Parameters:
+        path: dict node_id -> dict with parent_id, n_objects, approved, filled, named
+            and the current counters (progress_<counter>, None if unknown).
+        children: dict node_id -> dict with n_children, n_unknown (number of children with unknown counters)
+            and the sums of PROGRESS_COUNTERS over the children of the node that are *not* on the path.
+        modified: Collection of `node_id`s whose own values or children changed.
+
+    Returns:
+        (counters, deltas)
+        counters: dict node_id -> dict of PROGRESS_COUNTERS (None if unknown)
+            that replace the current counters of the modified nodes
+            (and of the nodes that become unknown).
+        deltas: dict node_id -> dict of PROGRESS_COUNTERS that are added to the current counters
+            of the other nodes (only if a counter changes).
+    """
+    modified = set(modified)
+
+    n_children = {}
+    n_unknown = {}
+    old_sums = {}
+    new_sums = {}
+    for node_id in path:
+        aggregate = children.get(node_id, {})
+        n_children[node_id] = aggregate.get("n_children", 0)
+        n_unknown[node_id] = aggregate.get("n_unknown", 0)
+        old_sums[node_id] = {k: aggregate.get(k) or 0
+                             for k in PROGRESS_COUNTERS}
+        new_sums[node_id] = dict(old_sums[node_id])
+
+    # Children on the path with unknown counters (before / after the modification)
+    old_unknown = set()
+    new_unknown = set()
+
+    for node in path.values():
+        if node["parent_id"] in path:
+            n_children[node["parent_id"]] += 1
+
+    def depth(node_id):
+        d = 0
+        while path[node_id]["parent_id"] in path:
+            node_id = path[node_id]["parent_id"]
+            d += 1
+        return d
+
+    def calc(node_id, sums):
+        node = path[node_id]
+        values = node_counters(
+            *(np.array([v]) for v in (node["n_objects"], node["approved"], node["filled"],
+                                      node["named"], n_children[node_id])),
+            {k: np.array([v]) for k, v in sums.items()})
+        return {k: int(v[0]) for k, v in values.items()}
+
+    counters = {}
+    deltas = {}
+
+    # Deepest first
+    for node_id in sorted(path, key=depth, reverse=True):
+        node = path[node_id]
+        parent_id = node["parent_id"]
+
+        old = {k: node["progress_" + k] for k in PROGRESS_COUNTERS}
+        if any(v is None for v in old.values()):
+            old = None
+
+        if n_unknown[node_id] or node_id in new_unknown:
+            new = None
+        else:
+            new = calc(node_id, new_sums[node_id])
+
+        if node_id in modified:
+            counters[node_id] = new
+        elif new is not None and old is not None and node_id not in old_unknown:
+            reference = calc(node_id, old_sums[node_id])
+            delta = {k: new[k] - reference[k] for k in PROGRESS_COUNTERS}
+            if any(delta.values()):
+                deltas[node_id] = delta
+            new = {k: old[k] + delta[k] for k in PROGRESS_COUNTERS}
+        else:
+            # Unknown counters stay unknown (until they are rebuilt, see Tree.rebuild_progress)
+            if old is not None:
+                counters[node_id] = None
+            new = None
+
+        if parent_id in path:
+            for values, sums, unknown in ((old, old_sums, old_unknown),
+                                          (new, new_sums, new_unknown)):
+                if values is None:
+                    unknown.add(parent_id)
+                else:
+                    for k, v in values.items():
+                        sums[parent_id][k] += v
+
+    return counters, deltas
+
+
+def progress_from_counters(counters, filled):
+    """
+    Convert the progress counters of a node to its progress.
+
+    Parameters:
+        counters: Mapping of PROGRESS_COUNTERS.
+        filled: Flag of the node.
+
+    Returns:
+        dict of PROGRESS_FIELDS for the node and its leaves.
+    """
+    result = {k: int(counters[k]) for k in PROGRESS_COUNTERS}
+
+    result["n_filled_objects"] = int(bool(filled)) * result["n_objects_deep"]
+    result["leaves_n_objects_deep"] = result["leaves_n_objects"]
+
+    return result
+
+
+def calc_progress(subtree, root_id):
+    """
+    Calculate the labeling progress of a subtree.
+
+    Approved nodes are not descended into, i.e. their successors are not counted.
+
+    Parameters:
+        subtree (pandas.DataFrame): See calc_progress_counters.
+        root_id: node_id of the root of the subtree.
+
+    Returns:
+        dict of PROGRESS_FIELDS for the root and the leaves.
+    """
+    root_mask = (subtree["node_id"] == root_id).to_numpy()
+    if not root_mask.any():
+        raise ValueError("root_id is not part of the subtree")
+
+    # The root must not have a parent inside the subtree
+    subtree = subtree.assign(
+        parent_id=subtree["parent_id"].where(~root_mask, np.nan))
+
+    counters = calc_progress_counters(subtree)
+    root_pos = np.flatnonzero(root_mask)[0]
+
+    return progress_from_counters(counters.iloc[root_pos],
+                                  subtree["filled"].iloc[root_pos])
@@ -2,7 +2,7 @@ import numpy as np
 from numpy.lib.arraysetops import unique
 from scipy.spatial.distance import cdist
 from sklearn.base import ClassifierMixin
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.cluster import AgglomerativeClustering, KMeans
 from sklearn.exceptions import NotFittedError
 from sklearn.preprocessing import LabelEncoder
 from sklearn.utils.extmath import softmax
@@ -15,6 +15,165 @@ def _check_is_clusterer(clusterer):
         raise TypeError("%s is not a proper clusterer instance." % (clusterer))
 
 
+def _sqdist_to(X, x_sqnorm, c):
+    """
+    Squared euclidean distances of the rows of X to one center per problem.
+
+    X: [n_problems, n_rows, n_features], c: [n_problems, n_features] -> [n_problems, n_rows]
+    """
+    d = (x_sqnorm - 2 * np.einsum("bnd,bd->bn", X, c)
+         + np.einsum("bd,bd->b", c, c)[:, np.newaxis])
+    return np.maximum(d, 0)
+
+
+def _assign(X, x_sqnorm, centers):
+    """
+    Nearest center and its squared euclidean distance for every row of every problem.
+    """
+    # |x|² - 2 x·c + |c|² (matmul uses batched BLAS)
+    distances = (np.einsum("bkd,bkd->bk", centers, centers)[:, np.newaxis, :]
+                 - 2 * np.matmul(X, centers.transpose(0, 2, 1)))
+    labels = np.argmin(distances, axis=2)
+    min_distances = np.take_along_axis(
+        distances, labels[..., np.newaxis], axis=2)[..., 0] + x_sqnorm
+
+    return labels, np.maximum(min_distances, 0)
+
+
+def batched_kmeans(Xs, n_clusters, random_states=None, max_iter=50, tol=1e-6):
+    """
+    Fit k-means (Lloyd's algorithm with k-means++ seeding) to many independent problems at once.
+
+    The problems are zero-padded to a common number of rows, so that every
+    step (seeding, assignment, update) is one vectorized operation over all problems.
+    Converged problems keep their centers while the others continue.
+
+    The result of a problem only depends on its data and its random state
+    (not on the other problems of the batch).
+
+    Parameters:
+        Xs: list of arrays of shape = [n_samples_i, n_features] (n_samples_i > 0)
+        n_clusters: int
+        random_states: list of seeds (one per problem) or None.
+        max_iter: Maximum number of iterations.
+        tol: A problem converged if no center moves more than tol (squared euclidean distance).
+
+    Returns:
+        (centers, labels, inertia)
+        centers: array of shape = [n_problems, n_clusters, n_features]
+        labels: list of arrays of shape = [n_samples_i]
+        inertia: array of shape = [n_problems]
+    """
+    n_problems, k = len(Xs), n_clusters
+    n_samples = np.array([X.shape[0] for X in Xs])
+    n_features = Xs[0].shape[1]
+
+    if (n_samples == 0).any():
+        raise ValueError("X contains no samples.")
+
+    X = np.zeros((n_problems, n_samples.max(), n_features))
+    for b, X_b in enumerate(Xs):
+        X[b, :n_samples[b]] = X_b
+    valid = np.arange(X.shape[1])[np.newaxis, :] < n_samples[:, np.newaxis]
+    x_sqnorm = np.einsum("bnd,bnd->bn", X, X)
+
+    if random_states is None:
+        random_states = [None] * n_problems
+
+    # Random numbers of the seeding (per problem)
+    u = np.stack([np.random.RandomState(rs).rand(k) for rs in random_states])
+
+    rows = np.arange(n_problems)
+
+    # k-means++ seeding: Choose the next center with probability proportional
+    # to the squared distance to the closest chosen center
+    centers = np.empty((n_problems, k, n_features))
+    idx = np.minimum((u[:, 0] * n_samples).astype(int), n_samples - 1)
+    centers[:, 0] = X[rows, idx]
+    closest = np.where(valid, _sqdist_to(X, x_sqnorm, centers[:, 0]), 0)
+    for i in range(1, k):
+        cumsum = np.cumsum(closest, axis=1)
+        total = cumsum[:, -1]
+        idx = np.count_nonzero(
+            cumsum <= (u[:, i] * total)[:, np.newaxis], axis=1)
+        # All rows are centers already: Choose uniformly
+        idx = np.where(total > 0, idx, (u[:, i] * n_samples).astype(int))
+        idx = np.minimum(idx, n_samples - 1)
+
+        centers[:, i] = X[rows, idx]
+        np.minimum(closest, np.where(valid, _sqdist_to(X, x_sqnorm, centers[:, i]), 0),
+                   out=closest)
+
+    active = np.arange(n_problems)
+    for _ in range(max_iter):
+        # Only iterate the problems that did not converge yet
+        X_a, centers_a, valid_a = X[active], centers[active], valid[active]
+        labels, _ = _assign(X_a, x_sqnorm[active], centers_a)
+
+        # Padded rows are not members of any cluster
+        members = ((labels[..., np.newaxis] == np.arange(k))
+                   & valid_a[..., np.newaxis]).astype(X.dtype)
+        support = members.sum(axis=1)
+        sums = np.matmul(members.transpose(0, 2, 1), X_a)
+
+        # Empty clusters keep their center
+        new_centers = np.where(support[..., np.newaxis] > 0,
+                               sums / np.maximum(support, 1)[..., np.newaxis],
+                               centers_a)
+
+        shift = np.max(np.sum((new_centers - centers_a) ** 2, axis=2), axis=1)
+        centers[active] = new_centers
+        active = active[shift > tol]
+
+        if not len(active):
+            break
+
+    labels, distances = _assign(X, x_sqnorm, centers)
+    inertia = np.where(valid, distances, 0).sum(axis=1)
+
+    return centers, [labels[b, :n_samples[b]] for b in range(n_problems)], inertia
+
+
+class LloydKMeans:
+    """
+    Lightweight k-means (Lloyd's algorithm with k-means++ seeding) in NumPy.
+
+    Avoids the per-fit overhead of sklearn.cluster.KMeans for small problems.
+    Can be used as the clusterer of Prototypes.
+    Many problems can be fitted at once using fit_prototypes_batched.
+
+    Parameters:
+        n_clusters: int
+        max_iter: Maximum number of iterations.
+        tol: Stop if no center moves more than tol (squared euclidean distance).
+        random_state: Seed of the seeding.
+
+    Attributes:
+        cluster_centers_: array of shape = [n_clusters, n_features]
+        labels_: array of shape = [n_samples]
+    """
+
+    def __init__(self, n_clusters, max_iter=50, tol=1e-6, random_state=None):
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, X):
+        centers, labels, inertia = batched_kmeans(
+            [np.asarray(X, dtype=float)], self.n_clusters, [self.random_state],
+            self.max_iter, self.tol)
+
+        self.cluster_centers_ = centers[0]
+        self.labels_ = labels[0]
+        self.inertia_ = float(inertia[0])
+
+        return self
+
+    def fit_predict(self, X):
+        return self.fit(X).labels_
+
+
 class Prototypes:
     """
     Represent a number of vectors by a lower number of prototypes.
@@ -64,8 +223,12 @@ class Prototypes:
 
         labels = self.clusterer.fit_predict(X)
 
-        self.prototypes_ = self.clusterer.cluster_centers_
-        self.support_ = np.bincount(labels)
+        # Drop empty clusters
+        support = np.bincount(labels, minlength=self.clusterer.n_clusters)
+        nonempty = support > 0
+
+        self.prototypes_ = self.clusterer.cluster_centers_[nonempty]
+        self.support_ = support[nonempty]
 
     def transform(self, X, metric='euclidean', **kwargs):
         """
@@ -109,11 +272,254 @@ class Prototypes:
             IEEE Comput. Soc. Press, pp. 566–568. doi: 10.1109/ICPR.1994.576361.
         """
         dist_matrix = cdist(
-            other.prototypes, self.prototypes_, metric=metric, **kwargs)
+            other.prototypes_, self.prototypes_, metric=metric, **kwargs)
 
         return max(np.mean(np.min(dist_matrix, axis=a)) for a in (0, 1))
 
 
+#: Default maximum drift (changed fraction of the fitted vectors) before a refit
+REFIT_DRIFT = 0.2
+
+#: Default maximum ratio of the quantization error of added vectors and the inertia of the fit
+REFIT_ERROR_RATIO = 2.0
+
+
+def fit_prototypes_batched(Xs, clusterer, random_states=None):
+    """
+    Fit Prototypes for many independent problems at once using batched_kmeans.
+
+    Equivalent to fitting Prototypes(clusterer) with
+    clusterer.random_state=random_states[i] to every Xs[i].
+
+    Parameters:
+        Xs: list of arrays of shape = [n_samples_i, n_features]
+        clusterer: LloydKMeans (template for n_clusters, max_iter and tol).
+        random_states: list of seeds (one per problem) or None.
+
+    Returns:
+        list of Prototypes in the same order as Xs.
+    """
+    if not isinstance(clusterer, LloydKMeans):
+        raise ValueError("clusterer is not a LloydKMeans.")
+
+    if random_states is None:
+        random_states = [None] * len(Xs)
+
+    k = clusterer.n_clusters
+    result = [Prototypes(None) for _ in Xs]
+
+    # Trivial problems are handled like in Prototypes.fit
+    batch = []
+    for i, X in enumerate(Xs):
+        if X.shape[0] == 0:
+            raise ValueError("X contains no samples.")
+
+        if k == 1:
+            result[i].prototypes_ = np.mean(X, axis=0)[np.newaxis, :]
+            result[i].support_ = np.array([X.shape[0]])
+        elif X.shape[0] <= k:
+            result[i].prototypes_ = X.copy()
+            result[i].support_ = np.ones(X.shape[0])
+        else:
+            batch.append(i)
+
+    if batch:
+        centers, labels, _ = batched_kmeans(
+            [np.asarray(Xs[i], dtype=float) for i in batch], k,
+            [random_states[i] for i in batch], clusterer.max_iter, clusterer.tol)
+
+        for i, centers_, labels_ in zip(batch, centers, labels):
+            # Drop empty clusters
+            support = np.bincount(labels_, minlength=k)
+            nonempty = support > 0
+
+            result[i].prototypes_ = centers_[nonempty]
+            result[i].support_ = support[nonempty]
+
+    return result
+
+
+def _nearest_prototypes(X, prototypes_):
+    """
+    Index and squared euclidean distance of the nearest prototype for every row in X.
+    """
+    dist_matrix = cdist(X, prototypes_, metric="sqeuclidean")
+    labels = np.argmin(dist_matrix, axis=1)
+    return labels, dist_matrix[np.arange(X.shape[0]), labels]
+
+
+class IncrementalPrototypes(Prototypes):
+    """
+    Prototypes that absorb added and removed vectors without a refit.
+
+    Per-prototype sums and (weighted) counts are kept, so that every update
+    assigns the vectors to their nearest prototype and moves it to the new mean
+    of its members (online k-means). Updating m vectors costs O(m·k·d).
+
+    If the prototypes were fitted on a sample, every vector has the weight
+    n_sample / n_vectors, so that the support stays in units of the sample.
+
+    The prototypes drift away from a k-means solution with every update.
+    This is measured by
+        drift: Changed (added or removed) fraction of the fitted vectors and
+        error_ratio: Mean squared distance of the added vectors to their prototype
+            relative to the mean squared distance of the fitted vectors (inertia).
+    needs_refit implements the refit policy.
+
+    Attributes:
+        prototypes_: array of shape = [n_prototypes, n_features]
+        support_: array of shape = [n_prototypes]
+        sums_: array of shape = [n_prototypes, n_features]
+            Weighted sum of the members of each prototype.
+        weight_: Weight of a single vector.
+        n_fit_: Total support after the fit.
+        n_changed_: Weight of the added and removed vectors since the fit.
+        n_added_: Weight of the added vectors since the fit.
+        error_: Weighted sum of the squared distances of the added vectors to their prototype.
+        inertia_: Mean squared distance of the fitted vectors to their prototype.
+    """
+
+    def fit(self, X, weight=1.0):
+        """
+        Calculate k prototypes based on X.
+
+        Parameters:
+            X: array of shape = [n_samples, n_features]
+            weight: Weight of a single vector (n_samples / n_vectors, if X is a sample).
+        """
+        super().fit(X)
+        self._reset(X, weight)
+
+    @classmethod
+    def from_prototypes(cls, prototypes, X, weight=1.0):
+        """
+        Create an IncrementalPrototypes object from fitted Prototypes.
+
+        Parameters:
+            prototypes: Prototypes fitted on X.
+            X: array of shape = [n_samples, n_features]
+            weight: See fit.
+        """
+        check_is_fitted(prototypes, ["prototypes_", "support_"])
+
+        result = cls(None)
+        result.prototypes_ = np.asarray(prototypes.prototypes_, dtype=float)
+        result.support_ = np.asarray(prototypes.support_, dtype=float)
+        result._reset(X, weight)
+
+        return result
+
+    def _reset(self, X, weight):
+        self.prototypes_ = np.asarray(self.prototypes_, dtype=float)
+        self.support_ = np.asarray(self.support_, dtype=float)
+        self.sums_ = self.prototypes_ * self.support_[:, np.newaxis]
+
+        self.weight_ = float(weight)
+        self.n_fit_ = float(self.support_.sum())
+        self.n_changed_ = 0.0
+        self.n_added_ = 0.0
+        self.error_ = 0.0
+
+        _, distances = _nearest_prototypes(X, self.prototypes_)
+        self.inertia_ = float(np.mean(distances))
+
+    def partial_fit(self, X):
+        """
+        Absorb added vectors.
+
+        Parameters:
+            X: array of shape = [n_samples, n_features]
+        """
+        check_is_fitted(self, ["sums_"])
+
+        if X.shape[0] == 0:
+            return
+
+        if self.prototypes_.shape[0] == 0:
+            # All prototypes were removed: Start over with the mean
+            self.sums_ = self.weight_ * X.sum(axis=0)[np.newaxis, :]
+            self.support_ = np.array([self.weight_ * X.shape[0]])
+            self.prototypes_ = self.sums_ / self.support_[:, np.newaxis]
+            self.n_changed_ += self.weight_ * X.shape[0]
+            self.n_added_ += self.weight_ * X.shape[0]
+            return
+
+        labels, distances = _nearest_prototypes(X, self.prototypes_)
+
+        np.add.at(self.sums_, labels, self.weight_ * X)
+        self.support_ += self.weight_ * \
+            np.bincount(labels, minlength=self.support_.shape[0])
+        self.prototypes_ = self.sums_ / self.support_[:, np.newaxis]
+
+        self.n_changed_ += self.weight_ * X.shape[0]
+        self.n_added_ += self.weight_ * X.shape[0]
+        self.error_ += self.weight_ * distances.sum()
+
+    def remove(self, X):
+        """
+        Remove vectors.
+
+        Each vector is subtracted from its nearest prototype.
+        Prototypes without remaining support are dropped.
+
+        Parameters:
+            X: array of shape = [n_samples, n_features]
+        """
+        check_is_fitted(self, ["sums_"])
+
+        if X.shape[0] == 0 or self.prototypes_.shape[0] == 0:
+            return
+
+        labels, _ = _nearest_prototypes(X, self.prototypes_)
+
+        np.subtract.at(self.sums_, labels, self.weight_ * X)
+        self.support_ -= self.weight_ * \
+            np.bincount(labels, minlength=self.support_.shape[0])
+
+        # Allow for rounding errors of the weights
+        nonempty = self.support_ > 1e-6 * self.weight_
+        self.sums_ = self.sums_[nonempty]
+        self.support_ = self.support_[nonempty]
+        self.prototypes_ = self.sums_ / self.support_[:, np.newaxis]
+
+        self.n_changed_ += self.weight_ * X.shape[0]
+
+    @property
+    def drift(self):
+        """
+        Changed fraction of the fitted vectors.
+        """
+        return self.n_changed_ / self.n_fit_ if self.n_fit_ > 0 else np.inf
+
+    @property
+    def error_ratio(self):
+        """
+        Mean squared distance of the added vectors to their prototype relative to the inertia of the fit.
+
+        1.0 if no vectors were added.
+        """
+        if self.n_added_ == 0:
+            return 1.0
+
+        if self.inertia_ == 0:
+            return np.inf if self.error_ > 0 else 1.0
+
+        return (self.error_ / self.n_added_) / self.inertia_
+
+    def needs_refit(self, max_drift=REFIT_DRIFT, max_error_ratio=REFIT_ERROR_RATIO):
+        """
+        Refit policy: Refit, if the prototypes drifted too far from the fitted solution.
+
+        This is the case if
+            - too many vectors changed (drift > max_drift),
+            - the added vectors are badly represented (error_ratio > max_error_ratio) or
+            - no prototypes remain.
+        """
+        return (self.prototypes_.shape[0] == 0
+                or self.drift > max_drift
+                or self.error_ratio > max_error_ratio)
+
+
 class PrototypeClassifier(ClassifierMixin):
     def __init__(self, clusterer, metric='euclidean', n_classes=None):
         self.metric = metric
@@ -174,19 +580,74 @@ class PrototypeClassifier(ClassifierMixin):
         ...
 
 
-def merge_prototypes(children, k, metric='euclidean'):
+#: Methods of merge_prototypes
+MERGE_METHODS = ("complete", "kmeans", "hierarchical")
+
+#: Metrics that are supported by all methods of merge_prototypes
+METRICS = ("euclidean", "cosine")
+
+#: Number of children that are merged at once by the hierarchical merge
+MERGE_GROUP_SIZE = 32
+
+
+def _merge_clusters(prototypes_, support_, labels):
+    """
+    Combine the prototypes of each cluster into their support-weighted mean.
+    """
+    unique_labels, labels = np.unique(labels, return_inverse=True)
+
+    new_support = np.zeros(unique_labels.shape[0], support_.dtype)
+    np.add.at(new_support, labels, support_)
+
+    # Weighted sum of all elements in the cluster
+    new_prototypes = np.zeros(
+        (unique_labels.shape[0], prototypes_.shape[1]))
+    np.add.at(new_prototypes, labels, prototypes_ * support_[:, np.newaxis])
+    # Normalize
+    new_prototypes /= new_support[:, np.newaxis]
+
+    result = Prototypes(None)
+    result.prototypes_ = new_prototypes.astype(prototypes_.dtype, copy=False)
+    result.support_ = new_support
+
+    return result
+
+
+def merge_prototypes(children, k, metric='euclidean', method="complete",
+                     group_size=MERGE_GROUP_SIZE, random_state=0):
     """
     Merge a number of prototypes of a list of children so that k new prototypes result.
 
+    The prototypes of all children are clustered and the prototypes
+    of each cluster are combined into their support-weighted mean.
+    For the cosine metric, the prototypes are clustered on the unit sphere.
+
+    Methods:
+        complete: Complete-linkage clustering of all prototypes.
+            O(n²) memory and O(n² log n) time in the number n of prototypes.
+        kmeans: Weighted k-means (weights: support) of all prototypes.
+            O(n·k·d) per iteration.
+        hierarchical: Complete-linkage merges of groups of `group_size` children,
+            repeated on the merged groups until only one group remains.
+            O(n·group_size·k) time.
+
     Parameters:
         children: list of Prototypes objects
         k: int
             Number of resulting prototypes
+        metric: Metric of the complete-linkage clustering.
+        method: One of MERGE_METHODS.
+        group_size: Number of children per group of the hierarchical merge.
+        random_state: Seed of the k-means initialization.
 
     Returns: Prototypes object
     """
-    clusterer = AgglomerativeClustering(
-        n_clusters=k, affinity=metric, linkage="complete")
+    if method not in MERGE_METHODS:
+        raise ValueError("Unknown method: {!r}".format(method))
+
+    if method == "kmeans" and metric not in ("euclidean", "cosine"):
+        raise ValueError(
+            "kmeans only supports the euclidean and the cosine metric")
 
     if not children:
         return Prototypes(None)
@@ -194,6 +655,12 @@ def merge_prototypes(children, k, metric='euclidean'):
     for c in children:
         check_is_fitted(c, ["prototypes_", "support_"])
 
+    if method == "hierarchical":
+        while len(children) > group_size:
+            children = [merge_prototypes(children[i:i + group_size], k, metric)
+                        for i in range(0, len(children), group_size)]
+        method = "complete"
+
     prototypes_ = np.concatenate([ncd.prototypes_ for ncd in children])
     support_ = np.concatenate([ncd.support_ for ncd in children])
 
@@ -204,29 +671,20 @@ def merge_prototypes(children, k, metric='euclidean'):
 
         return result
 
-    labels = clusterer.fit_predict(prototypes_)
-    unique_labels = np.unique(labels)
-
-    new_prototypes = np.empty(
-        (unique_labels.shape[0], prototypes_.shape[1]),
-        prototypes_.dtype)
-    new_support = np.empty(
-        (unique_labels.shape[0]),
-        support_.dtype)
-
-    for label in unique_labels:
-        mask = labels == label
-        new_support[label] = support_[mask].sum()
-
-        # Weighted sum of all elements in the cluster
-        x = np.sum(prototypes_[mask] * support_[mask, np.newaxis], axis=0)
-        # Normalize
-        x /= new_support[label]
-
-        new_prototypes[label] = x
-
-    result = Prototypes(None)
-    result.prototypes_ = new_prototypes
-    result.support_ = new_support
-
-    return result
+    X = prototypes_
+    if metric == "cosine":
+        # On the unit sphere, the euclidean distance is a monotonic function of the cosine distance.
+        # Zero prototypes (without a direction) stay at the origin.
+        norm = np.linalg.norm(X, axis=1, keepdims=True)
+        X = X / np.maximum(norm, np.finfo(norm.dtype).eps)
+        metric = "euclidean"
+
+    if method == "kmeans":
+        clusterer = KMeans(k, n_init=1, random_state=random_state)
+        labels = clusterer.fit(X, sample_weight=support_).labels_
+    else:
+        clusterer = AgglomerativeClustering(
+            n_clusters=k, affinity=metric, linkage="complete")
+        labels = clusterer.fit_predict(X)
+
+    return _merge_clusters(prototypes_, support_, labels)
@@ -11,27 +11,15 @@ import hdbscan
 from morphocluster.processing import Tree
 
 
-def _subsample_dataset(sample_size, dataset):
+def _subsample_index(sample_size, index):
     """
-    dataset["features"] is a numpy.ndarray
-    dataset["objids"] is a pandas.Series
+    Randomly choose sample_size entries of index (preserving their order).
     """
 
-    features = dataset["features"]
-    objids = dataset["objids"]
+    if len(index) <= sample_size:
+        return index
 
-    if features.shape[0] <= sample_size:
-        return dataset
-
-    idx = np.random.permutation(features.shape[0])[:sample_size]
-
-    features = features[idx]
-    objids = objids.iloc[idx].reset_index(drop=True)
-
-    return {
-        "features": features,
-        "objids": objids
-    }
+    return np.sort(np.random.permutation(index)[:sample_size])
 
 
 class Recluster:
@@ -73,6 +61,51 @@ class Recluster:
 
         return self
 
+    def load_feature_store(self, path, append=True):
+        """
+        Load object features from a FeatureStore.
+
+        The features are memory-mapped and only the rows that are actually
+        clustered are read from disk.
+
+        Parameters:
+            path: Directory of the store.
+            append: Append to the existing features (instead of replacing).
+        """
+        from morphocluster.feature_store import FeatureStore
+
+        print("Loading {}...".format(path))
+
+        store = FeatureStore(path)
+        rows, object_ids = store.live_rows()
+
+        if len(rows) == store.n_rows:
+            features = store.vectors
+        else:
+            # Some rows are shadowed by later appends
+            features = store.vectors[rows]
+
+        dataset = {
+            "features": features,
+            "objids": pd.Series(object_ids, dtype=object)
+        }
+
+        if append and self.dataset is not None:
+            self.dataset["features"] = np.concatenate((self.dataset["features"],
+                                                       dataset["features"]))
+
+            self.dataset["objids"] = pd.concat((self.dataset["objids"],
+                                                dataset["objids"]))
+        else:
+            self.dataset = dataset
+
+        print("Loaded {:,d} features.".format(len(dataset["features"])))
+
+        if append:
+            print("Dataset size: {:,d}".format(len(self.dataset["features"])))
+
+        return self
+
     def load_tree(self, tree):
         """
         Load an existing cluster tree.
@@ -85,7 +118,10 @@ class Recluster:
 
         return self
 
-    def _get_unapproved_dataset(self):
+    def _get_unapproved_index(self):
+        """
+        Get the index of unapproved objects in the dataset.
+        """
         approved_objids = []
         tree_objids = []
         for i, tree in enumerate(self.trees):
@@ -134,10 +170,7 @@ class Recluster:
         print("Unapproved objects present in dataset: {:,d} / {:,d} ({:.2%})".format(
             n_selected, n_total, (n_selected / n_total)))
 
-        return {
-            "features": self.dataset["features"][dataset_selector],
-            "objids": dataset_objids[dataset_selector].reset_index(drop=True)
-        }
+        return np.flatnonzero(dataset_selector.values)
 
     def cluster(self, ignore_approved=True, sample_size=None, **kwargs):
         """
@@ -145,13 +178,19 @@ class Recluster:
         """
 
         if ignore_approved:
-            dataset = self._get_unapproved_dataset()
+            index = self._get_unapproved_index()
         else:
-            dataset = self.dataset
+            index = np.arange(len(self.dataset["objids"]))
 
         if sample_size is not None:
             print("Subsampling dataset ({:,d})...".format(sample_size))
-            dataset = _subsample_dataset(sample_size, dataset)
+            index = _subsample_index(sample_size, index)
+
+        # Only gather the selected features (which is cheap for memory-mapped features)
+        dataset = {
+            "features": np.asarray(self.dataset["features"][index]),
+            "objids": pd.Series(self.dataset["objids"]).iloc[index].reset_index(drop=True)
+        }
 
         clusterer = hdbscan.HDBSCAN(**kwargs)
 
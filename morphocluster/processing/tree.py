@@ -267,7 +267,7 @@ class Tree(object):
         Get the ID of the root node.
         """
         selector = self.nodes["parent_id"].isnull()
-        return np.asscalar(self.nodes.loc[selector, "node_id"])
+        return self.nodes.loc[selector, "node_id"].item()
 
     def topological_order(self, root_id=None):
         """
@@ -284,21 +284,26 @@ class Tree(object):
         if root_id is None:
             root_id = self.get_root_id()
 
+        # Index nodes and their children once (instead of scanning for every node)
+        node_idxs = {}
+        for node_idx, node_id in zip(self.nodes.index, self.nodes["node_id"]):
+            node_idxs.setdefault(node_id, node_idx)
+
+        children = {parent_id: group.tolist()
+                    for parent_id, group in self.nodes.groupby("parent_id", sort=False)["node_id"]}
+
         queue = [root_id]
 
         while queue:
             node_id = queue.pop()
 
-            child_selector = self.nodes["parent_id"] == node_id
-            queue.extend(self.nodes.loc[child_selector, "node_id"])
-
-            node_selector = self.nodes["node_id"] == node_id
+            queue.extend(children.get(node_id, ()))
 
-            if not node_selector.any():
+            try:
+                node_idx = node_idxs[node_id]
+            except KeyError:
                 raise ValueError(
-                    "No matching row for node_id={}".format(node_id))
-
-            node_idx = node_selector.idxmax()
+                    "No matching row for node_id={}".format(node_id)) from None
 
             yield node_idx
 
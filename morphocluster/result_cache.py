@@ -0,0 +1,369 @@
+"""
+Cache of paginated results (see api.cache_serialize_page).
+
+Results are content-addressed: The key (the `request_id` of the API) is derived
+from the name of the function, its arguments and a version of its inputs
+(see Tree.get_cache_version). Repeated requests for unchanged inputs are
+served from the cache. Concurrent computations of the same result are coalesced
+using a Redis lock, so that only one worker computes it.
+
+A result is either stored as serialized pages or, lazily, as a compact
+serialized ordering from which individual pages are rendered (and stored) on demand.
+
+Entries expire after `ttl` seconds. The total size of the entries is capped
+at `max_bytes` (the oldest entries are evicted first).
+
+    <prefix>:<name>:<request_id>: Hash with the number of pages ("n"),
+        the ordering ("order", lazy results) and the pages ("0", "1", ...)
+    <prefix>:<name>:<request_id>:lock: Lock of the computation
+    <prefix>:entries: Sorted set key -> time of creation
+    <prefix>:sizes: Hash key -> size in bytes
+    <prefix>:bytes: Total size of the entries
+    <prefix>:stats: Hash with hits, misses, coalesced, renders, evicted
+"""
+
+import base64
+import hashlib
+import json
+import time
+import zlib
+
+import numpy as np
+from flask import current_app, has_app_context
+from redis.exceptions import LockError
+
+# Store an entry, replacing the size of a previous (e.g. expired) entry of the same key.
+#   KEYS[1]: Entry, KEYS[2]: Entries, KEYS[3]: Sizes, KEYS[4]: Total size
+#   ARGV[1]: TTL, ARGV[2]: Time, ARGV[3]: Size, ARGV[4...]: Field, value, ...
+_STORE_SCRIPT = """
+local old_size = redis.call('HGET', KEYS[3], KEYS[1])
+if old_size then
+    redis.call('DECRBY', KEYS[4], old_size)
+end
+redis.call('DEL', KEYS[1])
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], ARGV[3])
+redis.call('INCRBY', KEYS[4], ARGV[3])
+return 1
+"""
+
+# Store a page of an entry (if the entry still exists) and account for its size.
+#   KEYS[1]: Entry, KEYS[2]: Sizes, KEYS[3]: Total size
+#   ARGV[1]: Field, ARGV[2]: Value
+_STORE_PAGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[2], KEYS[1], string.len(ARGV[2]))
+redis.call('INCRBY', KEYS[3], string.len(ARGV[2]))
+return 1
+"""
+
+
+def encode_ordering(keys, scores):
+    """
+    Serialize an ordering compactly.
+
+    Parameters:
+        keys: List of json-serializable keys.
+        scores: Scores of the keys (stored as float32).
+
+    Returns:
+        bytes
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    ordering = {"keys": list(keys), "scores": base64.b64encode(scores.tobytes()).decode()}
+    # Fast compression, the ordering is written once and read once per page
+    return zlib.compress(json.dumps(ordering).encode(), 1)
+
+
+def decode_ordering(order, start=None, stop=None):
+    """
+    Deserialize the items [start:stop] of an ordering (see encode_ordering).
+
+    Returns:
+        List of (key, score).
+    """
+    ordering = json.loads(zlib.decompress(order).decode())
+    scores = np.frombuffer(base64.b64decode(ordering["scores"]), dtype=np.float32)
+    return list(zip(ordering["keys"][start:stop], scores[start:stop].tolist()))
+
+
+class ResultCache:
+    """
+    Cache of paginated results.
+
+    Parameters:
+        redis: Redis connection.
+        prefix: Prefix of all keys.
+        ttl: Lifetime of the entries in seconds.
+        max_bytes: Maximum total size of the entries.
+        lock_timeout: Maximum duration of a computation in seconds.
+            Waiting requests compute the result themselves afterwards.
+    """
+
+    def __init__(self, redis, prefix="morphocluster:results", ttl=3600,
+                 max_bytes=512 * 2 ** 20, lock_timeout=120):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        self.max_bytes = int(max_bytes)
+        self.lock_timeout = lock_timeout
+
+        self.entries_key = prefix + ":entries"
+        self.sizes_key = prefix + ":sizes"
+        self.bytes_key = prefix + ":bytes"
+        self.stats_key = prefix + ":stats"
+
+        self._store_entry = redis.register_script(_STORE_SCRIPT)
+        self._store_page = redis.register_script(_STORE_PAGE_SCRIPT)
+
+    @staticmethod
+    def make_request_id(name, kwargs, version=None):
+        """
+        Derive the request_id of a result from its inputs.
+        """
+        content = json.dumps([name, kwargs, version], sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _key(self, name, request_id):
+        return "{}:{}:{}".format(self.prefix, name, request_id)
+
+    def _load(self, key, page):
+        """
+        Returns:
+            (page_data, n_pages). n_pages is None if the entry does not exist.
+        """
+        n_pages, page_data = self.redis.hmget(key, "n", str(page))
+        return page_data, (int(n_pages) if n_pages is not None else None)
+
+    def _render(self, key, page, render):
+        """
+        Render and store a page of a lazy entry.
+        """
+        order = self.redis.hget(key, "order")
+        if order is None:
+            return None
+
+        page_data = render(order, page)
+        self._store_page(keys=[key, self.sizes_key, self.bytes_key],
+                         args=[str(page), page_data])
+        self.redis.hincrby(self.stats_key, "renders")
+
+        return page_data
+
+    def get_page(self, name, request_id, page, render=None):
+        """
+        Load a page of a cached result.
+
+        Parameters:
+            render: Callable (order, page) -> page_data for lazy results.
+
+        Returns:
+            (page_data, n_pages) or None if the result is unknown.
+            page_data is None if the page does not exist.
+        """
+        key = self._key(name, request_id)
+        page_data, n_pages = self._load(key, page)
+
+        self.redis.hincrby(self.stats_key, "hits" if n_pages is not None else "misses")
+
+        if n_pages is None:
+            return None
+
+        if page_data is None and render is not None and 0 <= page < n_pages:
+            page_data = self._render(key, page, render)
+
+        return page_data, n_pages
+
+    def get_or_compute(self, name, request_id, page, compute, render=None):
+        """
+        Load a page of a result or compute (and store) the result.
+
+        Parameters:
+            compute: Callable that returns the list of serialized pages (bytes) or,
+                for lazy results, (order, n_pages, pages) with the serialized
+                ordering (bytes) and a dict of already rendered pages.
+            render: Callable (order, page) -> page_data for lazy results.
+
+        Returns:
+            (page_data, n_pages)
+            page_data is None if the page does not exist.
+        """
+        key = self._key(name, request_id)
+
+        cached = self.get_page(name, request_id, page, render)
+        if cached is not None:
+            return cached
+
+        lock = self.redis.lock(key + ":lock", timeout=self.lock_timeout,
+                               blocking_timeout=self.lock_timeout)
+        try:
+            acquired = lock.acquire()
+        except LockError:
+            acquired = False
+
+        try:
+            if acquired:
+                # The result may have been computed while waiting for the lock
+                page_data, n_pages = self._load(key, page)
+                if n_pages is not None:
+                    self.redis.hincrby(self.stats_key, "coalesced")
+                    if page_data is None and render is not None and 0 <= page < n_pages:
+                        page_data = self._render(key, page, render)
+                    return page_data, n_pages
+
+            result = compute()
+
+            if render is None:
+                n_pages = len(result)
+                fields = {str(i): p for i, p in enumerate(result)}
+            else:
+                order, n_pages, pages = result
+                fields = {str(i): p for i, p in pages.items()}
+                fields["order"] = order
+
+            if acquired:
+                self._store(key, dict(fields, n=n_pages))
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except LockError:
+                    # The lock expired during the computation
+                    pass
+
+        if not 0 <= page < n_pages:
+            return None, n_pages
+
+        if str(page) in fields:
+            return fields[str(page)], n_pages
+
+        if acquired:
+            page_data = self._render(key, page, render)
+            if page_data is not None:
+                return page_data, n_pages
+
+        return render(order, page), n_pages
+
+    def _store(self, key, fields):
+        size = sum(len(v) for v in fields.values() if isinstance(v, bytes))
+        if size > self.max_bytes:
+            return
+
+        args = [self.ttl, time.time(), size]
+        for field, value in fields.items():
+            args.extend((field, value))
+
+        self._store_entry(keys=[key, self.entries_key, self.sizes_key, self.bytes_key],
+                          args=args)
+
+        self._trim()
+
+    def _trim(self):
+        """
+        Forget expired entries and evict the oldest entries while the size exceeds max_bytes.
+        """
+        expired = self.redis.zrangebyscore(
+            self.entries_key, "-inf", time.time() - self.ttl)
+        self._evict(expired, count=False)
+
+        while int(self.redis.get(self.bytes_key) or 0) > self.max_bytes:
+            oldest = self.redis.zrange(self.entries_key, 0, 15)
+            if not oldest:
+                break
+            self._evict(oldest)
+
+    def _evict(self, keys, count=True):
+        if not keys:
+            return
+
+        sizes = self.redis.hmget(self.sizes_key, keys)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(*keys)
+        pipe.zrem(self.entries_key, *keys)
+        pipe.hdel(self.sizes_key, *keys)
+        pipe.decrby(self.bytes_key, sum(int(s or 0) for s in sizes))
+        if count:
+            pipe.hincrby(self.stats_key, "evicted", len(keys))
+        pipe.execute()
+
+    def metrics(self):
+        """
+        Metrics of the cache.
+
+        Returns:
+            dict with
+                hits, misses: Number of requests served from the cache (computed).
+                coalesced: Number of misses that were computed by a concurrent request.
+                renders: Number of pages rendered from a lazy result.
+                evicted: Number of entries evicted because of max_bytes.
+                hit_rate: (hits + coalesced) / (hits + misses) (or None).
+                n_entries, n_bytes: Number and total size of the entries.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.stats_key)
+        pipe.zcard(self.entries_key)
+        pipe.get(self.bytes_key)
+        stats, n_entries, n_bytes = pipe.execute()
+
+        stats = {k.decode(): int(v) for k, v in stats.items()}
+        result = {k: stats.get(k, 0)
+                  for k in ("hits", "misses", "coalesced", "renders", "evicted")}
+
+        total = result["hits"] + result["misses"]
+        result["hit_rate"] = (result["hits"] + result["coalesced"]) / total if total else None
+        result["n_entries"] = n_entries
+        result["n_bytes"] = int(n_bytes or 0)
+
+        return result
+
+
+class FlaskResultCache:
+    """
+    Flask extension that provides the ResultCache (in the Redis of redis_lru).
+    """
+
+    def __init__(self, app=None):
+        self._caches = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RESULT_CACHE_TTL", 3600)
+        app.config.setdefault("RESULT_CACHE_MAX_BYTES", 512 * 2 ** 20)
+        app.config.setdefault("RESULT_CACHE_LOCK_TIMEOUT", 120)
+        app.extensions["result_cache"] = self
+
+    @property
+    def cache(self):
+        """
+        The ResultCache of the current app (or None outside of an app context).
+        """
+        if not has_app_context():
+            return None
+
+        config = current_app.config
+
+        from morphocluster.extensions import redis_lru
+
+        key = (config["REDIS_LRU_URL"], config["RESULT_CACHE_TTL"],
+               config["RESULT_CACHE_MAX_BYTES"], config["RESULT_CACHE_LOCK_TIMEOUT"])
+
+        try:
+            return self._caches[key]
+        except KeyError:
+            cache = self._caches[key] = ResultCache(
+                redis_lru, ttl=config["RESULT_CACHE_TTL"],
+                max_bytes=config["RESULT_CACHE_MAX_BYTES"],
+                lock_timeout=config["RESULT_CACHE_LOCK_TIMEOUT"])
+            return cache
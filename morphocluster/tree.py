@@ -3,9 +3,12 @@ Created on 13.03.2018
 
 @author: mschroeder
 '''
+import contextlib
 import csv
+import functools
 import itertools
 import os
+import time
 import warnings
 from genericpath import commonprefix
 from numbers import Integral
@@ -13,26 +16,67 @@ from numbers import Integral
 import numpy as np
 import pandas as pd
 from etaprogress.progress import ProgressBar
-from sklearn.cluster import KMeans
+from flask import current_app, has_app_context
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import literal_column
-from sqlalchemy.sql.expression import bindparam, literal, select
+from sqlalchemy.sql.expression import (bindparam, case, cast, literal,
+                                       select, type_coerce)
 from sqlalchemy.sql.functions import coalesce, func
+from sqlalchemy.types import BigInteger, LargeBinary
 from timer_cm import Timer
 
 from _functools import reduce
 from morphocluster import processing
-from morphocluster.classifier import Classifier
-from morphocluster.extensions import database
-from morphocluster.helpers import combine_covariances, seq2array
-from morphocluster.member import MemberCollection
-from morphocluster.models import (nodes, nodes_objects, nodes_rejected_objects,
-                                  objects, projects)
-from morphocluster.processing.prototypes import Prototypes, merge_prototypes
-
-# TODO: Make N_PROTOTYPES configurable
-N_PROTOTYPES = 16
+from morphocluster.column_types import (IncrementalPrototypesType,
+                                        decode_vectors)
+from morphocluster.extensions import (ann_index, database, dirty_queue,
+                                      feature_store, node_cache)
+from morphocluster.helpers import TopK, combine_covariances, seq2array
+from morphocluster.ingest import copy_from_frame
+from morphocluster.models import (nodes, nodes_closure, nodes_objects,
+                                  nodes_progress_deltas,
+                                  nodes_rejected_objects, objects, projects)
+from morphocluster.processing.consolidation import (CLUSTERERS,
+                                                    consolidate_subtree,
+                                                    make_clusterer)
+from morphocluster.processing.progress import (PROGRESS_COUNTERS,
+                                               calc_path_deltas,
+                                               calc_progress_counters,
+                                               progress_from_counters)
+from morphocluster.processing.prototypes import MERGE_METHODS, METRICS
+
+# Columns of projects with the prototype settings (see get_prototype_settings).
+# (Default: 16 prototypes fitted with KMeans on up to 1000 objects per node, euclidean metric.)
+PROTOTYPE_SETTINGS = {"n_prototypes": "n_prototypes",
+                      "clusterer": "prototype_clusterer",
+                      "sample_size": "object_sample_size",
+                      "metric": "prototype_metric"}
+
+# Maximum number of objects moved from or to a node that are absorbed by the prototypes of its own objects.
+# Larger changes reset them (they are refitted by the next consolidation).
+INCREMENTAL_PROTOTYPES_LIMIT = 1000
+
+# Minimum number of scanned lists of the ANNIndex in recommend_objects
+# (recall@1000 ~0.92 at 200k objects, see benchmarks/bench_ann_index.py)
+ANN_N_PROBE = 64
+
+# Number of candidates that recommend_objects fetches and scores at once
+RECOMMEND_CHUNK_SIZE = 10000
+
+# Columns of nodes that are inputs of the progress counters
+PROGRESS_INPUTS = {"approved", "filled", "name"}
+
+# Number of pending deltas of the progress counters of a node above which
+# calculate_progress folds the deltas of the project (see Tree.fold_progress_deltas)
+PROGRESS_DELTAS_LIMIT = 1000
+
+# Advisory lock keys of nodes (NODE_LOCK_BASE + node_id) do not collide with project locks (project_id)
+NODE_LOCK_BASE = 1 << 62
+
+# Maximum number of nodes that consolidate_node locks individually to write back the cached values.
+# Larger write-backs lock the root of the consolidated subtree exclusively.
+NODE_LOCK_LIMIT = 1000
 
 
 class TreeError(Exception):
@@ -42,21 +86,6 @@ class TreeError(Exception):
     pass
 
 
-def _roundrobin(iterables):
-    "roundrobin('ABC', 'D', 'EF') --> A D E B F C"
-    # Recipe credited to George Sakkis
-    num_active = len(iterables)
-    nexts = itertools.cycle(iter(it).__next__ for it in iterables)
-    while num_active:
-        try:
-            for next_ in nexts:
-                yield next_()
-        except StopIteration:
-            # Remove the iterator we just exhausted from the cycle.
-            num_active -= 1
-            nexts = itertools.cycle(itertools.islice(nexts, num_active))
-
-
 def _paths_from_common_ancestor(paths):
     """
     Strips the common prefix (without the first common ancestor) from p1 and p2.
@@ -65,6 +94,30 @@ def _paths_from_common_ancestor(paths):
     return [p[common_anestor_idx:] for p in paths]
 
 
+def _path_depths(path):
+    """
+    Depths of the nodes on a union of paths from the root.
+
+    Parameters:
+        path: dict node_id -> dict with parent_id.
+
+    Returns:
+        dict node_id -> depth
+    """
+    depths = {}
+
+    def depth(node_id):
+        if node_id not in depths:
+            parent_id = path[node_id]["parent_id"]
+            depths[node_id] = depth(parent_id) + 1 if parent_id in path else 0
+        return depths[node_id]
+
+    for node_id in path:
+        depth(node_id)
+
+    return depths
+
+
 def _paths_to_node_order(paths):
     """
     TODO: Returns nodes from list of paths in bottom-up order.
@@ -137,78 +190,476 @@ def _rquery_subtree(node_id, recurse_cb=None):
     return q
 
 
+def _cquery_subtree(node_id):
+    """
+    Constructs a selectable for the subtree rooted at node_id using the closure table.
+
+    Same columns as _rquery_subtree, but without recursion.
+    """
+    return (select([nodes, nodes_closure.c.depth.label("level")])
+            .select_from(nodes_closure.join(nodes, nodes.c.node_id == nodes_closure.c.descendant_id))
+            .where(nodes_closure.c.ancestor_id == node_id)
+            .alias("q"))
+
+
+def _query_progress_deltas():
+    """
+    Constructs a selectable with the sums of the pending deltas of the progress counters
+    (progress_<counter>) per node_id (see Tree._record_modification).
+    """
+    return (select([nodes_progress_deltas.c.node_id] +
+                   [cast(func.sum(nodes_progress_deltas.c["progress_" + k]), BigInteger).label("progress_" + k)
+                    for k in PROGRESS_COUNTERS])
+            .group_by(nodes_progress_deltas.c.node_id)
+            .alias("progress_deltas"))
+
+
+def _progress_sql(alias):
+    """
+    SQL for the current progress counters of the nodes `alias`:
+    The stored counters plus their pending deltas (see Tree._record_modification).
+
+    Returns:
+        (expressions, join): dict of PROGRESS_COUNTERS -> SQL expression
+        and the join of the deltas (after FROM nodes AS <alias>,
+        pd.n_deltas is the number of pending deltas).
+    """
+    expressions = {k: "{0}.progress_{1} + COALESCE(pd.progress_{1}, 0)".format(alias, k)
+                   for k in PROGRESS_COUNTERS}
+    join = """
+    LEFT JOIN LATERAL (
+        SELECT count(*) AS n_deltas, {}
+        FROM nodes_progress_deltas AS d
+        WHERE d.node_id = {}.node_id
+    ) AS pd ON TRUE
+    """.format(", ".join("CAST(sum(d.progress_{0}) AS BIGINT) AS progress_{0}".format(k)
+                         for k in PROGRESS_COUNTERS), alias)
+    return expressions, join
+
+
 class Tree(object):
     """
     A tree as represented by the database.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, store=None, ann_indexes=None, use_closure=None, locking=None,
+                 queue=None, merge_method=None, cache=None):
+        """
+        Parameters:
+            connection: Database connection.
+            store: FeatureStore for object vectors.
+                Default: The store of the current app (if configured).
+                Otherwise, vectors are read from the database.
+            ann_indexes: Provider of ANNIndex objects (with a method get(project_id)).
+                Default: The indexes of the current app (if configured).
+            use_closure: Use the closure table for ancestor and (unrestricted) subtree queries
+                instead of recursive CTEs.
+                Default: TREE_USE_CLOSURE of the current app.
+            locking: "subtree" | "project". Granularity of the locks of modifications (see lock_paths).
+                Default: TREE_LOCKING of the current app ("subtree" without app).
+            queue: DirtyQueue for the background consolidation.
+                Default: The queue of the current app (if CONSOLIDATE_IN_BACKGROUND).
+                Otherwise, nodes are consolidated when they are read.
+            merge_method: Method of merge_prototypes in consolidate_node (see MERGE_METHODS).
+                Default: MERGE_PROTOTYPES_METHOD of the current app ("complete" without app).
+            cache: NodeCache for node records, children and paths.
+                Default: The cache of the current app (if NODE_CACHE).
+                Otherwise, nodes are always read from the database.
+        """
         self.connection = connection
+        self.feature_store = store if store is not None else feature_store.store
+        self.ann_indexes = ann_indexes if ann_indexes is not None else ann_index
+        self.dirty_queue = queue if queue is not None else dirty_queue.queue
+        self.node_cache = cache if cache is not None else node_cache.cache
+
+        if use_closure is None:
+            use_closure = has_app_context() and current_app.config.get(
+                "TREE_USE_CLOSURE", False)
+        self.use_closure = use_closure
+
+        if locking is None:
+            locking = current_app.config.get(
+                "TREE_LOCKING", "subtree") if has_app_context() else "subtree"
+        if locking not in ("subtree", "project"):
+            raise ValueError("Unknown locking: {!r}".format(locking))
+        self.locking = locking
+
+        if merge_method is None:
+            merge_method = current_app.config.get(
+                "MERGE_PROTOTYPES_METHOD", "complete") if has_app_context() else "complete"
+        if merge_method not in MERGE_METHODS:
+            raise ValueError("Unknown merge_method: {!r}".format(merge_method))
+        self.merge_method = merge_method
+
+        # Evictions from the node cache that are repeated after the commit (see transaction)
+        self._evicted = set()
+        self._evicted_paths = False
+        self._cleared = False
+
+        # Relocated objects that are updated in the ANNIndex after the commit (see transaction):
+        # (project_id, object_ids, None) or (project_id, None, node_id) for all objects of a node
+        self._relocated = []
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager for a (nested) transaction of modifications.
 
-    def load_project(self, name, tree):
+        The modifications evict the node cache before the commit (see _evict).
+        After the commit of the outermost transaction, the evictions are repeated,
+        so that readers of the old snapshot can not keep outdated entries
+        beyond the tombstones of the first eviction.
+        The relocated objects are updated in the ANNIndex only after a successful commit
+        (see _update_ann_indexes).
+
+        Use this instead of connection.begin() to group several modifications.
         """
-        Load a project from a saved tree.
+        outermost = not self.connection.in_transaction()
+
+        try:
+            with self.connection.begin():
+                yield
+        except BaseException:
+            if outermost:
+                self._relocated = []
+            raise
+        else:
+            if outermost:
+                self._update_ann_indexes()
+        finally:
+            if outermost:
+                self._evict_committed()
+
+    def _update_ann_indexes(self):
         """
+        Update the node_ids of the relocated objects in the ANNIndex of their project
+        (after the commit, see transaction).
 
-        if not isinstance(tree, processing.Tree):
-            tree = processing.Tree.from_saved(tree)
+        The current node_ids are read from the database under the lock of the index,
+        so that concurrent relocations end up in the index in the order of their commits.
+        """
+        relocated, self._relocated = self._relocated, []
 
-        with self.connection.begin():
-            project_id = self.create_project(name)
+        stmt = text("""
+        SELECT object_id, node_id
+        FROM nodes_objects
+        WHERE project_id = :project_id
+        AND object_id = ANY(:object_ids)
+        """)
 
-            # Lock project
+        for project_id, object_ids, node_id in relocated:
+            index = self.ann_indexes.get(project_id)
+            if index is None:
+                continue
+
+            with index.lock():
+                if node_id is not None:
+                    # All objects of the node (e.g. a merged node)
+                    object_ids = index.object_ids[index.node_ids == node_id]
+
+                if not len(object_ids):
+                    continue
+
+                rows = self.connection.execute(
+                    stmt, project_id=project_id, object_ids=[str(o) for o in object_ids]).fetchall()
+
+                if rows:
+                    index.update_node_ids([o for o, _ in rows], [n for _, n in rows])
+
+    def _evict(self, node_ids=(), paths=False, clear=False):
+        """
+        Evict nodes (paths: all paths, clear: everything) from the node cache,
+        now and again after the commit (see transaction).
+        """
+        if self.node_cache is None:
+            return
+
+        if clear:
+            self.node_cache.clear()
+            self._cleared = True
+            return
+
+        node_ids = [int(n) for n in node_ids if n is not None]
+        if node_ids:
+            self.node_cache.evict(node_ids)
+            self._evicted.update(node_ids)
+
+        if paths:
+            self.node_cache.evict_paths()
+            self._evicted_paths = True
+
+    def _evict_committed(self):
+        """
+        Repeat the evictions of the committed transaction (see transaction).
+        """
+        evicted, evicted_paths, cleared = self._evicted, self._evicted_paths, self._cleared
+        self._evicted, self._evicted_paths, self._cleared = set(), False, False
+
+        if self.node_cache is None:
+            return
+
+        if cleared:
+            self.node_cache.clear()
+            return
+
+        if evicted:
+            self.node_cache.evict(sorted(evicted))
+
+        if evicted_paths:
+            self.node_cache.evict_paths()
+
+    def _query_subtree(self, node_id, recurse_cb=None):
+        """
+        Selectable for the subtree rooted at node_id (see _rquery_subtree).
+
+        The closure table is used if there is no recurse_cb:
+        A restricted descent only visits a part of the subtree,
+        which a recursive CTE does more efficiently.
+        """
+        if self.use_closure and recurse_cb is None:
+            return _cquery_subtree(node_id)
+
+        return _rquery_subtree(node_id, recurse_cb)
+
+    def _closure_insert_node(self, node_id):
+        """
+        Insert a new node into the closure table.
+        """
+        stmt = text("""
+        INSERT INTO nodes_closure (ancestor_id, descendant_id, depth)
+        SELECT :node_id, :node_id, 0
+        UNION ALL
+        SELECT c.ancestor_id, n.node_id, c.depth + 1
+        FROM nodes AS n
+        JOIN nodes_closure AS c
+        ON c.descendant_id = n.parent_id
+        WHERE n.node_id = :node_id
+        """)
+        self.connection.execute(stmt, node_id=node_id)
+
+    def _closure_move_subtree(self, node_id, parent_id):
+        """
+        Move the subtree rooted at node_id below parent_id in the closure table.
+        """
+        # Detach the subtree from the former ancestors of node_id
+        stmt = text("""
+        DELETE FROM nodes_closure AS l
+        USING nodes_closure AS sub
+        WHERE sub.ancestor_id = :node_id
+            AND l.descendant_id = sub.descendant_id
+            AND l.ancestor_id IN (
+                SELECT ancestor_id FROM nodes_closure
+                WHERE descendant_id = :node_id AND depth > 0
+            )
+        """)
+        self.connection.execute(stmt, node_id=node_id)
+
+        if parent_id is None:
+            return
+
+        # Attach the subtree to parent_id and its ancestors
+        stmt = text("""
+        INSERT INTO nodes_closure (ancestor_id, descendant_id, depth)
+        SELECT sup.ancestor_id, sub.descendant_id, sup.depth + sub.depth + 1
+        FROM nodes_closure AS sup, nodes_closure AS sub
+        WHERE sup.descendant_id = :parent_id AND sub.ancestor_id = :node_id
+        """)
+        self.connection.execute(stmt, node_id=node_id, parent_id=parent_id)
+
+    def rebuild_closure(self, project_id):
+        """
+        Rebuild the closure table for a project.
+        """
+        with self.transaction():
             self.lock_project(project_id)
 
-            bar = ProgressBar(len(tree.nodes) +
-                              len(tree.objects), max_width=40)
+            stmt = text("""
+            DELETE FROM nodes_closure
+            WHERE descendant_id IN (SELECT node_id FROM nodes WHERE project_id = :project_id)
+            """)
+            self.connection.execute(stmt, project_id=project_id)
 
-            def progress_cb(nadd):
-                bar.numerator += nadd
-                print(bar, end="\r")
+            stmt = text("""
+            INSERT INTO nodes_closure (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE c AS (
+                SELECT node_id AS ancestor_id, node_id AS descendant_id, 0 AS depth
+                FROM nodes
+                WHERE project_id = :project_id
+                UNION ALL
+                SELECT c.ancestor_id, n.node_id, c.depth + 1
+                FROM c
+                JOIN nodes AS n
+                ON n.parent_id = c.descendant_id
+            )
+            SELECT ancestor_id, descendant_id, depth FROM c
+            """)
+            return self.connection.execute(stmt, project_id=project_id).rowcount
 
-            for node in tree.topological_order():
-                name = node["name"] if "name" in node and pd.notnull(
-                    node["name"]) else None
+    def load_project(self, name, tree):
+        """
+        Load a project from a saved tree.
 
-                object_ids = tree.objects_for_node(node["node_id"])[
-                    "object_id"].tolist()
-                parent_id = int(node["parent_id"]) if pd.notnull(
-                    node["parent_id"]) else None
+        node_ids are taken from the sequence up front, so that parent ids can be
+        resolved in pandas. nodes and nodes_objects are then streamed into the
+        database using COPY.
+        """
 
-                flag_names = ("approved", "starred", "filled")
-                flags = {k: bool(node[k])
-                         for k in flag_names if k in node and pd.notnull(node[k])}
+        if not isinstance(tree, processing.Tree):
+            tree = processing.Tree.from_saved(tree)
 
-                self.create_node(project_id,
-                                 orig_node_id=int(node["node_id"]),
-                                 orig_parent=parent_id,
-                                 object_ids=object_ids,
-                                 name=name,
-                                 progress_cb=progress_cb,
-                                 **flags)
+        with Timer("Tree.load_project") as timer, self.transaction():
+            project_id = self.create_project(name)
 
-                # Update progress bar
-                progress_cb(1)
-            print()
+            # Lock project
+            self.lock_project(project_id)
 
-        print("Done after {}s.".format(bar._eta.elapsed))
+            with timer.child("Prepare nodes"):
+                # Parents have to be inserted before their children
+                tree_nodes = tree.nodes.loc[list(tree.topological_order_idx())]
+
+                node_ids = self._reserve_node_ids(len(tree_nodes))
+                node_id_map = pd.Series(node_ids, index=tree_nodes["node_id"].values)
+
+                parent_ids = tree_nodes["parent_id"].map(node_id_map)
+                unknown_parents = tree_nodes["parent_id"].notnull() & parent_ids.isnull()
+                if unknown_parents.any():
+                    raise TreeError("Unknown parents: {!r}".format(
+                        tree_nodes.loc[unknown_parents, "parent_id"].unique().tolist()))
+
+                db_nodes = pd.DataFrame({
+                    "node_id": node_ids,
+                    "orig_id": tree_nodes["node_id"].astype(np.int64).values,
+                    "project_id": project_id,
+                    "parent_id": parent_ids.astype("Int64").values,
+                    "name": tree_nodes["name"].values if "name" in tree_nodes else None,
+                })
+
+                for flag in ("approved", "starred", "filled"):
+                    db_nodes[flag] = (tree_nodes[flag].fillna(False).astype(bool).values
+                                      if flag in tree_nodes else False)
+
+            with timer.child("Prepare objects"):
+                object_node_ids = tree.objects["node_id"].map(node_id_map)
+                if object_node_ids.isnull().any():
+                    raise TreeError("Objects of unknown nodes: {!r}".format(
+                        tree.objects.loc[object_node_ids.isnull(), "node_id"].unique().tolist()))
+
+                db_nodes_objects = pd.DataFrame({
+                    "node_id": object_node_ids.astype(np.int64).values,
+                    "project_id": project_id,
+                    "object_id": tree.objects["object_id"].astype(str).values,
+                })
+
+            with timer.child("Progress"):
+                # Parents come before their children
+                parent_pos = pd.Index(node_ids).get_indexer(
+                    parent_ids.fillna(-1).astype(np.int64))
+                levels = np.zeros(len(db_nodes), dtype=np.int64)
+                for i, p in enumerate(parent_pos):
+                    if p >= 0:
+                        levels[i] = levels[p] + 1
+
+                n_objects = (db_nodes_objects["node_id"].value_counts()
+                             .reindex(node_ids, fill_value=0))
+
+                counters = calc_progress_counters(db_nodes.assign(
+                    level=levels, n_objects=n_objects.values))
+                for k in PROGRESS_COUNTERS:
+                    db_nodes["progress_" + k] = counters[k].values
+
+            start = time.perf_counter()
+
+            with timer.child("COPY nodes"):
+                copy_from_frame(self.connection, "nodes", db_nodes)
+
+            with timer.child("COPY nodes_objects"):
+                copy_from_frame(self.connection, "nodes_objects", db_nodes_objects)
+
+            with timer.child("Closure"):
+                self.rebuild_closure(project_id)
+
+            elapsed = time.perf_counter() - start
+            n_rows = len(db_nodes) + len(db_nodes_objects)
+
+            print("Loaded {:,d} nodes and {:,d} objects in {:.1f}s ({:,.0f} rows/s).".format(
+                len(db_nodes), len(db_nodes_objects), elapsed, n_rows / max(elapsed, 1e-9)))
 
         return project_id
 
-    def lock_project(self, project_id):
+    def _reserve_node_ids(self, n):
+        """
+        Take n node_ids from the sequence of nodes.node_id.
+        """
+        stmt = text("""
+        SELECT nextval(pg_get_serial_sequence('nodes', 'node_id'))
+        FROM generate_series(1, :n)
+        """)
+        return np.array([r for (r,) in self.connection.execute(stmt, n=n)], dtype=np.int64)
+
+    def lock_project(self, project_id, shared=False):
         """
         Acquire advisory transaction lock for a project.
+
+        Operations on the whole project take the lock exclusively,
+        modifications of single nodes (see lock_paths) take it shared.
         """
-        return self.connection.execute(select([func.pg_advisory_xact_lock(project_id)]))
+        lock = func.pg_advisory_xact_lock_shared if shared else func.pg_advisory_xact_lock
+        return self.connection.execute(select([lock(project_id)]))
 
-    def lock_project_for_node(self, node_id):
+    def lock_project_for_node(self, node_id, shared=False):
         """
         Acquire advisory project lock given a node ID.
         """
         project_id = (select([nodes.c.project_id])
                       .where(nodes.c.node_id == node_id)
                       .as_scalar())
-        return self.lock_project(project_id)
+        return self.lock_project(project_id, shared)
+
+    def lock_paths(self, node_ids, exclusive=()):
+        """
+        Acquire the advisory transaction locks for a modification of the given nodes.
+
+        With subtree locking, these are
+            - the shared project lock,
+            - shared locks on the nodes and all of their ancestors and
+            - exclusive locks on the nodes in `exclusive` (whose own values, children or subtrees change,
+              see _record_modification).
+
+        All node locks are acquired in one statement in ascending order of node_id.
+        Modifications in disjoint subtrees proceed concurrently, while a node that is locked
+        exclusively waits for (and blocks) all modifications below it.
+        All other rows are written in ascending order of node_id as well (see _record_modification),
+        so that concurrent modifications can not deadlock.
+
+        With project locking, the exclusive project lock is acquired instead (former behavior).
+
+        Parameters:
+            node_ids: Collection of `node_id`s (all from the same project).
+            exclusive: Subset of `node_ids` that is locked exclusively.
+        """
+        node_ids = sorted(set(int(n) for n in node_ids if n is not None))
+        if not node_ids:
+            return
+
+        if self.locking == "project":
+            self.lock_project_for_node(node_ids[0])
+            return
+
+        self.lock_project_for_node(node_ids[0], shared=True)
+
+        stmt = text("""
+        WITH RECURSIVE {},
+        path_nodes AS (
+            SELECT DISTINCT ancestor_id AS node_id FROM paths
+        )
+        SELECT CASE WHEN l.node_id = ANY(:exclusive)
+            THEN pg_advisory_xact_lock(:base + l.node_id)
+            ELSE pg_advisory_xact_lock_shared(:base + l.node_id) END
+        FROM (SELECT node_id FROM path_nodes ORDER BY node_id) AS l
+        """.format(self._paths_cte()))
+        exclusive = [int(n) for n in exclusive if n is not None]
+        self.connection.execute(stmt, node_ids=node_ids, exclusive=exclusive,
+                                base=NODE_LOCK_BASE).fetchall()
 
     def __load_project_old(self, name, path, root_first=True):
         tree_fn = os.path.join(path, "tree.csv")
@@ -234,7 +685,7 @@ class Tree(object):
 
         root_orig_id = int(raw_tree_nodes["parent"].iloc[0])
 
-        with self.connection.begin():
+        with self.transaction():
             project_id = self.create_project(name)
 
             bar = ProgressBar(len(raw_tree_objects) +
@@ -284,8 +735,8 @@ class Tree(object):
         return project_id
 
     def connect_supertree(self, root_id):
-        with self.connection.begin():
-            successors = _rquery_subtree(root_id)
+        with self.transaction():
+            successors = self._query_subtree(root_id)
 
             supersuccessor_ids = (select([successors.c.node_id])
                                   .where(successors.c.starred == True))
@@ -300,7 +751,7 @@ class Tree(object):
                 def recurse_cb(q, _):
                     return q.c.starred == False
 
-                successors = _rquery_subtree(node_id, recurse_cb)
+                successors = self._query_subtree(node_id, recurse_cb)
 
                 # ===============================================================
                 # UPDATE nodes
@@ -319,89 +770,339 @@ class Tree(object):
                 print(bar, end="\r")
             print()
 
-    def get_objects_recursive(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(
-            nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
+            self._evict(clear=True)
 
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id))
+    def get_objects_recursive(self, node_id):
+        # Select all descendants
+        subtree = self._query_subtree(node_id)
 
-        # For each node in rquery, get associated objects
+        # For each node in the subtree, get associated objects
         obj_query = select([objects]).distinct().\
-            select_from(rquery.join(nodes_objects).join(objects))
+            select_from(subtree
+                        .join(nodes_objects, nodes_objects.c.node_id == subtree.c.node_id)
+                        .join(objects))
 
         result = self.connection.execute(obj_query)
 
         return [dict(r) for r in result]
 
+    def _query_progress_subtree(self, node_id):
+        """
+        Query the subtree rooted at node_id with the input columns of calc_progress_counters
+        and the current progress counters (including the pending deltas).
+        """
+        subtree = self._query_subtree(node_id)
+        deltas = _query_progress_deltas()
+
+        # Real number of own objects
+        n_objects = (select([func.count()])
+                     .select_from(nodes_objects)
+                     .where(nodes_objects.c.node_id == subtree.c.node_id)
+                     .as_scalar()
+                     .label("n_objects"))
+
+        stmt = select([subtree.c.node_id,
+                       subtree.c.parent_id,
+                       subtree.c.level,
+                       subtree.c.approved,
+                       subtree.c.filled,
+                       subtree.c.name,
+                       n_objects] +
+                      [(subtree.c["progress_" + k] + coalesce(deltas.c["progress_" + k], 0)).label("progress_" + k)
+                       for k in PROGRESS_COUNTERS]).select_from(
+                          subtree.outerjoin(deltas, deltas.c.node_id == subtree.c.node_id))
+
+        subtree = pd.read_sql_query(stmt, self.connection)
+
+        if len(subtree) == 0:
+            raise TreeError("Unknown node: {}".format(node_id))
+
+        return subtree
+
     def calculate_progress(self, node_id):
         """
         Calculate labeling progress.
 
         - Number of objects below approved nodes
+
+        The progress is read from the progress counters of the node (see _record_modification).
+        Unknown counters are computed for the whole subtree first (see rebuild_progress).
+        Many pending deltas are folded into the stored counters (see fold_progress_deltas).
         """
 
-        with self.connection.begin():
-            subtree = self.consolidate_node(
-                node_id, depth="full", return_="raw", descend_approved=False)
-            """ subtree = _rquery_subtree(node_id)
-            subtree = (select([subtree])
-                    .order_by(subtree.c.level.desc()))
-            subtree = pd.read_sql_query(
-                subtree, self.connection, index_col="node_id") """
-
-        subtree["n_approved_objects"] = subtree["approved"] * \
-            subtree["_n_objects_deep"]
-        subtree["n_filled_objects"] = subtree["filled"] * \
-            subtree["_n_objects_deep"]
-        subtree["n_named_objects"] = pd.notna(
-            subtree["name"]) * subtree["_n_objects_deep"]
-        subtree["n_approved_nodes"] = subtree["approved"].astype(int)
-        subtree["n_filled_nodes"] = subtree["filled"].astype(int)
-        subtree["n_nodes"] = 1
-
-        fields = ["_n_objects", "_n_objects_deep", "n_filled_objects", "n_approved_objects",
-                  "n_named_objects", "n_approved_nodes", "n_filled_nodes", "n_nodes"]
-
-        # Leaves
-        leaves_mask = subtree["_n_children"] == 0
-        leaves_result = subtree.loc[leaves_mask, fields].sum(axis=0).to_dict()
-        leaves_result = {"leaves_{}".format(
-            k.lstrip('_')): v for k, v in leaves_result.items()}
-
-        # Compute deep values for root
-        # subtree is ordered deep-first
-        for nid in subtree.index:
-            child_selector = (subtree['parent_id'] == nid)
-
-            subtree.at[nid, "n_approved_objects"] = max(
-                subtree.at[nid, "n_approved_objects"],
-                subtree.loc[child_selector, "n_approved_objects"].sum())
-
-            subtree.at[nid, "n_named_objects"] = max(
-                subtree.at[nid, "n_named_objects"],
-                subtree.loc[child_selector, "n_named_objects"].sum())
-
-            subtree.at[nid, "n_approved_nodes"] = (
-                subtree.at[nid, "n_approved_nodes"]
-                + subtree.loc[child_selector, "n_approved_nodes"].sum())
-
-            subtree.at[nid, "n_filled_nodes"] = (
-                subtree.at[nid, "n_filled_nodes"]
-                + subtree.loc[child_selector, "n_filled_nodes"].sum())
-
-            subtree.at[nid, "n_nodes"] = (
-                subtree.at[nid, "n_nodes"]
-                + subtree.loc[child_selector, "n_nodes"].sum())
-
-        deep_result = subtree.loc[node_id, fields].to_dict()
-        deep_result = {k.lstrip('_'): v for k, v in deep_result.items()}
-
-        return dict(**leaves_result, **deep_result)
+        expressions, join = _progress_sql("n")
+        stmt = text("""
+        SELECT n.project_id, n.filled, pd.n_deltas, {}
+        FROM nodes AS n
+        {}
+        WHERE n.node_id = :node_id
+        """.format(", ".join("{} AS progress_{}".format(e, k) for k, e in expressions.items()), join))
+        row = self.connection.execute(stmt, node_id=node_id).fetchone()
+
+        if row is None:
+            raise TreeError("Unknown node: {}".format(node_id))
+
+        counters = {k: row["progress_" + k] for k in PROGRESS_COUNTERS}
+
+        if any(v is None for v in counters.values()):
+            counters = self.rebuild_progress(node_id).loc[node_id]
+        elif row["n_deltas"] > PROGRESS_DELTAS_LIMIT:
+            self.fold_progress_deltas(row["project_id"])
+
+        return progress_from_counters(counters, row["filled"])
+
+    def rebuild_progress(self, node_id):
+        """
+        Compute and store the progress counters of the subtree rooted at node_id.
+
+        Returns:
+            DataFrame of the counters (index: node_id).
+        """
+
+        with self.transaction():
+            self.lock_paths([node_id], exclusive=[node_id])
+
+            subtree = self._query_progress_subtree(node_id)
+            counters = calc_progress_counters(subtree)
+            counters.index = subtree["node_id"]
+
+            self.connection.execute(text("""
+            CREATE TEMPORARY TABLE staging_progress (
+                node_id BIGINT, {}
+            ) ON COMMIT DROP
+            """.format(", ".join("progress_{} BIGINT".format(k) for k in PROGRESS_COUNTERS))))
+
+            copy_from_frame(self.connection, "staging_progress",
+                            counters.add_prefix("progress_").reset_index())
+
+            self.connection.execute(text("""
+            UPDATE nodes AS n
+            SET {}
+            FROM staging_progress AS s
+            WHERE n.node_id = s.node_id
+            """.format(", ".join("progress_{0} = s.progress_{0}".format(k) for k in PROGRESS_COUNTERS))))
+
+            # The pending deltas are contained in the new counters
+            self.connection.execute(text("""
+            DELETE FROM nodes_progress_deltas AS d
+            USING staging_progress AS s
+            WHERE d.node_id = s.node_id
+            """))
+
+            self.connection.execute(text("DROP TABLE staging_progress"))
+
+            self._evict(counters.index.tolist())
+
+        return counters
+
+    def check_progress(self, node_id):
+        """
+        Verify the current progress counters of the subtree rooted at node_id against a full recomputation.
+
+        Returns:
+            DataFrame of the inconsistent nodes (index: node_id)
+            with the current ("progress_<counter>") and the expected (<counter>) values.
+            Unknown counters are not reported.
+        """
+        subtree = self._query_progress_subtree(node_id)
+        counters = calc_progress_counters(subtree)
+
+        stored = subtree[["progress_" + k for k in PROGRESS_COUNTERS]]
+        known = stored.notnull().all(axis=1).to_numpy()
+        mismatch = (stored.to_numpy() != counters.to_numpy()).any(axis=1)
+
+        result = pd.concat((stored, counters), axis=1)
+        result.index = subtree["node_id"]
+
+        return result[known & mismatch]
+
+    def _record_modification(self, node_ids, unapprove=(), touch=True, own_prototypes=None):
+        """
+        Record a modification of the own values, objects or children of the given nodes.
+
+        The caller must hold exclusive locks on the given nodes and on the nodes in `unapprove`
+        (see lock_paths). Nodes that gain or lose children are modified, too.
+
+        - The nodes get a new version (the current transaction id), if `touch`.
+          This invalidates the cached values of the nodes and their ancestors
+          without writing to the ancestors (see _find_stale).
+        - The approval of the nodes in `unapprove` is revoked (they get a new version, too).
+        - The prototypes of the own objects of the nodes in `own_prototypes` are replaced.
+        - The progress counters along the paths of all nodes are updated (see calc_path_deltas).
+          The counters of the modified nodes are recomputed (deepest first)
+          from their own values and the current counters of their other children.
+          Their ancestors only receive the changes of the counters (deltas),
+          which are inserted into nodes_progress_deltas instead of writing the rows of the ancestors.
+          As the deltas commute, concurrent modifications in disjoint subtrees neither
+          lose updates nor wait for each other on the rows of their common ancestors (like the root).
+          The current counters of a node are its stored counters plus the sum of its deltas
+          (see fold_progress_deltas).
+          If the counters of a child are unknown, the counters of the node
+          (and consequently of its ancestors) become unknown, too.
+
+        All rows are written in ascending order of node_id (see lock_paths).
+
+        With background consolidation, the nodes on the paths are queued (see dirty_queue).
+        (As this happens before the commit, readers queue stale nodes again, see _defer_consolidation.)
+
+        The nodes on the paths are evicted from the node cache.
+
+        Parameters:
+            node_ids: Collection of modified `node_id`s.
+            unapprove: Collection of `node_id`s whose approval is revoked.
+            touch: Give the modified nodes a new version.
+                False if only inputs of the progress (flags, name) changed.
+            own_prototypes: dict node_id -> IncrementalPrototypes (or None to reset them).
+        """
+
+        own_prototypes = {int(n): p for n, p in (own_prototypes or {}).items()}
+        unapprove = set(int(n) for n in unapprove if n is not None)
+        modified = set(int(n) for n in node_ids if n is not None) | unapprove | set(own_prototypes)
+        if not modified:
+            return
+
+        expressions, join = _progress_sql("n")
+
+        stmt = text("""
+        WITH RECURSIVE {},
+        path_nodes AS (
+            SELECT DISTINCT ancestor_id AS node_id FROM paths
+        )
+        SELECT n.node_id, n.parent_id, n.approved, n.filled, n.name IS NOT NULL AS named,
+            (SELECT count(*) FROM nodes_objects AS no WHERE no.node_id = n.node_id) AS n_objects,
+            {}
+        FROM nodes AS n
+        JOIN path_nodes USING (node_id)
+        {}
+        """.format(self._paths_cte(),
+                   ", ".join("{} AS progress_{}".format(e, k) for k, e in expressions.items()),
+                   join))
+        path = {r["node_id"]: dict(r) for r in self.connection.execute(
+            stmt, node_ids=list(modified))}
+
+        if not path:
+            return
+
+        for node_id in unapprove:
+            if node_id in path:
+                path[node_id]["approved"] = False
+
+        path_ids = list(path.keys())
+
+        # Aggregate the counters of all other children of the path nodes
+        stmt = text("""
+        SELECT n.parent_id, count(*) AS n_children,
+            count(*) - count(n.progress_n_nodes) AS n_unknown,
+            {}
+        FROM nodes AS n
+        {}
+        WHERE n.parent_id = ANY(:path_ids) AND NOT n.node_id = ANY(:path_ids)
+        GROUP BY n.parent_id
+        """.format(", ".join("CAST(sum({}) AS BIGINT) AS {}".format(e, k) for k, e in expressions.items()),
+                   join))
+        children = {r["parent_id"]: dict(r) for r in self.connection.execute(
+            stmt, path_ids=path_ids)}
+
+        counters, deltas = calc_path_deltas(path, children, modified)
+
+        # Replace the counters of the modified nodes (and of nodes that become unknown)
+        updates = [dict(_node_id=node_id,
+                        _modified=touch and node_id in modified,
+                        _unapprove=node_id in unapprove,
+                        _replace_own_prototypes=node_id in own_prototypes,
+                        _own_prototypes=own_prototypes.get(node_id),
+                        **{"progress_" + k: (counters[node_id] or {}).get(k) for k in PROGRESS_COUNTERS})
+                   for node_id in sorted(counters)]
+
+        stmt = text("""
+        UPDATE nodes
+        SET version = CASE WHEN :_modified THEN txid_current() ELSE version END,
+            approved = approved AND NOT :_unapprove,
+            _own_prototypes = CASE WHEN :_replace_own_prototypes THEN :_own_prototypes ELSE _own_prototypes END,
+            {}
+        WHERE node_id = :_node_id
+        """.format(", ".join("progress_{0} = :progress_{0}".format(k) for k in PROGRESS_COUNTERS)))
+        stmt = stmt.bindparams(bindparam(
+            "_own_prototypes", type_=IncrementalPrototypesType()))
+        if updates:
+            self.connection.execute(stmt, updates)
+
+            # The replaced counters contain the pending deltas
+            self.connection.execute(
+                nodes_progress_deltas.delete(nodes_progress_deltas.c.node_id.in_(sorted(counters))))
+
+        # Insert the deltas of the ancestors
+        if deltas:
+            self.connection.execute(
+                nodes_progress_deltas.insert(),
+                [dict(node_id=node_id, **{"progress_" + k: v for k, v in deltas[node_id].items()})
+                 for node_id in sorted(deltas)])
+
+        if self.dirty_queue is not None and touch:
+            self.dirty_queue.push(_path_depths(path))
+
+        self._evict(path_ids)
+
+    def fold_progress_deltas(self, project_id):
+        """
+        Fold the pending deltas of the progress counters of a project into the stored counters
+        (see _record_modification).
+
+        Nodes that are locked by a concurrent modification are skipped (they are folded later).
+
+        Returns:
+            Number of folded nodes.
+        """
+
+        with self.transaction():
+            if self.locking == "project":
+                self.lock_project(project_id)
+                lock = "TRUE"
+            else:
+                self.lock_project(project_id, shared=True)
+                lock = "pg_try_advisory_xact_lock(:base + node_id)"
+
+            # Lock the nodes in a separate statement, so that the following statements
+            # see all deltas that were committed before
+            stmt = text("""
+            SELECT node_id
+            FROM (
+                SELECT DISTINCT d.node_id
+                FROM nodes_progress_deltas AS d
+                JOIN nodes AS n USING (node_id)
+                WHERE n.project_id = :project_id
+                ORDER BY d.node_id
+            ) AS pending
+            WHERE {}
+            """.format(lock))
+            node_ids = [r for (r,) in self.connection.execute(
+                stmt, project_id=project_id, base=NODE_LOCK_BASE)]
+
+            if not node_ids:
+                return 0
+
+            stmt = text("""
+            UPDATE nodes AS n
+            SET {}
+            FROM (
+                SELECT node_id, {}
+                FROM nodes_progress_deltas
+                WHERE node_id = ANY(:node_ids)
+                GROUP BY node_id
+            ) AS d
+            WHERE n.node_id = d.node_id
+            """.format(", ".join("progress_{0} = n.progress_{0} + d.progress_{0}".format(k)
+                                 for k in PROGRESS_COUNTERS),
+                       ", ".join("CAST(sum(progress_{0}) AS BIGINT) AS progress_{0}".format(k)
+                                 for k in PROGRESS_COUNTERS)))
+            self.connection.execute(stmt, node_ids=node_ids)
+
+            self.connection.execute(
+                nodes_progress_deltas.delete(nodes_progress_deltas.c.node_id.in_(node_ids)))
+
+            self._evict(node_ids)
+
+        return len(node_ids)
 
     def export_classifications(self, root_id, classification_fn):
         """
@@ -428,9 +1129,9 @@ class Tree(object):
         """
         Generate a processing.Tree from the tree below root_id.
         """
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(root_id)
+        with self.transaction():
+            # No modifications of the subtree during the export
+            self.lock_paths([root_id], exclusive=[root_id])
 
             # Get complete subtree with up to date cached values
             print("Consolidating cached values...")
@@ -443,7 +1144,7 @@ class Tree(object):
 
             print("Getting objects...")
             # Get subtree below root
-            subtree = _rquery_subtree(root_id)
+            subtree = self._query_subtree(root_id)
 
             # Get object IDs for all nodes
             node_objects = (
@@ -537,35 +1238,234 @@ class Tree(object):
         Returns:
             List of `node_id`s.
         """
+        return self.get_paths([node_id]).get(int(node_id), [])
+
+    def get_paths(self, node_ids):
+        """
+        Get the paths of many nodes at once.
+
+        Returns:
+            dict node_id -> list of `node_id`s (root first).
+            Unknown nodes are missing.
+        """
+        node_ids = set(int(n) for n in node_ids if n is not None)
+
+        paths, token = {}, None
+        if self.node_cache is not None and node_ids:
+            paths, token = self.node_cache.get_paths(node_ids)
+
+        missing = node_ids.difference(paths)
+        if missing:
+            queried = self._query_paths(missing)
+            if token is not None:
+                self.node_cache.set_paths(queried, token)
+            paths.update(queried)
+
+        return paths
+
+    def _query_paths(self, node_ids):
+        """
+        Query the paths of nodes in a single statement.
+
+        Every ancestor is only retrieved once (with its parent),
+        the paths are assembled from the shared prefixes.
+        """
+        if self.use_closure:
+            stmt = text("""
+            SELECT node_id, parent_id
+            FROM nodes
+            WHERE node_id IN (
+                SELECT ancestor_id
+                FROM nodes_closure
+                WHERE descendant_id = ANY(:node_ids)
+            )
+            """)
+        else:
+            # UNION (instead of UNION ALL) visits shared ancestors only once
+            stmt = text("""
+            WITH RECURSIVE ancestors AS (
+                SELECT node_id, parent_id
+                FROM nodes
+                WHERE node_id = ANY(:node_ids)
+                UNION
+                SELECT n.node_id, n.parent_id
+                FROM ancestors AS a
+                JOIN nodes AS n
+                ON n.node_id = a.parent_id
+            )
+            SELECT node_id, parent_id FROM ancestors
+            """)
+
+        parents = dict(self.connection.execute(
+            stmt, node_ids=list(node_ids)).fetchall())
+
+        prefixes = {}
+
+        def path_of(node_id):
+            # Walk up to the nearest known prefix
+            chain = []
+            while node_id is not None and node_id not in prefixes:
+                chain.append(node_id)
+                node_id = parents.get(node_id)
+
+            path = prefixes[node_id] if node_id is not None else []
+            for n in reversed(chain):
+                path = path + [n]
+                prefixes[n] = path
+
+            return path
+
+        return {node_id: path_of(node_id) for node_id in node_ids if node_id in parents}
+
+    def get_cache_version(self, node_id):
+        """
+        Get a version of the inputs of the results for a node (see api.cache_serialize_page).
+
+        The version changes if the node or one of its ancestors is modified
+        or consolidated, if the node's children change (including their
+        flags and names), if a node anywhere below is modified
+        or if objects are rejected for the node.
+
+        The node and its children are consolidated first (like get_children does for the results),
+        so that a result is not stored under the version from before the consolidation.
+
+        Returns:
+            Hex digest.
+        """
+        self._consolidate_or_defer(node_id, children=True)
+
+        # Modifications below the node that are not yet reflected in its cached values
+        # are found like in _find_stale: Only recently modified nodes are inspected.
         stmt = text("""
-            WITH RECURSIVE q AS
+        WITH RECURSIVE {},
+        recent AS (
+            SELECT r.node_id, r.version
+            FROM nodes AS r
+            JOIN nodes AS u
+            ON r.project_id = u.project_id
+            WHERE u.node_id = :node_id AND r.version > COALESCE(u._cache_epoch, 0)
+        ),
+        {}
+        SELECT md5(concat_ws('|',
             (
-                SELECT  n.*, 1 AS level
-                FROM    nodes AS n
-                WHERE   n.node_id = :node_id
-                UNION ALL
-                SELECT  p.*, level + 1
-                FROM    q
-                JOIN    nodes AS p
-                ON      p.node_id = q.parent_id
+                SELECT string_agg(concat_ws(':', n.node_id, n.version, n._cache_epoch), ','
+                                  ORDER BY p.depth)
+                FROM paths AS p
+                JOIN nodes AS n
+                ON n.node_id = p.ancestor_id
+            ),
+            (
+                SELECT string_agg(concat_ws(':', c.node_id, c.version, c._cache_epoch,
+                                            c.starred, c.approved, c.filled, c.name), ','
+                                  ORDER BY c.node_id)
+                FROM nodes AS c
+                WHERE c.parent_id = :node_id
+            ),
+            (
+                SELECT max(r.version)
+                FROM recent AS r
+                JOIN recent_paths AS rp
+                ON rp.descendant_id = r.node_id
+                WHERE rp.ancestor_id = :node_id
+            ),
+            (
+                SELECT count(*)
+                FROM nodes_rejected_objects
+                WHERE node_id = :node_id
             )
-            SELECT  node_id
-            FROM    q
-            ORDER BY
-            level DESC
-        """)
-        rows = self.connection.execute(stmt, node_id=node_id).fetchall()
-        return [r for (r,) in rows]
+        ))
+        """.format(self._paths_cte("= :node_id"),
+                   self._paths_cte("IN (SELECT node_id FROM recent)", "recent_paths")))
+
+        return self.connection.execute(stmt, node_id=int(node_id)).scalar()
 
-    def create_project(self, name):
+    def create_project(self, name, **settings):
         """
         Create a project with a name and return its id.
+
+        Parameters:
+            settings: Prototype settings (see set_prototype_settings).
         """
-        stmt = projects.insert({"name": name})
+        stmt = projects.insert({"name": name,
+                                **self._validate_prototype_settings(settings)})
         result = self.connection.execute(stmt)
         project_id = result.inserted_primary_key[0]
 
-        return project_id
+        return project_id
+
+    def get_prototype_settings(self, project_id):
+        """
+        Get the prototype settings of a project.
+
+        Parameters:
+            project_id: ID of the project (or a scalar subquery).
+
+        Returns:
+            dict with
+                n_prototypes: Number of prototypes per node.
+                clusterer: Clusterer of the prototypes of the own objects of a node (see CLUSTERERS).
+                sample_size: Maximum number of objects per node used to calculate cached values.
+                metric: Metric of merge_prototypes and recommend_objects (see METRICS).
+        """
+        stmt = (select([projects.c[c].label(k) for k, c in PROTOTYPE_SETTINGS.items()])
+                .where(projects.c.project_id == project_id))
+        result = self.connection.execute(stmt).fetchone()
+
+        if result is None:
+            raise TreeError("Unknown project: {}".format(project_id))
+
+        return dict(result)
+
+    def _validate_prototype_settings(self, settings):
+        """
+        Validate prototype settings and map them to their columns.
+        """
+        unknown = set(settings) - set(PROTOTYPE_SETTINGS)
+        if unknown:
+            raise TreeError("Unknown prototype settings: {}".format(
+                ", ".join(sorted(unknown))))
+
+        settings = {k: v for k, v in settings.items() if v is not None}
+
+        for key in ("n_prototypes", "sample_size"):
+            if key in settings and (not isinstance(settings[key], Integral) or settings[key] < 1):
+                raise TreeError("{} must be a positive integer: {!r}".format(key, settings[key]))
+
+        if settings.get("clusterer", "kmeans") not in CLUSTERERS:
+            raise TreeError("Unknown clusterer: {!r}".format(settings["clusterer"]))
+
+        if settings.get("metric", "euclidean") not in METRICS:
+            raise TreeError("Unknown metric: {!r}".format(settings["metric"]))
+
+        return {PROTOTYPE_SETTINGS[k]: v for k, v in settings.items()}
+
+    def set_prototype_settings(self, project_id, **settings):
+        """
+        Change the prototype settings of a project (see get_prototype_settings).
+
+        The cached values of all nodes of the project are invalidated
+        and the prototypes of the own objects of all nodes are reset.
+
+        Parameters:
+            project_id: ID of the project.
+            n_prototypes, clusterer, sample_size, metric: New values (None to keep the current value).
+        """
+        values = self._validate_prototype_settings(settings)
+        if not values:
+            return
+
+        with self.transaction():
+            self.lock_project(project_id)
+
+            self.connection.execute(projects.update()
+                                    .where(projects.c.project_id == project_id)
+                                    .values(values))
+
+            self.connection.execute(nodes.update()
+                                    .where(nodes.c.project_id == project_id)
+                                    .values(cache_valid=False, _own_prototypes=None))
+
+            self._evict(clear=True)
 
     def create_node(self, project_id=None, orig_node_id=None, parent_id=None, orig_parent=None, object_ids=None, name=None, progress_cb=None, **kwargs):
         """
@@ -575,11 +1475,12 @@ class Tree(object):
             node ID
         """
         if project_id is None and parent_id is not None:
-            project_id = (select([nodes.c.project_id])
-                          .where(nodes.c.node_id == parent_id)
-                          .as_scalar())
-            # Make sure that the retrieved id is non-NULL by coalescing with -1 which will trigger an IntegrityError
-            project_id = coalesce(project_id, -1)
+            project_id = self.connection.execute(
+                select([nodes.c.project_id])
+                .where(nodes.c.node_id == parent_id)).scalar()
+
+            if project_id is None:
+                raise TreeError("Unknown parent: {!r}".format(parent_id))
 
         if parent_id is None and orig_parent is not None:
             # Subquery: Find parent by its orig_id
@@ -588,114 +1489,65 @@ class Tree(object):
             # Make sure that the retrieved id is non-NULL by coalescing with -1 which will trigger an IntegrityError
             parent_id = coalesce(parent_id, -1)
 
-        row = {"project_id": project_id,
-               "parent_id": parent_id,
-               "orig_id": orig_node_id,
-               "name": name,
-               **kwargs}
-
-        stmt = nodes.insert(row)
-
-        try:
-            result = self.connection.execute(stmt)
-        except SQLAlchemyError as e:
-            row["orig_parent"] = orig_parent
-            raise TreeError(
-                "Node could not be created: {!r}".format(row)) from e
-
-        node_id = result.inserted_primary_key[0]
-
-        if object_ids is not None:
-            object_ids = iter(object_ids)
-            while True:
-                chunk = itertools.islice(object_ids, 1000)
-
-                data = [dict(node_id=node_id, object_id=object_id,
-                             project_id=project_id) for object_id in chunk]
-
-                if not data:
-                    break
-
-                self.connection.execute(nodes_objects.insert(), data)
-
-                if callable(progress_cb):
-                    progress_cb(len(data))
-        return node_id
-
-    def _calc_type_objects(self, children, objects_):
-        """
-        Calculate nine type objects for a node as
-            a) a sample of nine type objects from its children, or
-            b) nine of its own objects, if the node is a leaf.
-        """
-        if len(children) > 0:
-            # Randomly subsample children
-            subsample = np.random.choice(
-                children, min(len(children), 9), replace=False)
-            result = list(itertools.islice(_roundrobin(
-                [c["_type_objects"] for c in subsample]), 9))
-
-            if len(result) == 0:
-                print("\n", subsample)
+        with self.transaction():
+            # The parent gains a child (see _record_modification)
+            if isinstance(parent_id, Integral):
+                self.lock_paths([parent_id], exclusive=[parent_id])
 
-            return result
-        else:
-            return [o["object_id"] for o in objects_[:9]]
+            row = {"project_id": project_id,
+                   "parent_id": parent_id,
+                   "orig_id": orig_node_id,
+                   "name": name,
+                   **kwargs}
 
-    def _calc_own_type_objects(self, children, objects_):
-        """
-        Calculate nine own type objects_ for a node as
-            a) the nine objects_ with maximum distance to the children, or
-            b) [], if the node is a leaf.
-        """
+            stmt = nodes.insert(row)
 
-        if len(children) > 0 and len(objects_) > 0:
             try:
-                classifier = Classifier(children.vectors)
-                distances = classifier.distances(objects_.vectors)
-                max_dist = np.max(distances, axis=0)
-                max_dist_idx = np.argsort(max_dist)[::-1]
+                result = self.connection.execute(stmt)
+            except SQLAlchemyError as e:
+                row["orig_parent"] = orig_parent
+                raise TreeError(
+                    "Node could not be created: {!r}".format(row)) from e
 
-                assert len(max_dist_idx) == len(objects_), "{} != {}".format(
-                    len(max_dist_idx), len(objects_))
+            node_id = result.inserted_primary_key[0]
 
-                return [objects_[i]["object_id"] for i in max_dist_idx[:9]]
+            self._closure_insert_node(node_id)
 
-            except:
-                print("child_vectors", children.vectors.shape)
-                print("object_vectors", objects_.vectors.shape)
-                raise
+            if parent_id is not None and not isinstance(parent_id, Integral):
+                # The parent was looked up by its orig_id
+                parent_id = self.connection.execute(
+                    select([nodes.c.parent_id]).where(nodes.c.node_id == node_id)).scalar()
+                self.lock_paths([parent_id], exclusive=[parent_id])
 
-        else:
-            return []
+            if object_ids is not None:
+                object_ids = iter(object_ids)
+                while True:
+                    chunk = itertools.islice(object_ids, 1000)
 
-    def _calc_n_objects_deep(self, node, children):
-        """
-        Recursively calculate the number of objects.
-        """
+                    data = [dict(node_id=node_id, object_id=object_id,
+                                 project_id=project_id) for object_id in chunk]
 
-        child_ns = [c["_n_objects_deep"] for c in children]
+                    if not data:
+                        break
 
-        if any(n is None for n in child_ns):
-            return None
+                    self.connection.execute(nodes_objects.insert(), data)
 
-        return int(node["_n_objects"] + sum(child_ns))
+                    if callable(progress_cb):
+                        progress_cb(len(data))
 
-    def _query_n_objects_deep(self, node):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(nodes.c.node_id ==
-                                       node["node_id"]).cte(recursive=True)
+            # The parent has a new child
+            self._record_modification([node_id, parent_id])
 
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
+        return node_id
 
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id))
+    def _query_n_objects_deep(self, node):
+        # Select all descendants
+        subtree = self._query_subtree(node["node_id"])
 
-        # For each node in rquery, calculate #objects
-        deep_count = select([rquery.c.node_id, func.count(nodes_objects.c.object_id).label("count")]).\
-            select_from(rquery.join(nodes_objects)).\
-            group_by(rquery.c.node_id).\
+        # For each node in the subtree, calculate #objects
+        deep_count = select([subtree.c.node_id, func.count(nodes_objects.c.object_id).label("count")]).\
+            select_from(subtree.join(nodes_objects, nodes_objects.c.node_id == subtree.c.node_id)).\
+            group_by(subtree.c.node_id).\
             alias("deep_count")
 
         # Build total sum
@@ -706,18 +1558,11 @@ class Tree(object):
         return int(result)
 
     def node_n_descendants(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(
-            nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id))
+        # Select all descendants
+        subtree = self._query_subtree(node_id)
 
         # Count results
-        stmt = select([func.count()]).select_from(rquery)
+        stmt = select([func.count()]).select_from(subtree)
 
         result = self.connection.scalar(stmt) or 0
 
@@ -727,9 +1572,17 @@ class Tree(object):
         assert isinstance(
             node_id, Integral), "node_id is not integral: {!r}".format(node_id)
 
+        # Only fresh records are cached
+        token = None
+        if self.node_cache is not None and require_valid:
+            hits, token = self.node_cache.get_nodes([node_id])
+            if node_id in hits:
+                return dict(hits[node_id], stale=False)
+
+        stale = set()
         if require_valid:
             # TODO: Directly use values instead of reading again from DB
-            self.consolidate_node(node_id)
+            stale = self._consolidate_or_defer(node_id)
 
         stmt = (select([nodes])
                 .where(nodes.c.node_id == node_id))
@@ -739,7 +1592,55 @@ class Tree(object):
         if result is None:
             raise TreeError("Node {} is unknown.".format(node_id))
 
-        return dict(result)
+        if token is not None and result["cache_valid"] and node_id not in stale:
+            self.node_cache.set_nodes([dict(result)], token)
+
+        return dict(result, stale=node_id in stale)
+
+    def _consolidate_or_defer(self, node_id, children=False):
+        """
+        Consolidate the node (and its children) or, with background consolidation,
+        find the stale ones (see _defer_consolidation).
+
+        Returns:
+            Set of stale `node_id`s.
+        """
+        if self.dirty_queue is not None:
+            return self._defer_consolidation(node_id, children)
+
+        self.consolidate_node(node_id, depth="children" if children else 0)
+        return set()
+
+    def _defer_consolidation(self, node_id, children=False):
+        """
+        Background consolidation: Find the stale nodes among node_id (and its children)
+        instead of consolidating them.
+
+        The stale nodes are queued (again). Nodes without cached values
+        are consolidated immediately, as there is nothing to serve.
+
+        Returns:
+            Set of stale `node_id`s.
+        """
+        condition = nodes.c.node_id == node_id
+        if children:
+            condition |= nodes.c.parent_id == node_id
+
+        stmt = select([nodes.c.node_id, nodes.c.cache_valid]).where(condition)
+        rows = self.connection.execute(stmt).fetchall()
+
+        if not all(cache_valid for _, cache_valid in rows):
+            self.consolidate_node(node_id, depth=1 if children else 0)
+            return set()
+
+        stale = set(self._find_stale(node_id)) & {r for r, _ in rows}
+
+        if stale:
+            depth = len(self.get_path_ids(node_id)) - 1
+            self.dirty_queue.push({n: depth if n == node_id else depth + 1
+                                   for n in stale})
+
+        return stale
 
     def get_children(self, node_id,
                      require_valid=True,
@@ -763,8 +1664,17 @@ class Tree(object):
         assert isinstance(
             node_id, Integral), "node_id is not integral: {!r}".format(node_id)
 
+        # Only fresh children are cached
+        token = None
+        if self.node_cache is not None and require_valid and not supertree:
+            variant = "{}:{}".format(include, order_by)
+            cached, token = self.node_cache.get_children(node_id, variant)
+            if cached is not None:
+                return [dict(r, stale=False) for r in cached]
+
+        stale = set()
         if require_valid:
-            self.consolidate_node(node_id, depth="children")
+            stale = self._consolidate_or_defer(node_id, children=True)
 
         stmt = select([nodes])
 
@@ -781,7 +1691,11 @@ class Tree(object):
 
         result = self.connection.execute(stmt, node_id=node_id).fetchall()
 
-        return [dict(r) for r in result]
+        if token is not None and not stale and all(r["cache_valid"] for r in result):
+            self.node_cache.set_children(
+                node_id, variant, [dict(r) for r in result], token)
+
+        return [dict(r, stale=r["node_id"] in stale) for r in result]
 
     def merge_node_into(self, node_id, dest_node_id):
         """
@@ -792,25 +1706,48 @@ class Tree(object):
         n will be deleted.
         """
 
-        with self.connection.begin():
+        with self.transaction():
+            # The dest node gains the objects and children of n, the parent of n loses a child
+            # (see _record_modification)
+            stmt = select([nodes.c.parent_id]).where(nodes.c.node_id == node_id)
+            locked = [node_id, dest_node_id, self.connection.execute(stmt).scalar()]
+            self.lock_paths(locked, exclusive=locked)
+
             # Change node for objects
             stmt = nodes_objects.update().values(node_id=dest_node_id).where(
                 nodes_objects.c.node_id == node_id)
             self.connection.execute(stmt)
 
+            # Keep the nearest neighbour index up to date (after the commit)
+            project_id = select([nodes.c.project_id]).where(
+                nodes.c.node_id == node_id)
+            project_id = self.connection.execute(project_id).scalar()
+            self._relocated.append((project_id, None, node_id))
+
             # Change parent for children
             stmt = nodes.update().values(parent_id=dest_node_id).where(
-                nodes.c.parent_id == node_id)
-            self.connection.execute(stmt)
+                nodes.c.parent_id == node_id).returning(nodes.c.node_id)
+            child_ids = [r for (r,) in self.connection.execute(stmt)]
+
+            for child_id in child_ids:
+                self._closure_move_subtree(child_id, dest_node_id)
+
+            # The children (and their descendants) have new paths
+            self._evict(child_ids + [node_id], paths=True)
 
             # Delete node
-            stmt = nodes.delete(nodes.c.node_id == node_id)
-            self.connection.execute(stmt)
+            stmt = nodes.delete(nodes.c.node_id == node_id).returning(
+                nodes.c.parent_id)
+            old_parent_id = self.connection.execute(stmt).scalar()
 
-            # Invalidate dest node
-            stmt = nodes.update().values(cache_valid=False).where(
-                nodes.c.node_id == dest_node_id)
-            self.connection.execute(stmt)
+            # n was moved concurrently before the locks were acquired (rare; the late lock is not ordered)
+            if old_parent_id not in locked:
+                self.lock_paths([old_parent_id], exclusive=[old_parent_id])
+
+            # Invalidate dest node and the former parent.
+            # The prototypes of the own objects of the dest node are refitted.
+            self._record_modification([dest_node_id, old_parent_id],
+                                      own_prototypes={dest_node_id: None})
 
             # TODO: Unapprove
 
@@ -832,6 +1769,131 @@ class Tree(object):
 
         return [dict(r) for r in result]
 
+    def _query_object_sample(self, node_ids, sample_size):
+        """
+        Query a random sample of objects for multiple nodes in one query.
+
+        Returns:
+            (object_node_ids, object_ids, vectors)
+            vectors is an array of shape = [n_objects, n_features].
+        """
+        if self.feature_store is not None:
+            stmt = text("""
+            SELECT node_id, object_id
+            FROM (
+                SELECT  no.node_id, o.object_id,
+                        row_number() OVER (PARTITION BY no.node_id ORDER BY o.rand) AS rank
+                FROM    nodes_objects AS no
+                JOIN    objects AS o
+                ON      o.object_id = no.object_id
+                WHERE   no.node_id = ANY(:node_ids)
+            ) AS s
+            WHERE rank <= :sample_size
+            ORDER BY node_id, rank
+            """)
+        else:
+            stmt = text("""
+            SELECT node_id, object_id, vector
+            FROM (
+                SELECT  no.node_id, o.object_id, o.vector,
+                        row_number() OVER (PARTITION BY no.node_id ORDER BY o.rand) AS rank
+                FROM    nodes_objects AS no
+                JOIN    objects AS o
+                ON      o.object_id = no.object_id
+                WHERE   no.node_id = ANY(:node_ids)
+            ) AS s
+            WHERE rank <= :sample_size
+            ORDER BY node_id, rank
+            """).columns(vector=LargeBinary)
+
+        rows = self.connection.execute(
+            stmt, node_ids=list(node_ids), sample_size=sample_size).fetchall()
+
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=object), np.empty((0, 0))
+
+        if self.feature_store is not None:
+            object_node_ids, object_ids = zip(*rows)
+            object_node_ids = np.array(object_node_ids, dtype=np.int64)
+            object_ids = np.array(object_ids, dtype=object)
+
+            vectors, found = self.feature_store.get_vectors(
+                object_ids, missing="mask")
+        else:
+            object_node_ids, object_ids, vectors = zip(*rows)
+            object_node_ids = np.array(object_node_ids, dtype=np.int64)
+            object_ids = np.array(object_ids, dtype=object)
+
+            found = np.array([v is not None for v in vectors], dtype=bool)
+            vectors = decode_vectors(v for v in vectors if v is not None)
+
+        # Objects without a vector are skipped
+        if not found.all():
+            missing = object_ids[~found]
+            warnings.warn("Skipping {:d} objects without a vector: {}{}".format(
+                len(missing), ", ".join(missing[:5]), ", ..." if len(missing) > 5 else ""))
+
+        return object_node_ids[found], object_ids[found], vectors
+
+    def get_project_objects(self, project_id):
+        """
+        Get all objects of a project with their node and vector.
+
+        Objects without a vector are skipped.
+
+        Returns:
+            (object_ids, node_ids, vectors)
+        """
+        if self.feature_store is not None:
+            stmt = select([nodes_objects.c.object_id, nodes_objects.c.node_id]).where(
+                nodes_objects.c.project_id == project_id)
+        else:
+            stmt = (select([nodes_objects.c.object_id, nodes_objects.c.node_id,
+                            type_coerce(objects.c.vector, LargeBinary).label("vector")])
+                    .select_from(nodes_objects.join(objects))
+                    .where((nodes_objects.c.project_id == project_id) & objects.c.vector.isnot(None)))
+
+        rows = self.connection.execute(stmt).fetchall()
+
+        if not rows:
+            return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty((0, 0))
+
+        columns = list(zip(*rows))
+        object_ids = np.array(columns[0], dtype=object)
+        node_ids = np.array(columns[1], dtype=np.int64)
+
+        if self.feature_store is not None:
+            vectors, found = self.feature_store.get_vectors(
+                object_ids, missing="mask")
+            return object_ids[found], node_ids[found], vectors
+
+        return object_ids, node_ids, decode_vectors(columns[2])
+
+    def get_object_vectors(self, object_ids):
+        """
+        Get the vectors of multiple objects.
+
+        Vectors are read from the feature store, if available.
+
+        Returns:
+            array of shape = [n_objects, n_features].
+        """
+        object_ids = list(object_ids)
+
+        if self.feature_store is not None:
+            return self.feature_store.get_vectors(object_ids)
+
+        stmt = (select([objects.c.object_id,
+                        type_coerce(objects.c.vector, LargeBinary).label("vector")])
+                .where(objects.c.object_id.in_(object_ids)))
+
+        vectors = dict(self.connection.execute(stmt).fetchall())
+
+        try:
+            return decode_vectors(vectors[object_id] for object_id in object_ids)
+        except (KeyError, TypeError) as exc:
+            raise TreeError("Missing vectors: {}".format(exc)) from exc
+
     def get_n_objects(self, node_id):
         stmt = select([func.count()]).select_from(
             nodes_objects).where(nodes_objects.c.node_id == node_id)
@@ -842,29 +1904,51 @@ class Tree(object):
     def invalidate_node_and_parents(self, node_id):
         """
         Invalidate the cached values in the node and its parents.
+
+        Only the node is written, the parents become stale lazily (see _find_stale).
         """
 
-        with self.connection.begin():
-            self.lock_project_for_node(node_id)
+        with self.transaction():
+            self.lock_paths([node_id], exclusive=[node_id])
 
-            stmt = text("""
-            WITH RECURSIVE q AS
-            (
-                SELECT  n.*, 1 AS level
-                FROM    nodes AS n
-                WHERE   n.node_id = :node_id
-                UNION ALL
-                SELECT  p.*, level + 1
-                FROM    q
-                JOIN    nodes AS p
-                ON      p.node_id = q.parent_id
-            )
-            UPDATE nodes
-            SET cache_valid = FALSE
-            WHERE node_id IN (SELECT node_id from q);
-            """)
+            self._record_modification([node_id])
+
+    def _find_stale(self, node_id):
+        """
+        Find the nodes in the subtree rooted at node_id whose (valid) cached values are older than a modification below.
+
+        Only nodes on the paths from recently modified nodes (newer than the cached values of node_id)
+        are inspected. Nothing is written, so that readers do not block modifications.
 
-            self.connection.execute(stmt, node_id=node_id)
+        Returns:
+            List of stale node_ids.
+        """
+        stmt = text("""
+        WITH RECURSIVE recent AS (
+            SELECT r.node_id, r.version
+            FROM nodes AS r
+            JOIN nodes AS u
+            ON r.project_id = u.project_id
+            WHERE u.node_id = :node_id AND r.version > COALESCE(u._cache_epoch, 0)
+        ),
+        {},
+        -- Recent nodes inside the subtree and their distance to node_id
+        inside AS (
+            SELECT descendant_id, depth FROM paths WHERE ancestor_id = :node_id
+        )
+        SELECT DISTINCT a.node_id
+        FROM paths AS p
+        JOIN inside AS i
+        ON i.descendant_id = p.descendant_id AND p.depth <= i.depth
+        JOIN recent AS r
+        ON r.node_id = p.descendant_id
+        JOIN nodes AS a
+        ON a.node_id = p.ancestor_id
+        WHERE a.cache_valid
+        AND (a._cache_epoch IS NULL OR r.version > a._cache_epoch)
+        """.format(self._paths_cte("IN (SELECT node_id FROM recent)")))
+
+        return [r for (r,) in self.connection.execute(stmt, node_id=node_id)]
 
     def recommend_children(self, node_id, max_n=1000):
         node = self.get_node(node_id)
@@ -898,10 +1982,13 @@ class Tree(object):
 
         return nodes_[order].tolist()
 
-    def recommend_objects(self, node_id, max_n=1000):
+    def recommend_objects(self, node_id, max_n=1000, exact=False):
         """
         Recommend objects for a node.
 
+        If the project has an ANNIndex, it is used to find the nearest objects.
+        Otherwise (or if exact=True), all candidate objects are queried.
+
         Note: Most time is spent querying all objects below a node.
         This can be sped up, if the nodes a relatively small.
 
@@ -912,75 +1999,211 @@ class Tree(object):
                 lie under these max_n quasi-randomly chosen objects.
         """
         with Timer("Tree.recommend_objects") as timer:
-            node = self.get_node(node_id)
+            object_ids, _, vectors, node_ids = self._rank_objects(
+                node_id, max_n, exact, timer)
+
+            if not len(object_ids):
+                return []
+
+            with timer.child("Result assembly"):
+                return self._query_recommended_objects(object_ids, vectors, node_ids)
+
+    def rank_recommended_objects(self, node_id, max_n=1000, exact=False):
+        """
+        Rank the recommended objects for a node (like recommend_objects)
+        without querying the rows of the objects.
 
-            # Get the path to the node (without the node itself)
-            path = self.get_path_ids(node_id)[:-1]
+        Returns:
+            (object_ids, scores), sorted by score (smaller is better).
+        """
+        with Timer("Tree.rank_recommended_objects") as timer:
+            object_ids, scores, _, node_ids = self._rank_objects(
+                node_id, max_n, exact, timer)
+
+            if node_ids is not None and len(object_ids):
+                with timer.child("Filter assigned"):
+                    stmt = (select([nodes_objects.c.object_id])
+                            .where(nodes_objects.c.object_id.in_([str(o) for o in object_ids])
+                                   & nodes_objects.c.node_id.in_(node_ids)))
+                    assigned = set(r for (r,) in self.connection.execute(stmt))
+                    mask = np.array([str(o) in assigned for o in object_ids], dtype=bool)
+                    object_ids, scores = object_ids[mask], scores[mask]
+
+            return object_ids, scores
+
+    def _rank_objects(self, node_id, max_n, exact, timer):
+        """
+        Find the max_n nearest candidate objects for a node.
 
-            objects_ = []
+        Returns:
+            (object_ids, scores, vectors, node_ids), sorted by score.
+            node_ids: Only the objects that are currently assigned to one of
+                these nodes are valid (None if all are valid).
+        """
+        node = self.get_node(node_id)
 
-            rejected_object_ids = (select([nodes_rejected_objects.c.object_id])
-                                   .where(nodes_rejected_objects.c.node_id == node_id)
-                                   .alias("rejected_object_ids"))
+        # Get the path to the node (without the node itself)
+        path = self.get_path_ids(node_id)[:-1]
 
-            with timer.child("Query matching objects"):
-                # Traverse the parse in reverse
-                for parent_id in path[::-1]:
-                    n_left = max_n - len(objects_)
+        index = None if exact else self.ann_indexes.get(node["project_id"])
+        if index is not None:
+            with timer.child("Query index"):
+                return self._recommend_objects_ann(index, node, path, max_n)
 
-                    # Break if we already have enough nodes
-                    if n_left <= 0:
-                        break
+        prots = node["_prototypes"]
+        if prots is None:
+            raise TreeError("Node has no prototypes!")
 
-                    # Get objects below parent_id that are not rejected by node_id
-                    stmt = (select([objects])
-                            .select_from(objects.join(nodes_objects))
-                            .where((nodes_objects.c.node_id == parent_id) & (~objects.c.object_id.in_(rejected_object_ids))))
+        metric = self.get_prototype_settings(node["project_id"])["metric"]
 
-                    result = self.connection.execute(stmt).fetchall()
+        rejected_object_ids = (select([nodes_rejected_objects.c.object_id])
+                               .where(nodes_rejected_objects.c.node_id == node_id)
+                               .alias("rejected_object_ids"))
 
-                    objects_.extend(dict(r) for r in result)
+        # Keep the max_n nearest objects while streaming all candidates
+        top = TopK(max_n)
+        n_candidates = 0
 
-            if not objects_:
-                return []
+        with timer.child("Stream and score candidates"):
+            # Traverse the path in reverse
+            for parent_id in path[::-1]:
+                # Break if we already have enough objects
+                if n_candidates >= max_n:
+                    break
 
-            with timer.child("Convert to array"):
-                vectors = [o["vector"] for o in objects_]
-                objects_ = np.array(objects_, dtype=object)
-                vectors = np.array(vectors)
+                # Get objects below parent_id that are not rejected by node_id
+                columns = [objects.c.object_id]
+                condition = (nodes_objects.c.node_id == parent_id) & (
+                    ~objects.c.object_id.in_(rejected_object_ids))
+                if self.feature_store is None:
+                    columns.append(type_coerce(
+                        objects.c.vector, LargeBinary).label("vector"))
+                    condition &= objects.c.vector.isnot(None)
+
+                # Use a server-side cursor
+                stmt = (select(columns)
+                        .select_from(objects.join(nodes_objects))
+                        .where(condition)
+                        .execution_options(stream_results=True))
+
+                result = self.connection.execute(stmt)
+
+                while True:
+                    rows = result.fetchmany(RECOMMEND_CHUNK_SIZE)
+                    if not rows:
+                        break
 
-            with timer.child("Calculate distances"):
-                prots = node["_prototypes"]
-                if prots is None:
-                    raise TreeError("Node has no prototypes!")
+                    n_candidates += len(rows)
 
-                distances = prots.transform(vectors)
+                    object_ids = np.array([r[0] for r in rows], dtype=object)
+                    if self.feature_store is not None:
+                        vectors, found = self.feature_store.get_vectors(
+                            object_ids, missing="mask")
+                        object_ids = object_ids[found]
+                    else:
+                        vectors = decode_vectors(r[1] for r in rows)
 
-            with timer.child("Sorting"):
-                order = np.argsort(distances)[:max_n]
+                    top.push(prots.transform(vectors, metric), object_ids, vectors)
 
-            with timer.child("Result assembly"):
-                return objects_[order].tolist()
+        top = top.result()
+        if top is None:
+            return np.empty(0, dtype=object), np.empty(0), np.empty((0, 0)), None
 
-    def invalidate_nodes(self, nodes_to_invalidate, unapprove=False):
+        scores, object_ids, vectors = top
+
+        return object_ids, scores, vectors, None
+
+    def _query_recommended_objects(self, object_ids, vectors, node_ids=None):
         """
-        Invalidate the provided nodes.
+        Query the rows of recommended objects and attach their vectors.
 
         Parameters:
-            nodes_to_invalidate: Collection of `node_id`s
+            node_ids: Only return objects that are currently assigned to one of these nodes.
+
+        Returns:
+            List of objects in the order of object_ids.
+        """
+        object_ids = [str(o) for o in object_ids]
+
+        stmt = select([objects.c.object_id, objects.c.path, objects.c.rand])
+        condition = objects.c.object_id.in_(object_ids)
+        if node_ids is not None:
+            stmt = stmt.select_from(objects.join(nodes_objects))
+            condition &= nodes_objects.c.node_id.in_(node_ids)
+
+        objects_ = {r["object_id"]: dict(r)
+                    for r in self.connection.execute(stmt.where(condition))}
+
+        result = []
+        for object_id, vector in zip(object_ids, vectors):
+            o = objects_.get(object_id)
+            if o is not None:
+                o["vector"] = vector
+                result.append(o)
+
+        return result
+
+    def _recommend_objects_ann(self, index, node, path, max_n):
         """
+        Rank the recommended objects for a node using an ANNIndex (see _rank_objects).
+
+        The candidates are the same as in the exhaustive search:
+        The objects of the ancestors (from the nearest one upwards)
+        until at least max_n objects are collected.
+        """
+        prots = node["_prototypes"]
+        if prots is None:
+            raise TreeError("Node has no prototypes!")
+
+        # Count the candidates of each ancestor (without transferring them)
+        stmt = text("""
+        SELECT no.node_id, count(*)
+        FROM nodes_objects AS no
+        WHERE no.node_id = ANY(:path) AND no.object_id NOT IN (
+            SELECT object_id FROM nodes_rejected_objects WHERE node_id = :node_id
+        )
+        GROUP BY no.node_id
+        """)
+        counts = dict(self.connection.execute(
+            stmt, path=path, node_id=node["node_id"]).fetchall())
+
+        candidate_node_ids = []
+        n_candidates = 0
+        for parent_id in path[::-1]:
+            if n_candidates >= max_n:
+                break
+            candidate_node_ids.append(parent_id)
+            n_candidates += counts.get(parent_id, 0)
+
+        if not n_candidates:
+            return np.empty(0, dtype=object), np.empty(0), np.empty((0, 0)), None
+
+        stmt = select([nodes_rejected_objects.c.object_id]).where(
+            nodes_rejected_objects.c.node_id == node["node_id"])
+        rejected_object_ids = [r for (r,) in self.connection.execute(stmt)]
+
+        rows, distances = index.search(prots.prototypes_, max_n,
+                                       node_ids=candidate_node_ids,
+                                       exclude=rejected_object_ids,
+                                       n_probe=ANN_N_PROBE)
+
+        # Objects that the index lists under a stale node are dropped later
+        return (index.object_ids[rows], distances, index.vectors[rows],
+                candidate_node_ids)
 
-        # TODO: Get project ids for requested node ids and lock the projects
-        # Otherwise a deadlock might occur.
+    def invalidate_nodes(self, nodes_to_invalidate, unapprove=False):
+        """
+        Invalidate the provided nodes (and lazily their ancestors).
 
-        values = {nodes.c.cache_valid: False}
+        The caller must hold exclusive locks on the nodes (see lock_paths).
 
-        if unapprove:
-            values[nodes.c.approved] = False
+        Parameters:
+            nodes_to_invalidate: Collection of `node_id`s
+            unapprove: Also revoke the approval of the nodes.
+        """
 
-        stmt = nodes.update().values(values).where(
-            nodes.c.node_id.in_(nodes_to_invalidate))
-        self.connection.execute(stmt)
+        self._record_modification(nodes_to_invalidate,
+                                  nodes_to_invalidate if unapprove else ())
 
     def relocate_nodes(self, node_ids, parent_id, unapprove=False):
         """
@@ -990,9 +2213,31 @@ class Tree(object):
         if len(node_ids) == 0:
             return
 
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(parent_id)
+        def get_nodes_to_unapprove(old_parent_ids):
+            """
+            Nodes on the paths of the old parents and the new parent
+            up to (including) their first common ancestor.
+            """
+            if not unapprove:
+                return set()
+
+            # Relocated roots have no old parent
+            old_parent_ids = [p for p in old_parent_ids if p is not None]
+            old_parent_paths = self.get_paths(old_parent_ids)
+            parent_paths = [self.get_path_ids(parent_id)] + \
+                [old_parent_paths[p] for p in old_parent_ids]
+            paths_to_update = _paths_from_common_ancestor(parent_paths)
+            return set(sum(paths_to_update, []))
+
+        with self.transaction():
+            # The moved subtrees are restructured, the old and the new parent lose and gain children
+            # and the approval of the nodes on their paths is revoked (see _record_modification)
+            stmt = select([nodes.c.parent_id]).distinct().where(
+                nodes.c.node_id.in_(node_ids))
+            old_parent_ids = [r for (r,) in self.connection.execute(stmt)]
+            locked = (set(node_ids) | {parent_id} | set(old_parent_ids)
+                      | get_nodes_to_unapprove(old_parent_ids))
+            self.lock_paths(locked, exclusive=locked)
 
             new_parent_path = self.get_path_ids(parent_id)
 
@@ -1020,82 +2265,265 @@ class Tree(object):
             # Fetch old_parent_ids
             result = self.connection.execute(
                 stmt, new_parent_id=parent_id, node_ids=tuple(node_ids)).fetchall()
+            old_parent_ids = [r["old_parent_id"] for r in result]
 
-            # Invalidate subtree rooted at first common ancestor
-            parent_paths = [new_parent_path] + \
-                [self.get_path_ids(r["old_parent_id"]) for r in result]
-            paths_to_update = _paths_from_common_ancestor(parent_paths)
-            nodes_to_invalidate = set(sum(paths_to_update, []))
+            # Unapprove subtree rooted at first common ancestor
+            nodes_to_unapprove = get_nodes_to_unapprove(old_parent_ids)
+            assert not unapprove or parent_id in nodes_to_unapprove
+
+            # Nodes that were moved concurrently before the locks were acquired
+            # (rare; the late locks are not ordered)
+            late = (set(old_parent_ids) | nodes_to_unapprove) - locked
+            self.lock_paths(late, exclusive=late)
 
-            assert parent_id in nodes_to_invalidate
+            for node_id in node_ids:
+                self._closure_move_subtree(node_id, parent_id)
+
+            # The moved nodes (and their descendants) have new paths
+            self._evict(node_ids, paths=True)
 
-            self.invalidate_nodes(nodes_to_invalidate, unapprove)
+            # The ancestors are invalidated lazily
+            modified = [parent_id] + old_parent_ids
+
+            self._record_modification(modified, nodes_to_unapprove)
 
     def relocate_objects(self, object_ids, node_id, unapprove=False):
         """
-        Relocate an object to another node.
+        Relocate objects to another node.
+
+        The assignments are updated in a single statement that returns the
+        distinct previous nodes. Only nodes whose (deep) members change are invalidated.
+        The prototypes of the own objects of the old and the new nodes absorb
+        the moved objects (see _update_own_prototypes).
 
-        TODO: This is slow!
+        Parameters:
+            object_ids: Collection of `object_id`s (batches of 100k objects are fine).
+            node_id: Target node.
+            unapprove: Also revoke the approval of the invalidated nodes.
         """
 
         if len(object_ids) == 0:
             return
 
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(node_id)
+        object_ids = [str(o) for o in object_ids]
 
+        with self.transaction():
             # Poject id of the new node
             project_id = select([nodes.c.project_id]).where(
                 nodes.c.node_id == node_id)
             project_id = self.connection.execute(project_id).scalar()
 
-            new_node_path = self.get_path_ids(node_id)
+            # Lock the paths of the current nodes of the objects and of the new node.
+            # Their own prototypes are read and written and the approval of the
+            # affected nodes is revoked, so they are locked exclusively (see _record_modification).
+            stmt = text("""
+            SELECT DISTINCT node_id
+            FROM nodes_objects
+            WHERE project_id = :project_id
+            AND object_id = ANY(:object_ids)
+            AND node_id != :node_id
+            """)
+            locked = [r for (r,) in self.connection.execute(
+                stmt, node_id=node_id, project_id=project_id, object_ids=object_ids)]
+            if unapprove and locked:
+                locked = sorted(self._get_relocation_affected(locked, node_id))
+            self.lock_paths(locked + [node_id], exclusive=locked + [node_id])
+
+            # Update assignments and return the distinct old node_ids
+            # with the moved object_ids (if there are not too many).
+            # y holds the rows before the update.
+            stmt = text("""
+            WITH moved AS (
+                UPDATE nodes_objects AS x
+                SET node_id = :node_id
+                FROM nodes_objects AS y
+                WHERE y.project_id = :project_id
+                AND y.object_id = ANY(:object_ids)
+                AND y.node_id != :node_id
+                AND x.project_id = y.project_id
+                AND x.object_id = y.object_id
+                RETURNING y.node_id AS old_node_id, x.object_id
+            )
+            SELECT old_node_id,
+                CASE WHEN count(*) <= :limit THEN array_agg(object_id) END AS moved_ids
+            FROM moved
+            GROUP BY old_node_id
+            """)
+            moved = dict(self.connection.execute(
+                stmt, node_id=node_id, project_id=project_id, object_ids=object_ids,
+                limit=INCREMENTAL_PROTOTYPES_LIMIT).fetchall())
+            old_node_ids = list(moved)
 
-            # Find current node_ids of the objects
-            # This is slow!
-            # old_node_ids is required for invalidation
-            # TODO: Distinct!
-            stmt = select([nodes_objects.c.node_id], for_update=True).where(
-                nodes_objects.c.object_id.in_(object_ids) & (nodes_objects.c.project_id == project_id))
-            old_node_ids = [r["node_id"]
-                            for r in self.connection.execute(stmt).fetchall()]
+            if not old_node_ids:
+                return
 
-            # Update assignments
-            stmt = nodes_objects.update().values({"node_id": node_id})\
-                .where(nodes_objects.c.object_id.in_(object_ids) & (nodes_objects.c.project_id == project_id))
-            self.connection.execute(stmt)
+            if unapprove:
+                nodes_to_unapprove = self._get_relocation_affected(
+                    old_node_ids, node_id)
+
+                assert node_id in nodes_to_unapprove
+            else:
+                nodes_to_unapprove = set()
+
+            # Objects that were moved concurrently before the locks were acquired
+            # (rare; the late locks are not ordered)
+            late = (set(old_node_ids) | nodes_to_unapprove) - set(locked) - {node_id}
+            self.lock_paths(late, exclusive=late)
 
-            # # Return distinct old `parent_id`s
-            # stmt = text("""
-            # WITH updater AS (
-            #     UPDATE nodes_objects x
-            #     SET node_id = :node_id
-            #     FROM  (SELECT object_id, node_id FROM nodes_objects
-            #         WHERE project_id = :project_id AND object_id IN :object_ids FOR UPDATE) y
-            #     WHERE  project_id = :project_id AND x.object_id = y.object_id
-            #     RETURNING y.node_id AS old_node_id
-            # )
-            # SELECT DISTINCT old_node_id FROM updater;
-            # """)
-
-            # # Fetch old_parent_ids
-            # result = self.connection.execute(stmt,
-            #                                  node_id=node_id,
-            #                                  project_id=project_id,
-            #                                  object_ids=tuple(object_ids)
-            #                                  ).fetchall()
-
-            # Invalidate subtree rooted at first common ancestor
-            paths = [new_node_path] + [old_node_ids]
-            paths_to_update = _paths_from_common_ancestor(paths)
-            nodes_to_invalidate = set(sum(paths_to_update, []))
-
-            print("Invalidating {!r}...".format(nodes_to_invalidate))
-
-            assert node_id in nodes_to_invalidate
-
-            self.invalidate_nodes(nodes_to_invalidate, unapprove)
+            # Keep the nearest neighbour index up to date (after the commit)
+            self._relocated.append((project_id, object_ids, None))
+
+            own_prototypes = self._update_own_prototypes(moved, node_id)
+
+            # The ancestors are invalidated lazily
+            self._record_modification(
+                old_node_ids + [node_id], nodes_to_unapprove, own_prototypes=own_prototypes)
+
+    def _update_own_prototypes(self, moved, node_id):
+        """
+        Update the prototypes of the own objects of nodes after objects were moved.
+
+        The removed and added object vectors are absorbed without a refit
+        (see IncrementalPrototypes). Prototypes that can not be updated
+        (too many moved objects, missing vectors) are reset.
+        The nodes must be locked exclusively (see relocate_objects).
+
+        Parameters:
+            moved: dict old node_id -> list of moved object_ids (None if too many).
+            node_id: New node of the moved objects.
+
+        Returns:
+            dict node_id -> IncrementalPrototypes or None (for _record_modification).
+        """
+
+        stmt = (select([nodes.c.node_id, nodes.c._own_prototypes])
+                .where(nodes.c.node_id.in_(list(moved) + [node_id])
+                       & nodes.c._own_prototypes.isnot(None)))
+        models = dict(self.connection.execute(stmt).fetchall())
+
+        if not models:
+            return {}
+
+        # Removed object_ids per node and added object_ids (None if unknown)
+        changes = {n: (object_ids, False) for n, object_ids in moved.items()}
+        if any(object_ids is None for object_ids in moved.values()):
+            changes[node_id] = (None, True)
+        else:
+            added = [o for object_ids in moved.values() for o in object_ids]
+            if len(added) > INCREMENTAL_PROTOTYPES_LIMIT:
+                added = None
+            changes[node_id] = (added, True)
+
+        required = list(set(o for n in models
+                            for o in (changes[n][0] or ())))
+
+        try:
+            vectors = self.get_object_vectors(required)
+        except (TreeError, KeyError):
+            return {n: None for n in models}
+
+        positions = {o: i for i, o in enumerate(required)}
+
+        result = {}
+        for n, model in models.items():
+            object_ids, add = changes[n]
+
+            if object_ids is None:
+                result[n] = None
+                continue
+
+            X = vectors[[positions[o] for o in object_ids]]
+            if add:
+                model.partial_fit(X)
+            else:
+                model.remove(X)
+
+            result[n] = model
+
+        return result
+
+    def _paths_cte(self, selector="= ANY(:node_ids)", name="paths"):
+        """
+        SQL for a common table expression "paths(descendant_id, ancestor_id, depth)"
+        with the paths of the selected nodes (including the nodes themselves).
+
+        Must be used in a WITH RECURSIVE clause.
+
+        Parameters:
+            selector: SQL condition for the node_ids of the selected nodes.
+                Default: The nodes in the array parameter :node_ids.
+            name: Name of the common table expression.
+        """
+        if self.use_closure:
+            return """
+            {0} AS (
+                SELECT descendant_id, ancestor_id, depth
+                FROM nodes_closure
+                WHERE descendant_id {1}
+            )
+            """.format(name, selector)
+
+        return """
+        {0} AS (
+            SELECT node_id AS descendant_id, node_id AS ancestor_id, parent_id, 0 AS depth
+            FROM nodes
+            WHERE node_id {1}
+            UNION ALL
+            SELECT p.descendant_id, n.node_id, n.parent_id, p.depth + 1
+            FROM {0} AS p
+            JOIN nodes AS n
+            ON n.node_id = p.parent_id
+        )
+        """.format(name, selector)
+
+    def _get_relocation_affected(self, old_node_ids, node_id):
+        """
+        Get the nodes that are affected if objects move from `old_node_ids` to `node_id`.
+
+        For every old node o, these are the old and the new node and the
+        nodes on the path from o or `node_id` up to (including)
+        their first common ancestor (like _paths_from_common_ancestor).
+
+        Returns:
+            Set of `node_id`s.
+        """
+
+        stmt = text("""
+        WITH RECURSIVE {},
+        new_path AS (
+            SELECT ancestor_id, depth FROM paths WHERE descendant_id = :node_id
+        ),
+        old_paths AS (
+            SELECT descendant_id, ancestor_id FROM paths WHERE descendant_id = ANY(:old_node_ids)
+        ),
+        -- Ancestors of all old nodes
+        common AS (
+            SELECT ancestor_id FROM old_paths
+            GROUP BY ancestor_id
+            HAVING count(*) = :n_old
+        )
+        SELECT ancestor_id FROM old_paths
+        WHERE ancestor_id NOT IN (SELECT ancestor_id FROM new_path)
+        UNION
+        SELECT ancestor_id FROM new_path
+        WHERE ancestor_id NOT IN (SELECT ancestor_id FROM common)
+        UNION
+        -- First common ancestor of all old nodes and the new node
+        (
+            SELECT ancestor_id FROM new_path
+            WHERE ancestor_id IN (SELECT ancestor_id FROM common)
+            ORDER BY depth
+            LIMIT 1
+        )
+        """.format(self._paths_cte()))
+
+        result = self.connection.execute(stmt,
+                                         node_ids=list(old_node_ids) + [node_id],
+                                         old_node_ids=list(old_node_ids),
+                                         node_id=node_id,
+                                         n_old=len(old_node_ids))
+
+        return set(r for (r,) in result) | set(old_node_ids) | {node_id}
 
     def reject_objects(self, node_id, object_ids):
         """
@@ -1105,9 +2533,8 @@ class Tree(object):
         if not object_ids:
             return
 
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(node_id)
+        with self.transaction():
+            self.lock_paths([node_id])
 
             # Poject id of the node
             project_id = select([nodes.c.project_id]).where(
@@ -1128,8 +2555,19 @@ class Tree(object):
         if data.pop("node_id", None) is not None:
             raise TreeError("Do not update the node_id!")
 
-        stmt = nodes.update().values(data).where(nodes.c.node_id == node_id)
-        self.connection.execute(stmt)
+        with self.transaction():
+            # The row of the node is written before the rows of its path
+            self.lock_paths([node_id], exclusive=[node_id])
+
+            stmt = (nodes.update().values(data).where(nodes.c.node_id == node_id)
+                    .returning(nodes.c.parent_id))
+            parent_id = self.connection.execute(stmt).scalar()
+
+            if PROGRESS_INPUTS.intersection(data):
+                self._record_modification([node_id], touch=False)
+
+            # The parent lists the node among its children
+            self._evict([node_id, parent_id])
 
     def get_tip(self, node_id):
         """
@@ -1202,7 +2640,7 @@ class Tree(object):
         """
 
         # First try if there are candidates below this node
-        subtree = _rquery_subtree(node_id, recurse_cb)
+        subtree = self._query_subtree(node_id, recurse_cb)
 
         children = nodes.alias("children")
         n_children = (select([func.count()])
@@ -1244,7 +2682,7 @@ class Tree(object):
 
         return None
 
-    def consolidate_node(self, node_id, depth=0, descend_approved=True, return_=None):
+    def consolidate_node(self, node_id, depth=0, descend_approved=True, return_=None, n_workers=1):
         """
         Ensures that the calculated values of this node are valid.
 
@@ -1254,6 +2692,7 @@ class Tree(object):
             node_id: Root of the subtree that gets consolidated.
             depth: Ensure validity of cached values at least up to a certain depth.
             return_: None | "node" | "children". Return this node or its children.
+            n_workers: Number of processes used to fit the prototypes of each level.
 
         Returns:
             node dict or list of children, depending on return_ parameter.
@@ -1269,9 +2708,26 @@ class Tree(object):
                     "Unknown depth string: {}".format(depth))
 
         # Wrap everything in a transaction
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(node_id)
+        with self.transaction():
+            if self.locking == "project":
+                self.lock_project_for_node(node_id)
+            else:
+                # Readers do not wait for modifications.
+                # Only the write-back is locked (see below).
+                self.lock_project_for_node(node_id, shared=True)
+
+            # Modifications of finished transactions are reflected in the results.
+            # Modifications of running transactions have a newer version and make the results stale.
+            epoch = self.connection.execute(
+                text("SELECT txid_snapshot_xmin(txid_current_snapshot()) - 1")).scalar()
+
+            # Detect stale values
+            stale = self._find_stale(node_id)
+
+            def invalid(q):
+                if stale:
+                    return (q.c.cache_valid == False) | q.c.node_id.in_(stale)
+                return q.c.cache_valid == False
 
             if depth == -1:
                 if descend_approved:
@@ -1280,7 +2736,7 @@ class Tree(object):
                     # Only recurse into invalid nodes
                     # Ensure validity up to a certain level
                     def recurse_cb(q, s): return (
-                        q.c.cache_valid == False) | (q.c.approved == False)
+                        invalid(q) | (q.c.approved == False))
             else:
                 if not descend_approved:
                     raise NotImplementedError()
@@ -1288,9 +2744,9 @@ class Tree(object):
                 # Only recurse into invalid nodes
                 # Ensure validity up to a certain level
                 def recurse_cb(q, s): return (
-                    q.c.cache_valid == False) | (q.c.level < depth)
+                    invalid(q) | (q.c.level < depth))
 
-            invalid_subtree = _rquery_subtree(node_id, recurse_cb)
+            invalid_subtree = self._query_subtree(node_id, recurse_cb)
 
             # Readily query real n_objects
             n_objects = (select([func.count()])
@@ -1318,116 +2774,34 @@ class Tree(object):
             if len(invalid_subtree) == 0:
                 raise TreeError("Unknown node: {}".format(node_id))
 
+            invalid_subtree.loc[invalid_subtree.index.isin(
+                stale), "cache_valid"] = False
+
             if not invalid_subtree["cache_valid"].all():
-                # 1. _n_objects, _n_children
-                invalid_subtree["_n_objects"] = invalid_subtree["_n_objects_"]
-                invalid_subtree["_n_children"] = invalid_subtree["_n_children_"]
-
-                invalid_subtree["__updated"] = False
-
-                # Initialize clusterer
-                clusterer = KMeans(N_PROTOTYPES, n_init=2)
-
-                # Iterate over DataFrame fixing the values along the way
-                bar = ProgressBar(len(invalid_subtree), max_width=40)
-                for node_id in invalid_subtree.index:
-                    if invalid_subtree.at[node_id, "cache_valid"]:
-                        # Don't recalculate valid nodes as invalid_subtree (rightly)
-                        # doesn't include their children.
-                        continue
-
-                    child_selector = (invalid_subtree['parent_id'] == node_id)
-                    children = invalid_subtree.loc[child_selector]
-                    children_dict = MemberCollection(children.reset_index().to_dict('records'),
-                                                     "zero")
-
-                    # 2. _n_objects_deep
-                    _n_objects = invalid_subtree.loc[node_id, "_n_objects"]
-                    _n_objects_deep = (
-                        _n_objects
-                        + children["_n_objects_deep"].sum())
-                    invalid_subtree.at[node_id,
-                                       "_n_objects_deep"] = _n_objects_deep
-
-                    # Sample 1000 objects to speed up the calculation
-                    objects_ = MemberCollection(self.get_objects(node_id, order_by=objects.c.rand, limit=1000),
-                                                "raise")
-
-                    # 3. _own_type_objects, _type_objects
-                    # TODO: Replace _own_type_objects with "_atypical_objects"
-                    invalid_subtree.at[node_id, "_own_type_objects"] = (
-                        self._calc_own_type_objects(children_dict, objects_))
-                    # self._calc_own_type_objects(children_dict, objects_)
-
-                    invalid_subtree.at[node_id, "_type_objects"] = (
-                        self._calc_type_objects(children_dict, objects_))
-
-                    if len(children_dict) > 0 and len(invalid_subtree.at[node_id, "_type_objects"]) == 0:
-                        print(
-                            "\nNode {} has no type objects although it has children!".format(node_id))
-
-                    # 4. _centroid
-                    _centroid = []
-
-                    if len(objects_) > 0:
-                        # Object mean, weighted with number of objects
-                        obj_mean = np.sum(objects_.vectors, axis=0)
-                        obj_mean /= np.linalg.norm(obj_mean)
-                        _centroid.append(_n_objects * obj_mean)
-                    if len(children_dict) > 0:
-                        children_mean = np.sum(children_dict.cardinalities[:, np.newaxis] * children_dict.vectors,
-                                               axis=0)
-                        _centroid.append(children_mean)
-
-                    if len(_centroid) > 0:
-                        _centroid = np.sum(_centroid, axis=0)
-                        _centroid /= np.linalg.norm(_centroid)
-                    else:
-                        _centroid = None
-
-                    invalid_subtree.at[node_id, "_centroid"] = _centroid
-
-                    if invalid_subtree.loc[node_id, "_centroid"] is None:
-                        print("\nNode {} has no centroid!".format(node_id))
-
-                    # 5. _prototypes
-                    _prototypes = []
-
-                    if len(objects_) > 0:
-                        prots = Prototypes(clusterer)
-                        prots.fit(objects_.vectors)
-                        _prototypes.append(prots)
-                    if len(children_dict) > 0:
-                        _prototypes.extend(
-                            c["_prototypes"] for c in children_dict if c["_prototypes"] is not None)
-
-                    if len(_prototypes) > 0:
-                        try:
-                            _prototypes = merge_prototypes(
-                                _prototypes, N_PROTOTYPES)
-                        except:
-                            for prots in _prototypes:
-                                print(prots.prototypes_)
-                            raise
-                    else:
-                        _prototypes = None
-                        print("\nNode {} has no prototypes!".format(node_id))
+                invalid_node_ids = invalid_subtree.index[
+                    ~invalid_subtree["cache_valid"]].tolist()
 
-                    invalid_subtree.at[node_id, "_prototypes"] = _prototypes
+                project_id = int(invalid_subtree.at[node_id, "project_id"])
+                settings = self.get_prototype_settings(project_id)
 
-                    # Finally, flag as updated
-                    invalid_subtree.at[node_id, "__updated"] = True
+                # Sample up to sample_size objects per invalid node to speed up the calculation
+                object_node_ids, object_ids, vectors = self._query_object_sample(
+                    invalid_node_ids, settings["sample_size"])
 
-                    bar.numerator += 1
-                    print(node_id, bar, end="    \r")
-                print()
+                bar = ProgressBar(len(invalid_node_ids), max_width=40)
 
-                # Convert _n_objects_deep to int (might be object when containing NULL values in the database)
-                invalid_subtree["_n_objects_deep"] = invalid_subtree["_n_objects_deep"].astype(
-                    int)
+                def progress_cb(nadd):
+                    bar.numerator += nadd
+                    print(bar, end="    \r")
 
-                # Flag all rows as valid
-                invalid_subtree["cache_valid"] = True
+                invalid_subtree = consolidate_subtree(
+                    invalid_subtree, object_node_ids, object_ids, vectors,
+                    settings["n_prototypes"],
+                    make_clusterer=functools.partial(
+                        make_clusterer, settings["clusterer"], settings["n_prototypes"]),
+                    n_workers=n_workers, progress_cb=progress_cb,
+                    merge_method=self.merge_method, metric=settings["metric"])
+                print()
 
                 # Mask for updated rows
                 updated_selection = invalid_subtree["__updated"] == True
@@ -1438,15 +2812,35 @@ class Tree(object):
                     # Write results back to database
                     update_fields = ["cache_valid", "_centroid", "_prototypes", "_type_objects",
                                      "_own_type_objects", "_n_objects_deep",
-                                     "_n_objects", "_n_children"]
+                                     "_n_objects", "_n_children", "_cache_epoch"]
+
+                    invalid_subtree.loc[updated_selection,
+                                        "_cache_epoch"] = epoch
+
+                    # The written nodes must not be restructured concurrently (see lock_paths)
+                    updated_ids = invalid_subtree.index[updated_selection]
+                    if n_updated <= NODE_LOCK_LIMIT:
+                        self.lock_paths(updated_ids)
+                    else:
+                        self.lock_paths([node_id], exclusive=[node_id])
+
+                    # The prototypes of the own objects are only written if the node was not modified
+                    # since the snapshot. Otherwise, they were updated concurrently (see relocate_objects).
+                    own_prototypes = case(
+                        [(nodes.c.version <= epoch,
+                          bindparam("_new_own_prototypes", type_=nodes.c._own_prototypes.type))],
+                        else_=nodes.c._own_prototypes)
 
                     stmt = (nodes.update()
                             .where(nodes.c.node_id == bindparam('_node_id'))
-                            .values({k: bindparam(k) for k in update_fields}))
+                            .values({k: bindparam(k) for k in update_fields})
+                            .values(_own_prototypes=own_prototypes))
 
                     # Build the result list of dicts with _node_id and only update_fields
+                    # (in ascending order of node_id, see lock_paths)
                     result = invalid_subtree.loc[updated_selection,
-                                                 update_fields]
+                                                 update_fields + ["_own_prototypes"]].sort_index()
+                    result.rename(columns={"_own_prototypes": "_new_own_prototypes"}, inplace=True)
                     result.index.rename('_node_id', inplace=True)
                     result.reset_index(inplace=True)
 
@@ -13,6 +13,7 @@ setup(
         'h5py>=2.8.0',
         'scikit-learn',
         'scipy',
+        'threadpoolctl',
         'redis >= 3.0, < 3.1',
         'hiredis',
         'flask-restful',
@@ -27,5 +28,5 @@ setup(
         'Flask-RQ2',
     ],
     setup_requires=["pytest-runner"],
-    tests_require=["pytest"],
+    tests_require=["pytest", "requests"],
 )
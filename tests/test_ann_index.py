@@ -0,0 +1,99 @@
+"""
+pytest file for ann_index
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from morphocluster.ann_index import ANNIndex
+
+
+def _make_index(n_objects=2000, n_features=8, n_nodes=10, n_lists=20):
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(n_objects, n_features).astype(np.float32)
+    object_ids = np.array(["o{}".format(i) for i in range(n_objects)])
+    node_ids = rng.randint(0, n_nodes, n_objects)
+
+    index = ANNIndex.build(object_ids, vectors, node_ids, n_lists=n_lists)
+
+    return index, object_ids, vectors, node_ids
+
+
+def _brute_force(vectors, queries, mask, k):
+    distances = np.linalg.norm(
+        vectors[:, np.newaxis] - queries[np.newaxis], axis=-1).min(axis=1)
+    distances[~mask] = np.inf
+    return np.argsort(distances)[:min(k, mask.sum())]
+
+
+@pytest.mark.parametrize("exact", [True, False])
+def test_search(exact):
+    index, object_ids, vectors, node_ids = _make_index()
+    queries = vectors[:3] + 0.01
+
+    allowed = [1, 2]
+    exclude = object_ids[node_ids == 1][:5]
+
+    rows, distances = index.search(queries, 50, node_ids=allowed,
+                                   exclude=exclude, exact=exact,
+                                   n_probe=index.n_lists)
+
+    mask = np.isin(node_ids, allowed) & ~np.isin(object_ids, exclude)
+    expected = object_ids[_brute_force(vectors, queries, mask, 50)]
+
+    assert np.all(np.diff(distances) >= 0)
+    assert set(index.object_ids[rows]) == set(expected)
+
+
+def test_search_recall():
+    index, object_ids, vectors, _ = _make_index()
+    queries = vectors[:4]
+
+    rows, _ = index.search(queries, 20, n_probe=4)
+    expected = _brute_force(vectors, queries, np.ones(len(vectors), bool), 20)
+
+    recall = len(set(index.object_ids[rows]) & set(object_ids[expected])) / 20
+    assert recall >= 0.8
+
+
+def test_search_few_candidates():
+    index, object_ids, vectors, node_ids = _make_index()
+
+    # Less candidates than k: All of them are returned
+    rows, _ = index.search(vectors[:1], 1000, node_ids=[3])
+    assert set(index.object_ids[rows]) == set(object_ids[node_ids == 3])
+
+
+def test_update(tmp_path):
+    index, object_ids, vectors, _ = _make_index()
+    path = str(tmp_path / "index")
+    index.save(path)
+
+    index = ANNIndex.load(path)
+    index.update_node_ids(["o1", "o2", "unknown"], 42)
+
+    rows, _ = index.search(vectors[:1], 10, node_ids=[42])
+    assert sorted(index.object_ids[rows]) == ["o1", "o2"]
+
+    # Updates are written through to the file
+    index = ANNIndex.load(path, "r")
+    rows, _ = index.search(vectors[:1], 10, node_ids=[42])
+    assert sorted(index.object_ids[rows]) == ["o1", "o2"]
+
+    index = ANNIndex.load(path)
+    with index.lock():
+        index.replace_node_id(42, 43)
+    rows, _ = index.search(vectors[:1], 10, node_ids=[43])
+    assert sorted(index.object_ids[rows]) == ["o1", "o2"]
+
+    # One node_id per object
+    with index.lock():
+        index.update_node_ids(["o1", "o2"], [44, 45])
+    assert list(index.node_ids[index.get_rows(["o1", "o2"])]) == [44, 45]
+    assert os.path.exists(path + ".lock")
+
+    # Saving over an existing index
+    index.save(path)
+    assert len(ANNIndex.load(path)) == len(object_ids)
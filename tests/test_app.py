@@ -54,3 +54,799 @@ def test_auth(flask_client):
     }
     response = flask_client.get("/", headers=headers)
     assert response.status_code != 401
+
+
+def test_closure(flask_app):
+    from morphocluster.tree import Tree
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn, use_closure=True)
+        cte_tree = Tree(conn, use_closure=False)
+
+        project_id = tree.create_project("test_closure")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root)
+        b = tree.create_node(parent_id=a)
+        c = tree.create_node(parent_id=root)
+        d = tree.create_node(parent_id=b)
+
+        tree.relocate_nodes([b], c)
+        e = tree.create_node(parent_id=a)
+        tree.merge_node_into(a, c)
+
+        assert tree.get_path_ids(d) == [root, c, b, d]
+        assert tree.get_path_ids(e) == [root, c, e]
+
+        for node_id in (root, b, c, d, e):
+            assert tree.get_path_ids(node_id) == cte_tree.get_path_ids(node_id)
+            assert tree.node_n_descendants(
+                node_id) == cte_tree.node_n_descendants(node_id)
+
+        # Rebuilding yields the same rows
+        n_rows = tree.rebuild_closure(project_id)
+        # Self-links, root, c, b
+        assert n_rows == 5 + 4 + 3 + 1
+        assert tree.get_path_ids(d) == [root, c, b, d]
+
+
+def test_load_project(flask_app):
+    import pandas as pd
+
+    from morphocluster import models, processing
+    from morphocluster.tree import Tree
+
+    saved_nodes = pd.DataFrame({
+        "node_id": [1, 2, 3, 4],
+        "parent_id": [None, 1, 1, 3],
+        "name": [None, "a", "", "b,c"],
+        "approved": [False, True, None, False],
+    })
+    saved_objects = pd.DataFrame({
+        "object_id": ["lp{}".format(i) for i in range(10)],
+        "node_id": [1, 2, 2, 3, 4, 4, 4, 4, 2, 1],
+    })
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in saved_objects["object_id"]])
+
+        tree = Tree(conn)
+        project_id = tree.load_project(
+            "test_load_project", processing.Tree(saved_nodes, saved_objects))
+
+        root_id = tree.get_root_id(project_id)
+        children = tree.get_children(root_id, require_valid=False)
+
+        assert sorted(c["orig_id"] for c in children) == [2, 3]
+        assert [c["approved"] for c in sorted(children, key=lambda c: c["orig_id"])] == [True, False]
+        # Empty names are kept (missing names are NULL)
+        assert [c["name"] for c in sorted(children, key=lambda c: c["orig_id"])] == ["a", ""]
+        assert tree.get_node(root_id, require_valid=False)["name"] is None
+
+        node_4 = [n for n in tree.get_children(
+            [c for c in children if c["orig_id"] == 3][0]["node_id"], require_valid=False)][0]
+        assert node_4["name"] == "b,c"
+        assert tree.get_path_ids(node_4["node_id"])[0] == root_id
+        assert tree.get_n_objects(node_4["node_id"]) == 4
+
+        assert tree.consolidate_node(
+            root_id, return_="node")["_n_objects_deep"] == 10
+
+
+def test_ingest(flask_app, tmp_path):
+    import h5py
+    import numpy as np
+
+    from morphocluster import ingest, models
+    from sqlalchemy.sql import select
+
+    collection_fn = str(tmp_path / "collection.csv")
+    with open(collection_fn, "w") as f:
+        for i in range(25):
+            f.write("ing{0},ing{0}.jpg,label\n".format(i))
+
+    features_fn = str(tmp_path / "features.h5")
+    vectors = np.random.rand(25, 8).astype(np.float32)
+    with h5py.File(features_fn, "w") as f:
+        f.create_dataset("objids", data=[
+            "ing{}".format(i).encode() for i in range(25)])
+        f.create_dataset("features", data=vectors)
+
+    with database.engine.connect() as conn:
+        ingest.load_object_locations(conn, collection_fn, chunk_size=10)
+        ingest.load_features(conn, features_fn, chunk_size=10)
+
+        # Resuming a completed ingestion does nothing
+        ingest.load_object_locations(conn, collection_fn, chunk_size=10)
+
+        rows = conn.execute(select([models.objects.c.object_id, models.objects.c.vector])
+                            .where(models.objects.c.object_id.like("ing%"))).fetchall()
+
+        assert len(rows) == 25
+        for object_id, vector in rows:
+            np.testing.assert_array_equal(
+                vector, vectors[int(object_id[3:])])
+
+
+@pytest.mark.parametrize("use_closure", [True, False])
+def test_relocate_objects(flask_app, use_closure):
+    from morphocluster import models
+    from morphocluster.tree import Tree
+    from sqlalchemy.sql import select
+
+    prefix = "rel{:d}_".format(use_closure)
+    object_ids = [prefix + str(i) for i in range(6)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        tree = Tree(conn, use_closure=use_closure)
+        project_id = tree.create_project("test_relocate_objects")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:2])
+        b = tree.create_node(parent_id=a, object_ids=object_ids[2:4])
+        c = tree.create_node(parent_id=root, object_ids=object_ids[4:])
+        d = tree.create_node(parent_id=c)
+
+        tree.consolidate_node(root, depth="full")
+
+        tree.relocate_objects(object_ids[1:3], d)
+
+        def cache_valid():
+            return dict(conn.execute(select([models.nodes.c.node_id, models.nodes.c.cache_valid]).where(
+                models.nodes.c.project_id == project_id)).fetchall())
+
+        # Only the old and the new nodes are written, ancestors become stale lazily
+        assert all(cache_valid().values())
+
+        assert set(tree._find_stale(c)) == {c, d}
+        assert set(tree._find_stale(root)) == {root, a, b, c, d}
+
+        # Detection does not write
+        assert all(cache_valid().values())
+
+        assert tree.get_n_objects(a) == 1
+        assert tree.get_n_objects(d) == 2
+
+        # After consolidation, nothing is stale
+        tree.consolidate_node(root)
+        assert all(cache_valid().values())
+        assert tree._find_stale(root) == []
+
+        def approved():
+            return dict(conn.execute(select([models.nodes.c.node_id, models.nodes.c.approved]).where(
+                models.nodes.c.project_id == project_id)).fetchall())
+
+        for n in (root, a, b, c, d):
+            tree.update_node(n, {"approved": True})
+
+        # Unapproved are the paths up to (including) the first common ancestor
+        tree.relocate_objects(object_ids[3:4], d, unapprove=True)
+        assert approved() == {root: False, a: False, b: False, c: False, d: False}
+
+        for n in (root, a, b, c, d):
+            tree.update_node(n, {"approved": True})
+
+        tree.relocate_objects(object_ids[3:4], c, unapprove=True)
+        assert approved() == {root: True, a: True, b: True, c: False, d: False}
+
+
+@pytest.mark.parametrize("locking", ["subtree", "project"])
+def test_locking(flask_app, locking):
+    from morphocluster.tree import Tree
+    from sqlalchemy.exc import OperationalError
+
+    with database.engine.connect() as conn1, database.engine.connect() as conn2:
+        tree1 = Tree(conn1, locking=locking)
+        tree2 = Tree(conn2, locking=locking)
+
+        project_id = tree1.create_project("test_locking")
+        root = tree1.create_node(project_id)
+        a = tree1.create_node(parent_id=root)
+        b = tree1.create_node(parent_id=root)
+        a1 = tree1.create_node(parent_id=a)
+
+        tree1.consolidate_node(root, depth="full")
+
+        # Autocommit, so that the setting survives the rollback of a failed statement
+        conn2.execution_options(autocommit=True).execute("SET lock_timeout = '1s'")
+
+        txn = conn1.begin()
+        try:
+            tree1.update_node(a, {"name": "a"})
+
+            if locking == "subtree":
+                # Readers and modifications of a disjoint subtree proceed
+                assert tree2.get_node(root)["node_id"] == root
+                tree2.update_node(b, {"name": "b"})
+            else:
+                with pytest.raises(OperationalError):
+                    tree2.get_node(root)
+                with pytest.raises(OperationalError):
+                    tree2.update_node(b, {"name": "b"})
+
+            # Modifications below a locked node wait
+            with pytest.raises(OperationalError):
+                tree2.update_node(a1, {"name": "a1"})
+        finally:
+            txn.commit()
+
+        tree2.update_node(a1, {"name": "a1"})
+        assert len(tree2.check_progress(root)) == 0
+
+
+def test_background_consolidation(flask_app):
+    from morphocluster import models
+    from morphocluster.dirty_queue import DirtyQueue, process_dirty_queue
+    from morphocluster.extensions import rq
+    from morphocluster.tree import Tree
+
+    object_ids = ["dirty_{}".format(i) for i in range(4)]
+
+    queue = DirtyQueue(rq.connection, key="test:dirty")
+    queue.redis.delete(queue.key, queue.since_key, queue.stats_key)
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        tree = Tree(conn, queue=queue)
+        project_id = tree.create_project("test_background_consolidation")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:2])
+        b = tree.create_node(parent_id=root, object_ids=object_ids[2:])
+
+        # Nodes without cached values are consolidated immediately
+        assert not tree.get_node(root)["stale"]
+        queue.redis.delete(queue.key, queue.since_key)
+
+        tree.relocate_objects(object_ids[:1], b)
+
+        # The modified paths are queued (deepest first)
+        assert queue.metrics()["n_dirty"] == 3
+        assert queue.metrics()["max_depth"] == 1
+
+        # Readers get the last cached values
+        node = tree.get_node(root)
+        assert node["stale"]
+        assert node["_n_objects_deep"] == 4
+        assert {c["node_id"]: c["stale"]
+                for c in tree.get_children(root)} == {a: True, b: True}
+
+        assert process_dirty_queue(queue, tree) == 3
+        assert not tree.get_node(root)["stale"]
+        assert tree.get_node(b)["_n_objects"] == 3
+
+        metrics = queue.metrics()
+        assert metrics["n_dirty"] == 0
+        assert metrics["n_processed"] == 3
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_cache_version(flask_app, background):
+    from morphocluster import models
+    from morphocluster.dirty_queue import DirtyQueue
+    from morphocluster.extensions import rq
+    from morphocluster.tree import Tree
+
+    object_ids = ["version_{}_{}".format(background, i) for i in range(4)]
+
+    queue = None
+    if background:
+        queue = DirtyQueue(rq.connection, key="test:dirty_version")
+        queue.redis.delete(queue.key, queue.since_key, queue.stats_key)
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        tree = Tree(conn, queue=queue)
+        project_id = tree.create_project("test_cache_version_{}".format(background))
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root)
+        a1 = tree.create_node(parent_id=a, object_ids=object_ids[:2])
+        a2 = tree.create_node(parent_id=a, object_ids=object_ids[2:])
+        tree.consolidate_node(root, depth="full")
+
+        version = tree.get_cache_version(root)
+        assert tree.get_cache_version(root) == version
+
+        # A modification two levels below the node
+        tree.relocate_objects(object_ids[:1], a2)
+        assert tree.get_cache_version(root) != version
+
+        # The version does not change by reading the results
+        version = tree.get_cache_version(root)
+        tree.get_node(root)
+        tree.get_children(root)
+        assert tree.get_cache_version(root) == version
+
+
+def test_progress_counters(flask_app):
+    from morphocluster import models
+    from morphocluster.tree import Tree
+    from sqlalchemy.sql import func, select
+
+    object_ids = ["prog_{}".format(i) for i in range(8)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        tree = Tree(conn)
+        project_id = tree.create_project("test_progress_counters")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:3])
+        b = tree.create_node(parent_id=a, object_ids=object_ids[3:5])
+        c = tree.create_node(parent_id=root, object_ids=object_ids[5:])
+
+        tree.update_node(b, {"approved": True, "name": "b"})
+        tree.relocate_objects(object_ids[:1], c)
+        tree.relocate_nodes([b], c)
+        tree.update_node(a, {"filled": True})
+
+        # Counters were maintained incrementally
+        assert len(tree.check_progress(root)) == 0
+
+        def n_deltas():
+            stmt = (select([func.count()])
+                    .select_from(models.nodes_progress_deltas.join(models.nodes))
+                    .where(models.nodes.c.project_id == project_id))
+            return conn.execute(stmt).scalar()
+
+        # The ancestors received deltas
+        assert n_deltas() > 0
+        assert tree.fold_progress_deltas(project_id) > 0
+        assert n_deltas() == 0
+        assert len(tree.check_progress(root)) == 0
+
+        progress = tree.calculate_progress(root)
+        assert progress["n_objects_deep"] == 8
+        assert progress["n_approved_objects"] == 2
+        assert progress["n_named_objects"] == 2
+        assert progress["n_filled_nodes"] == 1
+        assert progress["n_nodes"] == 4
+
+        assert tree.rebuild_progress(root).loc[root, "n_nodes"] == 4
+
+
+def test_own_prototypes(flask_app):
+    import numpy as np
+    from morphocluster import models
+    from morphocluster.tree import Tree
+    from sqlalchemy.sql import select
+
+    rng = np.random.RandomState(0)
+    object_ids = ["ownprot_{}".format(i) for i in range(40)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o, "vector": rng.randn(8)} for o in object_ids])
+
+        tree = Tree(conn)
+        project_id = tree.create_project("test_own_prototypes")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:30])
+        b = tree.create_node(parent_id=root, object_ids=object_ids[30:])
+
+        tree.consolidate_node(root, depth="full")
+
+        def own_prototypes(node_id):
+            return conn.execute(select([models.nodes.c._own_prototypes]).where(
+                models.nodes.c.node_id == node_id)).scalar()
+
+        support_a, support_b = own_prototypes(a).support_.sum(), own_prototypes(b).support_.sum()
+
+        # Moved objects are absorbed without a refit
+        tree.relocate_objects(object_ids[:2], b)
+
+        prots_a, prots_b = own_prototypes(a), own_prototypes(b)
+        assert prots_a.support_.sum() == pytest.approx(support_a - 2)
+        assert prots_b.support_.sum() == pytest.approx(support_b + 2)
+        assert prots_b.n_added_ == 2
+
+        # ... and reused by the consolidation (if they do not need a refit)
+        assert not prots_a.needs_refit()
+        tree.consolidate_node(root)
+        np.testing.assert_allclose(own_prototypes(a).prototypes_, prots_a.prototypes_, rtol=1e-6)
+
+        # Merging resets the prototypes of the destination
+        tree.merge_node_into(b, a)
+        assert own_prototypes(a) is None
+
+
+def test_prototype_settings(flask_app):
+    import numpy as np
+    from morphocluster import models
+    from morphocluster.tree import Tree, TreeError
+
+    rng = np.random.RandomState(0)
+    object_ids = ["protset_{}".format(i) for i in range(50)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o, "vector": rng.randn(8)} for o in object_ids])
+
+        tree = Tree(conn)
+        project_id = tree.create_project(
+            "test_prototype_settings", n_prototypes=4, clusterer="lloyd")
+        root = tree.create_node(project_id, object_ids=object_ids)
+
+        assert tree.get_prototype_settings(project_id) == {
+            "n_prototypes": 4, "clusterer": "lloyd", "sample_size": 1000, "metric": "euclidean"}
+
+        node = tree.consolidate_node(root, return_="node")
+        assert node["_prototypes"].prototypes_.shape[0] == 4
+
+        # Changes invalidate the project
+        tree.set_prototype_settings(project_id, n_prototypes=2, metric="cosine")
+        assert not tree.get_node(root, require_valid=False)["cache_valid"]
+
+        node = tree.consolidate_node(root, return_="node")
+        assert node["_prototypes"].prototypes_.shape[0] == 2
+        assert len(tree.recommend_objects(root, max_n=10, exact=True)) <= 10
+
+        with pytest.raises(TreeError):
+            tree.set_prototype_settings(project_id, clusterer="dbscan")
+
+
+def test_node_cache(flask_app):
+    from sqlalchemy import event
+
+    from morphocluster import models
+    from morphocluster.extensions import redis_lru
+    from morphocluster.node_cache import NodeCache
+    from morphocluster.tree import Tree
+
+    object_ids = ["node_cache_{}".format(i) for i in range(4)]
+
+    cache = NodeCache(redis_lru, prefix="test:nodes", grace=0)
+    cache.redis.delete(cache.stats_key)
+    cache.clear()
+
+    queries = []
+
+    def count_query(*_):
+        queries.append(1)
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        tree = Tree(conn, cache=cache)
+        project_id = tree.create_project("test_node_cache")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:2])
+        b = tree.create_node(parent_id=root, object_ids=object_ids[2:])
+
+        # Fill the cache
+        tree.get_node(root)
+        tree.get_children(root)
+        tree.get_path_ids(a)
+
+        # Cached reads do not query the database
+        event.listen(conn, "before_cursor_execute", count_query)
+        try:
+            assert tree.get_node(root)["_n_objects_deep"] == 4
+            assert {c["node_id"] for c in tree.get_children(root)} == {a, b}
+            assert tree.get_path_ids(a) == [root, a]
+            assert not queries
+        finally:
+            event.remove(conn, "before_cursor_execute", count_query)
+
+        metrics = cache.metrics()
+        # The root and the records of the children
+        assert metrics["node_hits"] == 3
+        assert metrics["children_hits"] == 1
+        assert metrics["path_hits"] == 1
+        assert metrics["misses"] > 0
+
+        # Modifications evict the modified paths
+        tree.relocate_objects(object_ids[:1], b)
+        assert tree.get_node(root)["_n_objects_deep"] == 4
+        assert tree.get_node(b)["_n_objects"] == 3
+
+        tree.update_node(a, {"name": "a"})
+        assert {c["node_id"]: c["name"] for c in tree.get_children(root)}[a] == "a"
+
+        tree.relocate_nodes([a], b)
+        assert tree.get_path_ids(a) == [root, b, a]
+        assert [c["node_id"] for c in tree.get_children(root)] == [b]
+
+        # Evicted nodes are not cached again during the grace period
+        strict = NodeCache(redis_lru, prefix="test:nodes", grace=60)
+        _, token = strict.get_nodes([b])
+        strict.evict([b])
+        strict.set_nodes([tree.get_node(b, require_valid=False)], token)
+        assert b not in strict.get_nodes([b])[0]
+        strict.redis.delete(strict._key("evicted", b))
+
+        # Entries that readers of the old snapshot cache during a modification
+        # are evicted again after the commit
+        record = tree.get_node(b)
+        with tree.transaction():
+            tree.update_node(b, {"name": "b"})
+
+            _, token = cache.get_nodes([b])
+            cache.set_nodes([record], token)
+            assert b in cache.get_nodes([b])[0]
+
+        assert b not in cache.get_nodes([b])[0]
+        assert tree.get_node(b)["name"] == "b"
+
+        # Rebuilding the progress only evicts the rebuilt subtree
+        tree.get_node(root)
+        tree.get_node(a)
+        tree.rebuild_progress(b)
+        cached, _ = cache.get_nodes([root, a, b])
+        assert root in cached
+        assert a not in cached and b not in cached
+
+
+def test_ann_index_updates(flask_app):
+    import numpy as np
+    from morphocluster import models
+    from morphocluster.ann_index import ANNIndex
+    from morphocluster.tree import Tree
+
+    object_ids = ["ann_{}".format(i) for i in range(6)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o} for o in object_ids])
+
+        indexes = {}
+        tree = Tree(conn, ann_indexes=indexes)
+        project_id = tree.create_project("test_ann_index_updates")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root, object_ids=object_ids[:3])
+        b = tree.create_node(parent_id=root, object_ids=object_ids[3:])
+
+        vectors = np.random.RandomState(0).randn(len(object_ids), 4)
+        index = indexes[project_id] = ANNIndex.build(
+            np.array(object_ids), vectors, np.array([a] * 3 + [b] * 3), n_lists=2)
+
+        def node_ids(object_ids):
+            return list(index.node_ids[index.get_rows(object_ids)])
+
+        # The index is updated after the commit
+        with tree.transaction():
+            tree.relocate_objects(object_ids[:1], b)
+            assert node_ids(object_ids[:1]) == [a]
+        assert node_ids(object_ids[:1]) == [b]
+
+        # Rolled back relocations are not applied
+        with pytest.raises(ValueError):
+            with tree.transaction():
+                tree.relocate_objects(object_ids[1:2], b)
+                raise ValueError()
+        assert node_ids(object_ids[1:2]) == [a]
+
+        tree.merge_node_into(a, b)
+        assert node_ids(object_ids) == [b] * 6
+
+
+@pytest.mark.parametrize("use_closure", [False, True])
+def test_get_paths(flask_app, use_closure):
+    from morphocluster.tree import Tree
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn, use_closure=use_closure)
+        project_id = tree.create_project("test_get_paths")
+        root = tree.create_node(project_id)
+        a = tree.create_node(parent_id=root)
+        b = tree.create_node(parent_id=a)
+        c = tree.create_node(parent_id=root)
+
+        assert tree.get_paths([b, c, root, -1]) == {
+            b: [root, a, b], c: [root, c], root: [root]}
+        assert tree.get_path_ids(b) == [root, a, b]
+        assert tree.get_path_ids(-1) == []
+
+        # Nodes without a parent can be relocated
+        d = tree.create_node(project_id)
+        tree.relocate_nodes([d], c, unapprove=True)
+        assert tree.get_path_ids(d) == [root, c, d]
+
+
+def test_members_query_count(flask_app, flask_client):
+    from sqlalchemy import event
+
+    from morphocluster.tree import Tree
+
+    headers = {
+        'Authorization': _basic_auth_str("test", "test")
+    }
+
+    def count_member_queries(n_children):
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+            project_id = tree.create_project(
+                "test_members_query_count_{}".format(n_children))
+            root = tree.create_node(project_id)
+            node = tree.create_node(parent_id=root)
+            for _ in range(n_children):
+                tree.create_node(parent_id=node)
+
+        url = "/api/nodes/{}/members?nodes=1&page=0".format(node)
+
+        # Consolidate first (with different arguments, so that the result is not cached)
+        assert flask_client.get(url + "&descending=1", headers=headers).status_code == 200
+
+        queries = []
+
+        def count_query(*_):
+            queries.append(1)
+
+        event.listen(database.engine, "before_cursor_execute", count_query)
+        try:
+            response = flask_client.get(url, headers=headers)
+        finally:
+            event.remove(database.engine, "before_cursor_execute", count_query)
+
+        assert response.status_code == 200
+        assert len(response.get_json()["data"]) == n_children
+
+        return len(queries)
+
+    # The number of queries does not depend on the number of rendered nodes
+    assert count_member_queries(5) == count_member_queries(50)
+
+
+def test_result_cache(flask_app, flask_client):
+    import threading
+    import time
+
+    from morphocluster.extensions import redis_lru
+    from morphocluster.result_cache import ResultCache
+    from morphocluster.tree import Tree
+
+    headers = {
+        'Authorization': _basic_auth_str("test", "test")
+    }
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn)
+        project_id = tree.create_project("test_result_cache")
+        root = tree.create_node(project_id)
+        node = tree.create_node(parent_id=root)
+        for _ in range(3):
+            tree.create_node(parent_id=node)
+
+    url = "/api/nodes/{}/members?nodes=1&page=0".format(node)
+
+    # Identical requests share the result until the node changes
+    first = flask_client.get(url, headers=headers).get_json()
+    second = flask_client.get(url, headers=headers).get_json()
+    assert first["meta"]["request_id"] == second["meta"]["request_id"]
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn)
+        tree.create_node(parent_id=node)
+
+    third = flask_client.get(url, headers=headers).get_json()
+    assert third["meta"]["request_id"] != first["meta"]["request_id"]
+    assert len(third["data"]) == 4
+
+    # Concurrent identical computations are coalesced
+    cache = ResultCache(redis_lru, prefix="test:results", max_bytes=100)
+    for key in cache.redis.scan_iter("test:results:*"):
+        cache.redis.delete(key)
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.5)
+        return [b"page0", b"page1"]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache.get_or_compute("f", "coalesced", 1, compute))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [(b"page1", 2)] * 4
+
+    metrics = cache.metrics()
+    assert metrics["coalesced"] == 3
+    assert metrics["n_bytes"] == 10
+
+    # A result that expired in Redis replaces its size when it is computed again
+    cache.redis.pexpire(cache._key("f", "coalesced"), 1)
+    time.sleep(0.01)
+    assert cache.get_or_compute("f", "coalesced", 0, compute) == (b"page0", 2)
+    assert cache.metrics()["n_bytes"] == 10
+
+    # The size is capped (the oldest entries are evicted)
+    for i in range(20):
+        cache.get_or_compute("f", "capped_{}".format(i), 0, lambda: [b"x" * 10])
+    metrics = cache.metrics()
+    assert metrics["n_bytes"] <= 100
+    assert metrics["evicted"] > 0
+    assert cache.get_page("f", "coalesced", 0) is None
+
+
+def test_lazy_recommended_objects(flask_app, flask_client):
+    import numpy as np
+    from morphocluster import models
+    from morphocluster.extensions import result_cache
+    from morphocluster.tree import Tree
+
+    headers = {
+        'Authorization': _basic_auth_str("test", "test")
+    }
+
+    rng = np.random.RandomState(0)
+    object_ids = ["lazy_{}".format(i) for i in range(120)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o, "vector": rng.randn(8)} for o in object_ids])
+
+        tree = Tree(conn)
+        project_id = tree.create_project("test_lazy_recommended_objects")
+        root = tree.create_node(project_id, object_ids=object_ids[10:])
+        node = tree.create_node(parent_id=root, object_ids=object_ids[:10])
+        tree.consolidate_node(root)
+
+        # The ranking matches the recommendations
+        ranked, scores = tree.rank_recommended_objects(node, max_n=100, exact=True)
+        assert list(ranked) == [o["object_id"] for o in tree.recommend_objects(
+            node, max_n=100, exact=True)]
+        assert np.all(np.diff(scores) >= 0)
+
+    url = "/api/nodes/{}/recommended_objects".format(node)
+
+    with flask_app.app_context():
+        renders = result_cache.cache.metrics()["renders"]
+
+    first = flask_client.get(url + "?page=0", headers=headers).get_json()
+    assert first["meta"]["last_page"] == 2
+    assert len(first["data"]) == 50
+
+    # The first page is rendered with the ordering, the others when they are requested
+    request_id = first["meta"]["request_id"]
+    page_url = url + "?page={}&request_id=" + request_id
+    second = flask_client.get(page_url.format(1), headers=headers).get_json()
+    assert len(second["data"]) == 50
+    assert {o["object_id"] for o in first["data"] + second["data"]} <= set(object_ids[10:])
+
+    with flask_app.app_context():
+        assert result_cache.cache.metrics()["renders"] == renders + 1
+
+    # Rendered pages are stored
+    assert flask_client.get(page_url.format(1), headers=headers).get_json() == second
+    third = flask_client.get(page_url.format(2), headers=headers).get_json()
+    assert len(third["data"]) == 10
+
+    with flask_app.app_context():
+        assert result_cache.cache.metrics()["renders"] == renders + 2
+
+
+def test_objects_without_vector(flask_app):
+    import numpy as np
+    from morphocluster import models
+    from morphocluster.tree import Tree
+
+    rng = np.random.RandomState(0)
+    object_ids = ["novector_{}".format(i) for i in range(5)]
+
+    with database.engine.connect() as conn:
+        conn.execute(models.objects.insert(), [
+            {"object_id": o, "path": o, "vector": rng.randn(8) if i else None}
+            for i, o in enumerate(object_ids)])
+
+        tree = Tree(conn)
+        project_id = tree.create_project("test_objects_without_vector")
+        root = tree.create_node(project_id, object_ids=object_ids)
+
+        # Objects without a vector are skipped, but reported
+        with pytest.warns(UserWarning, match="novector_0"):
+            node = tree.consolidate_node(root, return_="node")
+
+        assert node["_n_objects_deep"] == 5
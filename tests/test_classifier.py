@@ -0,0 +1,44 @@
+"""
+pytest file for classifier
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist, pdist, squareform
+
+from morphocluster.classifier import Classifier, farthest_from, max_distances
+
+
+def _unit_vectors(n, n_features=8, seed=0):
+    X = np.random.RandomState(seed).randn(n, n_features)
+    return X / np.linalg.norm(X, axis=1)[:, np.newaxis]
+
+
+def test_farthest_from():
+    types = _unit_vectors(20)
+    X = _unit_vectors(100, seed=1)
+
+    reference = np.max(cdist(types, X), axis=0)
+
+    # Independent of the chunk size
+    np.testing.assert_allclose(max_distances(types, X, chunk_size=7), reference)
+
+    np.testing.assert_array_equal(farthest_from(types, X, 9, chunk_size=7),
+                                  np.argsort(reference)[::-1][:9])
+    np.testing.assert_array_equal(farthest_from(types, X),
+                                  np.argsort(reference)[::-1])
+    assert len(farthest_from(types, X, 0)) == 0
+
+
+def test_classifier_radius():
+    types = _unit_vectors(20)
+
+    distances = squareform(pdist(types))
+    np.fill_diagonal(distances, np.inf)
+
+    np.testing.assert_allclose(Classifier(types).radius, np.min(distances, axis=0))
+    assert np.isinf(Classifier(types[:1]).radius).all()
+
+    X = _unit_vectors(100, seed=1)
+    labels = Classifier(types).classify(X, safe=True)
+    unsafe = Classifier(types).classify(X, safe=False)
+    assert ((labels == -1) | (labels == unsafe)).all()
@@ -0,0 +1,81 @@
+"""
+pytest file for column_types
+"""
+
+import numpy as np
+import pytest
+
+from morphocluster.column_types import (decode_incremental_prototypes,
+                                        decode_prototypes, decode_vector,
+                                        decode_vectors,
+                                        encode_incremental_prototypes,
+                                        encode_prototypes, encode_vector)
+from morphocluster.processing.prototypes import (IncrementalPrototypes,
+                                                 Prototypes)
+
+N_FEATURES = 16
+
+
+def test_vector_roundtrip():
+    vector = np.random.rand(N_FEATURES)
+
+    buffer = encode_vector(vector)
+    assert len(buffer) == 4 * N_FEATURES
+
+    np.testing.assert_allclose(decode_vector(buffer), vector, rtol=1e-6)
+
+
+@pytest.mark.parametrize("n_vectors", [0, 1, 100])
+def test_decode_vectors(n_vectors):
+    vectors = np.random.rand(n_vectors, N_FEATURES).astype(np.float32)
+
+    result = decode_vectors((encode_vector(v) for v in vectors), N_FEATURES)
+
+    assert result.shape == (n_vectors, N_FEATURES)
+    np.testing.assert_array_equal(result, vectors)
+
+
+def test_decode_vectors_size_mismatch():
+    buffers = [encode_vector(np.zeros(N_FEATURES)), encode_vector(np.zeros(3))]
+
+    with pytest.raises(ValueError):
+        decode_vectors(buffers)
+
+
+def test_prototypes_roundtrip():
+    prots = Prototypes(None)
+    prots.prototypes_ = np.random.rand(5, N_FEATURES)
+    prots.support_ = np.arange(1, 6)
+
+    result = decode_prototypes(encode_prototypes(prots))
+
+    np.testing.assert_allclose(
+        result.prototypes_, prots.prototypes_, rtol=1e-6)
+    np.testing.assert_array_equal(result.support_, prots.support_)
+
+    # The decoded object is usable
+    assert result.transform(prots.prototypes_).shape == (5,)
+
+
+def test_incremental_prototypes_roundtrip():
+    rng = np.random.RandomState(0)
+    fitted = Prototypes(None)
+    fitted.prototypes_ = rng.rand(5, N_FEATURES)
+    fitted.support_ = np.arange(1, 6)
+
+    prots = IncrementalPrototypes.from_prototypes(
+        fitted, rng.rand(20, N_FEATURES), weight=0.5)
+    prots.partial_fit(rng.rand(3, N_FEATURES))
+
+    result = decode_incremental_prototypes(
+        encode_incremental_prototypes(prots))
+
+    assert isinstance(result, IncrementalPrototypes)
+    np.testing.assert_allclose(result.prototypes_, prots.prototypes_, rtol=1e-6)
+    np.testing.assert_allclose(result.sums_, prots.sums_, rtol=1e-6)
+    for field in ("weight_", "n_fit_", "n_changed_", "n_added_", "error_", "inertia_"):
+        assert getattr(result, field) == getattr(prots, field)
+
+    # The decoded object can be updated
+    result.remove(rng.rand(2, N_FEATURES))
+    assert result.drift == pytest.approx(prots.drift + 1 / prots.n_fit_)
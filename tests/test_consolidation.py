@@ -0,0 +1,237 @@
+"""
+pytest file for processing.consolidation
+"""
+
+import functools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from morphocluster.processing.consolidation import (CLUSTERERS, ChildIndex,
+                                                    consolidate_subtree,
+                                                    make_clusterer, node_seed)
+from morphocluster.processing.prototypes import Prototypes
+
+N_FEATURES = 8
+
+
+def _make_subtree(n_nodes, n_objects_per_node, seed=0):
+    """
+    Build a random subtree (like Tree.consolidate_node would query it) and a sample of objects.
+    """
+    rng = np.random.RandomState(seed)
+
+    parent_pos = np.array([-1] + [rng.randint(0, i)
+                                  for i in range(1, n_nodes)])
+    node_ids = np.arange(100, 100 + n_nodes)
+    parent_ids = np.where(parent_pos >= 0, node_ids[parent_pos], np.nan)
+
+    levels = np.zeros(n_nodes, dtype=int)
+    for i in range(1, n_nodes):
+        levels[i] = levels[parent_pos[i]] + 1
+
+    n_objects = rng.randint(0, n_objects_per_node + 1, n_nodes)
+    n_children = np.bincount(parent_pos[1:], minlength=n_nodes)
+
+    subtree = pd.DataFrame({
+        "node_id": node_ids,
+        "parent_id": parent_ids,
+        "level": levels,
+        "cache_valid": False,
+        "_n_objects_": n_objects,
+        "_n_children_": n_children,
+        "_n_objects_deep": None,
+        "_centroid": None,
+        "_prototypes": None,
+        "_type_objects": None,
+        "_own_type_objects": None,
+    }).set_index("node_id").sort_values("level", ascending=False)
+
+    object_node_ids = np.repeat(node_ids, n_objects)
+    object_ids = np.array(["o{}".format(i)
+                           for i in range(len(object_node_ids))], dtype=object)
+    vectors = rng.randn(len(object_node_ids), N_FEATURES)
+
+    return subtree, object_node_ids, object_ids, vectors
+
+
+def _reference_deep(subtree, object_node_ids, vectors):
+    """
+    Straightforward recursive calculation of _n_objects_deep and _centroid.
+    """
+    deep = {}
+    centroids = {}
+
+    for node_id in subtree.index:
+        children = subtree.index[subtree["parent_id"] == node_id]
+        n_objects = subtree.at[node_id, "_n_objects_"]
+        deep[node_id] = n_objects + sum(deep[c] for c in children)
+
+        parts = []
+        node_vectors = vectors[object_node_ids == node_id]
+        if len(node_vectors):
+            obj_mean = node_vectors.sum(axis=0)
+            parts.append(n_objects * obj_mean / np.linalg.norm(obj_mean))
+        parts.extend(deep[c] * centroids[c]
+                     for c in children if centroids[c] is not None)
+
+        if parts:
+            centroid = np.sum(parts, axis=0)
+            centroids[node_id] = centroid / np.linalg.norm(centroid)
+        else:
+            centroids[node_id] = None
+
+    return deep, centroids
+
+
+def test_child_index():
+    index = ChildIndex([10, 11, 12, 13], [np.nan, 10, 10, 12])
+
+    assert index.parent_pos.tolist() == [-1, 0, 0, 2]
+    assert sorted(index.children(0)) == [1, 2]
+    assert index.children(1).tolist() == []
+    assert index.children(2).tolist() == [3]
+    assert index.n_children().tolist() == [2, 0, 1, 0]
+
+
+@pytest.mark.parametrize("n_nodes", [1, 10, 50])
+def test_consolidate_subtree(n_nodes):
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(n_nodes, 20)
+
+    result = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4)
+
+    assert result["__updated"].all()
+    assert result["cache_valid"].all()
+
+    deep, centroids = _reference_deep(subtree, object_node_ids, vectors)
+
+    for node_id in result.index:
+        assert result.at[node_id, "_n_objects_deep"] == deep[node_id]
+
+        if centroids[node_id] is None:
+            assert result.at[node_id, "_centroid"] is None
+        else:
+            np.testing.assert_allclose(
+                result.at[node_id, "_centroid"], centroids[node_id])
+
+        if deep[node_id] > 0:
+            assert result.at[node_id, "_prototypes"] is not None
+            assert len(result.at[node_id, "_type_objects"]) > 0
+
+        # Own type objects are objects of the node itself
+        own_objects = set(object_ids[object_node_ids == node_id])
+        assert set(result.at[node_id, "_own_type_objects"]) <= own_objects
+
+
+def test_consolidate_subtree_keeps_valid():
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(20, 5)
+
+    valid = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4)
+
+    # Invalidate only the root
+    root_id = valid.index[valid["parent_id"].isna()][0]
+    valid["cache_valid"] = valid.index != root_id
+    del valid["__updated"]
+
+    # Only pass the objects of the invalid root
+    mask = object_node_ids == root_id
+    result = consolidate_subtree(
+        valid, object_node_ids[mask], object_ids[mask], vectors[mask], 4)
+
+    assert result["__updated"].sum() == 1
+    assert result.at[root_id, "_n_objects_deep"] == len(object_ids)
+
+    for node_id in result.index:
+        if node_id != root_id:
+            assert result.at[node_id, "_centroid"] is valid.at[node_id, "_centroid"]
+
+
+def test_consolidate_subtree_parallel():
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(30, 50)
+
+    serial = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4, n_workers=1)
+    parallel = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4, n_workers=2)
+
+    # Per-node seeds make the result independent of the number of workers
+    for node_id in serial.index:
+        if serial.at[node_id, "_prototypes"] is None:
+            assert parallel.at[node_id, "_prototypes"] is None
+        else:
+            np.testing.assert_allclose(serial.at[node_id, "_prototypes"].prototypes_,
+                                       parallel.at[node_id, "_prototypes"].prototypes_)
+        assert serial.at[node_id, "_type_objects"] == parallel.at[node_id, "_type_objects"]
+
+
+def test_consolidate_subtree_own_prototypes():
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(10, 30, seed=1)
+
+    valid = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4)
+    del valid["__updated"]
+
+    has_objects = valid["_n_objects_"] > 0
+    assert valid.loc[has_objects, "_own_prototypes"].notna().all()
+    assert valid.loc[~has_objects, "_own_prototypes"].isna().all()
+
+    # Invalidate two nodes with objects after some (absorbed) changes
+    keep_id, refit_id = valid.index[has_objects][:2]
+    keep, refit = valid.at[keep_id, "_own_prototypes"], valid.at[refit_id, "_own_prototypes"]
+    keep.remove(vectors[object_node_ids == keep_id][:1])
+    refit.remove(vectors[object_node_ids == refit_id][:10])
+    assert not keep.needs_refit() and refit.needs_refit()
+
+    valid["cache_valid"] = ~valid.index.isin([keep_id, refit_id])
+    result = consolidate_subtree(
+        valid, object_node_ids, object_ids, vectors, 4)
+
+    # Prototypes within the drift threshold are reused, the others are refitted
+    assert result.at[keep_id, "_own_prototypes"] is keep
+    assert result.at[refit_id, "_own_prototypes"] is not refit
+    assert result.at[refit_id, "_own_prototypes"].drift == 0
+
+
+@pytest.mark.parametrize("clusterer", CLUSTERERS)
+@pytest.mark.parametrize("metric", ["euclidean", "cosine"])
+def test_consolidate_subtree_settings(clusterer, metric):
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(20, 30)
+
+    result = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 3,
+        make_clusterer=functools.partial(make_clusterer, clusterer, 3),
+        metric=metric)
+
+    for prots in result["_prototypes"]:
+        if prots is not None:
+            assert prots.prototypes_.shape[0] <= 3
+
+
+def test_consolidate_subtree_batched():
+    subtree, object_node_ids, object_ids, vectors = _make_subtree(30, 50)
+
+    lloyd = functools.partial(make_clusterer, "lloyd", 4)
+    batched = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4, make_clusterer=lloyd)
+    parallel = consolidate_subtree(
+        subtree, object_node_ids, object_ids, vectors, 4, make_clusterer=lloyd, n_workers=2)
+
+    # Batched fits are equal to single fits (and independent of n_workers)
+    for node_id in batched.index:
+        own = batched.at[node_id, "_own_prototypes"]
+        if own is None:
+            continue
+
+        reference = Prototypes(lloyd(random_state=node_seed(0, node_id)))
+        reference.fit(vectors[object_node_ids == node_id])
+        np.testing.assert_allclose(own.prototypes_, reference.prototypes_)
+        np.testing.assert_allclose(own.prototypes_,
+                                   parallel.at[node_id, "_own_prototypes"].prototypes_)
+
+
+def test_make_clusterer_unknown():
+    with pytest.raises(ValueError):
+        make_clusterer("dbscan", 3)
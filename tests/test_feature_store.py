@@ -0,0 +1,132 @@
+"""
+pytest file for feature_store
+"""
+
+import json
+import os
+
+import flask
+import h5py
+import numpy as np
+import pytest
+
+from morphocluster.feature_store import (FeatureStore, FeatureStoreError,
+                                         FlaskFeatureStore)
+
+
+def test_append_get(tmp_path):
+    store = FeatureStore.create(str(tmp_path / "store"), 4)
+
+    vectors = np.random.rand(10, 4).astype(np.float32)
+    object_ids = ["o{}".format(i) for i in range(10)][::-1]
+    store.append(object_ids, vectors)
+
+    assert len(store) == 10
+    assert "o3" in store
+    assert "x" not in store
+
+    np.testing.assert_array_equal(
+        store.get_vectors(["o9", "o0", "o5"]), vectors[[0, 9, 4]])
+
+    with pytest.raises(KeyError):
+        store.get_vectors(["o1", "x"])
+
+    found_vectors, found = store.get_vectors(["o1", "x"], missing="mask")
+    assert found.tolist() == [True, False]
+    np.testing.assert_array_equal(found_vectors, vectors[[8]])
+
+    assert np.isnan(store.get_vectors(["x"], missing="nan")).all()
+
+    # Appended rows shadow existing ones
+    store.append(["o1", "new"], np.ones((2, 4)))
+    assert len(store) == 11
+    np.testing.assert_array_equal(store.get_vectors(["o1"]), np.ones((1, 4)))
+
+    rows, live_ids = store.live_rows()
+    # Row 8 ("o1") is shadowed by row 10
+    assert rows.tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 11]
+    assert live_ids.tolist()[-2:] == ["o1", "new"]
+
+    # Reopen read-only
+    store = FeatureStore(str(tmp_path / "store"))
+    np.testing.assert_array_equal(
+        store.get_vectors(["o0", "new"]), [vectors[9], np.ones(4)])
+
+    with pytest.raises(FeatureStoreError):
+        store.append(["a"], np.ones((1, 4)))
+
+
+def test_append_hdf5(tmp_path):
+    features_fn = str(tmp_path / "features.h5")
+    vectors = np.random.rand(25, 3).astype(np.float32)
+    with h5py.File(features_fn, "w") as f:
+        f.create_dataset("features", data=vectors)
+        f.create_dataset("objids", data=np.arange(25))
+
+    store = FeatureStore.create(str(tmp_path / "store"), 3)
+    store.append_hdf5(features_fn, chunk_size=10)
+
+    assert len(store) == 25
+    np.testing.assert_array_equal(store.get_vectors(["24", "0"]), vectors[[24, 0]])
+
+
+def test_missing_store(tmp_path):
+    with pytest.raises(FeatureStoreError):
+        FeatureStore(str(tmp_path))
+
+
+def test_generations(tmp_path):
+    path = str(tmp_path / "store")
+    store = FeatureStore.create(path, 2)
+    reader = FeatureStore(path)
+
+    for i in range(3):
+        store.append(["o{}".format(i)], np.full((1, 2), i))
+
+    assert store.generation == 3
+    # Only the current and the previous generation are kept
+    assert sorted(fn for fn in os.listdir(path) if fn.startswith("index_ids")) == [
+        "index_ids.2.npy", "index_ids.3.npy"]
+
+    # An open reader keeps its state until it is reopened
+    assert len(reader) == 0
+    assert len(FeatureStore(path)) == 3
+
+
+def test_legacy_index(tmp_path):
+    path = str(tmp_path / "store")
+    os.makedirs(path)
+    open(os.path.join(path, "features.f4"), "wb").close()
+    np.save(os.path.join(path, "index_ids.npy"), np.empty(0, dtype="U1"))
+    np.save(os.path.join(path, "index_rows.npy"), np.empty(0, dtype=np.int64))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"n_features": 2, "n_rows": 0}, f)
+
+    store = FeatureStore(path, "a")
+    assert store.generation is None
+
+    store.append(["a"], np.ones((1, 2)))
+    store.append(["b"], np.ones((1, 2)))
+    assert store.generation == 1
+    assert not os.path.exists(os.path.join(path, "index_ids.npy"))
+    assert len(FeatureStore(path)) == 2
+
+
+def test_flask_feature_store(tmp_path):
+    path = str(tmp_path / "store")
+    writer = FeatureStore.create(path, 2)
+
+    app = flask.Flask(__name__)
+    extension = FlaskFeatureStore(app)
+    app.config["FEATURE_STORE_PATH"] = path
+
+    with app.app_context():
+        store = extension.store
+        assert len(store) == 0
+        assert extension.store is store
+
+        # Commits of other processes are picked up
+        writer.append(["a"], np.ones((1, 2)))
+        store = extension.store
+        assert len(store) == 1
+        assert extension.store is store
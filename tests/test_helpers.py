@@ -0,0 +1,29 @@
+"""
+pytest file for helpers
+"""
+
+import numpy as np
+import pytest
+
+from morphocluster.helpers import TopK
+
+
+@pytest.mark.parametrize("k", [0, 1, 10, 1000])
+def test_topk(k):
+    rng = np.random.RandomState(0)
+    scores = rng.rand(500)
+    ids = np.arange(500)
+
+    top = TopK(k)
+    for start in range(0, 500, 37):
+        top.push(scores[start:start + 37], ids[start:start + 37])
+
+    top_scores, top_ids = top.result()
+
+    expected = np.argsort(scores)[:k]
+    np.testing.assert_array_equal(top_ids, expected)
+    np.testing.assert_array_equal(top_scores, scores[expected])
+
+
+def test_topk_empty():
+    assert TopK(10).result() is None
@@ -75,3 +75,54 @@ def test_merge_prototypes(make_dset, k, n_children):
     assert result.prototypes_.shape[0] <= k
     assert result.prototypes_.shape[1] == N_FEATURES
     assert result.prototypes_.shape[0] == result.support_.shape[0]
+
+
+def _make_children(n_children, k, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = 5 * rng.randn(8, N_FEATURES)
+
+    children = []
+    for i in range(n_children):
+        prots = Prototypes(None)
+        prots.prototypes_ = centers[i % 8] + rng.randn(k, N_FEATURES)
+        prots.support_ = rng.randint(1, 20, k)
+        children.append(prots)
+
+    return children
+
+
+@pytest.mark.parametrize("method", ["complete", "kmeans", "hierarchical"])
+def test_merge_prototypes_methods(method):
+    children = _make_children(100, 4)
+
+    result = merge_prototypes(children, 8, method=method, group_size=10)
+
+    assert result.prototypes_.shape == (8, N_FEATURES)
+    # The support is preserved
+    assert result.support_.sum() == sum(c.support_.sum() for c in children)
+
+    # The support-weighted mean is preserved
+    mean = (np.sum([c.prototypes_.T @ c.support_ for c in children], axis=0)
+            / result.support_.sum())
+    np.testing.assert_allclose(
+        result.prototypes_.T @ result.support_ / result.support_.sum(), mean)
+
+    # The result is close to the current method
+    reference = merge_prototypes(children, 8)
+    assert result.distance(reference) < 1.0
+
+    # A zero prototype has no direction under the cosine metric
+    children[0].prototypes_[0] = 0
+    result = merge_prototypes(children, 8, metric="cosine", method=method, group_size=10)
+    assert result.prototypes_.shape == (8, N_FEATURES)
+    assert np.isfinite(result.prototypes_).all()
+    assert result.support_.sum() == sum(c.support_.sum() for c in children)
+
+
+def test_merge_prototypes_unknown_method():
+    with pytest.raises(ValueError):
+        merge_prototypes(_make_children(2, 4), 2, method="single")
+
+    with pytest.raises(ValueError):
+        merge_prototypes(_make_children(2, 4), 2,
+                         metric="cityblock", method="kmeans")
@@ -0,0 +1,33 @@
+"""
+pytest file for processing.ordering
+"""
+
+import numpy as np
+import pytest
+
+from morphocluster.processing.ordering import ORDERINGS, similarity_order
+
+
+def _chain_length(vectors, order):
+    return np.linalg.norm(np.diff(vectors[order], axis=0), axis=1).sum()
+
+
+@pytest.mark.parametrize("method", ORDERINGS)
+def test_similarity_order(method):
+    rng = np.random.RandomState(0)
+
+    # Points along a noisy line
+    t = rng.permutation(200)
+    vectors = np.outer(t, rng.randn(8)) + 0.01 * rng.randn(200, 8)
+
+    order = similarity_order(vectors, method)
+
+    np.testing.assert_array_equal(np.sort(order), np.arange(200))
+
+    # Neighbors in the order are similar
+    assert _chain_length(vectors, order) < 0.1 * _chain_length(vectors, np.arange(200))
+
+
+def test_similarity_order_unknown():
+    with pytest.raises(ValueError):
+        similarity_order(np.zeros((10, 2)), "tsne")
@@ -0,0 +1,271 @@
+"""
+pytest file for processing.progress
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from morphocluster.processing.progress import (PROGRESS_COUNTERS,
+                                               PROGRESS_FIELDS,
+                                               calc_path_deltas,
+                                               calc_progress,
+                                               calc_progress_counters)
+
+
+def _make_subtree(n_nodes, seed=0):
+    rng = np.random.RandomState(seed)
+
+    parent_pos = np.array([-1] + [rng.randint(max(0, i - 5), i)
+                                  for i in range(1, n_nodes)])
+    node_ids = np.arange(100, 100 + n_nodes)
+    parent_ids = np.where(parent_pos >= 0, node_ids[parent_pos], np.nan)
+
+    levels = np.zeros(n_nodes, dtype=int)
+    for i in range(1, n_nodes):
+        levels[i] = levels[parent_pos[i]] + 1
+
+    return pd.DataFrame({
+        "node_id": node_ids,
+        "parent_id": parent_ids,
+        "level": levels,
+        "approved": rng.rand(n_nodes) < 0.2,
+        "filled": rng.rand(n_nodes) < 0.2,
+        "name": np.where(rng.rand(n_nodes) < 0.3, "name", None),
+        "n_objects": rng.randint(0, 10, n_nodes),
+    })
+
+
+def _calc_progress_reference(subtree, root_id):
+    """
+    Former implementation of Tree.calculate_progress (on the visible part of the subtree).
+    """
+    subtree = subtree.set_index("node_id")
+
+    # Deep object counts
+    subtree["_n_objects"] = subtree["n_objects"]
+    subtree["_n_objects_deep"] = subtree["n_objects"]
+    for nid in subtree.sort_values("level", ascending=False).index:
+        parent_id = subtree.at[nid, "parent_id"]
+        if nid != root_id and pd.notna(parent_id):
+            subtree.at[parent_id, "_n_objects_deep"] += subtree.at[nid, "_n_objects_deep"]
+
+    subtree["_n_children"] = [
+        (subtree["parent_id"] == nid).sum() for nid in subtree.index]
+
+    # Do not descend into approved nodes
+    visible = {root_id}
+    for nid in subtree.sort_values("level").index:
+        parent_id = subtree.at[nid, "parent_id"]
+        if parent_id in visible and not subtree.at[parent_id, "approved"]:
+            visible.add(nid)
+    subtree = subtree.loc[sorted(visible, key=lambda nid: -subtree.at[nid, "level"])]
+
+    subtree["n_approved_objects"] = subtree["approved"] * \
+        subtree["_n_objects_deep"]
+    subtree["n_filled_objects"] = subtree["filled"] * \
+        subtree["_n_objects_deep"]
+    subtree["n_named_objects"] = pd.notna(
+        subtree["name"]) * subtree["_n_objects_deep"]
+    subtree["n_approved_nodes"] = subtree["approved"].astype(int)
+    subtree["n_filled_nodes"] = subtree["filled"].astype(int)
+    subtree["n_nodes"] = 1
+
+    fields = ["_n_objects", "_n_objects_deep", "n_filled_objects", "n_approved_objects",
+              "n_named_objects", "n_approved_nodes", "n_filled_nodes", "n_nodes"]
+
+    leaves_mask = subtree["_n_children"] == 0
+    leaves_result = subtree.loc[leaves_mask, fields].sum(axis=0).to_dict()
+    leaves_result = {"leaves_{}".format(
+        k.lstrip('_')): v for k, v in leaves_result.items()}
+
+    for nid in subtree.index:
+        child_selector = (subtree['parent_id'] == nid)
+
+        for field in ("n_approved_objects", "n_named_objects"):
+            subtree.at[nid, field] = max(
+                subtree.at[nid, field],
+                subtree.loc[child_selector, field].sum())
+
+        for field in ("n_approved_nodes", "n_filled_nodes", "n_nodes"):
+            subtree.at[nid, field] = (
+                subtree.at[nid, field]
+                + subtree.loc[child_selector, field].sum())
+
+    deep_result = subtree.loc[root_id, fields].to_dict()
+    deep_result = {k.lstrip('_'): v for k, v in deep_result.items()}
+
+    return dict(**leaves_result, **deep_result)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_calc_progress(seed):
+    subtree = _make_subtree(200, seed)
+    root_id = 100
+
+    # Approved root: Only the root itself is counted
+    if seed == 0:
+        subtree.loc[0, "approved"] = True
+
+    result = calc_progress(subtree, root_id)
+    expected = _calc_progress_reference(subtree, root_id)
+
+    assert set(result) == set(PROGRESS_FIELDS) | {
+        "leaves_" + k for k in PROGRESS_FIELDS}
+    assert result == {k: int(v) for k, v in expected.items()}
+
+
+def test_calc_progress_inner_root():
+    subtree = _make_subtree(200, 1)
+
+    # Progress of an inner node (its parent is not part of the subtree)
+    root_id = subtree.loc[subtree["level"] == 1, "node_id"].iloc[0]
+    members = {root_id}
+    for row in subtree.sort_values("level").itertuples():
+        if row.parent_id in members:
+            members.add(row.node_id)
+    subtree = subtree[subtree["node_id"].isin(members)].reset_index(drop=True)
+
+    result = calc_progress(subtree, root_id)
+    expected = _calc_progress_reference(subtree, root_id)
+
+    assert result == {k: int(v) for k, v in expected.items()}
+
+
+def _path_inputs(subtree, counters, node_ids):
+    """
+    Build the inputs of calc_path_deltas like Tree._record_modification queries them.
+
+    counters are the current counters (before the modification).
+    """
+    by_id = subtree.set_index("node_id")
+    counters = counters.set_axis(subtree["node_id"])
+
+    path_ids = set()
+    for node_id in node_ids:
+        while pd.notna(node_id):
+            path_ids.add(node_id)
+            node_id = by_id.at[node_id, "parent_id"]
+
+    def current(node_id):
+        return {"progress_" + k: (None if pd.isna(v) else int(v))
+                for k, v in counters.loc[node_id, PROGRESS_COUNTERS].items()}
+
+    path = {node_id: {"parent_id": by_id.at[node_id, "parent_id"],
+                      "n_objects": by_id.at[node_id, "n_objects"],
+                      "approved": by_id.at[node_id, "approved"],
+                      "filled": by_id.at[node_id, "filled"],
+                      "named": pd.notna(by_id.at[node_id, "name"]),
+                      **current(node_id)}
+            for node_id in path_ids}
+
+    children = {}
+    others = by_id[~by_id.index.isin(path_ids) & by_id["parent_id"].isin(path_ids)]
+    for parent_id, group in others.groupby("parent_id"):
+        aggregate = counters.loc[group.index].sum().to_dict()
+        aggregate["n_children"] = len(group)
+        aggregate["n_unknown"] = int(counters.loc[group.index].isnull().any(axis=1).sum())
+        children[parent_id] = aggregate
+
+    return path, children
+
+
+def _apply_path_deltas(counters, node_ids, result):
+    """
+    Apply the result of calc_path_deltas to the counters (index: node_id) like Tree._record_modification.
+    """
+    counters = counters.set_axis(node_ids).astype(float)
+    replaced, deltas = result
+
+    for node_id, values in replaced.items():
+        counters.loc[node_id] = np.nan if values is None else pd.Series(values)
+    for node_id, values in deltas.items():
+        counters.loc[node_id] += pd.Series(values)
+
+    return counters
+
+
+def _modify(subtree, seed, node_ids):
+    """
+    Modify the given nodes (in place).
+
+    Returns:
+        The modified `node_id`s.
+    """
+    rng = np.random.RandomState(seed)
+    mask = subtree["node_id"].isin(node_ids)
+    subtree.loc[mask, "approved"] = ~subtree.loc[mask, "approved"]
+    subtree.loc[mask, "name"] = None
+    subtree.loc[mask, "n_objects"] = rng.randint(0, 10, mask.sum())
+    return list(node_ids)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_calc_path_deltas(seed):
+    subtree = _make_subtree(200, seed)
+    counters = calc_progress_counters(subtree)
+
+    modified = _modify(subtree, seed, subtree["node_id"].sample(3, random_state=seed))
+
+    # Relocate a leaf
+    leaf = subtree.loc[~subtree["node_id"].isin(subtree["parent_id"]), "node_id"].iloc[-1]
+    old_parent = subtree.loc[subtree["node_id"] == leaf, "parent_id"].item()
+    new_parent = subtree["node_id"].iloc[1]
+    subtree.loc[subtree["node_id"] == leaf, "parent_id"] = new_parent
+    subtree.loc[subtree["node_id"] == leaf, "level"] = subtree.loc[subtree["node_id"] == new_parent, "level"].item() + 1
+    modified += [old_parent, new_parent]
+
+    path, children = _path_inputs(subtree, counters, modified)
+    result = calc_path_deltas(path, children, modified)
+
+    # Only the modified nodes are replaced
+    assert set(result[0]) == set(modified)
+
+    expected = calc_progress_counters(subtree).set_axis(subtree["node_id"])
+    updated = _apply_path_deltas(counters, subtree["node_id"], result)
+    assert (updated.to_numpy() == expected.to_numpy()).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_calc_path_deltas_concurrent(seed):
+    """
+    Modifications in disjoint subtrees are calculated from the same counters
+    (like concurrent transactions). Their deltas add up.
+    """
+    subtree = _make_subtree(200, seed)
+    counters = calc_progress_counters(subtree)
+
+    # Two leaves in different subtrees
+    leaves = subtree.loc[~subtree["node_id"].isin(subtree["parent_id"]), "node_id"]
+    modified = [leaves.iloc[0], leaves.iloc[-1]]
+
+    results = []
+    for i, node_id in enumerate(modified):
+        _modify(subtree, seed + i, [node_id])
+        path, children = _path_inputs(subtree, counters, [node_id])
+        results.append(calc_path_deltas(path, children, [node_id]))
+
+    updated = counters.set_axis(subtree["node_id"])
+    for result in results:
+        updated = _apply_path_deltas(updated, subtree["node_id"], result)
+
+    expected = calc_progress_counters(subtree).set_axis(subtree["node_id"])
+    assert (updated.to_numpy() == expected.to_numpy()).all()
+
+
+def test_calc_path_deltas_unknown():
+    subtree = _make_subtree(50)
+    counters = calc_progress_counters(subtree).astype(float)
+
+    # Unknown counters of a node that is not on the path
+    leaf = subtree.loc[~subtree["node_id"].isin(subtree["parent_id"]), "node_id"].iloc[0]
+    counters.loc[subtree["node_id"] == leaf] = np.nan
+    parent_id = subtree.loc[subtree["node_id"] == leaf, "parent_id"].item()
+
+    path, children = _path_inputs(subtree, counters, [parent_id])
+    replaced, deltas = calc_path_deltas(path, children, [parent_id])
+
+    # The parent and all of its ancestors become unknown
+    assert set(replaced) == set(path)
+    assert all(v is None for v in replaced.values())
+    assert not deltas
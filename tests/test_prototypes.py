@@ -0,0 +1,149 @@
+"""
+pytest file for processing.prototypes
+"""
+
+import numpy as np
+import pytest
+from sklearn.cluster import KMeans
+
+from morphocluster.processing.prototypes import (IncrementalPrototypes,
+                                                 LloydKMeans, Prototypes,
+                                                 batched_kmeans,
+                                                 fit_prototypes_batched)
+
+N_FEATURES = 8
+
+
+def _fit(n_samples=200, k=4, weight=1.0, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n_samples, N_FEATURES)
+
+    prots = IncrementalPrototypes(KMeans(k, n_init=2, random_state=seed))
+    prots.fit(X, weight)
+
+    return prots, X, rng
+
+
+def test_incremental_prototypes_fit():
+    prots, X, _ = _fit()
+
+    np.testing.assert_allclose(prots.sums_,
+                               prots.prototypes_ * prots.support_[:, np.newaxis])
+    assert prots.n_fit_ == X.shape[0]
+    assert prots.inertia_ > 0
+    assert prots.drift == 0
+    assert not prots.needs_refit()
+
+
+@pytest.mark.parametrize("weight", [1.0, 0.1])
+def test_incremental_prototypes_add_remove(weight):
+    prots, _, rng = _fit(weight=weight)
+    prototypes_, support_ = prots.prototypes_.copy(), prots.support_.copy()
+
+    Y = rng.randn(10, N_FEATURES)
+    prots.partial_fit(Y)
+
+    # Every prototype is the mean of its members
+    np.testing.assert_allclose(prots.support_.sum(), support_.sum() + weight * 10)
+    np.testing.assert_allclose(prots.prototypes_,
+                               prots.sums_ / prots.support_[:, np.newaxis])
+    assert not np.allclose(prots.prototypes_, prototypes_)
+    assert prots.error_ratio > 0
+
+    # Removing the same vectors restores the prototypes
+    # (as long as the assignment of the vectors does not change)
+    prots.remove(Y)
+    np.testing.assert_allclose(prots.support_, support_)
+    np.testing.assert_allclose(prots.prototypes_, prototypes_, atol=1e-8)
+
+    np.testing.assert_allclose(prots.drift, 20 * weight / support_.sum())
+
+
+def test_incremental_prototypes_remove_all():
+    prots, X, _ = _fit(n_samples=3)
+
+    prots.remove(X)
+
+    assert prots.prototypes_.shape[0] == 0
+    assert prots.needs_refit()
+    assert np.isinf(prots.transform(X)).all()
+
+
+def test_incremental_prototypes_refit_policy():
+    prots, _, rng = _fit()
+
+    # Vectors close to the prototypes do not require a refit
+    prots.partial_fit(prots.prototypes_[:2])
+    assert prots.error_ratio < 1
+    assert not prots.needs_refit()
+
+    # Vectors far away from all prototypes are badly represented
+    prots.partial_fit(rng.randn(2, N_FEATURES) + 100)
+    assert prots.error_ratio > 2
+    assert prots.needs_refit()
+    assert not prots.needs_refit(max_error_ratio=np.inf)
+
+    # Too many changes
+    prots.partial_fit(rng.randn(50, N_FEATURES))
+    assert prots.drift > 0.2
+    assert prots.needs_refit(max_error_ratio=np.inf)
+
+
+def test_lloyd_kmeans():
+    rng = np.random.RandomState(0)
+    centers = 10 * rng.randn(4, N_FEATURES)
+    X = np.concatenate([c + rng.randn(50, N_FEATURES) for c in centers])
+
+    clusterer = LloydKMeans(4, random_state=0)
+    labels = clusterer.fit_predict(X)
+
+    # The well-separated clusters are found
+    assert len(set(labels)) == 4
+    for i in range(4):
+        assert len(set(labels[50 * i:50 * (i + 1)])) == 1
+
+    # Comparable to sklearn
+    reference = KMeans(4, n_init=2, random_state=0).fit(X)
+    assert clusterer.inertia_ == pytest.approx(reference.inertia_, rel=1e-6)
+
+    # Usable as a clusterer of Prototypes
+    prots = Prototypes(LloydKMeans(4, random_state=0))
+    prots.fit(X)
+    assert prots.support_.sum() == X.shape[0]
+
+
+def test_batched_kmeans():
+    rng = np.random.RandomState(0)
+    Xs = [rng.randn(n, N_FEATURES) for n in (5, 30, 100, 17)]
+
+    centers, labels, inertia = batched_kmeans(Xs, 4, random_states=[0, 1, 2, 3])
+
+    assert centers.shape == (4, 4, N_FEATURES)
+
+    # Every problem is solved like on its own (padding has no influence)
+    for i, X in enumerate(Xs):
+        single = LloydKMeans(4, random_state=i).fit(X)
+        np.testing.assert_allclose(centers[i], single.cluster_centers_)
+        np.testing.assert_array_equal(labels[i], single.labels_)
+        assert inertia[i] == pytest.approx(single.inertia_)
+
+    with pytest.raises(ValueError):
+        batched_kmeans([rng.randn(0, N_FEATURES)], 4)
+
+
+def test_fit_prototypes_batched():
+    rng = np.random.RandomState(0)
+    Xs = [rng.randn(n, N_FEATURES) for n in (1, 3, 4, 50, 200)]
+    clusterer = LloydKMeans(4)
+
+    batched = fit_prototypes_batched(Xs, clusterer, random_states=range(len(Xs)))
+
+    for i, (X, prots) in enumerate(zip(Xs, batched)):
+        reference = Prototypes(LloydKMeans(4, random_state=i))
+        reference.fit(X)
+
+        np.testing.assert_allclose(prots.prototypes_, reference.prototypes_)
+        np.testing.assert_array_equal(prots.support_, reference.support_)
+
+    with pytest.raises(ValueError):
+        fit_prototypes_batched(Xs, KMeans(4))
@@ -0,0 +1,32 @@
+"""
+pytest file for result_cache
+"""
+
+import numpy as np
+
+from morphocluster.result_cache import (ResultCache, decode_ordering,
+                                        encode_ordering)
+
+
+def test_ordering():
+    keys = ["o{}".format(i) for i in range(120)]
+    scores = np.linspace(0, 1, 120)
+
+    order = encode_ordering(keys, scores)
+
+    items = decode_ordering(order, 50, 100)
+    assert [k for k, _ in items] == keys[50:100]
+    np.testing.assert_allclose([s for _, s in items], scores[50:100], rtol=1e-6)
+
+    assert len(decode_ordering(order)) == 120
+    assert decode_ordering(order, 150, 200) == []
+    assert decode_ordering(encode_ordering([], [])) == []
+
+
+def test_make_request_id():
+    assert (ResultCache.make_request_id("f", {"a": 1, "b": 2}, "v")
+            == ResultCache.make_request_id("f", {"b": 2, "a": 1}, "v"))
+    assert (ResultCache.make_request_id("f", {"a": 1}, "v")
+            != ResultCache.make_request_id("f", {"a": 1}, "w"))
+    assert (ResultCache.make_request_id("f", {"a": 1}, "v")
+            != ResultCache.make_request_id("g", {"a": 1}, "v"))